@@ -37,11 +37,20 @@ import os.path
 import warnings
 warnings.filterwarnings('ignore', 'Not using MPI as mpi4py not found')
 
+from multiprocessing import Pool
+
 import skbio.diversity.alpha as alph
+from skbio.stats import subsample
 from numpy import array, zeros
+from scipy.sparse import csr_matrix
+from numpy.random import randint, seed
+from biom import load_table
 
 from qiime.util import FunctionWithParams
 from qiime.format import format_matrix
+from qiime.parse import parse_newick, PhyloNode, parse_matrix
+from qiime.rarefaction import get_rare_data
+from qiime.collate_alpha import write_output_file, make_output_row
 from sys import exit, stderr
 
 
@@ -379,6 +388,220 @@ def multiple_file_alpha(input_path, output_path, metrics, tree_path=None):
                           output_fp, tree_path)
 
 
+def _get_alpha_calcs(metrics_list, tree_path):
+    """Returns an AlphaDiversityCalc for each metric in metrics_list
+
+    Raises a ValueError if a metric is unknown, or if a phylogenetic
+    metric is requested without a tree.
+    """
+    calcs = []
+    for metric in metrics_list:
+        try:
+            metric_f = get_nonphylogenetic_metric(metric)
+            is_phylogenetic = False
+        except AttributeError:
+            try:
+                metric_f = get_phylogenetic_metric(metric)
+                is_phylogenetic = True
+            except AttributeError:
+                raise ValueError(
+                    "could not find metric.  %s.\n Known metrics are: %s\n"
+                    % (metric, ', '.join(list_known_metrics())))
+            if tree_path is None:
+                raise ValueError("phylogenetic metric supplied, but no " +
+                                 "phylogenetic tree supplied")
+        calcs.append(AlphaDiversityCalc(metric_f, is_phylogenetic))
+    return calcs
+
+
+def _rarefied_alpha_diversity(otu_table, calcs, tree, depth, subsample_f):
+    """Returns (sample_ids, data, calc_names) for one rarefied otu_table
+
+    Returns None if no samples have at least depth sequences.
+    """
+    rarefied_otu_table = get_rare_data(otu_table, depth, False,
+                                       subsample_f=subsample_f)
+    if rarefied_otu_table.is_empty():
+        return None
+    sample_ids = list(rarefied_otu_table.ids())
+
+    # the nonphylogenetic metrics are computed on each sample in turn, so
+    # the counts of each sample are only looked up once
+    nonphylogenetic_calcs = [c for c in calcs if not c.IsPhylogenetic]
+    nonphylogenetic_res = dict((c, []) for c in nonphylogenetic_calcs)
+    if nonphylogenetic_calcs:
+        counts = csr_matrix(rarefied_otu_table.matrix_data.T)
+        row = zeros(counts.shape[1], dtype=int)
+        for i in range(counts.shape[0]):
+            start, end = counts.indptr[i], counts.indptr[i + 1]
+            row[:] = 0
+            row[counts.indices[start:end]] = counts.data[start:end]
+            for c in nonphylogenetic_calcs:
+                nonphylogenetic_res[c].append(c.Metric(row, **c.Params))
+
+    calc_names = []
+    res = []
+    for c in calcs:
+        calc_names.extend(getattr(c.Metric, 'return_names',
+                                  (c.Metric.__name__,)))
+        if c.IsPhylogenetic:
+            metric_res = c(data_path=rarefied_otu_table,
+                           taxon_names=rarefied_otu_table.ids(
+                               axis='observation'),
+                           tree_path=tree,
+                           sample_names=rarefied_otu_table.ids())
+        else:
+            metric_res = array(nonphylogenetic_res[c])
+        if len(metric_res.shape) == 1:
+            res.append(metric_res)
+        else:
+            res.extend(metric_res.T)
+    return sample_ids, array(res).T, calc_names
+
+# state shared with the worker processes of rarefaction_alpha_diversity
+_worker_args = None
+
+
+def _init_rarefaction_worker(otu_table, calcs, tree, subsample_f):
+    global _worker_args
+    _worker_args = (otu_table, calcs, tree, subsample_f)
+
+
+def _rarefaction_worker(task):
+    depth, rep, rep_seed = task
+    # each task is seeded separately, as the forked workers otherwise all
+    # start from the same random state
+    seed(rep_seed)
+    otu_table, calcs, tree, subsample_f = _worker_args
+    return _rarefied_alpha_diversity(otu_table, calcs, tree, depth,
+                                     subsample_f)
+
+
+def rarefaction_alpha_diversity(otu_table, metrics, depths, num_reps,
+                                tree=None, subsample_f=subsample,
+                                jobs_to_start=1):
+    """Computes alpha diversity of rarefied OTU tables, all in memory
+
+    otu_table: a biom Table
+    metrics: list of alpha diversity metric names
+    depths: list of rarefaction depths (sequences per sample)
+    num_reps: number of rarefied tables to compute at each depth
+    tree: a PhyloNode tree, required by the phylogenetic metrics
+    subsample_f: function used to subsample the counts of each sample
+    jobs_to_start: number of processes to compute the rarefied tables in;
+     if 1, everything is computed in this process
+
+    Returns a list of (depth, rep, sample_ids, data, calc_names), in order
+     of depth and rep, where data is a samples x calc_names array. Samples
+     with fewer than depth sequences are omitted, as are depths at which
+     no samples remain. Neither the rarefied tables nor the alpha
+     diversity of each are written to disk.
+    """
+    calcs = _get_alpha_calcs(metrics, tree)
+    # get_rare_data fails if no samples are left
+    max_count = otu_table.sum(axis='sample').max()
+    tasks = [(depth, rep) for depth in depths if depth <= max_count
+             for rep in range(num_reps)]
+
+    if jobs_to_start <= 1:
+        results = [_rarefied_alpha_diversity(otu_table, calcs, tree, depth,
+                                             subsample_f)
+                   for depth, rep in tasks]
+    else:
+        # draw the seeds here so the results depend only on numpy's state in
+        # this process
+        tasks_with_seeds = [(depth, rep, randint(0, 2 ** 31 - 1))
+                            for depth, rep in tasks]
+        pool = Pool(min(jobs_to_start, len(tasks)) or 1,
+                    _init_rarefaction_worker,
+                    (otu_table, calcs, tree, subsample_f))
+        try:
+            results = pool.map(_rarefaction_worker, tasks_with_seeds)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    return [(depth, rep) + result
+            for (depth, rep), result in zip(tasks, results)
+            if result is not None]
+
+
+def write_collated_alpha(rarefaction_results, output_dir, example_fp=None):
+    """Writes the results of rarefaction_alpha_diversity, one file per metric
+
+    The files are those written by collate_alpha.py from the alpha
+     diversity of each rarefied OTU table, and can be passed to
+     make_rarefaction_plots.py. Samples are listed in the order of the
+     first (i.e., shallowest) rarefied table, and are n/a where they were
+     not present at a depth.
+
+    example_fp: an alpha diversity file (as written by alpha_diversity.py)
+     whose samples and metrics are written instead, as with collate_alpha.py
+     -e
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if not rarefaction_results:
+        return
+
+    if example_fp is None:
+        all_samples = rarefaction_results[0][2]
+        calc_names = rarefaction_results[0][4]
+    else:
+        example_f = open(example_fp, 'U')
+        calc_names, all_samples, _ = parse_matrix(example_f)
+        example_f.close()
+    for metric in calc_names:
+        metric_file_data = []
+        for depth, rep, sample_ids, data, f_metrics in rarefaction_results:
+            fname = 'alpha_rarefaction_%s_%s.txt' % (depth, rep)
+            metric_file_data.append(
+                make_output_row(f_metrics, metric, sample_ids, data, fname,
+                                len(all_samples), all_samples))
+        write_output_file(metric_file_data, output_dir, metric, all_samples)
+
+
+def single_file_alpha_rarefaction(otu_table_fp, metrics, output_dir,
+                                  min_depth, max_depth, step, num_reps=10,
+                                  tree_path=None, subsample_f=subsample,
+                                  jobs_to_start=1, example_fp=None):
+    """Computes and writes collated alpha diversity of rarefied OTU tables
+
+    This replaces running multiple_rarefactions.py, alpha_diversity.py and
+     collate_alpha.py in turn: the OTU table is rarefied at depths
+     min_depth to max_depth (inclusive) in steps of step, num_reps times
+     at each depth, and the collated alpha diversity tables are written to
+     output_dir without writing the intermediate files.
+
+    otu_table_fp: path to the biom OTU table
+    metrics: metric names (str, comma delimited if more than 1 metric; or
+     list)
+    tree_path: path to a newick tree, required by the phylogenetic metrics
+    example_fp: passed to write_collated_alpha
+    """
+    metrics_list = metrics
+    try:
+        metrics_list = metrics_list.split(',')
+    except AttributeError:
+        pass
+
+    otu_table = load_table(otu_table_fp)
+    if tree_path:
+        tree = parse_newick(open(tree_path, 'U'), PhyloNode)
+    else:
+        tree = None
+
+    results = rarefaction_alpha_diversity(otu_table, metrics_list,
+                                          range(min_depth, max_depth + 1,
+                                                step),
+                                          num_reps, tree, subsample_f,
+                                          jobs_to_start)
+    write_collated_alpha(results, output_dir, example_fp)
+
+
 def single_file_cup(otu_filepath, metrics, outfilepath, r):
     """Compute variations of the conditional uncovered probability.
 
@@ -21,21 +21,23 @@ from itertools import count
 from string import strip
 from tempfile import NamedTemporaryFile, mkdtemp
 from cStringIO import StringIO
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
+from multiprocessing import Pool
 from shutil import rmtree
 
 from skbio.parse.sequences import parse_fasta
 
 from bfillings.blast import blast_seqs, Blastall, BlastResult
-from bfillings.formatdb import build_blast_db_from_fasta_path
 from bfillings.uclust import Uclust
-from bfillings.sortmerna_v2 import (build_database_sortmerna,
-                                 sortmerna_map)
+from bfillings.sortmerna_v2 import sortmerna_map
 from bfillings import rdp_classifier
 from bfillings import mothur
 from bfillings import rtax
 
 from qiime.util import FunctionWithParams, get_rdp_jarpath, get_qiime_temp_dir
+from qiime.reference_db_cache import get_blast_db, get_sortmerna_db
+from qiime.naive_bayes import (classify_seqs, get_naive_bayes_model,
+                               truncate_lineage)
 
 """Contains code for assigning taxonomy, using several techniques.
 
@@ -314,7 +316,7 @@ class SortMeRNATaxonAssigner(TaxonAssigner):
         if not self.Params['sortmerna_db']:
             output_dir = mkdtemp()
             self.sortmerna_db, files_to_remove = \
-                build_database_sortmerna(abspath(self.Params[
+                get_sortmerna_db(abspath(self.Params[
                     'reference_sequences_fp']),
                     output_dir=output_dir)
             self.dirs_to_remove.append(output_dir)
@@ -467,7 +469,8 @@ class BlastTaxonAssigner(TaxonAssigner):
         _params = {
             'Min percent identity': 90.0,
             'Max E value': 1e-30,
-            'Application': 'blastn/megablast'
+            'Application': 'blastn/megablast',
+            'jobs_to_start': 1
         }
         _params.update(params)
         TaxonAssigner.__init__(self, _params)
@@ -475,6 +478,10 @@ class BlastTaxonAssigner(TaxonAssigner):
     def __call__(self, seq_path=None, seqs=None,
                  result_path=None, log_path=None):
         """Returns dict mapping {seq_id:(taxonomy, confidence)} for each seq.
+
+        Batches of self.SeqsPerBlastRun sequences are blasted in
+        self.Params['jobs_to_start'] processes at a time, and if result_path
+        is passed the results of each batch are written as it finishes.
         """
         assert seq_path or seqs, \
             "Must provide either seqs or seq_path when calling a BlastTaxonAssigner."
@@ -489,89 +496,110 @@ class BlastTaxonAssigner(TaxonAssigner):
         # as self.Params['reference_seqs_filepath']
         try:
             blast_db = self.Params['blast_db']
+            db_files_to_remove = []
         except KeyError:
-            # build a temporary blast_db
+            # build a temporary blast_db, or get it from the reference
+            # database cache
             reference_seqs_path = self.Params['reference_seqs_filepath']
-            refseqs_dir, refseqs_name = os.path.split(reference_seqs_path)
             blast_db, db_files_to_remove = \
-                build_blast_db_from_fasta_path(reference_seqs_path)
-
-        # build the mapping of sequence identifier
-        # (wrt to the blast db seqs) to taxonomy
-        id_to_taxonomy_map = self._parse_id_to_taxonomy_file(
-            open(self.Params['id_to_taxonomy_filepath'], 'U'))
-
-        # Iterate over the input self.SeqsPerBlastRun seqs at a time.
-        # There are two competing issues here when dealing with very large
-        # inputs. If all sequences are read in at once, the containing object
-        # can be very large, causing the system to page. On the other hand,
-        # in such cases it would be very slow to treat each sequence
-        # individually, since blast requires a filepath. Each call would
-        # therefore involve writing a single sequence to file, opening/closing
-        # and removing the file. To balance this, sequences are read in and
-        # blasted in chunks of self.SeqsPerBlastRun (defualt: 1000) at a time.
-        # This appears to solve the problem with the largest sets I've worked
-        # with so far.
-
-        if seq_path:
-            # Get a seq iterator
-            seqs = parse_fasta(open(seq_path))
-        # Build object to keep track of the current set of sequence to be
-        # blasted, and the results (i.e., seq_id -> (taxonomy,quaility score)
-        # mapping)
-        current_seqs = []
-        result = {}
+                get_blast_db(reference_seqs_path)
 
-        # Iterate over the (seq_id, seq) pairs
-        for seq_id, seq in seqs:
-            # append the current seq_id,seq to list of seqs to be blasted
-            current_seqs.append((seq_id, seq))
-
-            # When there are 1000 in the list, blast them
-            if len(current_seqs) == self.SeqsPerBlastRun:
-                # update the result object
-                result.update(self._seqs_to_taxonomy(
-                    current_seqs, blast_db, id_to_taxonomy_map))
-                # reset the list of seqs to be blasted
-                current_seqs = []
-        # Assign taxonomy to the remaining sequences
-        result.update(self._seqs_to_taxonomy(
-            current_seqs, blast_db, id_to_taxonomy_map))
-        # End iteration over the input self.SeqsPerBlastRun seqs at a time.
-
-        # Write log data if we have a path (while the logger can handle
-        # being called if we are not logging, some of these steps are slow).
-        if log_path is not None:
-            num_inspected = len(result)
-            logger.info('Number of sequences inspected: %s' % num_inspected)
-            num_null_hits = [r[1] for r in result.values()].count(None)
-            logger.info('Number with no blast hits: %s' % num_null_hits)
+        result_f = None
+        try:
+            # build the mapping of sequence identifier
+            # (wrt to the blast db seqs) to taxonomy
+            id_to_taxonomy_map = self._parse_id_to_taxonomy_file(
+                open(self.Params['id_to_taxonomy_filepath'], 'U'))
+
+            if seq_path:
+                # Get a seq iterator
+                seqs = parse_fasta(open(seq_path))
+
+            if result_path:
+                result_f = open(result_path, 'w')
+                result = None
+            else:
+                result = {}
+            # number of sequences inspected, and number with no blast hit
+            counts = [0, 0]
+
+            def record_batch_result(batch_result):
+                counts[0] += len(batch_result)
+                for seq_id, assignment in batch_result.iteritems():
+                    if assignment[1] is None:
+                        counts[1] += 1
+                    if result is None:
+                        result_f.write('%s\t%s\t%s\t%s\n' %
+                                       ((seq_id,) + tuple(assignment)))
+                if result is not None:
+                    result.update(batch_result)
+
+            batches = self._iter_seq_batches(seqs)
+            jobs_to_start = self.Params['jobs_to_start']
+            if jobs_to_start <= 1:
+                for batch in batches:
+                    record_batch_result(self._seqs_to_taxonomy(
+                        batch, blast_db, id_to_taxonomy_map))
+            else:
+                pool = Pool(jobs_to_start, _init_blast_worker,
+                            (self, blast_db, id_to_taxonomy_map))
+                try:
+                    pending = deque()
+                    for batch in batches:
+                        pending.append(pool.apply_async(_blast_worker,
+                                                        (batch,)))
+                        # only keep a couple of batches per process queued,
+                        # so that the input isn't all read into memory
+                        if len(pending) > 2 * jobs_to_start:
+                            record_batch_result(pending.popleft().get())
+                    while pending:
+                        record_batch_result(pending.popleft().get())
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+        finally:
+            if result_f is not None:
+                result_f.close()
+            # clean-up temp blastdb files, if a temp blastdb was created
+            map(remove, db_files_to_remove)
+
+        logger.info('Number of sequences inspected: %s' % counts[0])
+        logger.info('Number with no blast hits: %s' % counts[1])
 
         if result_path:
-            # if the user provided a result_path, write the
-            # results to file
-            of = open(result_path, 'w')
-            for seq_id, (lineage, confidence, blast_hit_id) in result.items():
-                of.write('%s\t%s\t%s\t%s\n' %
-                         (seq_id, lineage, confidence, blast_hit_id))
-            of.close()
-            result = None
             logger.info('Result path: %s' % result_path)
         else:
-            # Returning the data as a dict, so no modification to result
-            # is necessary.
-            pass
-
             # if no result_path was provided, return the data as a dict
             logger.info('Result path: None, returned as dict.')
 
-        # clean-up temp blastdb files, if a temp blastdb was created
-        if 'reference_seqs_filepath' in self.Params:
-            map(remove, db_files_to_remove)
-
         # return the result
         return result
 
+    def _iter_seq_batches(self, seqs):
+        """ Yield lists of self.SeqsPerBlastRun (seq_id, seq) pairs from seqs
+
+            There are two competing issues here when dealing with very large
+            inputs. If all sequences are read in at once, the containing
+            object can be very large, causing the system to page. On the
+            other hand, in such cases it would be very slow to treat each
+            sequence individually, since blast requires a filepath. Each call
+            would therefore involve writing a single sequence to file,
+            opening/closing and removing the file. To balance this, sequences
+            are read in and blasted in batches of self.SeqsPerBlastRun
+            (default: 1000) at a time.
+        """
+        batch = []
+        for seq_id, seq in seqs:
+            batch.append((seq_id, seq))
+            if len(batch) == self.SeqsPerBlastRun:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     def _seqs_to_taxonomy(self, seqs, blast_db, id_to_taxonomy_map):
         """ Assign taxonomy to (seq_id,seq) pairs
         """
@@ -665,6 +693,17 @@ class BlastTaxonAssigner(TaxonAssigner):
         return result
 
 
+def _init_blast_worker(taxon_assigner, blast_db, id_to_taxonomy_map):
+    global _blast_worker_args
+    _blast_worker_args = (taxon_assigner, blast_db, id_to_taxonomy_map)
+
+
+def _blast_worker(seqs):
+    taxon_assigner, blast_db, id_to_taxonomy_map = _blast_worker_args
+    return taxon_assigner._seqs_to_taxonomy(seqs, blast_db,
+                                            id_to_taxonomy_map)
+
+
 class MothurTaxonAssigner(TaxonAssigner):
 
     """Assign taxonomy using Mothur's naive Bayes implementation
@@ -1101,6 +1140,97 @@ _QIIME_RDP_ESCAPES = [
 ]
 
 
+class NaiveBayesTaxonAssigner(TaxonAssigner):
+
+    """Assign taxon using QIIME's implementation of RDP's naive Bayesian
+    classifier (see qiime.naive_bayes)
+
+    The model is trained on reference_sequences_fp and id_to_taxonomy_fp,
+    and kept in model_dir (or the reference database cache) if one is
+    passed, so that later runs can skip the training. If only model_dir is
+    passed, the model already in it is used.
+    """
+    Name = "NaiveBayesTaxonAssigner"
+    Application = "QIIME naive Bayes classifier"
+    Citation = "Wang, Q, G. M. Garrity, J. M. Tiedje, and J. R. Cole. 2007. Naive Bayesian Classifier for Rapid Assignment of rRNA Sequences into the New Bacterial Taxonomy. Appl Environ Microbiol. 73(16):5261-7."
+    _tracked_properties = ['Application', 'Citation']
+
+    def __init__(self, params):
+        """Return new NaiveBayesTaxonAssigner object with specified params.
+        """
+        _params = {
+            'Confidence': 0.80,
+            'id_to_taxonomy_fp': None,
+            'reference_sequences_fp': None,
+            'model_dir': None,
+            'word_size': 8,
+            'num_bootstraps': 100,
+            'seed': 0,
+            'jobs_to_start': 1
+        }
+        _params.update(params)
+        TaxonAssigner.__init__(self, _params)
+
+    def __call__(self, seq_path, result_path=None, log_path=None):
+        """Returns dict mapping {seq_id:(taxonomy, confidence)} for
+        each seq.
+
+        Parameters:
+        seq_path: path to file of sequences
+        result_path: path to file of results. If specified, dumps the
+            result to the desired path instead of returning it.
+        log_path: path to log, which should include dump of params.
+        """
+        reference_sequences_fp = self.Params['reference_sequences_fp']
+        id_to_taxonomy_fp = self.Params['id_to_taxonomy_fp']
+        model_dir = self.Params['model_dir']
+
+        if reference_sequences_fp and id_to_taxonomy_fp:
+            model_dir, dirs_to_remove = get_naive_bayes_model(
+                reference_sequences_fp, id_to_taxonomy_fp, model_dir,
+                self.Params['word_size'])
+        elif model_dir:
+            dirs_to_remove = []
+        else:
+            raise ValueError("NaiveBayesTaxonAssigner requires either "
+                             "reference_sequences_fp and id_to_taxonomy_fp, "
+                             "or the model_dir of a trained model.")
+
+        try:
+            seq_ids = []
+            seqs = []
+            for seq_id, seq in parse_fasta(open(seq_path, 'U')):
+                seq_ids.append(seq_id)
+                seqs.append(seq)
+            assignments = classify_seqs(
+                model_dir, seqs, num_bootstraps=self.Params['num_bootstraps'],
+                seed=self.Params['seed'],
+                jobs_to_start=self.Params['jobs_to_start'])
+        finally:
+            for dir_to_remove in dirs_to_remove:
+                rmtree(dir_to_remove)
+
+        min_conf = self.Params['Confidence']
+        results = {}
+        for seq_id, (lineage, confidences) in zip(seq_ids, assignments):
+            results[seq_id] = truncate_lineage(lineage, confidences, min_conf)
+
+        if result_path:
+            # same format as the RDP classifier output
+            result_f = open(result_path, 'w')
+            for seq_id in seq_ids:
+                lineage, confidence = results[seq_id]
+                result_f.write('%s\t%s\t%1.3f\n' %
+                               (seq_id, lineage, confidence))
+            result_f.close()
+            results = None
+
+        if log_path:
+            self.writeLog(log_path)
+
+        return results
+
+
 class RtaxTaxonAssigner(TaxonAssigner):
 
     """Assign taxon using RTAX
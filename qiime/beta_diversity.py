@@ -29,12 +29,15 @@ The output is a sample x sample matrix of distances, incl. row/col headers.
 """
 
 from StringIO import StringIO
-from sys import exit, stderr
+from sys import exit, stderr, modules
 import os.path
 import warnings
 warnings.filterwarnings('ignore', 'Not using MPI as mpi4py not found')
 
-from numpy import asarray
+from numpy import (asarray, arange, array, repeat, diff, bincount, minimum,
+                   sqrt, square, abs as np_abs, where, tril, isfinite, float64,
+                   save as np_save, load as np_load)
+from scipy.sparse import csr_matrix
 import cogent.maths.distance_transform as distance_transform
 from biom.parse import parse_biom_table
 from biom.table import Table
@@ -192,8 +195,378 @@ class BetaDiversityCalc(FunctionWithParams):
         return format_distance_matrix(sample_names, data)
 
 
+# dissimilarities which are not a function of only the pair of samples
+# being compared: computing one row requires the whole matrix
+_WHOLE_MATRIX_METRICS = ['dist_chisq', 'dist_gower', 'dist_hellinger',
+                         'binary_dist_chisq']
+
+
+def load_sample_matrix(otu_table):
+    """Returns the counts in otu_table as a sparse samples x OTUs matrix
+
+    The result is a scipy.sparse csr_matrix of floats with no explicit zeros,
+    as expected by the one_vs_all_* functions.
+    """
+    datamtx = csr_matrix(otu_table.matrix_data.T, dtype=float)
+    datamtx.sum_duplicates()
+    datamtx.eliminate_zeros()
+    return datamtx
+
+
+def _check_finite(datamtx):
+    if not isfinite(datamtx.data).all():
+        raise ValueError("non finite number in input matrix")
+
+
+def _check_nonnegative(datamtx):
+    _check_finite(datamtx)
+    if (datamtx.data < 0.0).any():
+        raise ValueError("negative value in input matrix")
+
+
+def _get_row(datamtx, row_index):
+    return datamtx[row_index].toarray().ravel()
+
+
+def _sum_by_row(datamtx, values):
+    """Sums values, one per stored element of datamtx, over each row"""
+    rows = repeat(arange(datamtx.shape[0]), diff(datamtx.indptr))
+    return bincount(rows, weights=values, minlength=datamtx.shape[0])
+
+
+def _sum_of_differences(datamtx, row_index, f):
+    """Sums f of the differences of each row and the row at row_index
+
+    f is applied elementwise to the differences (f(0) must be 0), and the
+    results are summed directly rather than as a difference of sums, so that
+    identical rows are exactly 0 apart however large their counts are.
+    """
+    x = _get_row(datamtx, row_index)
+    columns = x.nonzero()[0]
+    # in the columns where x is 0 the differences are the stored values
+    result = _sum_by_row(datamtx, where(x[datamtx.indices] == 0.0,
+                                        f(datamtx.data), 0.0))
+    # the columns where x is non-zero are compared densely
+    result += f(datamtx[:, columns].toarray() - x[columns]).sum(axis=1)
+    return result
+
+
+def _binary_counts(datamtx, row_index):
+    """Returns the number of OTUs in each row, in the row at row_index,
+    and shared by each row and the row at row_index
+    """
+    x = _get_row(datamtx, row_index)
+    a = diff(datamtx.indptr).astype(float)
+    b = float((x != 0).sum())
+    c = _sum_by_row(datamtx, (x[datamtx.indices] != 0).astype(float))
+    return a, b, c
+
+
+def _min_sums(datamtx, row_index):
+    """Returns the row sums, and the sums of the elementwise minimum of each
+    row and the row at row_index (non-negative data only)
+    """
+    x = _get_row(datamtx, row_index)
+    rowsums = asarray(datamtx.sum(axis=1)).ravel()
+    minsums = _sum_by_row(datamtx,
+                          minimum(datamtx.data, x[datamtx.indices]))
+    return rowsums, x.sum(), minsums
+
+
+def _divide_or_zero(top, bottom):
+    """top / bottom, or 0.0 where bottom is not positive"""
+    positive = bottom > 0.0
+    return where(positive, top / where(positive, bottom, 1.0), 0.0)
+
+
+def _one_vs_all(f):
+    """Sets the distance of the row at row_index to itself to 0.0"""
+    def one_vs_all_f(datamtx, row_index):
+        result = f(datamtx, row_index)
+        result[row_index] = 0.0
+        return result
+    one_vs_all_f.__name__ = f.__name__
+    one_vs_all_f.__doc__ = f.__doc__
+    return one_vs_all_f
+
+
+@_one_vs_all
+def one_vs_all_euclidean(datamtx, row_index):
+    """Euclidean distances of the row at row_index to every row"""
+    _check_finite(datamtx)
+    return sqrt(_sum_of_differences(datamtx, row_index, square))
+
+
+@_one_vs_all
+def one_vs_all_manhattan(datamtx, row_index):
+    """Manhattan distances of the row at row_index to every row"""
+    _check_finite(datamtx)
+    return _sum_of_differences(datamtx, row_index, np_abs)
+
+
+@_one_vs_all
+def one_vs_all_bray_curtis(datamtx, row_index):
+    """Bray-Curtis distances of the row at row_index to every row"""
+    _check_nonnegative(datamtx)
+    rowsums, xsum, minsums = _min_sums(datamtx, row_index)
+    return _divide_or_zero(rowsums + xsum - 2.0 * minsums, rowsums + xsum)
+
+
+@_one_vs_all
+def one_vs_all_soergel(datamtx, row_index):
+    """Soergel distances of the row at row_index to every row"""
+    _check_nonnegative(datamtx)
+    rowsums, xsum, minsums = _min_sums(datamtx, row_index)
+    return _divide_or_zero(rowsums + xsum - 2.0 * minsums,
+                           rowsums + xsum - minsums)
+
+
+@_one_vs_all
+def one_vs_all_kulczynski(datamtx, row_index):
+    """Kulczynski distances of the row at row_index to every row"""
+    _check_nonnegative(datamtx)
+    rowsums, xsum, minsums = _min_sums(datamtx, row_index)
+    if xsum == 0.0:
+        # 0.0 to the other empty rows, 1.0 to the rest
+        return where(rowsums == 0.0, 0.0, 1.0)
+    return where(rowsums == 0.0, 1.0,
+                 1.0 - (_divide_or_zero(minsums, rowsums) +
+                        minsums / xsum) / 2.0)
+
+
+@_one_vs_all
+def one_vs_all_canberra(datamtx, row_index):
+    """Canberra distances of the row at row_index to every row
+
+    As in cogent, the sum is divided by the number of OTUs which differ
+    between the two rows.
+    """
+    _check_nonnegative(datamtx)
+    x = _get_row(datamtx, row_index)
+    a, b, c = _binary_counts(datamtx, row_index)
+    xj = x[datamtx.indices]
+    shared = xj != 0
+    d = datamtx.data
+    # OTUs present in only one of the rows contribute 1.0 each
+    unshared = (a - c) + (b - c)
+    top = unshared + _sum_by_row(
+        datamtx, where(shared, np_abs(d - xj) / (d + xj), 0.0))
+    bottom = unshared + _sum_by_row(datamtx,
+                                    (shared & (d != xj)).astype(float))
+    return _divide_or_zero(top, bottom)
+
+
+@_one_vs_all
+def one_vs_all_binary_jaccard(datamtx, row_index):
+    """Binary Jaccard distances of the row at row_index to every row"""
+    _check_nonnegative(datamtx)
+    a, b, c = _binary_counts(datamtx, row_index)
+    return where((a == 0.0) & (b == 0.0), 0.0,
+                 1.0 - _divide_or_zero(c, a + b - c))
+
+
+@_one_vs_all
+def one_vs_all_binary_sorensen_dice(datamtx, row_index):
+    """Binary Sorensen-Dice distances of the row at row_index to every row"""
+    _check_nonnegative(datamtx)
+    a, b, c = _binary_counts(datamtx, row_index)
+    return where(a + b > 0.0, 1.0 - _divide_or_zero(2.0 * c, a + b), 0.0)
+
+
+@_one_vs_all
+def one_vs_all_binary_hamming(datamtx, row_index):
+    """Binary Hamming distances of the row at row_index to every row"""
+    _check_nonnegative(datamtx)
+    a, b, c = _binary_counts(datamtx, row_index)
+    return a + b - 2.0 * c
+
+
+@_one_vs_all
+def one_vs_all_binary_euclidean(datamtx, row_index):
+    """Binary Euclidean distances of the row at row_index to every row"""
+    _check_nonnegative(datamtx)
+    a, b, c = _binary_counts(datamtx, row_index)
+    return sqrt(a + b - 2.0 * c)
+
+
+def get_nonphylogenetic_row_metric(metric_f):
+    """Gets the one_vs_all_* function for a nonphylogenetic metric
+
+    metric_f: a metric returned by get_nonphylogenetic_metric
+
+    One-vs-all functions are f(sparse samples x OTUs matrix, row_index) ->
+    distances of the sample at row_index to every sample. AttributeError is
+    raised if there is no one-vs-all function for metric_f.
+    """
+    name = metric_f.__name__.replace('binary_dist_', 'binary_')
+    if name.startswith('dist_'):
+        name = name[5:]
+    return getattr(modules[__name__], 'one_vs_all_' + name)
+
+
+def _get_metric(metric, tree):
+    """Returns (metric_f, is_phylogenetic), exiting if metric is unknown
+    or requires a tree that wasn't provided
+    """
+    try:
+        return get_nonphylogenetic_metric(metric), False
+    except AttributeError:
+        try:
+            metric_f = get_phylogenetic_metric(metric)
+        except AttributeError:
+            stderr.write("Could not find metric %s.\n\nKnown metrics are: %s\n"
+                         % (metric, ', '.join(list_known_metrics())))
+            exit(1)
+        if tree is None:
+            stderr.write("metric %s requires a tree, but none found\n"
+                         % (metric,))
+            exit(1)
+        return metric_f, True
+
+
+def iter_beta_diversity(otu_table, metrics, tree=None, rowids=None,
+                        full_tree=False):
+    """Computes several beta diversity metrics on otu_table in one pass
+
+    otu_table: a biom Table
+    metrics: list of metric names
+    tree: a PhyloNode tree, required by the phylogenetic metrics
+    rowids: list of sample ids; if provided, only the distances of these
+     samples to every sample are computed
+    full_tree: if True, the tree is assumed to already contain only the
+     OTUs in otu_table
+
+    Yields (metric, dissims) for each metric in metrics, where dissims is the
+     samples x samples distance matrix, or the rows of it for rowids.
+
+    The table is loaded into a sparse matrix once for all metrics. Metrics
+     with a one_vs_all_* function are computed a row at a time with
+     vectorized operations on the sparse matrix; the dense matrix is only
+     built (once) if other metrics are requested.
+    """
+    metric_fs = [_get_metric(metric, tree) for metric in metrics]
+    datamtx = load_sample_matrix(otu_table)
+    sample_ids = otu_table.ids()
+    observation_ids = otu_table.ids(axis='observation')
+    dense = []
+
+    def get_otumtx():
+        if not dense:
+            dense.append(datamtx.toarray())
+        return dense[0]
+
+    if rowids is not None:
+        rowidxs = [otu_table.index(rowid, axis='sample') for rowid in rowids]
+
+    for metric, (metric_f, is_phylogenetic) in zip(metrics, metric_fs):
+        try:
+            if is_phylogenetic:
+                raise AttributeError
+            row_metric = get_nonphylogenetic_row_metric(metric_f)
+        except AttributeError:
+            row_metric = None
+
+        if rowids is None:
+            # standard, full way
+            if row_metric is not None:
+                dissims = array([row_metric(datamtx, i)
+                                 for i in range(len(sample_ids))])
+                # make the matrix exactly symmetric
+                dissims = tril(dissims) + tril(dissims, -1).T
+            elif is_phylogenetic:
+                dissims = metric_f(get_otumtx(), observation_ids, tree,
+                                   sample_ids, make_subtree=(not full_tree))
+            else:
+                dissims = metric_f(get_otumtx())
+            yield metric, dissims
+            continue
+
+        # only calc d(rowid1, *) for each rowid
+        if row_metric is not None:
+            yield metric, [row_metric(datamtx, rowidx) for rowidx in rowidxs]
+            continue
+
+        # first test if the dissim is a fn of only the pair
+        # if not, just calc the whole matrix
+        if metric_f.__name__ in _WHOLE_MATRIX_METRICS:
+            warnings.warn('dissimilarity ' + metric_f.__name__ +
+                          ' is not parallelized, calculating the whole matrix...')
+            full_dissims = metric_f(get_otumtx())
+            yield metric, [full_dissims[rowidx] for rowidx in rowidxs]
+            continue
+
+        otumtx = get_otumtx()
+        try:
+            row_metric = get_phylogenetic_row_metric(metric)
+        except AttributeError:
+            row_metric = None
+        row_dissims = []  # same order as rowids
+        for rowid, rowidx in zip(rowids, rowidxs):
+            if row_metric is not None:
+                # do whole row at once
+                row_dissims.append(row_metric(otumtx, observation_ids, tree,
+                                              sample_ids, rowid,
+                                              make_subtree=(not full_tree)))
+                continue
+            # do element by element
+            dissims = []
+            for i in range(len(sample_ids)):
+                if is_phylogenetic:
+                    dissim = metric_f(
+                        otumtx[[rowidx, i], :], observation_ids,
+                        tree, [sample_ids[rowidx], sample_ids[i]],
+                        make_subtree=(not full_tree))[0, 1]
+                else:
+                    dissim = metric_f(otumtx[[rowidx, i], :])[0, 1]
+                dissims.append(dissim)
+            row_dissims.append(dissims)
+        yield metric, row_dissims
+
+
+def _distance_matrix_rows_ids_fp(rows_fp):
+    return os.path.splitext(rows_fp)[0] + '_ids.txt'
+
+
+def write_distance_matrix_rows(rows_fp, dissims, row_ids, col_ids):
+    """ Write rows of a distance matrix in binary format
+
+    rows_fp: path of the .npy file the rows are written to (as float64); the
+     row and column sample ids are written (tab-separated, one line each) to
+     the same path with .npy replaced by _ids.txt
+    dissims: the rows of the distance matrix, in the order of row_ids
+    row_ids: the sample ids of the rows
+    col_ids: the sample ids of the columns
+
+    Returns the paths of the two files that were written.
+    """
+    dissims = asarray(dissims, dtype=float64)
+    if dissims.shape != (len(row_ids), len(col_ids)):
+        raise ValueError("Data shape of %s doesn't match header sizes %s %s"
+                         % (dissims.shape, len(row_ids), len(col_ids)))
+    np_save(rows_fp, dissims)
+    ids_fp = _distance_matrix_rows_ids_fp(rows_fp)
+    ids_f = open(ids_fp, 'w')
+    ids_f.write('%s\n%s\n' % ('\t'.join(row_ids), '\t'.join(col_ids)))
+    ids_f.close()
+    return [rows_fp, ids_fp]
+
+
+def load_distance_matrix_rows(rows_fp):
+    """ Load rows of a distance matrix written by write_distance_matrix_rows
+
+    Returns (row_ids, col_ids, rows), where rows is a read-only array which
+     is memory-mapped from rows_fp, so rows are only read from disk as they
+     are accessed.
+    """
+    ids_f = open(_distance_matrix_rows_ids_fp(rows_fp), 'U')
+    row_ids = ids_f.readline().rstrip('\n').split('\t')
+    col_ids = ids_f.readline().rstrip('\n').split('\t')
+    ids_f.close()
+    return row_ids, col_ids, np_load(rows_fp, mmap_mode='r')
+
+
 def single_file_beta(input_path, metrics, tree_path, output_dir,
-                     rowids=None, full_tree=False):
+                     rowids=None, full_tree=False, binary_rows=False):
     """ does beta diversity calc on a single otu table
 
     uses name in metrics to name output beta diversity files
@@ -205,6 +578,9 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
      tree_path (str)
      output_dir (str)
      rowids (comma separated str)
+     binary_rows (bool): if True and rowids are provided, the rows are
+      written with write_distance_matrix_rows (to a .npy file) rather than
+      as text
     """
     metrics_list = metrics
     try:
@@ -214,96 +590,35 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
 
     otu_table = load_table(input_path)
 
-    otumtx = asarray([v for v in otu_table.iter_data(axis='sample')])
-
     if tree_path:
         tree = parse_newick(open(tree_path, 'U'),
                             PhyloNode)
     else:
         tree = None
 
+    if rowids is not None:
+        rowids_list = rowids.split(',')
+    else:
+        rowids_list = None
+
     input_dir, input_filename = os.path.split(input_path)
     input_basename, input_ext = os.path.splitext(input_filename)
-    for metric in metrics_list:
+    for metric, dissims in iter_beta_diversity(otu_table, metrics_list, tree,
+                                               rowids_list, full_tree):
+        if binary_rows and rowids_list is not None:
+            write_distance_matrix_rows(
+                os.path.join(output_dir, metric + '_' + input_basename +
+                             '.npy'),
+                dissims, rowids_list, otu_table.ids())
+            continue
         outfilepath = os.path.join(output_dir, metric + '_' +
                                    input_basename + '.txt')
-        try:
-            metric_f = get_nonphylogenetic_metric(metric)
-            is_phylogenetic = False
-        except AttributeError:
-            try:
-                metric_f = get_phylogenetic_metric(metric)
-                is_phylogenetic = True
-                if tree is None:
-                    stderr.write("metric %s requires a tree, but none found\n"
-                                 % (metric,))
-                    exit(1)
-            except AttributeError:
-                stderr.write("Could not find metric %s.\n\nKnown metrics are: %s\n"
-                             % (metric, ', '.join(list_known_metrics())))
-                exit(1)
-        if rowids is None:
-            # standard, full way
-            if is_phylogenetic:
-                dissims = metric_f(otumtx, otu_table.ids(axis='observation'),
-                                   tree, otu_table.ids(),
-                                   make_subtree=(not full_tree))
-            else:
-                dissims = metric_f(otumtx)
-            f = open(outfilepath, 'w')
+        f = open(outfilepath, 'w')
+        if rowids_list is None:
             f.write(format_distance_matrix(otu_table.ids(), dissims))
-            f.close()
         else:
-            # only calc d(rowid1, *) for each rowid
-            rowids_list = rowids.split(',')
-            row_dissims = []  # same order as rowids_list
-            for rowid in rowids_list:
-                rowidx = otu_table.index(rowid, axis='sample')
-
-                # first test if we can the dissim is a fn of only the pair
-                # if not, just calc the whole matrix
-                if metric_f.__name__ == 'dist_chisq' or \
-                        metric_f.__name__ == 'dist_gower' or \
-                        metric_f.__name__ == 'dist_hellinger' or\
-                        metric_f.__name__ == 'binary_dist_chisq':
-                    warnings.warn('dissimilarity ' + metric_f.__name__ +
-                                  ' is not parallelized, calculating the whole matrix...')
-                    row_dissims.append(metric_f(otumtx)[rowidx])
-                else:
-                    try:
-                        row_metric = get_phylogenetic_row_metric(metric)
-                    except AttributeError:
-                        # do element by element
-                        dissims = []
-                        sample_ids = otu_table.ids()
-                        observation_ids = otu_table.ids(axis='observation')
-                        for i in range(len(sample_ids)):
-                            if is_phylogenetic:
-                                dissim = metric_f(
-                                    otumtx[[rowidx, i], :], observation_ids,
-                                    tree, [sample_ids[rowidx], sample_ids[i]],
-                                    make_subtree=(not full_tree))[0, 1]
-                            else:
-                                dissim = metric_f(otumtx[[rowidx, i], :])[0, 1]
-                            dissims.append(dissim)
-                        row_dissims.append(dissims)
-                    else:
-                        # do whole row at once
-                        dissims = row_metric(otumtx,
-                                             otu_table.ids(axis='observation'),
-                                             tree, otu_table.ids(), rowid,
-                                             make_subtree=(not full_tree))
-                        row_dissims.append(dissims)
-
-            # rows_outfilepath = os.path.join(output_dir, metric + '_' +\
-            #     '_'.join(rowids_list) + '_' + os.path.split(input_path)[1])
-            f = open(outfilepath, 'w')
-            f.write(
-                format_matrix(
-                    row_dissims,
-                    rowids_list,
-                    otu_table.ids()))
-            f.close()
+            f.write(format_matrix(dissims, rowids_list, otu_table.ids()))
+        f.close()
 
 
 def single_object_beta(otu_table, metrics, tr, rowids=None,
@@ -320,8 +635,6 @@ def single_object_beta(otu_table, metrics, tr, rowids=None,
                                         diversity metric
                 rowids -- comma seperated string
     """
-    otumtx = asarray([v for v in otu_table.iter_sample_data()])
-
     if tr:
         tree = tr
     else:
@@ -329,80 +642,19 @@ def single_object_beta(otu_table, metrics, tr, rowids=None,
 
     metrics_list = metrics.split(',')
 
-    for metric in metrics_list:
-        try:
-            metric_f = get_nonphylogenetic_metric(metric)
-            is_phylogenetic = False
-        except AttributeError:
-            try:
-                metric_f = get_phylogenetic_metric(metric)
-                is_phylogenetic = True
-                if tree is None:
-                    stderr.write("metric %s requires a tree, but none found\n"
-                                 % (metric,))
-                    exit(1)
-            except AttributeError:
-                stderr.write("Could not find metric %s.\n\nKnown metrics are: %s\n"
-                             % (metric, ', '.join(list_known_metrics())))
-                exit(1)
-        if rowids is None:
-            # standard, full way
-            if is_phylogenetic:
-                dissims = metric_f(otumtx, otu_table.ids(axis='observation'),
-                                   tree, otu_table.ids(),
-                                   make_subtree=(not full_tree))
-            else:
-                dissims = metric_f(otumtx)
-
-            return (
-                format_distance_matrix(
-                    otu_table.ids(),
-                    dissims).split(
-                    '\n')
-            )
+    if rowids is not None:
+        rowids_list = rowids.split(',')
+    else:
+        rowids_list = None
+
+    # only the result of the first metric is returned
+    for metric, dissims in iter_beta_diversity(otu_table, metrics_list[:1],
+                                               tree, rowids_list, full_tree):
+        if rowids_list is None:
+            return format_distance_matrix(otu_table.ids(),
+                                          dissims).split('\n')
         else:
-            # only calc d(rowid1, *) for each rowid
-            rowids_list = rowids.split(',')
-            row_dissims = []  # same order as rowids_list
-            for rowid in rowids_list:
-                rowidx = otu_table.index(rowid)
-
-                # first test if we can the dissim is a fn of only the pair
-                # if not, just calc the whole matrix
-                if metric_f.__name__ == 'dist_chisq' or \
-                        metric_f.__name__ == 'dist_gower' or \
-                        metric_f.__name__ == 'dist_hellinger' or\
-                        metric_f.__name__ == 'binary_dist_chisq':
-                    warnings.warn('dissimilarity ' + metric_f.__name__ +
-                                  ' is not parallelized, calculating the whole matrix...')
-                    row_dissims.append(metric_f(otumtx)[rowidx])
-                else:
-                    try:
-                        row_metric = get_phylogenetic_row_metric(metric)
-                    except AttributeError:
-                        # do element by element
-                        dissims = []
-                        sample_ids = otu_table.ids()
-                        observation_ids = otu_table.ids(axis='observation')
-                        for i in range(len(sample_ids)):
-                            if is_phylogenetic:
-                                dissim = metric_f(
-                                    otumtx[[rowidx, i], :], observation_ids,
-                                    tree, [sample_ids[rowidx], sample_ids[i]],
-                                    make_subtree=(not full_tree))[0, 1]
-                            else:
-                                dissim = metric_f(otumtx[[rowidx, i], :])[0, 1]
-                            dissims.append(dissim)
-                        row_dissims.append(dissims)
-                    else:
-                        # do whole row at once
-                        dissims = row_metric(otumtx,
-                                             otu_table.ids(axis='observation'),
-                                             tree, otu_table.ids(), rowid,
-                                             make_subtree=(not full_tree))
-                        row_dissims.append(dissims)
-
-            return format_matrix(row_dissims, rowids_list, otu_table.ids())
+            return format_matrix(dissims, rowids_list, otu_table.ids())
 
 
 def multiple_file_beta(input_path, output_dir, metrics, tree_path,
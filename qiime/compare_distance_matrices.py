@@ -21,7 +21,7 @@ from qiime.stats import MantelCorrelogram, PartialMantel
 
 def run_mantel_test(method, fps, distmats, num_perms, tail_type, comment,
                     control_dm_fp=None, control_dm=None,
-                    sample_id_map=None):
+                    sample_id_map=None, jobs_to_start=1):
     """Runs a Mantel test on all pairs of distance matrices.
 
     Returns a string suitable for writing out to a file containing the results
@@ -49,6 +49,8 @@ def run_mantel_test(method, fps, distmats, num_perms, tail_type, comment,
             then)
         sample_id_map - dict mapping sample IDs (i.e. what is expected by
             make_compatible_distance_matrices)
+        jobs_to_start - the number of processes over which to split the
+            permutations. Only applies when method is partial_mantel
     """
     if len(fps) != len(distmats):
         raise ValueError("Must provide the same number of filepaths as there "
@@ -112,7 +114,8 @@ def run_mantel_test(method, fps, distmats, num_perms, tail_type, comment,
                     fp1, fp2, n, corr_coeff, p_str, num_perms, tail_type)
             elif method == 'partial_mantel':
                 cdm = DistanceMatrix(cdm_data, cdm_labels)
-                results = PartialMantel(dm1, dm2, cdm)(num_perms)
+                results = PartialMantel(dm1, dm2, cdm)(num_perms,
+                                                       jobs_to_start)
                 p_str = p_value_to_str(results['mantel_p'], num_perms)
                 result += "%s\t%s\t%s\t%d\t%.5f\t%s\t%d\t%s\n" % (
                     fp1, fp2, control_dm_fp, len(dm1_labels),
@@ -122,7 +125,8 @@ def run_mantel_test(method, fps, distmats, num_perms, tail_type, comment,
 
 def run_mantel_correlogram(fps, distmats, num_perms, comment, alpha,
                            sample_id_map=None,
-                           variable_size_distance_classes=False):
+                           variable_size_distance_classes=False,
+                           jobs_to_start=1):
     """Runs a Mantel correlogram analysis on all pairs of distance matrices.
 
     Returns a string suitable for writing out to a file containing the results
@@ -152,6 +156,8 @@ def run_mantel_correlogram(fps, distmats, num_perms, comment, alpha,
         variable_size_distance_classes - create distance classes that vary in
             size (i.e. width) but have the same number of distances in each
             class
+        jobs_to_start - the number of processes over which to split the
+            permutations
     """
     if len(fps) != len(distmats):
         raise ValueError("Must provide the same number of filepaths as there "
@@ -186,7 +192,7 @@ def run_mantel_correlogram(fps, distmats, num_perms, comment, alpha,
             # the specified number of permutations.
             mc = MantelCorrelogram(dm1, dm2, alpha=alpha,
                                    variable_size_distance_classes=variable_size_distance_classes)
-            results = mc(num_perms)
+            results = mc(num_perms, jobs_to_start)
 
             # Generate a name for the current correlogram and save it and the
             # correlogram itself.
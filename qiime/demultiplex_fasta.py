@@ -18,10 +18,12 @@ __maintainer__ = "William Walters"
 __email__ = "william.a.walters@colorado.edu"
 
 from string import upper
-from itertools import izip
+from itertools import izip, islice
 from os.path import join
 from os import rename
-from collections import defaultdict
+from collections import defaultdict, deque
+from cStringIO import StringIO
+from multiprocessing import Pool
 from operator import itemgetter
 from gzip import GzipFile
 
@@ -59,7 +61,8 @@ def process_files_and_demultiplex_sequences(mapping_file,
                                             write_unassigned_reads=False,
                                             disable_bc_correction=False,
                                             added_demultiplex_field=None,
-                                            save_barcode_frequencies=False):
+                                            save_barcode_frequencies=False,
+                                            jobs_to_start=1):
     """ Handles file IO, calls main demultiplexing function
 
     mapping_file:  filepath to metadata mapping file.
@@ -79,6 +82,7 @@ def process_files_and_demultiplex_sequences(mapping_file,
      and demultiplexes according to data in fasta labels.
     save_barcode_frequencies:  Saves the frequencies of barcode sequences in
      a separate output file.
+    jobs_to_start:  Number of processes to demultiplex sequences in.
     """
 
     file_data = {}
@@ -105,7 +109,8 @@ def process_files_and_demultiplex_sequences(mapping_file,
     log_data, bc_freqs, seq_counts, corrected_bc_count =\
         demultiplex_sequences(file_data, keep_barcode, barcode_type,
                               max_bc_errors, start_index, write_unassigned_reads,
-                              disable_bc_correction, added_demultiplex_field)
+                              disable_bc_correction, added_demultiplex_field,
+                              jobs_to_start)
 
     final_log_data = process_log_data(log_data, seq_counts, mapping_file,
                                       fasta_files, qual_files, corrected_bc_count, keep_barcode, barcode_type,
@@ -143,7 +148,8 @@ def demultiplex_sequences(file_data,
                           start_index=1,
                           write_unassigned_reads=False,
                           disable_bc_correction=False,
-                          added_demultiplex_field=None):
+                          added_demultiplex_field=None,
+                          jobs_to_start=1):
     """ Main program function for demultiplexing fasta sequence data
 
     file_data:  dict of open file objects, contains input fasta, qual, and
@@ -160,6 +166,7 @@ def demultiplex_sequences(file_data,
     disable_bc_correction:  Only tests for exact matches to barcodes.
     added_demultiplex_field:  Uses data supplied in metadata mapping field
      and demultiplexes according to data in fasta labels.
+    jobs_to_start:  Number of processes to demultiplex sequences in.
     """
 
     header, mapping_data = check_map(file_data['mapping_file'], barcode_type,
@@ -177,7 +184,7 @@ def demultiplex_sequences(file_data,
         assign_seqs(
             file_data, ids_bcs_added_field, bc_lens, all_bcs, keep_barcode,
             barcode_type, max_bc_errors, start_index, write_unassigned_reads,
-            disable_bc_correction, added_demultiplex_field)
+            disable_bc_correction, added_demultiplex_field, jobs_to_start)
 
     return log_data, bc_freqs, seq_counts, corrected_bc_count
 
@@ -192,7 +199,9 @@ def assign_seqs(file_data,
                 start_index=1,
                 write_unassigned_reads=False,
                 disable_bc_correction=False,
-                added_demultiplex_field=None):
+                added_demultiplex_field=None,
+                jobs_to_start=1,
+                chunk_size=10000):
     """ Demultiplexes, writes seqs/qual files, returns log data
 
     file_data:  dict of open file objects, contains input fasta, qual, and
@@ -212,101 +221,268 @@ def assign_seqs(file_data,
     disable_bc_correction:  Only tests for exact matches to barcodes.
     added_demultiplex_field:  Uses data supplied in metadata mapping field
      and demultiplexes according to data in fasta labels.
-    save_barcode_frequencies:  Saves the frequencies of barcode sequences in
-     a separate output file.
+    jobs_to_start:  Number of processes to demultiplex sequences in.  If 1,
+     all sequences are demultiplexed in this process.
+    chunk_size:  Number of sequences demultiplexed at a time by each process.
+
+    Sequences are demultiplexed in chunks of chunk_size, which are written
+     to the output files in the order of the input files.
     """
 
+    demultiplexer = SequenceDemultiplexer(ids_bcs_added_field, bc_lens,
+                                          all_bcs, keep_barcode, barcode_type,
+                                          max_bc_errors, write_unassigned_reads,
+                                          disable_bc_correction,
+                                          added_demultiplex_field)
+
     log_data = initialize_log_data(ids_bcs_added_field)
     bc_freqs = defaultdict(int)
 
     seq_counts = 0
-    enum_val = start_index
     corrected_bc_count = [0, 0]
 
-    if file_data['qual_files']:
-        for curr_fasta, curr_qual in zip(file_data['fasta_files'],
-                                         file_data['qual_files']):
+    # The files are only used (and so only need to be in file_data) if
+    # there are qual files and/or if unassigned reads are written
+    output_f_names = ['demultiplexed_seqs_f', 'demultiplexed_qual_f',
+                      'unassigned_seqs_f', 'unassigned_qual_f']
+
+    def record_chunk_result(chunk_result):
+        outputs, chunk_log_data, chunk_bc_freqs, chunk_corrected_bc_count =\
+            chunk_result
+        for output_f_name, output in zip(output_f_names, outputs):
+            if output:
+                file_data[output_f_name].write(output)
+        for log_id, count in chunk_log_data.iteritems():
+            log_data[log_id] += count
+        for bc, count in chunk_bc_freqs:
+            bc_freqs[bc] += count
+        corrected_bc_count[0] += chunk_corrected_bc_count[0]
+        corrected_bc_count[1] += chunk_corrected_bc_count[1]
+
+    records = iter_demultiplex_records(file_data['fasta_files'],
+                                       file_data['qual_files'])
+    chunks = iter_chunks(records, chunk_size, start_index)
+
+    if jobs_to_start <= 1:
+        for chunk, enum_val in chunks:
+            seq_counts += len(chunk)
+            record_chunk_result(demultiplexer.demultiplex_chunk(chunk,
+                                                                enum_val))
+    else:
+        pool = Pool(jobs_to_start, _init_demultiplex_worker, (demultiplexer,))
+        try:
+            pending = deque()
+            for chunk, enum_val in chunks:
+                seq_counts += len(chunk)
+                pending.append(pool.apply_async(_demultiplex_worker,
+                                                (chunk, enum_val)))
+                # only keep a couple of chunks per process queued, so that
+                # the input isn't all read into memory
+                if len(pending) > 2 * jobs_to_start:
+                    record_chunk_result(pending.popleft().get())
+            while pending:
+                record_chunk_result(pending.popleft().get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    return log_data, bc_freqs, seq_counts, corrected_bc_count
+
+
+def iter_demultiplex_records(fasta_files, qual_files):
+    """ Yields (fasta_label, fasta_seq, qual_seq) for all sequences
+
+    fasta_files:  list of open fasta files
+    qual_files:  list of open qual files, paired with fasta_files, or an
+     empty list, in which case qual_seq is None
+    qual_seq is a list of quality scores.
+    """
+
+    if qual_files:
+        for curr_fasta, curr_qual in zip(fasta_files, qual_files):
             for fasta_data, qual_data in izip(parse_fasta(curr_fasta),
                                               MinimalQualParser(curr_qual, full_header=True)):
-
-                seq_counts += 1
                 fasta_label, fasta_seq = fasta_data
                 qual_label, qual_seq = qual_data
-
-                bc, corrected_bc, num_errors, added_field =\
-                    get_demultiplex_data(ids_bcs_added_field,
-                                         fasta_label, fasta_seq, bc_lens, all_bcs, barcode_type,
-                                         max_bc_errors, disable_bc_correction, added_demultiplex_field)
-
-                bc_freqs[bc] += 1
-
-                sample_id, log_id, bc_corrected_result =\
-                    get_output_ids(ids_bcs_added_field,
-                                   corrected_bc, num_errors, added_field, max_bc_errors,
-                                   enum_val)
-                if bc_corrected_result == 'corrected':
-                    corrected_bc_count[0] += 1
-                if bc_corrected_result == 'not_corrected':
-                    corrected_bc_count[1] += 1
-
-                label_line = get_label_line(sample_id, fasta_label, bc,
-                                            corrected_bc, num_errors)
-
-                if sample_id.startswith("Unassigned") and\
-                        write_unassigned_reads:
-                    write_fasta_line(file_data['unassigned_seqs_f'],
-                                     fasta_seq, label_line, True, len(bc))
-                    write_qual_line(file_data['unassigned_qual_f'],
-                                    list(qual_seq), label_line, True, len(bc))
-                elif not sample_id.startswith("Unassigned"):
-                    write_fasta_line(file_data['demultiplexed_seqs_f'],
-                                     fasta_seq, label_line, keep_barcode, len(bc))
-                    write_qual_line(file_data['demultiplexed_qual_f'],
-                                    list(qual_seq), label_line, keep_barcode, len(bc))
-
-                if log_id:
-                    log_data[log_id] += 1
-
-                enum_val += 1
-
+                # formatting python ints for output is much faster than
+                # formatting numpy ints
+                yield fasta_label, fasta_seq, qual_seq.tolist()
     else:
-        for curr_fasta in file_data['fasta_files']:
+        for curr_fasta in fasta_files:
             for fasta_label, fasta_seq in parse_fasta(curr_fasta):
-                seq_counts += 1
-                bc, corrected_bc, num_errors, added_field =\
-                    get_demultiplex_data(ids_bcs_added_field,
-                                         fasta_label, fasta_seq, bc_lens, all_bcs, barcode_type,
-                                         max_bc_errors, disable_bc_correction, added_demultiplex_field)
+                yield fasta_label, fasta_seq, None
 
-                bc_freqs[bc] += 1
 
-                sample_id, log_id, bc_corrected_result =\
-                    get_output_ids(ids_bcs_added_field,
-                                   corrected_bc, num_errors, added_field, max_bc_errors,
-                                   enum_val)
+def iter_chunks(records, chunk_size, start_index=1):
+    """ Yields (list of up to chunk_size records, index of first record) """
 
-                if bc_corrected_result == 'corrected':
-                    corrected_bc_count[0] += 1
-                if bc_corrected_result == 'not_corrected':
-                    corrected_bc_count[1] += 1
+    records = iter(records)
+    curr_index = start_index
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk, curr_index
+        curr_index += len(chunk)
 
-                label_line = get_label_line(sample_id, fasta_label, bc,
-                                            corrected_bc, num_errors)
 
-                if sample_id.startswith("Unassigned") and\
-                        write_unassigned_reads:
-                    write_fasta_line(file_data['unassigned_seqs_f'],
-                                     fasta_seq, label_line, True, len(bc))
-                elif not sample_id.startswith("Unassigned"):
-                    write_fasta_line(file_data['demultiplexed_seqs_f'],
-                                     fasta_seq, label_line, keep_barcode, len(bc))
+class SequenceDemultiplexer(object):
 
-                if log_id:
-                    log_data[log_id] += 1
+    """ Assigns sequences to samples by barcode and added demultiplex field
 
-                enum_val += 1
+    The correction of each barcode read (as from attempt_bc_correction, or
+     get_exact_bc_matches if correction is disabled) is looked up rather
+     than recomputed. The lookup starts with the barcodes in the mapping
+     file, and the correction of any other barcode read is added to it the
+     first time that it is seen, so reads with the same barcode errors are
+     only decoded once. Results are the same as get_demultiplex_data.
+    """
+
+    def __init__(self,
+                 ids_bcs_added_field,
+                 bc_lens,
+                 all_bcs,
+                 keep_barcode=False,
+                 barcode_type="golay_12",
+                 max_bc_errors=1.5,
+                 write_unassigned_reads=False,
+                 disable_bc_correction=False,
+                 added_demultiplex_field=None,
+                 max_cached=1000000):
+        self.ids_bcs_added_field = ids_bcs_added_field
+        self.bc_lens = bc_lens
+        self.all_bcs = all_bcs
+        self.keep_barcode = keep_barcode
+        self.barcode_type = barcode_type
+        self.max_bc_errors = max_bc_errors
+        self.write_unassigned_reads = write_unassigned_reads
+        self.disable_bc_correction = disable_bc_correction
+        self.added_demultiplex_field = added_demultiplex_field
+        self.max_cached = max_cached
+        # the distinct added fields, in the order that
+        # get_added_demultiplex_field tests them
+        self.added_fields = []
+        for curr_bc, curr_added_field in ids_bcs_added_field.keys():
+            if curr_added_field not in self.added_fields:
+                self.added_fields.append(curr_added_field)
+        self._bc_corrections = {}
+        for curr_bc in all_bcs:
+            self.correct_bc(curr_bc)
+
+    def correct_bc(self, curr_bc):
+        """ Returns the corrected barcode and number of errors of curr_bc """
+        try:
+            return self._bc_corrections[curr_bc]
+        except KeyError:
+            pass
+        if self.disable_bc_correction:
+            result = get_exact_bc_matches(curr_bc, self.all_bcs), 0
+        else:
+            result = attempt_bc_correction(curr_bc, self.all_bcs,
+                                           self.barcode_type)
+        if len(self._bc_corrections) >= self.max_cached:
+            self._bc_corrections.clear()
+        self._bc_corrections[curr_bc] = result
+        return result
+
+    def demultiplex(self, fasta_label, fasta_seq):
+        """ Returns bc, corrected_bc, num_errors, added_field for a sequence
+
+        As get_demultiplex_data.
+        """
+        if self.added_demultiplex_field:
+            added_field = match_added_demultiplex_field(
+                self.added_fields, fasta_label, self.added_demultiplex_field)
+        else:
+            added_field = None
+
+        for bc_len in self.bc_lens:
+            curr_bc = fasta_seq[0:bc_len]
+            corrected_bc, num_errors = self.correct_bc(curr_bc)
+            if added_field:
+                if (corrected_bc, added_field) in self.ids_bcs_added_field:
+                    break
+            elif corrected_bc is not None:
+                break
+
+        return curr_bc, corrected_bc, num_errors, added_field
+
+    def demultiplex_chunk(self, records, enum_val):
+        """ Demultiplexes records, enumerating them from enum_val
+
+        records:  list of (fasta_label, fasta_seq, qual_seq), where qual_seq
+         is a list of quality scores, or None if there are none
+        enum_val:  Value to follow the SampleID of the first record
+
+        Returns (outputs, log_data, bc_freqs, corrected_bc_count), where
+         outputs are the text to write to the demultiplexed fasta and qual
+         files and the unassigned fasta and qual files, bc_freqs is a list
+         of (barcode, count), and the rest are counts for these records
+         only, as in assign_seqs.
+        """
+        outputs = [StringIO() for i in range(4)]
+        demultiplexed_seqs_f, demultiplexed_qual_f, unassigned_seqs_f,\
+            unassigned_qual_f = outputs
+        log_data = defaultdict(int)
+        bc_freqs = defaultdict(int)
+        # barcodes in the order they were first seen, so that merging
+        # chunks builds bc_freqs in the same order as a single pass would
+        bcs_seen = []
+        corrected_bc_count = [0, 0]
+
+        for fasta_label, fasta_seq, qual_seq in records:
+            bc, corrected_bc, num_errors, added_field =\
+                self.demultiplex(fasta_label, fasta_seq)
+
+            if bc not in bc_freqs:
+                bcs_seen.append(bc)
+            bc_freqs[bc] += 1
+
+            sample_id, log_id, bc_corrected_result =\
+                get_output_ids(self.ids_bcs_added_field,
+                               corrected_bc, num_errors, added_field,
+                               self.max_bc_errors, enum_val)
+            if bc_corrected_result == 'corrected':
+                corrected_bc_count[0] += 1
+            if bc_corrected_result == 'not_corrected':
+                corrected_bc_count[1] += 1
+
+            label_line = get_label_line(sample_id, fasta_label, bc,
+                                        corrected_bc, num_errors)
+
+            if sample_id.startswith("Unassigned") and\
+                    self.write_unassigned_reads:
+                write_fasta_line(unassigned_seqs_f, fasta_seq, label_line,
+                                 True, len(bc))
+                if qual_seq is not None:
+                    write_qual_line(unassigned_qual_f, qual_seq, label_line,
+                                    True, len(bc))
+            elif not sample_id.startswith("Unassigned"):
+                write_fasta_line(demultiplexed_seqs_f, fasta_seq, label_line,
+                                 self.keep_barcode, len(bc))
+                if qual_seq is not None:
+                    write_qual_line(demultiplexed_qual_f, qual_seq,
+                                    label_line, self.keep_barcode, len(bc))
+
+            if log_id:
+                log_data[log_id] += 1
+
+            enum_val += 1
+
+        return ([output.getvalue() for output in outputs], dict(log_data),
+                [(bc, bc_freqs[bc]) for bc in bcs_seen], corrected_bc_count)
 
-    return log_data, bc_freqs, seq_counts, corrected_bc_count
+
+def _init_demultiplex_worker(demultiplexer):
+    global _demultiplexer
+    _demultiplexer = demultiplexer
+
+
+def _demultiplex_worker(records, enum_val):
+    return _demultiplexer.demultiplex_chunk(records, enum_val)
 
 
 def get_output_ids(ids_bcs_added_field,
@@ -605,8 +781,23 @@ def get_added_demultiplex_field(ids_bcs_added_field,
      and demultiplexes according to data in fasta labels.
     """
 
-    for curr_bc_added_field in ids_bcs_added_field.keys():
-        curr_added_field = curr_bc_added_field[1]
+    return match_added_demultiplex_field(
+        [curr_bc_added_field[1]
+         for curr_bc_added_field in ids_bcs_added_field.keys()],
+        fasta_label, added_demultiplex_field)
+
+
+def match_added_demultiplex_field(added_fields,
+                                  fasta_label,
+                                  added_demultiplex_field):
+    """ Returns the first of added_fields found in fasta label, or None
+
+    added_fields:  list of added demultiplex field values to test
+    added_demultiplex_field:  Uses data supplied in metadata mapping field
+     and demultiplexes according to data in fasta labels.
+    """
+
+    for curr_added_field in added_fields:
         if added_demultiplex_field == 'run_prefix':
             curr_label_slice = fasta_label[0:len(curr_added_field)]
             if curr_label_slice == curr_added_field:
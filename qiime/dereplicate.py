@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent", "Jens Reeder"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+"""Exact-match dereplication of sequence collections.
+
+The dereplication functions in this module key unique sequences on their
+128-bit (md5) digests rather than on the sequences themselves, and record
+the sequence identifiers as a compact list of (cluster index, seq_id)
+pairs. When the number of buffered seq_ids exceeds a budget, the pairs are
+spilled to partition files on disk, and the full clusters are streamed back
+one partition at a time when they are expanded. The same maps are used to
+merge chained OTU maps without holding all of their seq_ids in memory.
+"""
+
+from array import array
+from collections import defaultdict
+from hashlib import md5
+from itertools import izip
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qiime.util import get_qiime_temp_dir
+
+# maximum number of seq_ids kept in memory before they are spilled to disk
+MAX_SEQ_IDS_IN_MEMORY = 5000000
+
+
+class DereplicatedSeqIdMap(object):
+
+    """ Map of dereplicated sequence ids to the original sequence ids
+
+        This behaves like a read-only dict of {cluster_name: [seq_ids]}, but
+         is intended to be used through expand, which maps lists of cluster
+         names to the full lists of seq_ids in a single pass over the data.
+         Looking up individual clusters requires a pass over the data each
+         time.
+
+        max_seq_ids_in_memory: number of (cluster index, seq_id) pairs to
+         buffer before spilling them to disk
+        num_partitions: number of files the spilled pairs are distributed
+         over (by cluster index); expand holds one of these in memory at a
+         time
+        working_dir: directory in which to create the spill directory
+         (default: the QIIME temp_dir)
+
+        Spilled data is removed by close, which is also called when the map
+         is used as a context manager.
+    """
+
+    def __init__(self,
+                 max_seq_ids_in_memory=MAX_SEQ_IDS_IN_MEMORY,
+                 num_partitions=16,
+                 working_dir=None):
+        self._max_seq_ids_in_memory = max_seq_ids_in_memory
+        self._num_partitions = num_partitions
+        self._working_dir = working_dir
+        self._spill_dir = None
+        self._cluster_indices = array('I')
+        self._seq_ids = []
+        self._num_seq_ids = 0
+        # whether _seq_ids holds tab-separated groups of seq_ids (added by
+        # _add_seq_ids) rather than single seq_ids
+        self._joined = False
+        # for maps built by remap, the cluster that each of the internal
+        # cluster indices in _cluster_indices is part of (see remap)
+        self._owners = None
+        self.counts = array('I')
+        self.names = []
+        self._name_to_index = None
+
+    def new_cluster(self):
+        """ Create a new cluster and return its index """
+        self.counts.append(0)
+        return len(self.counts) - 1
+
+    def add(self, cluster_index, seq_id):
+        """ Record that seq_id belongs to cluster_index """
+        self._cluster_indices.append(cluster_index)
+        self._seq_ids.append(seq_id)
+        self.counts[cluster_index] += 1
+        self._num_seq_ids += 1
+        if self._num_seq_ids >= self._max_seq_ids_in_memory:
+            self._spill()
+
+    def _add_seq_ids(self, cluster_index, seq_ids):
+        """ Record that all of seq_ids belong to (internal) cluster_index
+
+            The seq_ids are stored (and spilled) as a single tab-separated
+             string, which is much faster and smaller than storing them
+             individually.
+        """
+        if not seq_ids:
+            return
+        self._cluster_indices.append(cluster_index)
+        self._seq_ids.append('\t'.join(seq_ids))
+        self._joined = True
+        if self._owners is not None:
+            cluster_index = self._owners[cluster_index]
+        self.counts[cluster_index] += len(seq_ids)
+        self._num_seq_ids += len(seq_ids)
+        if self._num_seq_ids >= self._max_seq_ids_in_memory:
+            self._spill()
+
+    def set_names(self, names):
+        """ Name the clusters (names[i] is the name of the ith cluster) """
+        if len(names) != len(self.counts):
+            raise ValueError("Number of names (%d) doesn't match number of "
+                             "clusters (%d)" % (len(names), len(self.counts)))
+        self.names = list(names)
+        self._name_to_index = dict((n, i) for i, n in enumerate(self.names))
+
+    @property
+    def spilled(self):
+        return self._spill_dir is not None
+
+    def _partition_fp(self, i):
+        return join(self._spill_dir, '%d.txt' % i)
+
+    def _spill(self):
+        """ Append the buffered (cluster index, seq_id) pairs to disk """
+        if not self._seq_ids:
+            return
+        if self._spill_dir is None:
+            working_dir = self._working_dir or get_qiime_temp_dir()
+            self._spill_dir = mkdtemp(dir=working_dir,
+                                      prefix='QiimeDereplication')
+            for i in range(self._num_partitions):
+                open(self._partition_fp(i), 'w').close()
+        partitions = [[] for i in range(self._num_partitions)]
+        owners = self._owners
+        for cluster_index, seq_id in izip(self._cluster_indices,
+                                          self._seq_ids):
+            # all of the internal clusters of a cluster are in the same
+            # partition, so it can be put back together from that partition
+            owner = cluster_index if owners is None else owners[cluster_index]
+            partitions[owner % self._num_partitions].append(
+                '%d\t%s\n' % (cluster_index, seq_id))
+        for i, lines in enumerate(partitions):
+            if lines:
+                f = open(self._partition_fp(i), 'a')
+                f.writelines(lines)
+                f.close()
+        self._cluster_indices = array('I')
+        self._seq_ids = []
+        self._num_seq_ids = 0
+
+    def _iter_groups(self):
+        """ Yield (cluster index, [seq_ids]) for every cluster
+
+            seq_ids are in the order in which they were added. If the map
+             has been spilled, one partition at a time is held in memory.
+        """
+        if not self.spilled:
+            groups = defaultdict(list)
+            for cluster_index, seq_id in izip(self._cluster_indices,
+                                              self._seq_ids):
+                groups[cluster_index].append(seq_id)
+            for e in self._join_owned_groups(groups):
+                yield e
+            return
+
+        self._spill()
+        for i in range(self._num_partitions):
+            groups = defaultdict(list)
+            for line in open(self._partition_fp(i), 'U'):
+                cluster_index, seq_id = line.rstrip('\n').split('\t', 1)
+                groups[int(cluster_index)].append(seq_id)
+            for e in self._join_owned_groups(groups):
+                yield e
+
+    def _join_owned_groups(self, groups):
+        """ Yield (cluster index, [seq_ids]) from {cluster index: [seq_ids]}
+
+            For maps built by remap, the seq_ids of the internal clusters of
+             each cluster are joined in the order of the internal indices.
+             Tab-separated groups of seq_ids are split.
+        """
+        if self._owners is None:
+            if not self._joined:
+                for e in groups.iteritems():
+                    yield e
+                return
+            for cluster_index, seq_ids in groups.iteritems():
+                yield cluster_index, '\t'.join(seq_ids).split('\t')
+            return
+
+        owned = defaultdict(list)
+        for cluster_index in groups:
+            owned[self._owners[cluster_index]].append(cluster_index)
+        for owner, cluster_indices in owned.iteritems():
+            cluster_indices.sort()
+            seq_ids = []
+            for cluster_index in cluster_indices:
+                seq_ids.extend(groups.pop(cluster_index))
+            yield owner, '\t'.join(seq_ids).split('\t')
+
+    def expand(self, clusters):
+        """ Replace each cluster name in clusters with its seq_ids
+
+            clusters: a list of lists of cluster names (e.g., the clusters
+             of dereplicated sequences returned by an OTU picker)
+
+            Returns a list of lists of seq_ids, in the same order as
+             clusters. A KeyError is raised if any name is not in the map.
+        """
+        positions = defaultdict(list)
+        for i, cluster in enumerate(clusters):
+            for j, name in enumerate(cluster):
+                positions[self._name_to_index[name]].append((i, j))
+        result = [[None] * len(cluster) for cluster in clusters]
+        for cluster_index, seq_ids in self._iter_groups():
+            for i, j in positions.get(cluster_index, ()):
+                result[i][j] = seq_ids
+        return [[seq_id for seq_ids in r for seq_id in seq_ids]
+                for r in result]
+
+    def remap(self, otus):
+        """ Map the OTUs in otus to the seq_ids of their members
+
+            otus: iterable of (otu_id, [cluster names]), where the cluster
+             names are names in this map (e.g., the lines of an OTU map
+             generated from the cluster representatives)
+
+            Returns a new DereplicatedSeqIdMap of {otu_id: [seq_ids]}, built
+             in one pass over this map's seq_ids, so if this map is spilled
+             to disk only one partition at a time is held in memory. The
+             seq_ids of an OTU are those of its members, in order. A KeyError
+             is raised if any member is not in this map. This map is left
+             unchanged.
+        """
+        result = DereplicatedSeqIdMap(self._max_seq_ids_in_memory,
+                                      self._num_partitions,
+                                      self._working_dir)
+        # each member of each OTU is an internal cluster of the result, so
+        # the seq_ids of the members can be added in any order and joined in
+        # the order of the members
+        result._owners = array('I')
+        try:
+            positions = defaultdict(list)
+            otu_ids = []
+            for otu_id, names in otus:
+                otu_index = result.new_cluster()
+                otu_ids.append(otu_id)
+                for name in names:
+                    positions[self._name_to_index[name]].append(
+                        len(result._owners))
+                    result._owners.append(otu_index)
+            for cluster_index, seq_ids in self._iter_groups():
+                for member_index in positions.get(cluster_index, ()):
+                    result._add_seq_ids(member_index, seq_ids)
+            result.set_names(otu_ids)
+        except:
+            result.close()
+            raise
+        return result
+
+    def count(self, name):
+        """ Return the number of seq_ids in the named cluster """
+        return self.counts[self._name_to_index[name]]
+
+    def close(self):
+        """ Discard the seq_ids, removing any data spilled to disk """
+        if self._spill_dir is not None:
+            rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+        self._cluster_indices = array('I')
+        self._seq_ids = []
+        self._num_seq_ids = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._name_to_index
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def __getitem__(self, name):
+        return self.expand([[name]])[0]
+
+    def iteritems(self):
+        """ Yield (cluster_name, [seq_ids]) for every cluster
+
+            The clusters are yielded in no particular order, holding one
+             partition of a spilled map in memory at a time.
+        """
+        for cluster_index, seq_ids in self._iter_groups():
+            yield self.names[cluster_index], seq_ids
+        for cluster_index, count in enumerate(self.counts):
+            if count == 0:
+                yield self.names[cluster_index], []
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __eq__(self, other):
+        try:
+            other = dict(other.items())
+        except AttributeError:
+            return False
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def seq_id_map_from_otus(otus,
+                         max_seq_ids_in_memory=MAX_SEQ_IDS_IN_MEMORY,
+                         working_dir=None):
+    """ Load OTUs into a DereplicatedSeqIdMap
+
+        otus: iterable of (otu_id, [seq_ids]) (e.g., the lines of an OTU map)
+
+        Returns a DereplicatedSeqIdMap of {otu_id: [seq_ids]}.
+    """
+    seq_id_map = DereplicatedSeqIdMap(max_seq_ids_in_memory,
+                                      working_dir=working_dir)
+    otu_ids = []
+    try:
+        for otu_id, seq_ids in otus:
+            otu_index = seq_id_map.new_cluster()
+            otu_ids.append(otu_id)
+            seq_id_map._add_seq_ids(otu_index, seq_ids)
+        seq_id_map.set_names(otu_ids)
+    except:
+        seq_id_map.close()
+        raise
+    return seq_id_map
+
+
+def dereplicate_exact_matches(seqs,
+                              max_seq_ids_in_memory=MAX_SEQ_IDS_IN_MEMORY,
+                              working_dir=None):
+    """ Collapse identical sequences
+
+        seqs: iterable of (seq_id, seq) pairs; seq_ids are truncated at the
+         first whitespace
+
+        Returns the list of (cluster_name, seq) pairs for the unique
+         sequences, in order of first occurence, and a DereplicatedSeqIdMap
+         mapping each cluster_name to the seq_ids with that sequence. Cluster
+         names are QiimeExactMatch.<first seq_id>.
+    """
+    seq_id_map = DereplicatedSeqIdMap(max_seq_ids_in_memory,
+                                      working_dir=working_dir)
+    digest_to_index = {}
+    filtered_seqs = []
+    for seq_id, seq in seqs:
+        seq_id = seq_id.split()[0]
+        digest = md5(seq).digest()
+        try:
+            cluster_index = digest_to_index[digest]
+        except KeyError:
+            cluster_index = seq_id_map.new_cluster()
+            digest_to_index[digest] = cluster_index
+            filtered_seqs.append(('QiimeExactMatch.%s' % seq_id, seq))
+        seq_id_map.add(cluster_index, seq_id)
+    seq_id_map.set_names([seq_id for seq_id, seq in filtered_seqs])
+    return filtered_seqs, seq_id_map
+
+
+def dereplicate_exact_prefixes(seqs,
+                               prefix_length=100,
+                               max_seq_ids_in_memory=MAX_SEQ_IDS_IN_MEMORY,
+                               working_dir=None):
+    """ Collapse sequences with identical prefixes
+
+        seqs: iterable of (seq_id, seq) pairs; seq_ids are truncated at the
+         first whitespace
+        prefix_length: length of the prefixes to compare
+
+        Returns the list of (seq_id, seq) pairs of the longest sequence
+         (the first seen, in case of ties) with each prefix, and a
+         DereplicatedSeqIdMap mapping each of those seq_ids to the seq_ids
+         with that prefix.
+    """
+    seq_id_map = DereplicatedSeqIdMap(max_seq_ids_in_memory,
+                                      working_dir=working_dir)
+    digest_to_index = {}
+    # the longest (seq_id, seq) for each cluster
+    best = []
+    for seq_id, seq in seqs:
+        seq_id = seq_id.split()[0]
+        digest = md5(seq[:prefix_length]).digest()
+        try:
+            cluster_index = digest_to_index[digest]
+            if len(seq) > len(best[cluster_index][1]):
+                best[cluster_index] = (seq_id, seq)
+        except KeyError:
+            cluster_index = seq_id_map.new_cluster()
+            digest_to_index[digest] = cluster_index
+            best.append((seq_id, seq))
+        seq_id_map.add(cluster_index, seq_id)
+    seq_id_map.set_names([seq_id for seq_id, seq in best])
+    return best, seq_id_map
@@ -82,6 +82,65 @@ def decode(seq, nt_to_bits=None):
 decode_golay_12 = decode
 
 
+def decode_many(seqs, nt_to_bits=None):
+    """decodes a list of 12 base nucleotide strings in one vectorized pass
+
+    inputs:
+    - seqs, a list of nucleotide strings
+    - nt_to_bits, e.g.: { "A":"11",  "C":"00", "T":"10", "G":"01"}
+    output:
+    list of (corrected_seq, num_bit_errors), one per input seq, identical to
+    what decode() returns for that seq. Seqs which are not 12 bases drawn
+    from nt_to_bits are passed to decode() individually."""
+    if nt_to_bits is None:
+        nt_to_bits = DEFAULT_GOLAY_NT_TO_BITS
+    results = [None] * len(seqs)
+
+    # map each ascii character to its 2 bit integer code (-1 if invalid)
+    nt_codes = numpy.empty(256, dtype=numpy.int8)
+    nt_codes.fill(-1)
+    code_to_nt = numpy.empty(4, dtype='S1')
+    for nt, bits in nt_to_bits.items():
+        nt_codes[ord(nt)] = int(bits, 2)
+        code_to_nt[int(bits, 2)] = nt
+
+    batch_indices = [i for i, seq in enumerate(seqs) if len(seq) == 12]
+    if batch_indices:
+        chars = numpy.frombuffer(
+            ''.join([seqs[i] for i in batch_indices]),
+            dtype=numpy.uint8).reshape((len(batch_indices), 12))
+        codes = nt_codes[chars]
+        valid = (codes >= 0).all(axis=1)
+        codes = codes[valid]
+        batch_indices = [i for i, v in zip(batch_indices, valid) if v]
+
+        received = numpy.empty((len(batch_indices), 24), dtype=numpy.uint8)
+        received[:, 0::2] = codes >> 1
+        received[:, 1::2] = codes & 1
+        syndromes = numpy.dot(received, _H_T_UINT8) % 2
+        syndrome_indices = numpy.dot(syndromes, _SYNDROME_WEIGHTS)
+        errors = _SYNDROME_ERROR_TABLE[syndrome_indices]
+        correctable = _SYNDROME_CORRECTABLE[syndrome_indices]
+        num_errors = errors.sum(axis=1)
+        corrected = (received + errors) % 2
+        corrected_codes = corrected[:, 0::2] * 2 + corrected[:, 1::2]
+        corrected_seqs = code_to_nt[corrected_codes].view('S12').ravel()
+
+        for i, seq, n, ok in zip(batch_indices, corrected_seqs,
+                                 num_errors, correctable):
+            if ok:
+                results[i] = (seq, int(n))
+            else:
+                results[i] = (None, 4)
+
+    for i, seq in enumerate(seqs):
+        if results[i] is None:
+            results[i] = decode(seq, nt_to_bits)
+    return results
+# alt name for the batch decode function
+decode_golay_12_many = decode_many
+
+
 def encode(bits, nt_to_bits=None):
     """ takes any 12 bits, returns the golay 24bit codeword in nucleotide format
 
@@ -242,4 +301,14 @@ for errvec in _ALL_3BIT_ERRORS:
     syn = tuple(numpy.dot(DEFAULT_H, errvec) % 2)
     DEFAULT_SYNDROME_LUT[syn] = (errvec)
 
+# the same lookup table packed as arrays indexed by the syndrome read as a
+# 12 bit integer, used by decode_many()
+_H_T_UINT8 = DEFAULT_H.T.astype(numpy.uint8)
+_SYNDROME_WEIGHTS = 2 ** numpy.arange(11, -1, -1)
+_SYNDROME_ERROR_TABLE = numpy.zeros((4096, 24), dtype=numpy.uint8)
+_SYNDROME_CORRECTABLE = numpy.zeros(4096, dtype=bool)
+for syn, errvec in DEFAULT_SYNDROME_LUT.items():
+    _SYNDROME_ERROR_TABLE[numpy.dot(syn, _SYNDROME_WEIGHTS)] = errvec
+    _SYNDROME_CORRECTABLE[numpy.dot(syn, _SYNDROME_WEIGHTS)] = True
+
 # END module level constants
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+"""Measure how long it takes to import modules (e.g., at script startup).
+
+This module only depends on the standard library, so that importing it
+doesn't load any of the modules that it is used to profile. Each target is
+profiled in a fresh interpreter, since modules which are already loaded
+aren't imported again.
+"""
+
+import __builtin__
+from imp import load_source
+from json import loads
+from subprocess import PIPE, Popen
+from sys import executable, modules
+from time import time
+
+
+class ImportTimer(object):
+
+    """ Record the time taken by each import of a module not yet loaded
+
+        records is a list of (module name, cumulative time, self time,
+         depth) tuples in the order in which the imports started, where
+         cumulative time includes the imports that the module triggered and
+         self time does not, and depth is the number of imports the import
+         is nested in.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._stack = []
+        self._original_import = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=None,
+                level=-1):
+        if name in modules:
+            return self._original_import(name, globals, locals, fromlist,
+                                         level)
+        label = name
+        if not name and globals:
+            # from . import x
+            label = '%s.%s' % (globals.get('__package__') or
+                               globals.get('__name__'),
+                               ','.join(fromlist or []))
+        return self.time(label, self._original_import, name, globals,
+                         locals, fromlist, level)
+
+    def time(self, label, f, *args):
+        """ Return f(*args), recording the time it takes as label """
+        index = len(self.records)
+        self.records.append(None)
+        self._stack.append(0.0)
+        start = time()
+        try:
+            return f(*args)
+        finally:
+            elapsed = time() - start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.records[index] = (label, elapsed, elapsed - children,
+                                   len(self._stack))
+
+    def start(self):
+        self._original_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def stop(self):
+        __builtin__.__import__ = self._original_import
+
+
+def profile_import(target):
+    """ Import target in this interpreter, returning (total time, records)
+
+        target: a module name, or the path to a script (whose top level,
+         but not its main function, is run)
+        records: as in ImportTimer, for the modules which were loaded
+    """
+    timer = ImportTimer()
+    start = time()
+    timer.start()
+    try:
+        if target.endswith('.py'):
+            timer.time(target, load_source, '_profiled_script', target)
+        else:
+            __import__(target)
+    finally:
+        timer.stop()
+    return time() - start, timer.records
+
+
+def profile_import_subprocess(target, python_exe=executable):
+    """ Run profile_import(target) in a new interpreter and return its result
+    """
+    code = ('import sys\n'
+            'from json import dumps\n'
+            'from qiime.import_profiler import profile_import\n'
+            'sys.stdout.write(dumps(profile_import(%r)))\n' % target)
+    proc = Popen([python_exe, '-c', code], stdout=PIPE, stderr=PIPE)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise ImportError("Couldn't import %s:\n%s" % (target, stderr))
+    total_time, records = loads(stdout)
+    return total_time, [tuple(r) for r in records]
+
+
+def format_import_profile(target, total_time, records, num_modules=None,
+                          max_depth=None):
+    """ Return lines summarizing the import profile of target
+
+        The slowest num_modules imports (by cumulative time) are listed, or
+         all of them if num_modules is None. If max_depth is not None, only
+         imports nested at most max_depth deep are listed.
+    """
+    lines = ['Import time of %s: %1.1f ms (%d imports)' %
+             (target, total_time * 1000, len(records)),
+             '%10s %10s  %s' % ('cumul (ms)', 'self (ms)', 'module')]
+    if max_depth is not None:
+        records = [r for r in records if r[3] <= max_depth]
+    records = sorted(records, key=lambda r: r[1], reverse=True)
+    for name, cumulative_time, self_time, depth in records[:num_modules]:
+        lines.append('%10.1f %10.1f  %s%s' % (cumulative_time * 1000,
+                                              self_time * 1000,
+                                              '  ' * depth, name))
+    return lines
@@ -543,6 +543,23 @@ def generate_2d_plots(prefs, data, html_dir_path, data_dir_path, filename,
     groups_and_colors = iter_color_groups(mapping, prefs)
     groups_and_colors = list(groups_and_colors)
 
+    # Summarize the jackknifed PCoAs once, as the support PCoAs are parsed
+    # from their files each time they are iterated over
+    if 'support_pcoas' in data:
+        matrix_average, matrix_low, matrix_high, eigval_average, m_names = \
+            summarize_pcoas(data['coord'], data['support_pcoas'],
+                            method=data['ellipsoid_method'])
+        data['coord'] = \
+            (m_names, matrix_average, data['coord'][2], data['coord'][3])
+        for i in range(len(m_names)):
+            sample_location[m_names[i]] = i
+    else:
+        matrix_average = None
+        matrix_low = None
+        matrix_high = None
+        eigval_average = None
+        m_names = None
+
     for i in range(len(groups_and_colors)):
         labelname = groups_and_colors[i][0]
         groups = groups_and_colors[i][1]
@@ -559,21 +576,6 @@ def generate_2d_plots(prefs, data, html_dir_path, data_dir_path, filename,
         new_col_name = labelname
         img_data = {}
         plot_label = labelname
-
-        if 'support_pcoas' in data:
-            matrix_average, matrix_low, matrix_high, eigval_average, m_names = \
-                summarize_pcoas(data['coord'], data['support_pcoas'],
-                                method=data['ellipsoid_method'])
-            data['coord'] = \
-                (m_names, matrix_average, data['coord'][2], data['coord'][3])
-            for i in range(len(m_names)):
-                sample_location[m_names[i]] = i
-        else:
-            matrix_average = None
-            matrix_low = None
-            matrix_high = None
-            eigval_average = None
-            m_names = None
         iterator = 0
 
         for coord_tup in coord_tups:
@@ -25,7 +25,7 @@ from numpy import array, zeros
 from cogent.util.misc import flatten
 from biom.table import Table
 
-from qiime.parse import parse_otu_map
+from qiime.parse import parse_otu_map_to_sparse
 from qiime.util import get_generated_by_for_biom_tables
 
 
@@ -65,7 +65,7 @@ def make_otu_table(otu_map_f, otu_to_taxonomy=None, delim='_', table_id=None,
         Defaults to ``None``. If supplied, keys in the outer dict should be
         sample IDs, and keys in the inner dicts should be column names.
     """
-    data, sample_ids, otu_ids = parse_otu_map(
+    data, sample_ids, otu_ids = parse_otu_map_to_sparse(
         otu_map_f, delim=delim, otu_ids_to_exclude=otu_ids_to_exclude)
 
     if otu_to_taxonomy is not None:
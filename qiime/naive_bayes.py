@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+"""Naive Bayes taxonomy classifier, following the RDP Classifier.
+
+This implements the method of Wang et al. (2007) in numpy, so that taxonomy
+can be assigned without starting a JVM, and so that the trained model can be
+kept on disk and reused by later runs.
+
+Each training sequence is reduced to the set of overlapping words (k-mers,
+8 bases by default) that it contains, and each distinct lineage in the
+id-to-taxonomy map is a class (a "genus", in RDP's terms). With N training
+sequences, n(w) of which contain word w, and M sequences in a genus, m(w) of
+which contain w, the probability of w in the genus is
+
+    P(w | genus) = (m(w) + P(w)) / (M + 1), where P(w) = (n(w) + 0.5) / (N + 1)
+
+A query is assigned to the genus maximizing the sum over its words of
+log P(w | genus). The confidence at each rank of that genus's lineage is the
+fraction of bootstrap trials (100 by default, each scoring a random eighth of
+the query's words, drawn with replacement) which pick a genus with the same
+taxon at that rank.
+
+As log P(w | genus) = log(1 + m(w) / P(w)) + log P(w) - log(M + 1), and the
+middle term is the same for every genus, the model stores only the first term,
+which is zero unless m(w) > 0. It is saved as a sparse words x genera matrix
+in .npy files, which are memory-mapped when the model is loaded, so the
+processes classifying sequences in parallel share one copy of it.
+"""
+
+from json import dump, load
+from os import listdir
+from os.path import exists, join
+from string import strip
+from tempfile import mkdtemp
+from multiprocessing import Pool
+
+from numpy import (arange, argmax, array, concatenate, cumsum, empty, full,
+                   int32, int64, log, log1p, float32, frombuffer, ones,
+                   repeat, uint8, unique, zeros)
+from numpy import load as load_array, save as save_array
+from numpy.random import RandomState
+from scipy.sparse import coo_matrix, csr_matrix
+
+from skbio.parse.sequences import parse_fasta
+
+from qiime.util import create_dir, get_qiime_temp_dir
+from qiime.reference_db_cache import fasta_checksum, get_reference_db_cache
+
+DEFAULT_WORD_SIZE = 8
+DEFAULT_NUM_BOOTSTRAPS = 100
+# as in the RDP Classifier, bootstrap trials use an eighth of a query's words
+# (but at least MIN_WORDS), and queries with fewer than MIN_WORDS words are
+# not classified
+BOOTSTRAP_WORD_FRACTION = 8
+MIN_WORDS = 5
+
+_MODEL_INFO_FN = 'model.json'
+_MODEL_ARRAY_FNS = {'indptr': 'word_log_probs_indptr.npy',
+                    'indices': 'word_log_probs_indices.npy',
+                    'data': 'word_log_probs_data.npy'}
+_MODEL_FORMAT_VERSION = 1
+
+# base -> 2-bit code, with 4 for anything that isn't a base
+_BASE_CODES = full(256, 4, dtype=uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    for _base in _bases:
+        _BASE_CODES[ord(_base)] = _code
+
+
+def seq_to_words(seq, word_size=DEFAULT_WORD_SIZE):
+    """Return the overlapping words of seq as an array of word indices
+
+        Each word is encoded in 2 bits per base (A, C, G, T/U = 0-3), with
+         the first base most significant. Words containing anything other
+         than a base (e.g., N or gaps) are skipped.
+    """
+    codes = _BASE_CODES[frombuffer(str(seq), dtype=uint8)]
+    num_words = len(codes) - word_size + 1
+    if num_words <= 0:
+        return empty(0, dtype=int32)
+    # number of non-bases before each position
+    num_invalid = concatenate([[0], cumsum(codes == 4)])
+    valid = num_invalid[word_size:] == num_invalid[:num_words]
+    codes = codes.astype(int64) & 3
+    words = zeros(num_words, dtype=int64)
+    for i in range(word_size):
+        words <<= 2
+        words |= codes[i:i + num_words]
+    return words[valid].astype(int32)
+
+
+def _parse_id_to_lineage(id_to_taxonomy_f):
+    """Return dict of seq_id -> lineage (tuple of taxa) from id_to_taxonomy_f
+
+        Taxa are split on semicolons but otherwise left as they are, so
+         lineages are written out as they were read in.
+    """
+    result = {}
+    for line in id_to_taxonomy_f:
+        if not line.strip():
+            continue
+        seq_id, lineage_str = map(strip, line.split('\t'))
+        result[seq_id] = tuple(lineage_str.split(';'))
+    return result
+
+
+def train_naive_bayes_model(reference_seqs_fp, id_to_taxonomy_fp, output_dir,
+                            word_size=DEFAULT_WORD_SIZE):
+    """Train a model on the reference sequences and write it to output_dir
+
+        reference_seqs_fp: path to fasta file of training sequences
+        id_to_taxonomy_fp: path to tab-separated file of sequence id and
+         semicolon-separated lineage; only sequences listed in it are used
+        output_dir: directory to write the model to (created if it doesn't
+         exist)
+        word_size: length of the words used to classify sequences
+
+        Returns (output_dir, list of files written), like the bfillings
+         build_* functions.
+    """
+    if not 0 < word_size < 16:
+        raise ValueError("word_size must be between 1 and 15.")
+    id_to_lineage = _parse_id_to_lineage(open(id_to_taxonomy_fp, 'U'))
+
+    num_possible_words = 4 ** word_size
+    # number of training sequences containing each word
+    word_counts = zeros(num_possible_words, dtype=int64)
+    lineages = []
+    genus_indices = {}
+    # distinct words of each of a genus's training sequences
+    genus_words = []
+    for seq_id, seq in parse_fasta(open(reference_seqs_fp, 'U')):
+        lineage = id_to_lineage.get(seq_id.split()[0])
+        if lineage is None:
+            continue
+        try:
+            genus_index = genus_indices[lineage]
+        except KeyError:
+            genus_index = genus_indices[lineage] = len(lineages)
+            lineages.append(lineage)
+            genus_words.append([])
+        words = unique(seq_to_words(seq, word_size))
+        word_counts[words] += 1
+        genus_words[genus_index].append(words)
+
+    genus_sizes = array([len(seqs_words) for seqs_words in genus_words])
+    num_seqs = genus_sizes.sum()
+    if num_seqs == 0:
+        raise ValueError("None of the reference sequences in %s are listed "
+                         "in %s." % (reference_seqs_fp, id_to_taxonomy_fp))
+    word_priors = (word_counts + 0.5) / (num_seqs + 1)
+
+    # words x genera matrix of the number of sequences containing each word
+    rows = []
+    cols = []
+    counts = []
+    for genus_index, seqs_words in enumerate(genus_words):
+        words, word_genus_counts = unique(concatenate(seqs_words),
+                                          return_counts=True)
+        rows.append(words)
+        cols.append(full(len(words), genus_index, dtype=int32))
+        counts.append(word_genus_counts)
+    del genus_words
+    rows = concatenate(rows)
+    word_log_probs = coo_matrix(
+        (log1p(concatenate(counts) / word_priors[rows]).astype(float32),
+         (rows, concatenate(cols))),
+        shape=(num_possible_words, len(lineages))).tocsr()
+
+    create_dir(output_dir)
+    files = []
+    for name, fn in _MODEL_ARRAY_FNS.items():
+        fp = join(output_dir, fn)
+        save_array(fp, getattr(word_log_probs, name))
+        files.append(fp)
+    info_fp = join(output_dir, _MODEL_INFO_FN)
+    info_f = open(info_fp, 'w')
+    dump({'format_version': _MODEL_FORMAT_VERSION,
+          'word_size': word_size,
+          'lineages': lineages,
+          'genus_sizes': genus_sizes.tolist(),
+          'reference_seqs_md5': fasta_checksum(reference_seqs_fp),
+          'id_to_taxonomy_md5': fasta_checksum(id_to_taxonomy_fp)}, info_f)
+    info_f.close()
+    files.append(info_fp)
+    return output_dir, files
+
+
+def _load_model_info(model_dir):
+    info_fp = join(model_dir, _MODEL_INFO_FN)
+    if not exists(info_fp):
+        raise ValueError("%s doesn't contain a naive Bayes model." %
+                         model_dir)
+    info = load(open(info_fp, 'U'))
+    if info['format_version'] != _MODEL_FORMAT_VERSION:
+        raise ValueError("The model in %s was written by a different version "
+                         "of QIIME. Please retrain it." % model_dir)
+    return info
+
+
+class NaiveBayesModel(object):
+
+    """ A trained naive Bayes model, loaded from a directory
+
+        The word probabilities are memory-mapped, so loading a model is
+         cheap, and processes which load the same model share its memory.
+    """
+
+    def __init__(self, model_dir):
+        info = _load_model_info(model_dir)
+        self.word_size = info['word_size']
+        self.lineages = [tuple([taxon.encode('utf-8') for taxon in lineage])
+                         for lineage in info['lineages']]
+        arrays = dict([(name, load_array(join(model_dir, fn), mmap_mode='r'))
+                       for name, fn in _MODEL_ARRAY_FNS.items()])
+        self.word_log_probs = csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(4 ** self.word_size, len(self.lineages)), copy=False)
+        self.log_genus_sizes = log(array(info['genus_sizes']) + 1.0)
+
+        # genus x rank array of taxon indices, for comparing the genera picked
+        # by the bootstrap trials rank by rank; -1 past the end of a lineage
+        max_depth = max([len(lineage) for lineage in self.lineages])
+        self.genus_taxa = full((len(self.lineages), max_depth), -1,
+                               dtype=int64)
+        taxon_indices = {}
+        for genus_index, lineage in enumerate(self.lineages):
+            for depth in range(len(lineage)):
+                taxon = lineage[:depth + 1]
+                self.genus_taxa[genus_index, depth] = \
+                    taxon_indices.setdefault(taxon, len(taxon_indices))
+
+    def score(self, word_counts, num_words):
+        """ Return rows x genera array of log likelihoods, up to a constant
+
+            word_counts: sparse rows x possible words matrix of the number of
+             times each word is drawn in each row
+            num_words: array of the total number of words in each row
+        """
+        scores = word_counts.dot(self.word_log_probs).toarray()
+        scores -= num_words[:, None] * self.log_genus_sizes[None, :]
+        return scores
+
+    def classify(self, seqs, num_bootstraps=DEFAULT_NUM_BOOTSTRAPS, seed=0,
+                 start_index=0):
+        """ Return a (lineage, confidences) pair for each seq in seqs
+
+            confidences is the fraction of bootstrap trials that agree with
+             the lineage at each of its ranks. (None, None) is returned for
+             sequences with fewer than MIN_WORDS words.
+
+            The bootstrap trials of the i-th sequence (counting from
+             start_index) are drawn with RandomState([seed, i]), so a
+             sequence's result doesn't depend on how seqs are split up.
+        """
+        # classify as many sequences at a time as keeps the rows x genera
+        # array of scores at around 20 million entries
+        batch_size = max(1, 20000000 //
+                         ((num_bootstraps + 1) * len(self.lineages)))
+        results = []
+        for batch_start in range(0, len(seqs), batch_size):
+            results.extend(self._classify_batch(
+                seqs[batch_start:batch_start + batch_size], num_bootstraps,
+                seed, start_index + batch_start))
+        return results
+
+    def _classify_batch(self, seqs, num_bootstraps, seed, start_index):
+        num_rows = num_bootstraps + 1
+        rows = []
+        cols = []
+        num_words = []
+        classified = []
+        for i, seq in enumerate(seqs):
+            words = seq_to_words(seq, self.word_size)
+            n = len(words)
+            if n < MIN_WORDS:
+                continue
+            sample_size = max(n // BOOTSTRAP_WORD_FRACTION, MIN_WORDS)
+            samples = RandomState([seed, start_index + i]).randint(
+                0, n, (num_bootstraps, sample_size))
+            # row 0 is the whole sequence, and the rest are bootstrap trials
+            first_row = len(classified) * num_rows
+            rows.append(full(n, first_row, dtype=int64))
+            rows.append(repeat(arange(first_row + 1, first_row + num_rows),
+                               sample_size))
+            cols.append(words)
+            cols.append(words[samples.ravel()])
+            num_words.append(n)
+            num_words.extend([sample_size] * num_bootstraps)
+            classified.append(i)
+
+        results = [(None, None)] * len(seqs)
+        if not classified:
+            return results
+        rows = concatenate(rows)
+        word_counts = coo_matrix(
+            (ones(len(rows), dtype=float32), (rows, concatenate(cols))),
+            shape=(len(num_words), 4 ** self.word_size)).tocsr()
+        scores = self.score(word_counts, array(num_words, dtype=float32))
+        genera = argmax(scores, axis=1).reshape(len(classified), num_rows)
+        for i, seq_genera in zip(classified, genera):
+            genus = seq_genera[0]
+            lineage = self.lineages[genus]
+            depth = len(lineage)
+            agreements = (self.genus_taxa[seq_genera[1:], :depth] ==
+                          self.genus_taxa[genus, :depth])
+            results[i] = (lineage, agreements.mean(axis=0).tolist())
+        return results
+
+
+def truncate_lineage(lineage, confidences, min_confidence):
+    """ Return (lineage string, confidence) as reported by the RDP wrapper
+
+        The lineage is cut off at the first rank with confidence below
+         min_confidence, and the confidence of the last rank kept is
+         returned. ('Unclassified', 1.0) is returned if no rank is kept, and
+         ('Unassignable', 1.0) if the sequence was too short to classify.
+    """
+    if lineage is None:
+        return 'Unassignable', 1.0
+    kept = 0
+    for confidence in confidences:
+        if confidence < min_confidence:
+            break
+        kept += 1
+    if kept == 0:
+        return 'Unclassified', 1.0
+    return ';'.join(lineage[:kept]), confidences[kept - 1]
+
+
+def _init_classify_worker(model_dir):
+    global _worker_model
+    _worker_model = NaiveBayesModel(model_dir)
+
+
+def _classify_worker(args):
+    seqs, num_bootstraps, seed, start_index = args
+    return _worker_model.classify(seqs, num_bootstraps, seed, start_index)
+
+
+def classify_seqs(model_dir, seqs, num_bootstraps=DEFAULT_NUM_BOOTSTRAPS,
+                  seed=0, jobs_to_start=1, chunk_size=1000):
+    """ Classify seqs with the model in model_dir
+
+        seqs: list of sequences
+        jobs_to_start: number of processes to classify the sequences in, each
+         of which is given chunk_size sequences at a time
+
+        Returns a list of (lineage, confidences) pairs, as returned by
+         NaiveBayesModel.classify. The result doesn't depend on
+         jobs_to_start or chunk_size.
+    """
+    if jobs_to_start <= 1:
+        return NaiveBayesModel(model_dir).classify(seqs, num_bootstraps,
+                                                   seed)
+
+    # load the model now so a bad model_dir fails here, not in the workers
+    _load_model_info(model_dir)
+    pool = Pool(jobs_to_start, _init_classify_worker, (model_dir,))
+    try:
+        chunk_results = pool.map(
+            _classify_worker,
+            [(seqs[i:i + chunk_size], num_bootstraps, seed, i)
+             for i in range(0, len(seqs), chunk_size)])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return [result for results in chunk_results for result in results]
+
+
+def get_naive_bayes_model(reference_seqs_fp, id_to_taxonomy_fp,
+                          model_dir=None, word_size=DEFAULT_WORD_SIZE,
+                          qiime_config=None):
+    """ Return (model_dir, dirs to remove) for a model trained on the refs
+
+        If model_dir is passed, the model in it is used if it was trained on
+         these reference files (checked by their md5 checksums), and
+         otherwise a model is trained and written to it. Otherwise, the model
+         is taken from the reference database cache if one is configured
+         (see qiime.reference_db_cache), and trained in a temporary directory
+         (which the caller should remove) if not.
+    """
+    params = {'word_size': word_size,
+              'id_to_taxonomy_md5': fasta_checksum(id_to_taxonomy_fp)}
+
+    if model_dir is not None:
+        if exists(model_dir) and _MODEL_INFO_FN in listdir(model_dir):
+            info = _load_model_info(model_dir)
+            if (info['word_size'] != word_size or
+                    info['id_to_taxonomy_md5'] !=
+                    params['id_to_taxonomy_md5'] or
+                    info['reference_seqs_md5'] !=
+                    fasta_checksum(reference_seqs_fp)):
+                raise ValueError(
+                    "The model in %s was not trained on %s and %s with a word "
+                    "size of %d. Pass a different directory to train a new "
+                    "model." % (model_dir, reference_seqs_fp,
+                                id_to_taxonomy_fp, word_size))
+        else:
+            train_naive_bayes_model(reference_seqs_fp, id_to_taxonomy_fp,
+                                    model_dir, word_size)
+        return model_dir, []
+
+    def build_model(fasta_fp, output_dir):
+        return train_naive_bayes_model(fasta_fp, id_to_taxonomy_fp,
+                                       output_dir, word_size)
+
+    cache = get_reference_db_cache(qiime_config)
+    if cache is not None:
+        return cache.get('naive_bayes', reference_seqs_fp, build_model,
+                         params), []
+
+    model_dir = mkdtemp(dir=get_qiime_temp_dir(), prefix='naive_bayes_')
+    build_model(reference_seqs_fp, model_dir)
+    return model_dir, [model_dir]
@@ -9,9 +9,8 @@ __version__ = "1.8.0-dev"
 __maintainer__ = "Jai Ram Rideout"
 __email__ = "jai.rideout@gmail.com"
 
-from bfillings.formatdb import build_blast_db_from_fasta_path
-
 from qiime.parallel.util import ParallelWrapper
+from qiime.reference_db_cache import get_blast_db
 
 
 class ParallelTaxonomyAssigner(ParallelWrapper):
@@ -138,7 +137,8 @@ class ParallelBlastTaxonomyAssigner(ParallelTaxonomyAssigner):
             # Build the blast database from the reference_seqs_fp -- all procs
             # will then access one db rather than create one per proc.
             blast_db, db_files_to_remove = \
-                build_blast_db_from_fasta_path(params['reference_seqs_fp'])
+                get_blast_db(params['reference_seqs_fp'],
+                             use_cache=self._waits_for_jobs())
             self.files_to_remove += db_files_to_remove
             params['blast_db'] = blast_db
 
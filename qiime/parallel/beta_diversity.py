@@ -16,12 +16,15 @@ from biom import load_table
 
 from qiime.parallel.util import ParallelWrapper
 from qiime.format import format_distance_matrix
+from qiime.beta_diversity import load_distance_matrix_rows
 
 
 class ParallelBetaDiversity(ParallelWrapper):
     _script_name = "beta_diversity.py"
     _input_splitter = ParallelWrapper._input_existing_filepaths
     _job_prefix = 'BDIV'
+    _process_run_results_f = \
+        'qiime.parallel.beta_diversity.parallel_beta_diversity_process_run_results_f'
 
     def _identify_files_to_remove(self, job_result_filepaths, params):
         """ The output of the individual jobs are the files we want to keep
@@ -54,9 +57,10 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
         merge_map_f = open(merge_map_filepath, 'w')
 
         for metric in params['metrics'].split(','):
+            # the _ids.txt file of each .npy file is found from its path
             fps_to_merge = [
                 fp for fp in job_result_filepaths if '/%s_' %
-                metric in fp]
+                metric in fp and fp.endswith('.npy')]
             output_fp = join(
                 output_dir, '%s_%s.txt' %
                 (metric, input_file_basename))
@@ -114,14 +118,18 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
             input_dir, input_fn = split(input_fp)
             input_basename, input_ext = splitext(input_fn)
             sample_id_desc = sample_id_group.replace(',', '_')
-            output_fns = ['%s_%s.txt' % (metric, input_basename)
-                          for metric in metrics.split(',')]
+            # each job writes its rows in binary format (see
+            # qiime.beta_diversity.write_distance_matrix_rows)
+            output_fns = []
+            for metric in metrics.split(','):
+                output_fns.append('%s_%s.npy' % (metric, input_basename))
+                output_fns.append('%s_%s_ids.txt' % (metric, input_basename))
             rename_command, current_result_filepaths = self._get_rename_command(
                 output_fns, working_dir_i, output_dir_i)
 
             result_filepaths += current_result_filepaths
 
-            bdiv_command = '%s -i %s -o %s %s -m %s %s -r %s' %\
+            bdiv_command = '%s -i %s -o %s %s -m %s %s -b -r %s' %\
                 (self._script_name,
                  input_fp,
                  working_dir_i,
@@ -157,7 +165,7 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
              merge_map_filepath,
              deletion_list_filepath,
              self._seconds_to_sleep,
-             'qiime.parallel.beta_diversity.parallel_beta_diversity_process_run_results_f',
+             self._process_run_results_f,
              command_suffix)
 
         return result, []
@@ -230,21 +238,65 @@ def parallel_beta_diversity_process_run_results_f(f):
         fields = line.strip().split('\t')
         dm_components = fields[:-1]
         output_fp = fields[-1]
-        # assemble the current dm
-        dm = assemble_distance_matrix(map(open, dm_components))
-        # and write it to file
         output_f = open(output_fp, 'w')
-        output_f.write(dm)
+        if all([c.endswith('.npy') for c in dm_components]):
+            write_distance_matrix_from_rows(dm_components, output_f)
+        else:
+            # assemble the current dm from text components
+            output_f.write(assemble_distance_matrix(map(open,
+                                                        dm_components)))
         output_f.close()
 
     return True
 
 
+def write_distance_matrix_from_rows(rows_fps, output_f):
+    """ write the distance matrix assembled from binary row components
+
+        rows_fps: paths of .npy files written by
+         qiime.beta_diversity.write_distance_matrix_rows, which together
+         contain every row of the distance matrix
+        output_f: file-like object the tab-delimited distance matrix is
+         written to
+
+        The components are memory-mapped and the matrix is written one row
+         at a time, in the order of the column sample ids, so the full matrix
+         is never held in memory. The output is the same as
+         format_distance_matrix would produce.
+    """
+    labels = None
+    # map each sample id to its rows array and the index of its row
+    row_locations = {}
+    for rows_fp in rows_fps:
+        row_ids, col_ids, rows = load_distance_matrix_rows(rows_fp)
+        if labels is None:
+            labels = col_ids
+        elif col_ids != labels:
+            raise ValueError("Distance matrix components have different "
+                             "column sample ids: %s" % rows_fp)
+        for i, row_id in enumerate(row_ids):
+            row_locations[row_id] = (rows, i)
+    if labels is None:
+        raise ValueError("No distance matrix components to assemble.")
+
+    missing_ids = set(labels) - set(row_locations)
+    if missing_ids:
+        raise ValueError("Distance matrix components are missing rows for "
+                         "sample ids: %s" % ', '.join(sorted(missing_ids)))
+
+    output_f.write('\t'.join([''] + labels))
+    for label in labels:
+        rows, i = row_locations[label]
+        output_f.write('\n')
+        # repr of a python float is the same as str of a numpy float64, and
+        # much faster to compute
+        output_f.write('\t'.join([label] + map(repr, rows[i].tolist())))
+
+
 def assemble_distance_matrix(dm_components):
     """ assemble distance matrix components into a complete dm string
 
     """
-    print "I get called."
     data = {}
     # iterate over compenents
     for c in dm_components:
@@ -11,9 +11,8 @@ __email__ = "jai.rideout@gmail.com"
 
 from os.path import split, splitext
 
-from bfillings.formatdb import build_blast_db_from_fasta_path
-
 from qiime.util import load_qiime_config, get_options_lookup
+from qiime.reference_db_cache import get_blast_db
 from qiime.parallel.util import ParallelWrapper
 
 
@@ -28,7 +27,8 @@ class ParallelBlaster(ParallelWrapper):
             # Build the blast database from the refseqs_path -- all procs
             # will then access one db rather than create one per proc.
             blast_db, db_files_to_remove = \
-                build_blast_db_from_fasta_path(params['refseqs_path'])
+                get_blast_db(params['refseqs_path'],
+                             use_cache=self._waits_for_jobs())
             self.files_to_remove += db_files_to_remove
             params['blast_db'] = blast_db
 
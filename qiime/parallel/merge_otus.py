@@ -2,10 +2,16 @@
 
 from os.path import basename, join
 from time import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import Pool
+from traceback import format_exc
 from cogent.core.tree import TreeNode
+from biom import load_table
 from os import system
 import os
 
+from qiime.util import write_biom_table
+
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2013, The QIIME Project"
 __credits__ = ["Daniel McDonald", "Greg Caporaso", "Jai Ram Rideout"]
@@ -141,13 +147,6 @@ def torque_job(cmd, pollpath, name, queue):
     return to_submit
 
 
-def local_job(cmd, pollpath, name, queue):
-    """make a local job"""
-    to_submit = '%s; echo $? > %s' % (cmd, pollpath)
-
-    return to_submit
-
-
 def start_job(node, merge_otus_fp, queue, wrap_call=torque_job, submit=True):
     """Starts a process"""
     strfmt = {'MergeOTUs': merge_otus_fp,
@@ -163,3 +162,126 @@ def start_job(node, merge_otus_fp, queue, wrap_call=torque_job, submit=True):
 
     node.FullCommand = wrapped
     node.StartTime = time()
+
+
+def merge_tables_job(name, input_fps, output_fp):
+    """Merge the tables in input_fps and write the result to output_fp
+
+    Returns (name, error, run_time), where error is None if the merge
+    succeeded and the formatted traceback otherwise, and run_time is the wall
+    time of the merge in seconds. This is a module-level function so it can be
+    passed to a multiprocessing pool.
+    """
+    start_time = time()
+    try:
+        master = load_table(input_fps[0])
+        for input_fp in input_fps[1:]:
+            master = master.merge(load_table(input_fp))
+        write_biom_table(master, output_fp)
+    except Exception:
+        return name, format_exc(), time() - start_time
+    return name, None, time() - start_time
+
+
+class MergePool(Pool):
+
+    """A process pool that keeps a list of every worker process it starts
+
+    The workers only exit when the pool is closed, so a worker in this list
+    with an exitcode while merges are running has died.
+    """
+
+    def __init__(self, processes=None):
+        self.workers = []
+        Pool.__init__(self, processes)
+
+    def Process(self, *args, **kwargs):
+        worker = Pool.Process(*args, **kwargs)
+        self.workers.append(worker)
+        return worker
+
+
+def run_merge_tree(tree, jobs_to_start=1, log_f=None, verbose=False):
+    """Merge the tables of a merge tree in a local process pool
+
+    tree : the merge tree, as returned by mergeorder
+    jobs_to_start : number of worker processes to merge tables in
+    log_f : optional file-like object the start and run time of each merge
+        are written to
+
+    Each internal node is merged in the pool as soon as both of its children
+    are available, and the intermediate tables are written to the nodes'
+    FilePaths. Unlike start_job, nothing is run through the shell and there
+    are no poll files to wait on: the StartTime, EndTime, TotalTime and
+    Processed attributes of each node are set as the pool reports that its
+    merge is done. A JobError is raised if any merge fails, or if a worker
+    process dies (in which case the pool would never report its merge).
+    """
+    def log(msg):
+        if log_f is not None:
+            log_f.write(msg)
+            log_f.write('\n')
+            log_f.flush()
+        if verbose:
+            print msg
+
+    def is_ready(node):
+        return all([c.istip() or c.Processed for c in node.Children])
+
+    internal_nodes = dict((n.Name, n) for n in tree.nontips(include_self=True))
+    running = {}
+    pool = MergePool(processes=min(jobs_to_start, len(internal_nodes)))
+
+    def start(node):
+        input_fps = [c.FilePath for c in node.Children]
+        node.FullCommand = "merge_otu_tables.py -i %s -o %s" % \
+            (','.join(input_fps), node.FilePath)
+        node.StartTime = time()
+        log(node.FullCommand)
+        running[node.Name] = pool.apply_async(
+            merge_tables_job, (node.Name, input_fps, node.FilePath))
+
+    try:
+        for node in internal_nodes.values():
+            if is_ready(node):
+                start(node)
+
+        while running:
+            # prefer a merge that has already finished, otherwise wait on any
+            # of them
+            name, result = min(running.items(),
+                               key=lambda item: not item[1].ready())
+            try:
+                # waiting with a timeout keeps the wait interruptible, and
+                # lets dead workers be noticed
+                name, error, run_time = result.get(1)
+            except TimeoutError:
+                if any([w.exitcode is not None for w in pool.workers]):
+                    raise JobError("A merge worker process died while "
+                                   "running node(s): %s" %
+                                   ', '.join(sorted(running)))
+                continue
+            except Exception as e:
+                # a job can only fail outside of merge_tables_job (e.g., if
+                # its arguments can't be sent to the worker)
+                error = str(e)
+            del running[name]
+            node = internal_nodes[name]
+            if error is not None:
+                raise JobError("Node %s did not complete correctly!\n%s" %
+                               (name, error))
+            node.EndTime = time()
+            node.TotalTime = run_time
+            node.ExitStatus = '0'
+            node.Processed = True
+            log("Node %s completed in %f seconds" % (name, run_time))
+
+            parent = node.Parent
+            if parent is not None and is_ready(parent):
+                start(parent)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
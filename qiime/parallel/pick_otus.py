@@ -11,16 +11,17 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 from math import ceil
-from os.path import basename, join
+from os.path import basename, join, split
 from os import mkdir
 from re import compile
 
-from bfillings.formatdb import build_blast_db_from_fasta_path
-from bfillings.sortmerna_v2 import build_database_sortmerna
+from numpy import array, dot, zeros
+from numpy.linalg import lstsq
 
 from skbio.parse.sequences import parse_fasta
 
-from qiime.parallel.util import ParallelWrapper, BufferedWriter
+from qiime.reference_db_cache import get_blast_db, get_sortmerna_db
+from qiime.parallel.util import ParallelWrapper, ShardedWriter
 from qiime.parallel.poller import basic_process_run_results_f
 
 
@@ -111,9 +112,10 @@ class ParallelPickOtusSortMeRNA(ParallelPickOtus):
         if not params['sortmerna_db']:
             # Build the sortmerna database from the reference_seqs_fp
             sortmerna_db, db_files_to_remove = \
-                build_database_sortmerna(params['refseqs_fp'],
-                                         max_pos=params['sortmerna_max_pos'],
-                                         output_dir=working_dir)
+                get_sortmerna_db(params['refseqs_fp'],
+                                 max_pos=params['sortmerna_max_pos'],
+                                 output_dir=working_dir,
+                                 use_cache=self._waits_for_jobs())
             self.files_to_remove += db_files_to_remove
             params['sortmerna_db'] = sortmerna_db
 
@@ -336,7 +338,8 @@ class ParallelPickOtusBlast(ParallelPickOtus):
             # Build the blast database from the reference_seqs_fp -- all procs
             # will then access one db rather than create one per proc
             blast_db, db_files_to_remove = \
-                build_blast_db_from_fasta_path(params['refseqs_fp'])
+                get_blast_db(params['refseqs_fp'],
+                             use_cache=self._waits_for_jobs())
             self.files_to_remove += db_files_to_remove
             params['blast_db'] = blast_db
 
@@ -457,6 +460,20 @@ class ParallelPickOtusTrie(ParallelPickOtus):
     _process_run_results_f =\
         'qiime.parallel.pick_otus.parallel_pick_otus_trie_process_run_results_f'
 
+    def __init__(self, cost_model=None, **kwargs):
+        """
+        cost_model: function of (number of sequences, number of bases) that
+         estimates the run time of a set of sequences, used to distribute the
+         prefixes over the jobs (default: LinearCostModel(), i.e., the number
+         of bases)
+
+        All other arguments are passed to ParallelWrapper.
+        """
+        super(ParallelPickOtusTrie, self).__init__(**kwargs)
+        if cost_model is None:
+            cost_model = LinearCostModel()
+        self._cost_model = cost_model
+
     def _call_initialization(self,
                              input_fp,
                              output_dir,
@@ -467,6 +484,8 @@ class ParallelPickOtusTrie(ParallelPickOtus):
         """ Called as the first step in __call__.
         """
         self.prefix_counts = {}
+        self.prefix_lengths = {}
+        self.job_sizes = []
 
     def _split_along_prefix(self,
                             input_fp,
@@ -476,7 +495,8 @@ class ParallelPickOtusTrie(ParallelPickOtus):
                             output_dir):
         """ Split input sequences into sets with identical prefix"""
         out_files = []
-        buffered_handles = {}
+        out_fps = {}
+        writer = ShardedWriter()
         prefix_length = params['prefix_length'] or 1
         for seq_id, seq in parse_fasta(open(input_fp)):
 
@@ -485,19 +505,20 @@ class ParallelPickOtusTrie(ParallelPickOtus):
                                  + " Found seq %s with length %d" % (seq_id, len(seq)))
             prefix = seq[:prefix_length]
 
-            if (prefix not in buffered_handles):
+            if (prefix not in out_fps):
                 # never seen this prefix before
                 out_fp = "%s/%s%s" % (output_dir, job_prefix, prefix)
-                buffered_handles[prefix] = BufferedWriter(out_fp)
+                out_fps[prefix] = out_fp
                 out_files.append(out_fp)
                 self.prefix_counts[prefix] = 0
+                self.prefix_lengths[prefix] = 0
 
             self.prefix_counts[prefix] += 1
-            buffered_handles[prefix].write('>%s\n%s\n' % (seq_id, seq))
+            self.prefix_lengths[prefix] += len(seq)
+            writer.write(out_fps[prefix], '>%s\n%s\n' % (seq_id, seq))
 
-        # make sure all buffers are closed and flushed
-        for buf_fh in buffered_handles.itervalues():
-            buf_fh.close()
+        # make sure all buffers are flushed and files closed
+        writer.close()
 
         remove_files = True
         return out_files, remove_files
@@ -558,8 +579,9 @@ class ParallelPickOtusTrie(ParallelPickOtus):
                              command_suffix=None):
         """ merge a list of commands into n commands
 
-        Uses the size of each jobs to estimate an even distribution
-        of commands ofver the n jobs.
+        Uses the estimated cost (see cost_model) of each job to find an even
+        distribution of commands over the n jobs. The number of sequences and
+        bases in each of the merged jobs is stored in job_sizes.
 
         commands: dict of commands keyed by prefix
 
@@ -568,8 +590,15 @@ class ParallelPickOtusTrie(ParallelPickOtus):
         if n < 1:
             raise ValueError("number of commands (n) must be an integer >= 1")
 
-        # Distribute jobs according to their load
-        grouped_prefixe, levels = greedy_partition(self.prefix_counts, n)
+        # Distribute jobs according to their estimated load
+        costs = dict((prefix, self._cost_model(self.prefix_counts[prefix],
+                                               self.prefix_lengths[prefix]))
+                     for prefix in self.prefix_counts)
+        grouped_prefixe, levels = greedy_partition(costs, n)
+        self.job_sizes = [
+            (sum([self.prefix_counts[prefix] for prefix in bucket]),
+             sum([self.prefix_lengths[prefix] for prefix in bucket]))
+            for bucket in grouped_prefixe]
 
         # TODO: remove after profiling or maybe move to log file
 #       print levels
@@ -595,6 +624,94 @@ class ParallelPickOtusTrie(ParallelPickOtus):
 
         return result
 
+    def _write_job_timings(self, job_timings_fp):
+        """ Write the job timings, and the size and run time of each job
+
+            The sizes and run times are written to job_costs.txt, in the same
+             directory as job_timings_fp, which can be passed to
+             fit_cost_model to estimate the costs of later runs.
+        """
+        super(ParallelPickOtusTrie, self)._write_job_timings(job_timings_fp)
+        f = open(join(split(job_timings_fp)[0], 'job_costs.txt'), 'w')
+        f.write('#job\tnum_seqs\tnum_bases\tseconds\n')
+        for i, ((num_seqs, num_bases), (command, run_time)) in \
+                enumerate(zip(self.job_sizes, self.job_timings)):
+            f.write('%d\t%d\t%d\t%1.3f\n' % (i, num_seqs, num_bases,
+                                                run_time))
+        f.close()
+
+
+class LinearCostModel(object):
+
+    """ Estimate the run time of a job from the sequences it processes
+
+        The cost of a set of sequences is modeled as
+         per_seq * num_seqs + per_base * num_bases. The default model (0, 1)
+         just counts bases; use fit (or fit_cost_model) to estimate the
+         coefficients from the run times of previous jobs.
+    """
+
+    def __init__(self, per_seq=0.0, per_base=1.0):
+        self.per_seq = per_seq
+        self.per_base = per_base
+
+    def __call__(self, num_seqs, num_bases):
+        return self.per_seq * num_seqs + self.per_base * num_bases
+
+    @classmethod
+    def fit(cls, job_sizes, run_times):
+        """ Fit a model to the run times of previous jobs
+
+            job_sizes: list of (num_seqs, num_bases) pairs, one per job
+            run_times: run time of each job
+
+            The coefficients are fit by least squares, and are constrained to
+             be non-negative. If the run times carry no information (e.g.,
+             they are all zero) the default model is returned.
+        """
+        sizes = array(job_sizes, dtype=float).reshape(-1, 2)
+        times = array(run_times, dtype=float)
+        if len(sizes) != len(times) or len(times) == 0:
+            raise ValueError("Need one run time for each of at least one "
+                             "job size.")
+        coefs = lstsq(sizes, times, rcond=-1)[0]
+        if (coefs < 0).any():
+            # the best fit with a negative coefficient has that coefficient
+            # at zero, so keep the better of the two single-term fits
+            best_error = None
+            for i in range(2):
+                x = sizes[:, i]
+                single_coefs = zeros(2)
+                if dot(x, x) > 0:
+                    single_coefs[i] = max(dot(x, times) / dot(x, x), 0.0)
+                error = ((dot(sizes, single_coefs) - times) ** 2).sum()
+                if best_error is None or error < best_error:
+                    best_error, coefs = error, single_coefs
+        if not coefs.any():
+            return cls()
+        return cls(coefs[0], coefs[1])
+
+
+def fit_cost_model(job_costs_f):
+    """ Fit a LinearCostModel to the job_costs.txt file of a previous run
+
+        job_costs_f: lines of a job_costs.txt file, as written by
+         ParallelPickOtusTrie when temporary files are retained; jobs that
+         processed no sequences are ignored
+    """
+    job_sizes = []
+    run_times = []
+    for line in job_costs_f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        num_seqs, num_bases = int(fields[1]), int(fields[2])
+        if num_seqs > 0:
+            job_sizes.append((num_seqs, num_bases))
+            run_times.append(float(fields[3]))
+    return LinearCostModel.fit(job_sizes, run_times)
+
 
 def parallel_pick_otus_trie_process_run_results_f(f):
     """ Copy each list of infiles to each outfile and delete infiles
@@ -655,7 +772,8 @@ def parallel_pick_otus_trie_process_run_results_f(f):
 def greedy_partition(counts, n):
     """Distribute k counts evenly across n buckets,
 
-    counts: dict of key, counts pairs
+    counts: dict of key, counts pairs (the counts can be any estimate of the
+     cost of each key, e.g. from a LinearCostModel)
     n: number of buckets that the counts should be distributed over
     """
 
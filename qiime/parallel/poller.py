@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from time import sleep
+from time import sleep, time
 from optparse import OptionParser
-from os import getenv, remove
-from os.path import exists, isdir
+from os import getenv, remove, read, close
+from os.path import exists, isdir, split, join, abspath
 from shutil import rmtree
-from skbio.util import remove_files
-from qiime.parse import parse_tmp_to_final_filepath_map_file
+from select import select
+from struct import calcsize, unpack_from
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
 
 __author__ = "Greg Caporaso"
 __copyright__ = "Copyright 2011, The QIIME Project"
@@ -74,6 +76,7 @@ def basic_process_run_results_f(f):
          concatenate f1.txt, f2.txt, and f3.txt into f_combined.txt
          and f1.log, f2.log, and f3.log into f_combined.log
     """
+    from qiime.parse import parse_tmp_to_final_filepath_map_file
     infiles_lists, out_filepaths = parse_tmp_to_final_filepath_map_file(f)
     for infiles_list, out_filepath in zip(infiles_lists, out_filepaths):
         try:
@@ -148,6 +151,7 @@ def verbose_process_run_results_f(f):
          concatenate f1.txt, f2.txt, and f3.txt into f_combined.txt
          and f1.log, f2.log, and f3.log into f_combined.log
     """
+    from qiime.parse import parse_tmp_to_final_filepath_map_file
     infiles_lists, out_filepaths = parse_tmp_to_final_filepath_map_file(f)
     for infiles_list, out_filepath in zip(infiles_lists, out_filepaths):
         try:
@@ -218,3 +222,203 @@ def poller(check_run_complete_f,
     clean_up_f(clean_up_file)
     est_per_proc_run_time = number_of_loops * seconds_to_sleep
     return est_per_proc_run_time
+
+
+# inotify event masks (see inotify(7)). A job's output file is complete when
+# it is renamed into place (IN_MOVED_TO) or when a process that was writing
+# it directly closes it (IN_CLOSE_WRITE).
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT_HEADER = 'iIII'
+INOTIFY_EVENT_HEADER_SIZE = calcsize(INOTIFY_EVENT_HEADER)
+
+
+class Inotify(object):
+
+    """ Minimal ctypes wrapper around the Linux inotify API
+
+        Raises OSError on construction if inotify is not available (e.g., on
+         non-Linux systems), so callers can fall back to polling.
+    """
+
+    def __init__(self):
+        libc_fp = find_library('c')
+        if libc_fp is None:
+            raise OSError("Can't find the C library.")
+        self._libc = CDLL(libc_fp, use_errno=True)
+        try:
+            self._libc.inotify_init
+        except AttributeError:
+            raise OSError("inotify is not supported on this system.")
+        self.fd = self._libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(get_errno(), "Can't initialize inotify.")
+        self._watched_dirs = {}
+
+    def add_watch(self, dir_path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        """ Watch dir_path for events in mask """
+        wd = self._libc.inotify_add_watch(self.fd, dir_path, mask)
+        if wd < 0:
+            raise OSError(get_errno(), "Can't watch directory: %s" % dir_path)
+        self._watched_dirs[wd] = dir_path
+
+    def read_events(self, timeout):
+        """ Return paths of the files with events, waiting at most timeout s
+
+            An empty list is returned if no events occured in timeout seconds.
+        """
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        buf = read(self.fd, 65536)
+        result = []
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, name_len = \
+                unpack_from(INOTIFY_EVENT_HEADER, buf, i)
+            i += INOTIFY_EVENT_HEADER_SIZE
+            name = buf[i:i + name_len].rstrip('\0')
+            i += name_len
+            if wd in self._watched_dirs and name:
+                result.append(join(self._watched_dirs[wd], name))
+        return result
+
+    def close(self):
+        close(self.fd)
+
+
+class CompletionWatcher(object):
+
+    """ Wait for a collection of expected output files to be created
+
+        Only files which are still pending are checked, and each one is
+         removed from the pending set as soon as it is found, so the cost of
+         a check falls as jobs finish. The time at which each file was found
+         (in seconds since the watcher was created) is recorded in
+         completion_times, which can be used to identify straggling jobs.
+
+        If use_inotify is True (the default is to use it where available),
+         the directories containing the expected files are watched with
+         inotify and each file is found the moment it is renamed into place.
+         seconds_to_sleep is then only the interval between safety re-checks
+         of the pending files (e.g., for writes made on other hosts of a
+         network filesystem, which inotify does not report). Otherwise the
+         pending files are checked every seconds_to_sleep seconds.
+    """
+
+    def __init__(self, filepaths, seconds_to_sleep, use_inotify=None):
+        self._start_time = time()
+        self._seconds_to_sleep = seconds_to_sleep
+        self.filepaths = [abspath(fp) for fp in filepaths]
+        self.pending = set(self.filepaths)
+        self.completion_times = {}
+        self._inotify = None
+
+        if use_inotify is None or use_inotify:
+            try:
+                self._inotify = self._init_inotify()
+            except OSError:
+                if use_inotify:
+                    raise
+        # catch any files that were created before we started watching
+        self.check_pending()
+
+    def _init_inotify(self):
+        inotify = Inotify()
+        try:
+            for dir_path in set([split(fp)[0] for fp in self.pending]):
+                inotify.add_watch(dir_path)
+        except OSError:
+            inotify.close()
+            raise
+        return inotify
+
+    def _mark_complete(self, fp):
+        self.pending.discard(fp)
+        self.completion_times[fp] = time() - self._start_time
+
+    def check_pending(self):
+        """ Check each pending file, returning True if none are pending """
+        for fp in list(self.pending):
+            if exists(fp):
+                self._mark_complete(fp)
+        return not self.pending
+
+    def wait(self):
+        """ Block until all of the expected files exist
+
+            Returns the number of times the watcher woke up to check for
+             completed files.
+        """
+        number_of_loops = 0
+        try:
+            while self.pending:
+                if self._inotify is None:
+                    sleep(self._seconds_to_sleep)
+                    self.check_pending()
+                else:
+                    fps = self._inotify.read_events(self._seconds_to_sleep)
+                    if fps:
+                        for fp in fps:
+                            if fp in self.pending:
+                                self._mark_complete(fp)
+                    else:
+                        self.check_pending()
+                number_of_loops += 1
+        finally:
+            self.close()
+        return number_of_loops
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def format_completion_times(self):
+        """ Return lines of filepath<tab>seconds, in order of completion """
+        result = ['#filepath\tseconds to completion']
+        for fp, t in sorted(self.completion_times.items(),
+                            key=lambda e: (e[1], e[0])):
+            result.append('%s\t%1.3f' % (fp, t))
+        return result
+
+
+def watching_poller(check_run_complete_file,
+                    process_run_results_f,
+                    clean_up_f,
+                    process_run_results_file,
+                    clean_up_file,
+                    seconds_to_sleep,
+                    completion_times_f=None,
+                    use_inotify=None):
+    """ Waits for completion of job(s) and then processes/cleans up results
+
+        This is an event-driven alternative to poller for the common case
+         where a run is complete when all of the filepaths listed in
+         check_run_complete_file exist (i.e., basic_check_run_complete_f).
+
+        check_run_complete_file: file containing list of filepaths which
+         must exist for the run to be complete
+        process_run_results_f: function applied to process the results
+         of the job(s)
+        clean_up_f: function applied to clean up after the job(s) -- run
+         after process_run_results_f
+        process_run_results_file: file passed to process_run_results_f
+        clean_up_file: file passed to clean_up_f
+        seconds_to_sleep: number of seconds between checks for completed
+         files (only used as a safety interval if inotify is in use)
+        completion_times_f: if provided, an open file to which the time
+         each expected file was detected is written
+        use_inotify: passed to CompletionWatcher
+
+    """
+    filepaths = [l.strip() for l in check_run_complete_file if l.strip()]
+    watcher = CompletionWatcher(filepaths,
+                                seconds_to_sleep,
+                                use_inotify=use_inotify)
+    watcher.wait()
+    if completion_times_f is not None:
+        completion_times_f.write('\n'.join(watcher.format_completion_times()))
+        completion_times_f.write('\n')
+    process_run_results_f(process_run_results_file)
+    clean_up_f(clean_up_file)
+    return watcher.completion_times
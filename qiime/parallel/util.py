@@ -11,34 +11,234 @@ __version__ = "1.8.0-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
+import sys
 from math import ceil
-from os.path import split, splitext, join
+from os.path import split, splitext, join, exists
 from os import makedirs, mkdir
 from random import choice
-from skbio.parse.sequences import parse_fasta
-from qiime.split import split_fasta
+from shlex import split as shell_split
+from StringIO import StringIO
+from time import time
+from traceback import format_exc
+from types import ModuleType
+from collections import OrderedDict
+from distutils.spawn import find_executable
+from multiprocessing import Process
+from multiprocessing.pool import Pool
 from qiime.util import load_qiime_config, qiime_system_call, count_seqs
-
-qiime_config = load_qiime_config()
+from qiime.parallel.poller import get_function_handle, basic_clean_up_f
 
 RANDOM_JOB_PREFIX_CHARS = "abcdefghigklmnopqrstuvwxyz"
 RANDOM_JOB_PREFIX_CHARS += RANDOM_JOB_PREFIX_CHARS.upper()
 RANDOM_JOB_PREFIX_CHARS += "0123456790"
 
+# The values of the parallel_executor qiime_config variable. 'cluster_jobs'
+# submits the jobs with cluster_jobs_fp and waits on them with poller.py,
+# 'multiprocessing' runs them in a JobPool owned by the current process,
+# calling the main function of QIIME scripts in the pool's workers (see
+# run_job_command).
+PARALLEL_EXECUTORS = ['cluster_jobs', 'multiprocessing']
+
+# Subcommands that the parallel wrappers use to wrap each job command, but
+# which must not be run when the command is handed directly to a shell (see
+# write_job_files in start_parallel_jobs.py).
+IGNORED_SUBCOMMANDS = {}.fromkeys(['/bin/bash', 'exit'])
+
+
+def strip_job_command(command):
+    """ Remove the /bin/bash and exit subcommands wrapping a job command
+    """
+    return ';'.join([subcommand for subcommand in command.split(';')
+                     if subcommand.strip() not in IGNORED_SUBCOMMANDS])
+
+
+# Subcommands containing these are always run in a shell
+SHELL_METACHARACTERS = set('<>|&$`*?(){}')
+
+
+def get_python_script_fp(argv):
+    """ Return the filepath of the python script run by argv, or None
+
+        argv[0] is looked up as a filepath and then on the PATH, and is a
+         python script if its first line is a python shebang line.
+    """
+    script_fp = argv[0]
+    if not exists(script_fp):
+        script_fp = find_executable(script_fp)
+    if script_fp is None or not script_fp.endswith('.py'):
+        return None
+    first_line = open(script_fp, 'U').readline()
+    if not (first_line.startswith('#!') and 'python' in first_line):
+        return None
+    return script_fp
+
+
+def run_python_script(script_fp, argv):
+    """ Run the main function of the script at script_fp in this process
+
+        sys.argv is set to argv while it runs, and what it writes to
+         sys.stdout and sys.stderr is captured. Returns (stdout, stderr,
+         return_value), where return_value is the script's exit status, or 1
+         if it raised an exception (whose traceback is added to stderr).
+
+        The script's top level is run again on each call, but the modules it
+         imports, such as QIIME's own, are only imported once per process, and
+         any other changes it makes to the process (e.g., to the working
+         directory) are kept. Jobs are therefore run in a JobPool, in which
+         every job gets a new worker process. The script is importable as
+         _qiime_parallel_job_script while it runs, so that the functions it
+         defines can be passed to a process pool of its own.
+    """
+    script = ModuleType('_qiime_parallel_job_script')
+    script.__file__ = script_fp
+    sys.modules[script.__name__] = script
+    original_argv = sys.argv
+    original_stdout = sys.stdout
+    original_stderr = sys.stderr
+    sys.argv = list(argv)
+    sys.stdout = StringIO()
+    sys.stderr = StringIO()
+    try:
+        try:
+            exec compile(open(script_fp, 'U').read(), script_fp, 'exec',
+                         0, True) in script.__dict__
+            script.main()
+            return_value = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return_value = e.code or 0
+            else:
+                # sys.exit(message) prints message and exits with status 1
+                sys.stderr.write('%s\n' % e.code)
+                return_value = 1
+        except Exception:
+            sys.stderr.write(format_exc())
+            return_value = 1
+        return sys.stdout.getvalue(), sys.stderr.getvalue(), return_value
+    finally:
+        del sys.modules[script.__name__]
+        sys.argv = original_argv
+        sys.stdout = original_stdout
+        sys.stderr = original_stderr
+
+
+def run_job_command(command):
+    """ Run a single job command
+
+        Subcommands which run a python script (e.g., a QIIME script) are run
+         by calling the script's main function in this process with
+         run_python_script, so a job doesn't start a new python interpreter
+         and import QIIME again. Other subcommands (e.g., the mv commands
+         which move the job's output into place) are run in a shell. The
+         subcommands are run in order, stopping at the first which fails. If
+         the command changes the shell's state (cd or export), the whole
+         command is run in one shell.
+
+        Returns (command, stdout, stderr, return_value, run_time), where
+         run_time is the wall time of the job in seconds. This is a
+         module-level function so it can be passed to a multiprocessing pool.
+    """
+    start_time = time()
+    subcommands = [subcommand.strip()
+                   for subcommand in strip_job_command(command).split(';')
+                   if subcommand.strip()]
+    if [subcommand for subcommand in subcommands
+            if subcommand.split()[0] in ('cd', 'export')]:
+        subcommands = ['; '.join(subcommands)]
+
+    stdout = []
+    stderr = []
+    return_value = 0
+    for subcommand in subcommands:
+        script_fp = None
+        if not SHELL_METACHARACTERS.intersection(subcommand):
+            argv = shell_split(subcommand)
+            script_fp = get_python_script_fp(argv)
+        if script_fp is not None:
+            out, err, return_value = run_python_script(script_fp, argv)
+        else:
+            # IMPORTANT: this must use qiime_system_call() for the same
+            # reasons described in ParallelWrapper.__call__
+            out, err, return_value = qiime_system_call(subcommand)
+        stdout.append(out)
+        stderr.append(err)
+        if return_value != 0:
+            break
+    return (command, ''.join(stdout), ''.join(stderr), return_value,
+            time() - start_time)
+
+
+class _JobProcess(Process):
+
+    """ A non-daemonic pool worker, which may start processes of its own
+    """
+
+    def _get_daemon(self):
+        return False
+
+    def _set_daemon(self, value):
+        pass
+
+    daemon = property(_get_daemon, _set_daemon)
+
+
+class JobPool(Pool):
+
+    """ Process pool which runs each job in a new worker process
+
+        The workers are not daemonic, so the QIIME scripts called in them
+         (see run_job_command) can start pools of their own (e.g.,
+         split_libraries_fastq.py with --num_workers). Each worker runs a
+         single job and exits, so nothing a job changes in its process (e.g.,
+         the load_qiime_config cache, module globals, the working directory
+         or the environment) carries over to the next job. Workers are forked
+         from the current process, so QIIME is still only imported once.
+    """
+    Process = _JobProcess
+
+    def __init__(self, processes=None):
+        Pool.__init__(self, processes, maxtasksperchild=1)
+
 
 class ParallelWrapper(object):
 
     """
     """
+    _process_run_results_f = \
+        'qiime.parallel.poller.basic_process_run_results_f'
 
     def __init__(self,
-                 cluster_jobs_fp=qiime_config['cluster_jobs_fp'],
-                 jobs_to_start=int(qiime_config['jobs_to_start']),
+                 cluster_jobs_fp=None,
+                 jobs_to_start=None,
                  poller_fp='poller.py',
                  retain_temp_files=False,
                  suppress_polling=False,
-                 seconds_to_sleep=int(qiime_config['seconds_to_sleep'])):
-        """  """
+                 seconds_to_sleep=None,
+                 parallel_executor=None,
+                 shards_per_job=None):
+        """ Options which are None default to the qiime_config values """
+        qiime_config = load_qiime_config()
+        if cluster_jobs_fp is None:
+            cluster_jobs_fp = qiime_config['cluster_jobs_fp']
+        if jobs_to_start is None:
+            jobs_to_start = int(qiime_config['jobs_to_start'])
+        if seconds_to_sleep is None:
+            seconds_to_sleep = int(qiime_config['seconds_to_sleep'])
+        if parallel_executor is None:
+            parallel_executor = qiime_config['parallel_executor']
+        if shards_per_job is None:
+            shards_per_job = int(qiime_config['shards_per_job'])
+        if parallel_executor not in PARALLEL_EXECUTORS:
+            raise ValueError("Unknown parallel_executor: %s. Valid choices "
+                             "are: %s" % (parallel_executor,
+                                          ', '.join(PARALLEL_EXECUTORS)))
+        if shards_per_job < 1:
+            raise ValueError("shards_per_job must be an integer >= 1")
+        if shards_per_job > 1 and parallel_executor != 'multiprocessing':
+            # cluster_jobs scripts start every job they are given at once,
+            # so there would be no pool for the shards to be scheduled on
+            raise ValueError("shards_per_job > 1 requires the "
+                             "multiprocessing parallel_executor")
 
         self._cluster_jobs_fp = cluster_jobs_fp
         self._jobs_to_start = jobs_to_start
@@ -46,6 +246,10 @@ class ParallelWrapper(object):
         self._retain_temp_files = retain_temp_files
         self._suppress_polling = suppress_polling
         self._seconds_to_sleep = seconds_to_sleep
+        self._parallel_executor = parallel_executor
+        self._shards_per_job = shards_per_job
+        self._poll_directly = False
+        self.job_timings = []
 
     def _call_initialization(self,
                              input_fp,
@@ -119,17 +323,20 @@ class ParallelWrapper(object):
             input_file_basename, input_ext = splitext(input_fn)
 
         # Split the input file into the individual job input files. Add the
-        # individual job files to the files_to_remove list
+        # individual job files to the files_to_remove list. When sharding,
+        # the input is split into shards_per_job times as many pieces as
+        # there are workers, and the workers take shards as they become free.
         input_fps, remove_input_on_completion = self._input_splitter(
             input_fp,
             params,
-            self._jobs_to_start,
+            self._jobs_to_start * self._shards_per_job,
             job_prefix,
             working_dir)
         if remove_input_on_completion:
             self.files_to_remove += input_fps
 
         # Perform any method-specific setup (e.g., formatting a BLAST database)
+        self._poll_directly = poll_directly
         self._precommand_initiation(input_fp, output_dir, working_dir, params)
 
         # Generate the list of commands to be pushed out to workers
@@ -150,6 +357,26 @@ class ParallelWrapper(object):
                                                   input_file_basename,
                                                   params)
 
+        if self._parallel_executor == 'multiprocessing':
+            # Run the jobs in a process pool owned by this process. There
+            # are no job files to submit and nothing to poll for: the
+            # results are collected directly from the pool.
+            if not suppress_submit_jobs:
+                self._run_jobs_in_process(commands,
+                                          merge_map_filepath,
+                                          deletion_list_filepath)
+                if self._retain_temp_files:
+                    self._write_job_timings(
+                        join(working_dir, 'job_timings.txt'))
+            self.files_to_remove = []
+            self._call_cleanup(input_fp,
+                               output_dir,
+                               params,
+                               job_prefix,
+                               poll_directly,
+                               suppress_submit_jobs)
+            return
+
         # Set up poller apparatus if the user does not suppress polling
         if not self._suppress_polling:
             poller_command = self._initiate_polling(job_result_filepaths,
@@ -257,6 +484,82 @@ class ParallelWrapper(object):
 
         return stdout, stderr, return_value
 
+    def _waits_for_jobs(self):
+        """ Return True if this process waits for the jobs to finish
+
+            This is the case when the jobs are run in a local process pool, or
+             when the poller is run by this process. Databases taken from the
+             reference database cache are only locked against removal while
+             this process runs, so the cache is only used when this is True.
+        """
+        return self._parallel_executor == 'multiprocessing' or \
+            (self._poll_directly and not self._suppress_polling)
+
+    def _run_jobs_in_process(self,
+                             commands,
+                             merge_map_filepath,
+                             deletion_list_filepath):
+        """ Run the jobs in a local process pool and process their results
+
+            Each command is submitted to a JobPool of (at most) jobs_to_start
+             worker processes, and the AsyncResult returned for each one is
+             waited on in turn rather than polling the filesystem for output
+             files. Each command is run with run_job_command, so the QIIME
+             scripts it runs are called in the worker process rather than
+             starting a new python interpreter, and its other subcommands are
+             run in a shell. A new worker takes the next command as soon as one
+             finishes, so when there are more commands than workers (i.e.,
+             with shards_per_job > 1) slow shards don't hold up the others. The
+             wall time of each command is stored in job_timings, in command
+             order. Once all jobs succeed, the merge map is passed to the
+             _process_run_results_f function and the temporary files are
+             removed, as poller.py would do.
+        """
+        self.job_timings = []
+        if not commands:
+            return
+
+        pool = JobPool(processes=min(self._jobs_to_start, len(commands)))
+        try:
+            futures = [pool.apply_async(run_job_command, (command,))
+                       for command in commands]
+            pool.close()
+            for future in futures:
+                command, stdout, stderr, return_value, run_time = \
+                    future.get()
+                self.job_timings.append((command, run_time))
+                if return_value != 0:
+                    msg = "\n\n*** Parallel job failed. \n" +\
+                        "Command run was:\n %s\n" % command +\
+                        "Command returned exit status: %d\n" % return_value +\
+                        "Stdout:\n%s\nStderr\n%s\n" % (stdout, stderr)
+                    raise RuntimeError(msg)
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if self._suppress_polling:
+            return
+
+        process_run_results_f = \
+            get_function_handle(self._process_run_results_f)
+        process_run_results_f(list(open(merge_map_filepath)))
+
+        if not self._retain_temp_files:
+            self._write_filepaths_to_file(self.files_to_remove,
+                                          deletion_list_filepath)
+            basic_clean_up_f(self.files_to_remove)
+
+    def _write_job_timings(self, job_timings_fp):
+        """ Write the wall time of each job run by _run_jobs_in_process """
+        f = open(job_timings_fp, 'w')
+        f.write('#job\tseconds\tcommand\n')
+        for i, (command, run_time) in enumerate(self.job_timings):
+            f.write('%d\t%1.3f\t%s\n' % (i, run_time, command))
+        f.close()
+
     def _identify_files_to_remove(self, job_result_filepaths, params):
         """ Select the files to remove: by default remove all files
         """
@@ -480,6 +783,7 @@ class ParallelWrapper(object):
             jobs_to_start)
 
         # split the fasta files and get the list of resulting files
+        from qiime.split import split_fasta
         tmp_fasta_fps =\
             split_fasta(open(input_fp), num_seqs_per_file,
                         job_prefix, working_dir=output_dir)
@@ -546,3 +850,81 @@ class BufferedWriter():
         fh.close()
 
         self.buffer = []
+
+
+class ShardedWriter(object):
+
+    """Write to many files through a bounded number of open filehandles
+
+    Data written to each file (shard) is buffered in memory, and a shard's
+    buffer is only written out when it holds buffer_size bytes, when the
+    buffers of all shards together hold more than max_buffered_bytes (in
+    which case the largest buffer is written out), or on close. Filehandles
+    are kept open between writes, but at most max_open_files of them at a
+    time: the least recently used handle is closed to make room for a new one.
+
+    Unlike BufferedWriter, which opens and closes its file on every flush,
+    this keeps the number of open and close calls low when the input is split
+    over many files.
+    """
+
+    def __init__(self, max_open_files=64, buffer_size=2 ** 18,
+                 max_buffered_bytes=2 ** 26):
+        if max_open_files < 1:
+            raise ValueError("max_open_files must be 1 or larger.")
+        self._max_open_files = max_open_files
+        self._buffer_size = buffer_size
+        self._max_buffered_bytes = max_buffered_bytes
+        self._buffers = {}
+        self._buffer_sizes = {}
+        self._buffered_bytes = 0
+        self._handles = OrderedDict()
+        # filepaths in the order they were first written to
+        self.filepaths = []
+
+    def write(self, filepath, data):
+        """write data to the file at filepath
+
+        The file is created (or truncated) the first time it is written to.
+        """
+        try:
+            self._buffers[filepath].append(data)
+        except KeyError:
+            self._buffers[filepath] = [data]
+            self._buffer_sizes[filepath] = 0
+            self.filepaths.append(filepath)
+            # create the file, so it exists even if nothing is flushed
+            open(filepath, 'w').close()
+        self._buffer_sizes[filepath] += len(data)
+        self._buffered_bytes += len(data)
+
+        if self._buffer_sizes[filepath] >= self._buffer_size:
+            self._flush(filepath)
+        elif self._buffered_bytes > self._max_buffered_bytes:
+            self._flush(max(self._buffer_sizes,
+                            key=self._buffer_sizes.__getitem__))
+
+    def _flush(self, filepath):
+        """write the buffer of filepath to its file"""
+        if not self._buffer_sizes[filepath]:
+            return
+        try:
+            fh = self._handles.pop(filepath)
+        except KeyError:
+            if len(self._handles) >= self._max_open_files:
+                self._handles.popitem(last=False)[1].close()
+            fh = open(filepath, 'a')
+        # the most recently used handle goes last
+        self._handles[filepath] = fh
+        fh.write(''.join(self._buffers[filepath]))
+        self._buffered_bytes -= self._buffer_sizes[filepath]
+        self._buffers[filepath] = []
+        self._buffer_sizes[filepath] = 0
+
+    def close(self):
+        """write out all buffers and close all filehandles"""
+        for filepath in self.filepaths:
+            self._flush(filepath)
+        for fh in self._handles.itervalues():
+            fh.close()
+        self._handles = OrderedDict()
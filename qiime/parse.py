@@ -14,13 +14,14 @@ __email__ = "gregcaporaso@gmail.com"
 
 from string import strip
 from collections import defaultdict
+from array import array
 import os
-from os.path import expandvars
 import re
 from types import GeneratorType
 
-from numpy import concatenate, repeat, zeros, nan, asarray
+from numpy import concatenate, repeat, zeros, nan, asarray, frombuffer
 from numpy.random import permutation
+from scipy.sparse import coo_matrix
 
 from skbio.stats.ordination import OrdinationResults
 from skbio.parse.record_finder import LabeledRecordFinder
@@ -30,6 +31,10 @@ from skbio.parse.sequences.fasta import FastaFinder
 from skbio.sequence import DNA
 from cogent.core.tree import PhyloNode
 
+# the qiime_config parsers live in qiime.util, so that loading the
+# qiime_config doesn't require this module's dependencies
+from qiime.util import parse_qiime_config_file, parse_qiime_config_files
+
 
 def is_casava_v180_or_later(header_line):
     """ True if this file is generated by Illumina software post-casava 1.8 """
@@ -631,44 +636,6 @@ def parse_qiime_parameters(lines):
     return result
 
 
-def parse_qiime_config_file(qiime_config_file):
-    """ Parse lines in a qiime_config file
-    """
-    result = {}
-    for line in qiime_config_file:
-        line = line.strip()
-        # ignore blank lines or lines beginning with '#'
-        if not line or line.startswith('#'):
-            continue
-        fields = line.split()
-        param_id = fields[0]
-        param_value = expandvars(' '.join(fields[1:])) or None
-        result[param_id] = param_value
-    return result
-
-
-def parse_qiime_config_files(qiime_config_files):
-    """ Parse files in (ordered!) list of qiime_config_files
-
-        The order of files must be least important to most important.
-         Values defined in earlier files will be overwritten if the same
-         values are defined in later files.
-    """
-    # The qiime_config object is a default dict: if keys are not
-    # present, none is returned
-    def return_none():
-        return None
-    results = defaultdict(return_none)
-
-    for qiime_config_file in qiime_config_files:
-        try:
-            results.update(parse_qiime_config_file(qiime_config_file))
-        except IOError:
-            pass
-
-    return results
-
-
 def parse_tmp_to_final_filepath_map_file(lines):
     """Parses poller maps of tmp -> final file names
 
@@ -907,6 +874,59 @@ def parse_otu_map(otu_map_f, otu_ids_to_exclude=None, delim='_'):
     return result, sample_ids, otu_ids
 
 
+def parse_otu_map_to_sparse(otu_map_f, otu_ids_to_exclude=None, delim='_'):
+    """ parse otu map file into a scipy.sparse (otu x sample) count matrix
+
+        Counts for each OTU are accumulated into compact arrays of
+         (otu_idx, sample_idx, count) as the file is streamed, so memory use
+         scales with the number of non-zero cells rather than the number of
+         sequences. OTU and sample indices are the same as those assigned by
+         parse_otu_map, and the matrix can be passed directly to
+         biom.table.Table.
+
+        returns: csr_matrix, sample_ids, otu_ids
+    """
+    if otu_ids_to_exclude is None:
+        otu_ids_to_exclude = {}
+
+    otu_indices = array('i')
+    sample_indices = array('i')
+    counts = array('i')
+    sample_ids = []
+    sample_id_idx = {}
+    otu_ids = []
+    otu_count = 0
+    sample_count = 0
+    for line in otu_map_f:
+        fields = line.strip().split('\t')
+        otu_id = fields[0]
+        if otu_id in otu_ids_to_exclude:
+            continue
+        otu_counts = defaultdict(int)
+        for seq_id in fields[1:]:
+            sample_id = seq_id.split(delim)[0]
+            try:
+                sample_index = sample_id_idx[sample_id]
+            except KeyError:
+                sample_index = sample_count
+                sample_id_idx[sample_id] = sample_index
+                sample_count += 1
+                sample_ids.append(sample_id)
+            otu_counts[sample_index] += 1
+        otu_indices.extend([otu_count] * len(otu_counts))
+        sample_indices.extend(otu_counts.keys())
+        counts.extend(otu_counts.values())
+        otu_count += 1
+        otu_ids.append(otu_id)
+
+    data = coo_matrix((frombuffer(counts, dtype=counts.typecode),
+                       (frombuffer(otu_indices, dtype=otu_indices.typecode),
+                        frombuffer(sample_indices,
+                                   dtype=sample_indices.typecode))),
+                      shape=(otu_count, sample_count), dtype=float)
+    return data.tocsr(), sample_ids, otu_ids
+
+
 def parse_sample_id_map(sample_id_map_f):
     """Parses the lines of a sample ID map file into a dictionary.
 
@@ -25,14 +25,16 @@ from tempfile import mkstemp
 from bfillings.mothur import parse_otu_list as mothur_parse
 
 from skbio.util import remove_files, flatten
-from skbio.tree import CompressedTrie, fasta_to_pairlist
 from skbio.parse.sequences import parse_fasta
 from skbio.alignment import SequenceCollection
 from skbio.sequence import DNA
 
+from qiime.prefix_map import PackedPrefixIndex
+from qiime.dereplicate import (DereplicatedSeqIdMap, dereplicate_exact_matches,
+                               dereplicate_exact_prefixes,
+                               seq_id_map_from_otus, MAX_SEQ_IDS_IN_MEMORY)
 from qiime.util import FunctionWithParams, get_qiime_temp_dir
 from qiime.sort import sort_fasta_by_abundance
-from qiime.parse import fields_to_dict
 
 from bfillings.blast import blast_seqs, Blastall, BlastResult
 from bfillings.formatdb import build_blast_db_from_fasta_path
@@ -83,83 +85,42 @@ class OtuPicker(FunctionWithParams):
         raise NotImplementedError("OtuPicker is an abstract class")
 
     def _prefilter_exact_prefixes(self, seqs, prefix_length=100):
+        """ Collapse seqs with identical prefixes to the longest such seq
+
+            Returns the list of (seq_id, seq) pairs to cluster and a
+             DereplicatedSeqIdMap of {seq_id: [seq_ids]}. The
+             'max_seq_ids_in_memory' param controls when the map is spilled
+             to disk.
         """
-        """
-        unique_prefixes = {}
-        for seq_id, seq in seqs:
-            seq_len = len(seq)
-            seq_id = seq_id.split()[0]
-            current_prefix = seq[:prefix_length]
-            try:
-                prefix_data = unique_prefixes[current_prefix]
-                if seq_len > prefix_data[2]:
-                    # if this is the longest seq with this prefix so far,
-                    # update the list of seq_ids, the best seq_len, and the
-                    # best hit seq_id
-                    prefix_data[0].append(seq_id)
-                    prefix_data[1] = seq_id
-                    prefix_data[2] = seq_len
-                    prefix_data[3] = seq
-                else:
-                    # if longer have been seen, only update the list of seq_ids
-                    prefix_data[0].append(seq_id)
-            except KeyError:
-                # list of seq_ids mapped to this prefix, best hit seq_id, best
-                # hit seq_len
-                unique_prefixes[current_prefix] = [[seq_id],
-                                                   seq_id,
-                                                   seq_len,
-                                                   seq]
-
-        # construct the result objects
-        filtered_seqs = []
-        seq_id_map = {}
-        for data in unique_prefixes.values():
-            filtered_seqs.append((data[1], data[3]))
-            seq_id_map[data[1]] = data[0]
-
-        return filtered_seqs, seq_id_map
+        return dereplicate_exact_prefixes(
+            seqs,
+            prefix_length,
+            max_seq_ids_in_memory=self.Params.get('max_seq_ids_in_memory',
+                                                  MAX_SEQ_IDS_IN_MEMORY))
 
     def _prefilter_exact_matches(self, seqs):
+        """ Collapse identical seqs
+
+            Returns the list of (seq_id, seq) pairs to cluster and a
+             DereplicatedSeqIdMap of {seq_id: [seq_ids]}. The
+             'max_seq_ids_in_memory' param controls when the map is spilled
+             to disk.
         """
-        """
-        unique_sequences = {}
-        seq_id_map = {}
-        filtered_seqs = []
-        for seq_id, seq in seqs:
-            seq_id = seq_id.split()[0]
-            try:
-                temp_seq_id = unique_sequences[seq]
-            except KeyError:
-                # unseen sequence so create a new temp_seq_id,
-                # a new unique_sequence entry, and new seq_id_map
-                # entry, and add the sequence to the list of
-                # filtered seqs -- this will retain the order
-                # of the input sequences too
-                temp_seq_id = 'QiimeExactMatch.%s' % seq_id
-                unique_sequences[seq] = temp_seq_id
-                seq_id_map[temp_seq_id] = []
-                filtered_seqs.append((temp_seq_id, seq))
-            seq_id_map[temp_seq_id].append(seq_id)
-        return filtered_seqs, seq_id_map
+        return dereplicate_exact_matches(
+            seqs,
+            max_seq_ids_in_memory=self.Params.get('max_seq_ids_in_memory',
+                                                  MAX_SEQ_IDS_IN_MEMORY))
 
     def _prefilter_with_trie(self, seq_path):
 
         trunc_id = lambda a_b: (a_b[0].split()[0], a_b[1])
-        # get the prefix map
+        # get the prefix map and the representative seqs in a single pass
+        # over the input
         with open(seq_path, 'U') as seq_lines:
-            t = CompressedTrie(fasta_to_pairlist(imap(trunc_id,
-                                                      parse_fasta(seq_lines))))
-        mapping = t.prefix_map
+            index = PackedPrefixIndex(imap(trunc_id, parse_fasta(seq_lines)))
+        mapping, filtered_seqs = index.prefix_map_with_seqs()
         for key in mapping.keys():
                 mapping[key].append(key)
-
-        # collect the representative seqs
-        filtered_seqs = []
-        for (label, seq) in parse_fasta(open(seq_path)):
-            label = label.split()[0]
-            if label in mapping:
-                filtered_seqs.append((label, seq))
         return filtered_seqs, mapping
 
     def _map_filtered_clusters_to_full_clusters(self, clusters, filter_map):
@@ -171,6 +132,11 @@ class OtuPicker(FunctionWithParams):
                                 duplicate FASTA sequences
             Output: an extended list of cluster lists
         """
+        if isinstance(filter_map, DereplicatedSeqIdMap):
+            # expand all clusters in one pass over the (possibly spilled)
+            # map rather than looking up each seq_id
+            return filter_map.expand(clusters)
+
         results = []
         for cluster in clusters:
             full_cluster = []
@@ -271,10 +237,9 @@ class SortmernaV2OtuPicker(OtuPicker):
             cluster_map = dict(zip(cluster_names, clusters))
 
             # Expand failures
-            temp_failures = []
-            for fa in failures:
-                temp_failures.extend(exact_match_id_map[fa])
-            failures = temp_failures
+            failures = self._map_filtered_clusters_to_full_clusters(
+                [failures], exact_match_id_map)[0]
+            exact_match_id_map.close()
 
         self.log_lines.append('Num OTUs: %d' % len(cluster_map))
         self.log_lines.append('Num failures: %d' % len(failures))
@@ -345,7 +310,7 @@ class SortmernaV2OtuPicker(OtuPicker):
         for seq_id, seq in seqs_to_cluster:
             unique_seqs_f.write('>%s count=%d;\n%s\n' %
                                 (seq_id,
-                                 len(exact_match_id_map[seq_id]),
+                                 exact_match_id_map.count(seq_id),
                                  seq))
         unique_seqs_f.close()
 
@@ -661,7 +626,7 @@ class SumaClustOtuPicker(OtuPicker):
         for seq_id, seq in seqs_to_cluster:
             unique_seqs_f.write('>%s count=%d;\n%s\n'
                                 % (seq_id,
-                                   len(exact_match_id_map[seq_id]),
+                                   exact_match_id_map.count(seq_id),
                                    seq))
         unique_seqs_f.close()
         # clean up the seqs_to_cluster list as it can be big and we
@@ -702,6 +667,7 @@ class SumaClustOtuPicker(OtuPicker):
         if prefilter_identical_sequences:
             clusters = self._map_filtered_clusters_to_full_clusters(
                 clusters, exact_match_id_map)
+            exact_match_id_map.close()
 
         self.log_lines.append('Num OTUs: %d' % len(clusters))
 
@@ -967,8 +933,7 @@ class TrieOtuPicker(OtuPicker):
                         parse_fasta(open(seq_path)))
 
         # Build the mapping
-        t = CompressedTrie(fasta_to_pairlist(seqs))
-        mapping = t.prefix_map
+        mapping = PackedPrefixIndex(seqs).prefix_map()
         log_lines.append('Num OTUs: %d' % len(mapping))
 
         if result_path:
@@ -1098,6 +1063,8 @@ class CdHitOtuPicker(OtuPicker):
         if prefix_prefilter_length is not None or trie_prefilter:
             clusters = self._map_filtered_clusters_to_full_clusters(
                 clusters, filter_map)
+            if isinstance(filter_map, DereplicatedSeqIdMap):
+                filter_map.close()
 
         if result_path:
             # if the user provided a result_path, write the
@@ -1295,6 +1262,7 @@ class UclustOtuPicker(UclustOtuPickerBase):
         if prefilter_identical_sequences:
             clusters = self._map_filtered_clusters_to_full_clusters(
                 clusters, exact_match_id_map)
+            exact_match_id_map.close()
 
         otu_id_prefix = self.Params['new_cluster_identifier']
         if otu_id_prefix is None:
@@ -1923,10 +1891,9 @@ class UclustReferenceOtuPicker(UclustOtuPickerBase):
             cluster_map = dict(zip(cluster_names, clusters))
 
             # expand failures
-            temp_failures = []
-            for fa in failures:
-                temp_failures.extend(exact_match_id_map[fa])
-            failures = temp_failures
+            failures = self._map_filtered_clusters_to_full_clusters(
+                [failures], exact_match_id_map)[0]
+            exact_match_id_map.close()
 
         self._rename_clusters(cluster_map, new_seeds)
 
@@ -2099,6 +2066,9 @@ def expand_otu_map_seq_ids(otu_map, seq_id_map):
 
 
 def expand_failures(failures, seq_id_map):
+    if isinstance(seq_id_map, DereplicatedSeqIdMap):
+        return seq_id_map.expand([[f.strip() for f in failures]])[0]
+
     result = []
     for failure in failures:
         failure = failure.strip()
@@ -2106,15 +2076,42 @@ def expand_failures(failures, seq_id_map):
     return result
 
 
-def map_otu_map_files(otu_files, failures_file=None):
-    # passing delim=None splits on any whitespace, so can handle mixed tabs
-    # and spaces
-    result = fields_to_dict(otu_files[0], delim=None)
-    for otu_file in otu_files[1:]:
-        current_otu_map = fields_to_dict(otu_file, delim=None)
-        result = expand_otu_map_seq_ids(current_otu_map, result)
-    if failures_file:
-        result = expand_failures(failures_file, result)
+def _iter_otu_map_fields(otu_map_f):
+    """ Yield (otu_id, [seq_ids]) for each line of an OTU map
+
+        Fields are split on any whitespace, so mixed tabs and spaces are
+         handled.
+    """
+    for line in otu_map_f:
+        fields = line.split()
+        if fields:
+            yield fields[0], fields[1:]
+
+
+def map_otu_map_files(otu_files, failures_file=None,
+                      max_seq_ids_in_memory=MAX_SEQ_IDS_IN_MEMORY):
+    """ Expand chained OTU maps to the seq_ids in the first map
+
+        The maps are merged one at a time into a DereplicatedSeqIdMap, which
+         is spilled to disk when it holds more than max_seq_ids_in_memory
+         seq_ids. Returns the DereplicatedSeqIdMap of {otu_id: [seq_ids]},
+         which the caller should close, or if failures_file is passed, the
+         list of seq_ids of the failures.
+    """
+    result = seq_id_map_from_otus(_iter_otu_map_fields(otu_files[0]),
+                                  max_seq_ids_in_memory)
+    try:
+        for otu_file in otu_files[1:]:
+            previous_result = result
+            result = previous_result.remap(_iter_otu_map_fields(otu_file))
+            previous_result.close()
+        if failures_file:
+            failures = expand_failures(failures_file, result)
+            result.close()
+            return failures
+    except:
+        result.close()
+        raise
     return result
 
 # End functions to support merging OTU tables
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent", "Jens Reeder"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+"""Compact prefix mapping of large sequence collections.
+
+PackedPrefixIndex computes the same prefix map as a compressed trie (i.e.,
+skbio.tree.CompressedTrie(fasta_to_pairlist(seqs)).prefix_map) without
+building a tree of Python objects. Sequences are packed 2 bits per base (or
+one byte per character, if any sequence contains a character other than
+A, C, G or T) into numpy arrays, sorted once, and the prefix relationships
+are recovered from the longest common prefixes of neighbouring sequences in
+sorted order.
+"""
+
+from array import array
+
+from numpy import (array as nparray, zeros, empty, arange, frombuffer,
+                   concatenate, uint8, uint32, argsort, ascontiguousarray,
+                   minimum, where)
+
+# 2-bit codes for the unambiguous bases. These sort in the same order as the
+# characters, so sorting packed sequences sorts the sequences.
+_NT_TO_CODE = zeros(256, dtype=uint8) + 255
+for _i, _nt in enumerate('ACGT'):
+    _NT_TO_CODE[ord(_nt)] = _i
+_CODE_TO_NT = nparray([ord(nt) for nt in 'ACGT'], dtype=uint8)
+
+# number of leading zero bits in each byte value
+_LEADING_ZEROS = nparray([8] + [7 - int(i).bit_length() + 1
+                                for i in range(1, 256)], dtype=uint8)
+
+
+class PackedPrefixIndex(object):
+
+    """ Collection of (seq_id, seq) pairs supporting prefix mapping
+
+        seqs: optional iterable of (seq_id, seq) pairs to add to the index
+        chunk_size: number of sequences to buffer as strings before packing
+         them into arrays
+
+        Sequences are buffered and packed chunk_size at a time, so the input
+         is read in a single pass and only the packed sequences and their
+         identifiers are kept.
+    """
+
+    def __init__(self, seqs=None, chunk_size=100000):
+        self._chunk_size = chunk_size
+        self._bits_per_char = 2
+        self._chunks = []
+        self._buffer = []
+        self.ids = []
+        self.lengths = array('I')
+        if seqs is not None:
+            self.extend(seqs)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, seq_id, seq):
+        """ Add a single sequence to the index """
+        self.ids.append(seq_id)
+        self.lengths.append(len(seq))
+        self._buffer.append(seq)
+        if len(self._buffer) >= self._chunk_size:
+            self._pack_buffer()
+
+    def extend(self, seqs):
+        """ Add (seq_id, seq) pairs to the index """
+        for seq_id, seq in seqs:
+            self.add(seq_id, seq)
+
+    def _pack_buffer(self):
+        if not self._buffer:
+            return
+        lengths = nparray([len(s) for s in self._buffer], dtype=uint32)
+        chars = frombuffer(''.join(self._buffer), dtype=uint8)
+        self._buffer = []
+        # lay the sequences out as the rows of a zero-padded matrix
+        width = int(lengths.max()) if len(lengths) else 0
+        raw = zeros((len(lengths), width), dtype=uint8)
+        raw[arange(width) < lengths[:, None]] = chars
+
+        if self._bits_per_char == 2:
+            codes = _NT_TO_CODE[raw]
+            codes[raw == 0] = 0
+            if (codes == 255).any():
+                self._widen()
+            else:
+                self._chunks.append(self._pack_codes(codes))
+                return
+        self._chunks.append(raw)
+
+    def _pack_codes(self, codes):
+        """ Pack a matrix of 2-bit codes 4 to a byte """
+        n, width = codes.shape
+        padded_width = -(-width // 4) * 4
+        if padded_width != width:
+            padded = zeros((n, padded_width), dtype=uint8)
+            padded[:, :width] = codes
+            codes = padded
+        codes = codes.reshape(n, padded_width // 4, 4)
+        return ((codes[:, :, 0] << 6) | (codes[:, :, 1] << 4) |
+                (codes[:, :, 2] << 2) | codes[:, :, 3])
+
+    def _unpack_codes(self, packed):
+        """ Return the matrix of characters in a packed 2-bit matrix """
+        n, width = packed.shape
+        codes = empty((n, width, 4), dtype=uint8)
+        for i, shift in enumerate((6, 4, 2, 0)):
+            codes[:, :, i] = (packed >> shift) & 3
+        return _CODE_TO_NT[codes.reshape(n, width * 4)]
+
+    def _widen(self):
+        """ Switch from 2 bits to 8 bits (i.e., raw characters) per base """
+        lengths = frombuffer(self.lengths, dtype=uint32)
+        start = 0
+        for i, c in enumerate(self._chunks):
+            raw = self._unpack_codes(c)
+            # the padding was unpacked as As: set it back to zeros
+            chunk_lengths = lengths[start:start + c.shape[0]]
+            raw[arange(raw.shape[1]) >= chunk_lengths[:, None]] = 0
+            self._chunks[i] = raw
+            start += c.shape[0]
+        self._bits_per_char = 8
+
+    def _packed_matrix(self):
+        """ Return all packed sequences as the rows of one matrix """
+        self._pack_buffer()
+        width = max([c.shape[1] for c in self._chunks] + [0])
+        result = zeros((len(self), width), dtype=uint8)
+        start = 0
+        for c in self._chunks:
+            result[start:start + c.shape[0], :c.shape[1]] = c
+            start += c.shape[0]
+        self._chunks = [result]
+        return result
+
+    def _sort_order(self, packed):
+        """ Return the indices of the sequences in lexicographic order
+
+            Ties between identical sequences are broken by input order.
+        """
+        n, width = packed.shape
+        keys = empty((n, width + 8), dtype=uint8)
+        keys[:, :width] = packed
+        # a shorter sequence padded with A (i.e., 0) sorts before any longer
+        # sequence it is a prefix of if the length is compared next
+        keys[:, width:width + 4] = \
+            frombuffer(self.lengths, dtype=uint32).astype('>u4')\
+            .view(uint8).reshape(n, 4)
+        keys[:, width + 4:] = \
+            arange(n, dtype='>u4').view(uint8).reshape(n, 4)
+        keys = ascontiguousarray(keys).view('V%d' % (width + 8)).ravel()
+        return argsort(keys)
+
+    def _neighbour_lcps(self, packed, order, lengths, block_size=100000):
+        """ Longest common prefix of each sequence with the next, in order
+
+            lengths must be the sequence lengths in sorted order.
+        """
+        chars_per_byte = 8 // self._bits_per_char
+        n = len(order)
+        if packed.shape[1] == 0:
+            # only empty sequences
+            return zeros(max(n - 1, 0), dtype=uint32)
+        result = empty(max(n - 1, 0), dtype=uint32)
+        for start in range(0, n - 1, block_size):
+            rows = packed[order[start:start + block_size + 1]]
+            x, y = rows[:-1], rows[1:]
+            diff = x != y
+            first = diff.argmax(1)
+            r = arange(len(first))
+            lcp = first * chars_per_byte + \
+                _LEADING_ZEROS[x[r, first] ^ y[r, first]] // \
+                self._bits_per_char
+            lcp = where(diff[r, first], lcp, 2 ** 31)
+            l = lengths[start:start + block_size + 1]
+            result[start:start + len(lcp)] = minimum(minimum(l[:-1], l[1:]),
+                                                     lcp)
+        return result
+
+    def _prefix_map_indices(self, block_size=100000):
+        """ Return the prefix map in terms of sequence indices """
+        packed = self._packed_matrix()
+        n = len(self)
+        if n == 0:
+            return {}
+        order = self._sort_order(packed)
+        lengths = frombuffer(self.lengths, dtype=uint32)[order]
+        lcps = self._neighbour_lcps(packed, order, lengths)
+
+        # group runs of identical sequences: group g covers
+        # order[starts[g]:starts[g + 1]]
+        identical = (lcps == lengths[:-1]) & (lengths[1:] == lengths[:-1])
+        starts = concatenate([[0], where(~identical)[0] + 1, [n]])
+        group_lengths = lengths[starts[:-1]]
+        # lcp of the last sequence of each group with the next sequence
+        next_lcps = concatenate([lcps[starts[1:-1] - 1].astype(int),
+                                 [-1]])
+
+        mapping = {}
+        # each stack entry is a sequence which is a prefix of the sequences
+        # that follow it: [length, members, best key, best group size]
+        stack = []
+        for block_start in range(0, len(group_lengths), block_size):
+            block_end = block_start + block_size
+            for start, end, length, next_lcp in zip(
+                    starts[block_start:block_end].tolist(),
+                    starts[block_start + 1:block_end + 1].tolist(),
+                    group_lengths[block_start:block_end].tolist(),
+                    next_lcps[block_start:block_end].tolist()):
+                members = order[start:end].tolist()
+                if next_lcp >= length:
+                    # a proper prefix of the next sequence: its members join
+                    # the largest group of the sequences it is a prefix of
+                    stack.append([length, members, None, -1])
+                else:
+                    key = members[0]
+                    mapping[key] = members[1:]
+                    if stack and len(members) - 1 > stack[-1][3]:
+                        stack[-1][2] = key
+                        stack[-1][3] = len(members) - 1
+
+                # close the prefixes which the next sequence doesn't extend
+                while stack and stack[-1][0] > next_lcp:
+                    prefix_length, prefix_members, key, size = stack.pop()
+                    mapping[key].extend(prefix_members)
+                    size = len(mapping[key])
+                    if stack and size > stack[-1][3]:
+                        stack[-1][2] = key
+                        stack[-1][3] = size
+        return mapping
+
+    def prefix_map(self):
+        """ Return the prefix map of the sequences
+
+            The result is a dict of {seq_id: [seq_ids]}, where each key is
+             the first seq_id of a sequence which is not a prefix of any
+             other sequence, and the values are the remaining seq_ids with
+             that sequence, followed by the seq_ids of sequences which are
+             prefixes of it (each prefix is assigned to the largest group
+             it is a prefix of).
+        """
+        ids = self.ids
+        return dict((ids[k], [ids[m] for m in v])
+                    for k, v in self._prefix_map_indices().iteritems())
+
+    def prefix_map_with_seqs(self):
+        """ Return the prefix map and the (seq_id, seq) pairs of its keys
+
+            The (seq_id, seq) pairs are returned in input order, so the keys'
+             sequences don't need to be read from the input again.
+        """
+        index_map = self._prefix_map_indices()
+        keys = sorted(index_map)
+        ids = self.ids
+        mapping = dict((ids[k], [ids[m] for m in v])
+                       for k, v in index_map.iteritems())
+        return mapping, [(ids[k], self.get_seq(k)) for k in keys]
+
+    def get_seq(self, i):
+        """ Return the ith sequence added to the index """
+        self._pack_buffer()
+        start = 0
+        for c in self._chunks:
+            if i < start + c.shape[0]:
+                row = c[i - start:i - start + 1]
+                break
+            start += c.shape[0]
+        else:
+            raise IndexError("Sequence index out of range: %d" % i)
+        if self._bits_per_char == 2:
+            row = self._unpack_codes(row)
+        return row[0, :self.lengths[i]].tostring()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+"""Cache of reference databases (e.g., BLAST and SortMeRNA indexes).
+
+Building a database from a large reference collection (e.g., Greengenes or
+SILVA) can take many minutes, and the parallel scripts used to rebuild it in a
+temporary directory on every run. ReferenceDbCache stores each database in a
+directory keyed by the md5 of the reference FASTA file's contents, the tool
+that built it and its build parameters, so it is only built once no matter
+where the reference file lives or how many runs use it.
+
+Concurrent runs coordinate through file locks: the first run to need a
+database builds it while the others wait, and each process that gets a
+database holds a shared lock on it until it exits. When the databases take
+up more than the cache's maximum size, the least recently used ones that are
+not locked are removed. Only the process that called get holds the lock, not
+the jobs it starts, so the parallel scripts only use the cache when they wait
+for their jobs to finish (see ParallelWrapper._waits_for_jobs). Cluster runs
+that return once their jobs are submitted build a temporary database, as
+before.
+
+The cache is enabled by setting reference_db_cache_dir in the qiime_config
+file; get_blast_db and get_sortmerna_db fall back to building a temporary
+database (as before) when it is not set.
+"""
+
+import fcntl
+from hashlib import md5
+from json import dump, load
+from os import listdir, rename, stat, utime, walk
+from os.path import abspath, exists, getsize, join, relpath
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from bfillings.formatdb import build_blast_db_from_fasta_path
+from bfillings.sortmerna_v2 import build_database_sortmerna
+
+from qiime.util import load_qiime_config, create_dir
+
+# name of the file recording an entry's database path and build details;
+# an entry is complete once this file exists
+_ENTRY_INFO_FN = 'entry_info.json'
+
+
+def fasta_checksum(fasta_fp, block_size=2 ** 20):
+    """Return the md5 hex digest of the contents of fasta_fp"""
+    digest = md5()
+    f = open(fasta_fp, 'rb')
+    try:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+class ReferenceDbCache(object):
+
+    """ Content-addressed cache of databases built from reference FASTA files
+
+        cache_dir: directory the databases are stored in (created if it
+         doesn't exist)
+        max_size: maximum total size in bytes of the cached databases, or
+         None for no limit
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = abspath(cache_dir)
+        self.max_size = max_size
+        create_dir(self.cache_dir)
+        # open lock files of the entries in use by this object, by key
+        self._held_locks = {}
+
+    def _entry_dir(self, key):
+        return join(self.cache_dir, key)
+
+    def _lock_fp(self, key):
+        return join(self.cache_dir, key + '.lock')
+
+    def entry_key(self, tool, fasta_fp, params=None):
+        """Return the key of the database built by tool from fasta_fp"""
+        params = sorted((params or {}).items())
+        key_data = '\0'.join([tool, repr(params), fasta_checksum(fasta_fp)])
+        return '%s-%s' % (tool, md5(key_data).hexdigest())
+
+    def get(self, tool, fasta_fp, build_f, params=None):
+        """Return the path of the database built by tool from fasta_fp
+
+            tool: name of the tool that builds the database (e.g., formatdb)
+            fasta_fp: path to the reference FASTA file
+            build_f: function that builds the database, called as
+             build_f(fasta_fp, output_dir) if the database isn't cached, and
+             returning (database path, list of files created) like the
+             bfillings build_* functions
+            params: dict of build parameters which affect the database (other
+             than the FASTA file itself)
+
+            The database is kept (with a shared lock held on it) until close
+             is called or this process exits. Other processes using the
+             database (e.g., cluster jobs) are not covered by the lock.
+        """
+        key = self.entry_key(tool, fasta_fp, params)
+        entry_dir = self._entry_dir(key)
+        if key in self._held_locks:
+            return self._entry_db_path(entry_dir)
+
+        info_fp = join(entry_dir, _ENTRY_INFO_FN)
+        lock_f = open(self._lock_fp(key), 'a')
+        try:
+            # a shared lock is enough to use a complete entry (and stops it
+            # being evicted); only one process builds it at a time, and the
+            # others wait for it then recheck
+            fcntl.flock(lock_f, fcntl.LOCK_SH)
+            if not exists(info_fp):
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+                fcntl.flock(lock_f, fcntl.LOCK_EX)
+                if not exists(info_fp):
+                    self._build(entry_dir, tool, fasta_fp, build_f, params)
+                fcntl.flock(lock_f, fcntl.LOCK_SH)
+            # mark the entry as recently used
+            utime(info_fp, None)
+        except:
+            lock_f.close()
+            raise
+        self._held_locks[key] = lock_f
+
+        self.evict()
+        return self._entry_db_path(entry_dir)
+
+    def _entry_db_path(self, entry_dir):
+        info = load(open(join(entry_dir, _ENTRY_INFO_FN), 'U'))
+        return join(entry_dir, info['db_path'])
+
+    def _build(self, entry_dir, tool, fasta_fp, build_f, params):
+        """Build the database in a temporary directory and move it in place
+        """
+        if exists(entry_dir):
+            # left by a build that was interrupted
+            rmtree(entry_dir)
+        build_dir = mkdtemp(dir=self.cache_dir, prefix='.building_')
+        try:
+            db_path, db_files = build_f(abspath(fasta_fp), build_dir)
+            info_f = open(join(build_dir, _ENTRY_INFO_FN), 'w')
+            dump({'tool': tool,
+                  'fasta_fp': abspath(fasta_fp),
+                  'params': params or {},
+                  'db_path': relpath(db_path, build_dir),
+                  'build_time': time()}, info_f)
+            info_f.close()
+            rename(build_dir, entry_dir)
+        except:
+            rmtree(build_dir, ignore_errors=True)
+            raise
+
+    def _entry_size(self, entry_dir):
+        return sum([getsize(join(dirpath, fn))
+                    for dirpath, dirnames, fns in walk(entry_dir)
+                    for fn in fns])
+
+    def entries(self):
+        """Return (key, last used time, size in bytes) of each cached entry
+        """
+        result = []
+        for key in listdir(self.cache_dir):
+            info_fp = join(self._entry_dir(key), _ENTRY_INFO_FN)
+            if key.startswith('.') or key.endswith('.lock') or \
+                    not exists(info_fp):
+                continue
+            result.append((key, stat(info_fp).st_mtime,
+                           self._entry_size(self._entry_dir(key))))
+        return result
+
+    def evict(self):
+        """Remove the least recently used entries until within max_size
+
+            Entries that are in use (by this or another process) are never
+             removed. Returns the keys of the removed entries.
+        """
+        if self.max_size is None:
+            return []
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        total_size = sum([size for key, last_used, size in entries])
+        removed = []
+        for key, last_used, size in entries:
+            if total_size <= self.max_size:
+                break
+            lock_f = open(self._lock_fp(key), 'a')
+            try:
+                try:
+                    fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    # in use
+                    continue
+                rmtree(self._entry_dir(key), ignore_errors=True)
+                total_size -= size
+                removed.append(key)
+            finally:
+                lock_f.close()
+        return removed
+
+    def close(self):
+        """Release the entries used by this object"""
+        for lock_f in self._held_locks.values():
+            lock_f.close()
+        self._held_locks = {}
+
+
+_caches = {}
+
+
+def get_reference_db_cache(qiime_config=None):
+    """Return the ReferenceDbCache configured in qiime_config, or None
+
+        The cache directory is reference_db_cache_dir, and its maximum size
+         is reference_db_cache_max_gb gigabytes. One cache object is created
+         per directory, so the databases used by a process stay locked until
+         it exits.
+    """
+    if qiime_config is None:
+        qiime_config = load_qiime_config()
+    cache_dir = qiime_config.get('reference_db_cache_dir')
+    if not cache_dir:
+        return None
+    cache_dir = abspath(cache_dir)
+    if cache_dir not in _caches:
+        max_gb = qiime_config.get('reference_db_cache_max_gb')
+        if max_gb:
+            max_size = int(float(max_gb) * 2 ** 30)
+        else:
+            max_size = None
+        _caches[cache_dir] = ReferenceDbCache(cache_dir, max_size)
+    return _caches[cache_dir]
+
+
+def get_blast_db(fasta_fp, qiime_config=None, use_cache=True):
+    """Return (blast_db, db_files_to_remove) for the reference fasta_fp
+
+        The BLAST database is taken from the reference database cache (and
+         there are no files to remove) if one is configured and use_cache is
+         True. Otherwise a database is built next to fasta_fp, and the files
+         to remove are the files that were created.
+    """
+    cache = get_reference_db_cache(qiime_config) if use_cache else None
+    if cache is None:
+        return build_blast_db_from_fasta_path(fasta_fp)
+    blast_db = cache.get('formatdb', fasta_fp,
+                         lambda fp, output_dir:
+                         build_blast_db_from_fasta_path(fp,
+                                                        output_dir=output_dir))
+    return blast_db, []
+
+
+def get_sortmerna_db(fasta_fp, max_pos=None, output_dir=None,
+                     qiime_config=None, use_cache=True):
+    """Return (sortmerna_db, db_files_to_remove) for the reference fasta_fp
+
+        The index is taken from the reference database cache (and there are
+         no files to remove) if one is configured and use_cache is True.
+         Otherwise it is built in output_dir, and the files to remove are the
+         files that were created.
+    """
+    cache = get_reference_db_cache(qiime_config) if use_cache else None
+    if cache is None:
+        return build_database_sortmerna(fasta_fp, max_pos=max_pos,
+                                        output_dir=output_dir)
+    sortmerna_db = cache.get('indexdb_rna', fasta_fp,
+                             lambda fp, output_dir:
+                             build_database_sortmerna(fp, max_pos=max_pos,
+                                                      output_dir=output_dir),
+                             {'max_pos': max_pos})
+    return sortmerna_db, []
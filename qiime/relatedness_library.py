@@ -10,8 +10,10 @@ __version__ = "1.8.0-dev"
 __maintainer__ = "William Van Treuren"
 __email__ = "wdwvt1@gmail.com"
 
+from multiprocessing import Pool
+
 from numpy.random import shuffle
-from numpy import std, mean, arange, eye
+from numpy import std, mean, arange, eye, empty, intp, inf, array_split
 from numpy.ma import masked_array
 
 
@@ -60,6 +62,10 @@ phylocom - mean = -1.2081908, std = 0.03177133
 rel - mean = -1.23526, std = 0.02437
 """
 
+# approximate number of distances gathered at once when computing the
+# statistics of the random draws
+DRAW_BLOCK_SIZE = 2 ** 22
+
 # used by both NRI and NTI
 
 
@@ -67,10 +73,111 @@ def reduce_mtx(distmat, indices):
     """Returns rows,cols of distmat where rows,cols=indices."""
     return distmat.take(indices, 0).take(indices, 1)
 
+
+def _draw_stats(distmat, draws, stat):
+    """Return the mpd or mntd (stat) of each row of draws.
+    Notes:
+     Each row of draws is a list of indices into distmat. The nxn matrices
+     of all draws in a block are gathered with one fancy index, so at most
+     about DRAW_BLOCK_SIZE distances are held in memory at once."""
+    iters, n = draws.shape
+    size = distmat.shape[0]
+    flat = distmat.ravel()
+    result = empty(iters)
+    block_size = max(1, DRAW_BLOCK_SIZE // max(n * n, 1))
+    diag = arange(n)
+    for start in range(0, iters, block_size):
+        block = draws[start:start + block_size]
+        mtxs = flat.take((block * size)[:, :, None] + block[:, None, :])
+        if stat == 'mpd':
+            result[start:start + len(block)] = \
+                mtxs.sum(axis=(1, 2)) / (n * n - n)
+        else:
+            mtxs[:, diag, diag] = inf
+            result[start:start + len(block)] = mtxs.min(1).mean(1)
+    return result
+
+
+def _init_draw_worker(distmat):
+    global _worker_distmat
+    _worker_distmat = distmat
+
+
+def _draw_worker(task):
+    draws, stat = task
+    return _draw_stats(_worker_distmat, draws, stat)
+
+
+class NullModel(object):
+
+    """ Null distributions of MPD and MNTD of random draws of taxa
+
+        distmat: distance matrix between all taxa
+        iters: number of random draws for each group size
+        jobs_to_start: number of processes over which to split the draws
+
+        The draws follow null model 2: each is a random set of taxa drawn
+         without replacement from all taxa in distmat. The draws for each
+         group size are made once, and the mean and standard deviation of
+         their MPD and MNTD are cached, so any number of groups of the same
+         size (e.g. the samples of an OTU table) share a single null
+         distribution.
+    """
+
+    def __init__(self, distmat, iters, jobs_to_start=1):
+        self.distmat = distmat
+        self.iters = iters
+        self.jobs_to_start = jobs_to_start
+        self._draws = {}
+        self._stats = {}
+
+    def draws(self, n):
+        """Return the iters x n matrix of draws of n taxa."""
+        if n not in self._draws:
+            draws = empty((self.iters, n), dtype=intp)
+            indices = arange(self.distmat.shape[0])  # square so rows=cols
+            for row in draws:
+                shuffle(indices)  # shuffling indices after its been shuffled
+                # is not mathematically different than shuffling fresh
+                # arange(n)
+                row[:] = indices[:n]
+            self._draws[n] = draws
+        return self._draws[n]
+
+    def _null_stats(self, n, stat):
+        if (n, stat) not in self._stats:
+            draws = self.draws(n)
+            if self.jobs_to_start <= 1 or len(draws) < 2:
+                values = _draw_stats(self.distmat, draws, stat)
+            else:
+                jobs = min(self.jobs_to_start, len(draws))
+                pool = Pool(jobs, _init_draw_worker, (self.distmat,))
+                try:
+                    values = pool.map(_draw_worker,
+                                      [(chunk, stat) for chunk in
+                                       array_split(draws, jobs)])
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+                values = [v for chunk in values for v in chunk]
+            self._stats[(n, stat)] = (mean(values), std(values))
+        return self._stats[(n, stat)]
+
+    def mpd(self, n):
+        """Return mean,std of the mpd of the draws of n taxa."""
+        return self._null_stats(n, 'mpd')
+
+    def mntd(self, n):
+        """Return mean,std of the mntd of the draws of n taxa."""
+        return self._null_stats(n, 'mntd')
+
 # NRI
 
 
-def nri(distmat, marginals, group, iters):
+def nri(distmat, marginals, group, iters, null_model=None):
     """Calculate the NRI of the selected group.
     Notes:
      distmat - distance matrix between taxa.
@@ -78,11 +185,16 @@ def nri(distmat, marginals, group, iters):
      names. only need to provide row xor col marginals since its a dist mat.
      group - list of ids of the group that you want to calculate the nri of.
      iters - number of iterations to use. 1000 is suggested.
+     null_model - NullModel of distmat to draw the random groups from. pass
+     the same NullModel for many groups to reuse its draws (iters is then
+     ignored).
      MPD (mean phylogenetic distance) is calculated by mpd.
     """
     group_marginals = [marginals.index(i) for i in group]
     mn_x_obs = mpd(reduce_mtx(distmat, group_marginals))
-    mn_x_n, sd_x_n = random_mpd(distmat, len(group_marginals), iters)
+    if null_model is None:
+        null_model = NullModel(distmat, iters)
+    mn_x_n, sd_x_n = null_model.mpd(len(group_marginals))
     if abs(sd_x_n) < .00001:
         raise ValueError('The standard deviation of the means of the random' +
                          ' draws from the distance matrix was less than .00001. This is' +
@@ -96,7 +208,7 @@ def mpd(distmat):
     return distmat.sum() / (distmat.size - distmat.shape[0])
 
 
-def random_mpd(distmat, n, iters):
+def random_mpd(distmat, n, iters, jobs_to_start=1):
     """Calc mean,std of mean of iters # of rand nxn distmats drawn from distmat.
     Notes:
      Calculate the std of the means of the distances in the nxn mat excluding
@@ -104,18 +216,12 @@ def random_mpd(distmat, n, iters):
      The forumula from Webb 2002 seems to calculate the standard deviation of
      the distances but based on tests of Phylocom and the Phylocom manual,
      Phylocom computes the standard deviations of the means."""
-    means = []
-    indices = arange(distmat.shape[0])  # square so rows=cols
-    for i in range(iters):
-        shuffle(indices)  # shuffling indices after its been shuffled is not
-        # mathematically different than shuffling fresh arange(n)
-        means.append(mpd(reduce_mtx(distmat, indices[:n])))
-    return mean(means), std(means)
+    return NullModel(distmat, iters, jobs_to_start).mpd(n)
 
 # NTI
 
 
-def nti(distmat, marginals, group, iters):
+def nti(distmat, marginals, group, iters, null_model=None):
     """Calculates the NTI of the selected group.
     Notes:
      distmat - distance matrix between taxa.
@@ -123,11 +229,16 @@ def nti(distmat, marginals, group, iters):
      names. only need to provide row xor col marginals since its a dist mat.
      group - list of ids of the group that you want to calculate the nti of.
      iters - number of iterations to use. 1000 is suggested.
+     null_model - NullModel of distmat to draw the random groups from. pass
+     the same NullModel for many groups to reuse its draws (iters is then
+     ignored).
      MNTD (mean nearest taxon distance) is calculated by mntd.
     """
     group_marginals = [marginals.index(i) for i in group]
     mn_y_obs = mntd(reduce_mtx(distmat, group_marginals))
-    mn_y_n, sd_y_n = random_mntd(distmat, len(group_marginals), iters)
+    if null_model is None:
+        null_model = NullModel(distmat, iters)
+    mn_y_n, sd_y_n = null_model.mntd(len(group_marginals))
     if abs(sd_y_n) < .00001:
         raise ValueError('The standard deviation of the means of the random' +
                          ' draws from the distance matrix was less than .00001. This is' +
@@ -141,7 +252,7 @@ def mntd(distmat):
     return masked_array(distmat, eye(distmat.shape[0])).min(0).mean()
 
 
-def random_mntd(distmat, n, iters):
+def random_mntd(distmat, n, iters, jobs_to_start=1):
     """Calc mean,std of mntd of iters # of rand nxn mtx's drawn from distmat.
     Notes:
      Calculate the std of the means of minimums of the distances in the nxn mat
@@ -150,10 +261,4 @@ def random_mntd(distmat, n, iters):
      the distances but based on tests of Phylocom and the Phylocom manual,
      Phylocom computes the standard deviations of the means.
      """
-    means = []
-    indices = arange(distmat.shape[0])  # square so rows=cols
-    for i in range(iters):
-        shuffle(indices)  # shuffling indices after its been shuffled is not
-        # mathematically different than shuffling fresh arange(n)
-        means.append(mntd(reduce_mtx(distmat, indices[:n])))
-    return mean(means), std(means)
+    return NullModel(distmat, iters, jobs_to_start).mntd(n)
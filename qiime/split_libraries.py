@@ -40,7 +40,7 @@ from os import mkdir, stat
 from collections import defaultdict
 from string import upper
 
-from numpy import array, mean, arange, histogram
+from numpy import array, mean, arange, histogram, asarray
 from numpy import __version__ as numpy_version
 import warnings
 warnings.filterwarnings('ignore', 'Not using MPI as mpi4py not found')
@@ -57,7 +57,7 @@ from qiime.barcode import correct_barcode
 from qiime.hamming import decode_barcode_8
 from qiime.golay import decode as decode_golay_12
 from qiime.format import format_histograms
-from qiime.parse import QiimeParseError, parse_qual_scores
+from qiime.parse import QiimeParseError
 from qiime.util import create_dir, median_absolute_deviation
 
 # Including new=True in the histogram() call is necessary to
@@ -125,6 +125,77 @@ def ok_mm_primer(primer_seq, all_primer_seqs, primer_mm):
     return False
 
 
+class PrimerMatcher(object):
+
+    """ Tests whether sequences are within max mismatches of any primer
+
+    Gives the same answers as primer_exceeds_mismatches (and so
+     ok_mm_primer), but is built once for a set of primers (e.g., all of
+     the expansions of a degenerate primer) rather than scanning all of them
+     for every sequence. Each primer is split into max_mismatches + 1
+     segments, and a sequence can only be within max_mismatches of a primer
+     if at least one of those segments matches exactly, so only the primers
+     which share a segment with the sequence are compared to it. Results are
+     remembered, since many reads have the same primer sequence.
+    """
+
+    def __init__(self, primers, max_mismatches, max_cached=100000):
+        self.primers = set(primers)
+        self.max_mismatches = max_mismatches
+        self.max_cached = max_cached
+        self._cache = {}
+        # primer length -> (segment boundaries, [{segment: [primers]}])
+        self._seeds = {}
+        # primers too short to split into max_mismatches + 1 segments
+        self._unseeded = []
+        num_segments = max_mismatches + 1
+        for primer in self.primers:
+            primer_len = len(primer)
+            if primer_len < num_segments:
+                self._unseeded.append(primer)
+                continue
+            try:
+                bounds, segment_indices = self._seeds[primer_len]
+            except KeyError:
+                bounds = [i * primer_len // num_segments
+                          for i in range(num_segments + 1)]
+                segment_indices = [{} for i in range(num_segments)]
+                self._seeds[primer_len] = bounds, segment_indices
+            for i, segment_index in enumerate(segment_indices):
+                segment = primer[bounds[i]:bounds[i + 1]]
+                segment_index.setdefault(segment, []).append(primer)
+
+    def _candidates(self, seq):
+        """ Returns the primers which seq needs to be compared against """
+        seq_len = len(seq)
+        candidates = set(self._unseeded)
+        for primer_len, (bounds, segment_indices) in self._seeds.iteritems():
+            if seq_len < primer_len:
+                # only a prefix of these primers is compared, so the
+                # segments don't apply
+                for segment_index in segment_indices:
+                    for primers in segment_index.itervalues():
+                        candidates.update(primers)
+                continue
+            for i, segment_index in enumerate(segment_indices):
+                candidates.update(
+                    segment_index.get(seq[bounds[i]:bounds[i + 1]], ()))
+        return candidates
+
+    def exceeds_mismatches(self, seq):
+        """ Returns True if seq exceeds max mismatches to every primer """
+        try:
+            return self._cache[seq]
+        except KeyError:
+            pass
+        result = seq not in self.primers and \
+            not ok_mm_primer(seq, self._candidates(seq), self.max_mismatches)
+        if len(self._cache) >= self.max_cached:
+            self._cache.clear()
+        self._cache[seq] = result
+        return result
+
+
 def MatchScorerAmbigs(match, mismatch, matches=None):
     """ Alternative scorer factory for sw_align which allows match to ambiguous chars
 
@@ -236,6 +307,14 @@ def local_align_primer_seq(primer, sequence, sw_scorer=equality_scorer_ambigs):
 
     query_sequence = str(sequence)
 
+    # An exact occurrence of a non-degenerate primer is the best possible
+    # local alignment, and the hit start is the first occurrence of the
+    # aligned target, so the alignment can be skipped.
+    if query_primer and not set(query_primer).difference('ACGT'):
+        hit_start = query_sequence.find(query_primer)
+        if hit_start != -1:
+            return 0, hit_start
+
     # Get alignment object from primer, target sequence
     alignment = pair_hmm_align_unaligned_seqs([query_primer, query_sequence])
 
@@ -531,6 +610,141 @@ def qual_missing(id_, seq, qual):
 QualMissing = SeqQualBad('Missing Qual Score', qual_missing)
 
 
+def read_qual_record(qual_file, value_cast_f=int, line=None):
+    """Read the next qual record from qual_file
+
+    line is the first line of the record if it has already been read from
+    qual_file (i.e., the line returned by the previous call), so that the
+    file never has to seek back to it: seeking backwards in a gzipped file
+    decompresses it again from the start.
+
+    Returns (seq_id, qual_scores, next_line), where next_line is the header
+    line of the following record ('' at the end of the file), or None if
+    there are no more records. Blank lines and lines beginning with '#' are
+    ignored, as in MinimalQualParser.
+    """
+    if line is None:
+        line = qual_file.readline()
+    while line and (not line.strip() or line.startswith('#')):
+        line = qual_file.readline()
+    if not line:
+        return None
+    if not line.startswith('>'):
+        raise QiimeParseError(
+            "Invalid qual file. Check the format of the qual files.")
+    seq_id = line[1:].split()[0]
+
+    score_lines = []
+    line = qual_file.readline()
+    while line and not line.startswith('>'):
+        if not line.startswith('#'):
+            score_lines.append(line)
+        line = qual_file.readline()
+    try:
+        qual_scores = asarray(' '.join(score_lines).split(),
+                              dtype=value_cast_f)
+    except ValueError:
+        raise QiimeParseError(
+            "Invalid qual file. Check the format of the qual files.")
+    return seq_id, qual_scores, line
+
+
+class StreamingQualScores(object):
+
+    """Quality scores which are read from qual files as they are requested
+
+    This is used in place of a {seq_id: qual_scores} dict of all of the
+    quality scores (check_seqs only calls get), so that only one record's
+    scores are held in memory at a time.
+
+    get is expected to be called in the order in which the sequences appear
+    in the fasta files. While the qual files contain the same ids in the
+    same order, each record is read as it is requested, and the files are
+    only ever read forwards. When a requested id isn't the next qual record,
+    the qual files are indexed (recording the position of each record's
+    header, not its scores) and the file is seeked to the record; reading
+    then continues in lockstep from the record after it. Seeking backwards
+    in a gzipped qual file decompresses it again from the start, so the
+    fallback is much slower for gzipped files.
+
+    qual_files: the open qual files, positioned at their start
+    """
+
+    def __init__(self, qual_files, value_cast_f=int):
+        self.qual_files = list(qual_files)
+        self._value_cast_f = value_cast_f
+        # the file being read in lockstep, and the line read from it which
+        # starts the next record (None if no line has been read ahead)
+        self._file_index = 0
+        self._line = None
+        # the next record, if it has been read but not requested
+        self._next_record = None
+        self._index = None
+        self.indexed_lookups = 0
+
+    def __nonzero__(self):
+        return len(self.qual_files) > 0
+
+    def _read_next(self):
+        """ Return the next (seq_id, qual_scores) in lockstep, or None """
+        while self._file_index < len(self.qual_files):
+            result = read_qual_record(self.qual_files[self._file_index],
+                                      self._value_cast_f, self._line)
+            if result is not None:
+                seq_id, qual_scores, self._line = result
+                return seq_id, qual_scores
+            self._file_index += 1
+            self._line = None
+            if self._file_index < len(self.qual_files):
+                qual_file = self.qual_files[self._file_index]
+                # the file was read through if the index has been built
+                if qual_file.tell() != 0:
+                    qual_file.seek(0)
+        return None
+
+    def _build_index(self):
+        """ Map each seq_id to the position of its record's header line """
+        if self._file_index < len(self.qual_files):
+            resume_at = self.qual_files[self._file_index].tell()
+        index = {}
+        for file_index, qual_file in enumerate(self.qual_files):
+            qual_file.seek(0)
+            while True:
+                offset = qual_file.tell()
+                line = qual_file.readline()
+                if not line:
+                    break
+                if line.startswith('>'):
+                    index[line[1:].split()[0]] = (file_index, offset)
+        # carry on reading in lockstep from where we were
+        if self._file_index < len(self.qual_files):
+            self.qual_files[self._file_index].seek(resume_at)
+        return index
+
+    def get(self, seq_id, default=None):
+        """ Return the qual scores of seq_id, or default if it has none """
+        if self._next_record is None:
+            self._next_record = self._read_next()
+        if self._next_record is not None and \
+                self._next_record[0] == seq_id:
+            qual_scores = self._next_record[1]
+            self._next_record = None
+            return qual_scores
+
+        if self._index is None:
+            self._index = self._build_index()
+        try:
+            file_index, offset = self._index[seq_id]
+        except KeyError:
+            return default
+        self.indexed_lookups += 1
+        self._file_index = file_index
+        self._line = None
+        self._next_record = None
+        self.qual_files[file_index].seek(offset)
+        return self._read_next()[1]
+
+
 def get_seq_lengths(seq_lengths, bc_counts):
     """Convenience wrapper for getting lengths of good and bad seqs"""
     all_seq_lengths = seq_lengths.values()
@@ -574,7 +788,12 @@ def check_seqs(fasta_out, fasta_files, starting_ix, valid_map, qual_mappings,
                discard_bad_windows=False, min_qual_score=25, min_seq_len=200,
                median_length_filtering=None, added_demultiplex_field=None,
                reverse_primer_mismatches=0, truncate_ambi_bases=False):
-    """Checks fasta-format sequences and qual files for validity."""
+    """Checks fasta-format sequences and qual files for validity.
+
+    qual_mappings: {seq_id: qual_scores}, or a StreamingQualScores object
+     (anything with a dict-like get method); ids without qual scores are
+     looked up as None
+    """
 
     seq_lengths = {}
 
@@ -594,6 +813,9 @@ def check_seqs(fasta_out, fasta_files, starting_ix, valid_map, qual_mappings,
 
     primer_mismatch_count = 0
     all_primers_lens = sorted(set(all_primers.values()))
+    # barcode -> PrimerMatcher for the barcode's primers
+    primer_matchers = {}
+    all_primers_matcher = PrimerMatcher(all_primers, max_primer_mm)
 
     reverse_primer_not_found = 0
 
@@ -659,8 +881,15 @@ def check_seqs(fasta_out, fasta_files, starting_ix, valid_map, qual_mappings,
                     # of the given primer, or degenerate variations thereof.
                     primer_len = current_primers.values()[0]
 
-                    if primer_exceeds_mismatches(raw_seq[:primer_len],
-                                                 current_primers, max_primer_mm):
+                    try:
+                        primer_matcher = primer_matchers[raw_barcode]
+                    except KeyError:
+                        primer_matcher = PrimerMatcher(current_primers,
+                                                       max_primer_mm)
+                        primer_matchers[raw_barcode] = primer_matcher
+
+                    if primer_matcher.exceeds_mismatches(
+                            raw_seq[:primer_len]):
                         bc_counts['#FAILED'].append(curr_rid)
                         primer_mismatch_count += 1
                         continue
@@ -671,12 +900,10 @@ def check_seqs(fasta_out, fasta_files, starting_ix, valid_map, qual_mappings,
                     # our primer sets, so, in ascending order of all the given
                     # primer lengths, a sequence will the sliced out and compared
                     # to the primer set.
-                    current_primers = all_primers
                     found_match = False
                     for seq_slice_len in all_primers_lens:
-                        if not(
-                            primer_exceeds_mismatches(raw_seq[:seq_slice_len],
-                                                      current_primers, max_primer_mm)):
+                        if not all_primers_matcher.exceeds_mismatches(
+                                raw_seq[:seq_slice_len]):
                             primer_len = seq_slice_len
                             found_match = True
                             break
@@ -1360,15 +1587,10 @@ def preprocess(fasta_files, qual_files, mapping_file,
 
     for f in fasta_files:
         f.seek(0)
-    if qual_files:
-        for q in qual_files:
-            q.seek(0)
-        # Load quality scores
-        qual_mappings = parse_qual_scores(qual_files)
-        for q in qual_files:
-            q.close()
-    else:
-        qual_mappings = {}
+    for q in qual_files:
+        q.seek(0)
+    # quality scores are read as check_seqs needs them
+    qual_mappings = StreamingQualScores(qual_files)
 
     # make filters
     filters = []
@@ -1406,7 +1628,7 @@ def preprocess(fasta_files, qual_files, mapping_file,
             'Num ambiguous bases exceeds limit of %s' % max_ambig,
             lambda id_, seq, qual: count_ambig(seq) > max_ambig))
 
-    if qual_mappings:
+    if qual_files:
         filters.append(QualMissing)
         filters.append(SeqQualBad(
             'Mean qual score below minimum of %s' % min_qual_score,
@@ -1445,6 +1667,8 @@ def preprocess(fasta_files, qual_files, mapping_file,
                                                           discard_bad_windows, min_qual_score, min_seq_len,
                                                           median_length_filtering, added_demultiplex_field,
                                                           reverse_primer_mismatches, truncate_ambi_bases)
+    for q in qual_files:
+        q.close()
 
     # Write log file
     log_file = open(dir_prefix + '/' + "split_library_log.txt", 'w+')
@@ -10,11 +10,14 @@ __version__ = "1.8.0-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
-from itertools import izip, cycle
+from itertools import izip, cycle, combinations, product, islice
+from multiprocessing import Pool
 from os.path import split, splitext, join
 from os import makedirs
+from collections import defaultdict
 
-from numpy import log10, arange, histogram
+from numpy import (log10, arange, histogram, array, empty, zeros, cumsum,
+                   frombuffer, int32, uint8, newaxis, ndarray)
 
 from skbio.parse.sequences import parse_fastq
 from skbio.sequence import DNA
@@ -24,7 +27,7 @@ from qiime.format import (format_histogram_one_count,
                           format_split_libraries_fastq_log)
 from qiime.parse import is_casava_v180_or_later
 from qiime.hamming import decode_hamming_8
-from qiime.golay import decode_golay_12
+from qiime.golay import decode_golay_12, decode_golay_12_many
 from qiime.util import qiime_open
 
 
@@ -76,6 +79,23 @@ def read_qual_score_filter(seq, qual, max_run_length, threshold):
     return seq, qual
 
 
+def illumina_qual_digit_is_zero(header):
+    """Return True if the header's Illumina quality digit is 0"""
+    h = header.split()[0]
+    try:
+        # this block is a little strange because each of these
+        # can throw a ValueError. The same thing needs to be done
+        # in either case, so it doesn't really make sense to split
+        # into two separate try/excepts, particulary because that would
+        # complicate the logic
+        quality_char = header[h.index('#') + 1]
+        illumina_quality_digit = int(quality_char)
+    except ValueError:
+        return False
+    else:
+        return illumina_quality_digit == 0
+
+
 def quality_filter_sequence(header,
                             sequence,
                             quality,
@@ -84,21 +104,8 @@ def quality_filter_sequence(header,
                             min_per_read_length,
                             seq_max_N,
                             filter_bad_illumina_qual_digit):
-    if filter_bad_illumina_qual_digit:
-        h = header.split()[0]
-        try:
-            # this block is a little strange because each of these
-            # can throw a ValueError. The same thing needs to be done
-            # in either case, so it doesn't really make sense to split
-            # into two separate try/excepts, particulary because that would
-            # complicate the logic
-            quality_char = header[h.index('#') + 1]
-            illumina_quality_digit = int(quality_char)
-        except ValueError:
-            pass
-        else:
-            if illumina_quality_digit == 0:
-                return 3, sequence, quality
+    if filter_bad_illumina_qual_digit and illumina_qual_digit_is_zero(header):
+        return 3, sequence, quality
 
     sequence, quality = read_qual_score_filter(sequence,
                                                quality,
@@ -113,6 +120,103 @@ def quality_filter_sequence(header,
         return 0, sequence, quality
 
 
+def qual_score_filter_lengths(quals, max_run_length, threshold):
+    """Compute read_qual_score_filter truncation points for many reads
+
+       quals: 2-D array of quality scores, one row per read (so all reads
+        must be the same length)
+
+       returns an array with the length that each read should be truncated
+        to, which is the full read length if it has no run of more than
+        max_run_length scores <= threshold
+    """
+    num_reads, read_length = quals.shape
+    lengths = empty(num_reads, dtype=int)
+    lengths.fill(read_length)
+    run_length = max_run_length + 1
+    if threshold is None or run_length > read_length:
+        return lengths
+
+    # bad_counts[:, j] - bad_counts[:, i] is the number of bad scores in
+    # positions i to j - 1, so a window which is entirely bad marks the
+    # start of the first run that is too long
+    bad_counts = zeros((num_reads, read_length + 1), dtype=int32)
+    cumsum(quals <= threshold, axis=1, out=bad_counts[:, 1:])
+    too_bad = (bad_counts[:, run_length:] -
+               bad_counts[:, :-run_length]) == run_length
+    has_bad_run = too_bad.any(axis=1)
+    lengths[has_bad_run] = too_bad[has_bad_run].argmax(axis=1)
+    return lengths
+
+
+def quality_filter_sequences(headers,
+                             sequences,
+                             qualities,
+                             max_bad_run_length,
+                             phred_quality_threshold,
+                             min_per_read_length,
+                             seq_max_N,
+                             filter_bad_illumina_qual_digit):
+    """Apply quality_filter_sequence to many reads at once
+
+       Reads are grouped by length, and each group is packed into 2-D
+       arrays of sequence characters and quality scores so truncation
+       points and N counts are computed for the whole group at once.
+
+       returns a list of (quality filter result, sequence, quality), one
+        per read, identical to what quality_filter_sequence returns
+    """
+    results = [None] * len(sequences)
+    reads_by_length = defaultdict(list)
+    for i, (header, sequence, quality) in enumerate(
+            izip(headers, sequences, qualities)):
+        if filter_bad_illumina_qual_digit and \
+           illumina_qual_digit_is_zero(header):
+            results[i] = (3, sequence, quality)
+        elif len(sequence) != len(quality) or \
+                not isinstance(quality, ndarray):
+            # leave it to read_qual_score_filter to handle (or fail on)
+            # this read
+            results[i] = quality_filter_sequence(header,
+                                                 sequence,
+                                                 quality,
+                                                 max_bad_run_length,
+                                                 phred_quality_threshold,
+                                                 min_per_read_length,
+                                                 seq_max_N,
+                                                 False)
+        else:
+            reads_by_length[len(sequence)].append(i)
+
+    for read_length, indices in reads_by_length.items():
+        if read_length == 0:
+            # handled on their own as numpy can't build a 0-width array
+            # from the joined sequences
+            lengths = [0] * len(indices)
+            n_counts = [0] * len(indices)
+        else:
+            lengths = qual_score_filter_lengths(
+                array([qualities[i] for i in indices]),
+                max_bad_run_length,
+                phred_quality_threshold)
+            seq_chars = frombuffer(''.join([sequences[i] for i in indices]),
+                                   dtype=uint8).reshape((len(indices),
+                                                         read_length))
+            n_counts = ((seq_chars == ord('N')) &
+                        (arange(read_length) < lengths[:, newaxis])).sum(1)
+
+        for i, length, n_count in izip(indices, lengths, n_counts):
+            sequence = sequences[i][:length]
+            quality = qualities[i][:length]
+            if length < min_per_read_length:
+                results[i] = (1, sequence, quality)
+            elif n_count > seq_max_N:
+                results[i] = (2, sequence, quality)
+            else:
+                results[i] = (0, sequence, quality)
+    return results
+
+
 def check_header_match_pre180(header1, header2):
 
     # split on '#' and '/' to handle cases with and without the
@@ -141,6 +245,12 @@ BARCODE_DECODER_LOOKUP = {
     #'hamming_8':decode_hamming_8,
 }
 
+# vectorized equivalents of the BARCODE_DECODER_LOOKUP functions, taking a
+# list of barcodes and returning a list of (corrected barcode, num errors)
+BATCH_BARCODE_DECODER_LOOKUP = {
+    decode_golay_12: decode_golay_12_many,
+}
+
 
 def correct_barcode(barcode, barcode_to_sample_id, correction_fn):
     """Correct barcode given barcode, dict of valid barcodes, and correction fn
@@ -173,6 +283,133 @@ def correct_barcode(barcode, barcode_to_sample_id, correction_fn):
         return num_errors, corrected_barcode, True, sample_id
 
 
+def barcode_neighbors(barcode, max_nt_errors, alphabet='ACGT'):
+    """Yield every sequence within max_nt_errors substitutions of barcode
+
+       barcode itself is not yielded. Each neighbor is yielded once.
+    """
+    for num_errors in range(1, max_nt_errors + 1):
+        for positions in combinations(range(len(barcode)), num_errors):
+            choices = [[nt for nt in alphabet if nt != barcode[p]]
+                       for p in positions]
+            for substitutions in product(*choices):
+                neighbor = list(barcode)
+                for p, nt in zip(positions, substitutions):
+                    neighbor[p] = nt
+                yield ''.join(neighbor)
+
+
+class BarcodeCorrector(object):
+
+    """Lookup table of correct_barcode results
+
+       Every barcode in barcode_to_sample_id and, when a batch decoder is
+       available for correction_fn, every sequence within max_nt_errors
+       substitutions of one of those barcodes is corrected up front, so most
+       reads are resolved with a single dict lookup. Other barcodes are
+       corrected on demand and memoized (up to max_cached of them). Results
+       are always identical to calling correct_barcode directly.
+    """
+
+    def __init__(self,
+                 barcode_to_sample_id,
+                 correction_fn,
+                 max_nt_errors=2,
+                 max_cached=2 ** 20,
+                 batch_size=2 ** 16):
+        self.barcode_to_sample_id = barcode_to_sample_id
+        self.correction_fn = correction_fn
+        self.batch_correction_fn = \
+            BATCH_BARCODE_DECODER_LOOKUP.get(correction_fn, None)
+        self.max_cached = max_cached
+        self.batch_size = batch_size
+        self._num_cached = 0
+
+        self._index = {}
+        for barcode, sample_id in barcode_to_sample_id.items():
+            self._index[barcode] = (0, barcode, False, sample_id)
+
+        if self.batch_correction_fn is not None:
+            neighbors = []
+            for barcode in barcode_to_sample_id:
+                for neighbor in barcode_neighbors(barcode, max_nt_errors):
+                    if neighbor not in self._index:
+                        # placeholder, so each neighbor is corrected once
+                        self._index[neighbor] = None
+                        neighbors.append(neighbor)
+            for start in range(0, len(neighbors), batch_size):
+                batch = neighbors[start:start + batch_size]
+                for barcode, result in zip(batch, self._correct(batch)):
+                    self._index[barcode] = result
+
+    def __call__(self, barcode):
+        """Return correct_barcode(barcode, ...) for a single barcode"""
+        try:
+            return self._index[barcode]
+        except KeyError:
+            result = correct_barcode(barcode,
+                                     self.barcode_to_sample_id,
+                                     self.correction_fn)
+            self._cache(barcode, result)
+            return result
+
+    def correct_barcodes(self, barcodes):
+        """Return correct_barcode results for a list of barcodes
+
+           Barcodes missing from the index are corrected together with the
+           batch decoder (if there is one) rather than one at a time.
+        """
+        index = self._index
+        misses = list(set([bc for bc in barcodes if bc not in index]))
+        corrected = {}
+        for start in range(0, len(misses), self.batch_size):
+            batch = misses[start:start + self.batch_size]
+            corrected.update(zip(batch, self._correct(batch)))
+        for barcode, result in corrected.items():
+            self._cache(barcode, result)
+
+        results = []
+        for barcode in barcodes:
+            try:
+                results.append(index[barcode])
+            except KeyError:
+                # the cache was full
+                results.append(corrected[barcode])
+        return results
+
+    def _cache(self, barcode, result):
+        if self._num_cached < self.max_cached:
+            self._index[barcode] = result
+            self._num_cached += 1
+
+    def _correct(self, barcodes):
+        """Compute correct_barcode results for barcodes not in the index"""
+        if self.batch_correction_fn is None:
+            return [correct_barcode(bc,
+                                    self.barcode_to_sample_id,
+                                    self.correction_fn)
+                    for bc in barcodes]
+
+        barcode_to_sample_id = self.barcode_to_sample_id
+        results = [None] * len(barcodes)
+        to_decode = []
+        for i, barcode in enumerate(barcodes):
+            if barcode in barcode_to_sample_id or 'N' in barcode:
+                results[i] = correct_barcode(barcode,
+                                             barcode_to_sample_id,
+                                             self.correction_fn)
+            else:
+                to_decode.append(i)
+
+        decoded = self.batch_correction_fn([barcodes[i] for i in to_decode])
+        for i, (corrected_barcode, num_errors) in zip(to_decode, decoded):
+            results[i] = (num_errors,
+                          corrected_barcode,
+                          True,
+                          barcode_to_sample_id.get(corrected_barcode, None))
+        return results
+
+
 def process_fastq_single_end_read_file_no_barcode(
         fastq_read_f,
         sample_id,
@@ -186,7 +423,9 @@ def process_fastq_single_end_read_file_no_barcode(
         filter_bad_illumina_qual_digit=False,
         log_f=None,
         histogram_f=None,
-        phred_offset=None):
+        phred_offset=None,
+        num_workers=1,
+        chunk_size=10000):
     """ Quality filtering when a single sample has been run in a lane
 
         This code simulates a barcode file to allow us to re-use the quality
@@ -215,7 +454,9 @@ def process_fastq_single_end_read_file_no_barcode(
             barcode_correction_fn=None,
             max_barcode_errors=0,
             strict_header_match=False,
-            phred_offset=phred_offset):
+            phred_offset=phred_offset,
+            num_workers=num_workers,
+            chunk_size=chunk_size):
         yield e
 
 
@@ -236,13 +477,16 @@ def process_fastq_single_end_read_file(fastq_read_f,
                                        barcode_correction_fn=None,
                                        max_barcode_errors=1.5,
                                        strict_header_match=True,
-                                       phred_offset=None):
+                                       phred_offset=None,
+                                       num_workers=1,
+                                       chunk_size=10000):
     """parses fastq single-end read file
-    """
-    header_index = 0
-    sequence_index = 1
-    quality_index = 2
 
+       If num_workers > 1, the read and barcode files are read in chunks of
+       chunk_size records, and the chunks are barcode corrected and quality
+       filtered in a pool of num_workers processes. Output (including
+       sequence ids, log and histogram) is identical to the serial mode.
+    """
     seq_id = start_seq_id
     # grab the first lines and then seek back to the beginning of the file
     try:
@@ -282,122 +526,62 @@ def process_fastq_single_end_read_file(fastq_read_f,
     min_per_read_length = min_per_read_length_fraction * \
         len(fastq_read_f_line2)
 
-    # prep data for logging
-    input_sequence_count = 0
-    count_barcode_not_in_map = 0
-    count_too_short = 0
-    count_too_many_N = 0
-    count_bad_illumina_qual_digit = 0
-    count_barcode_errors_exceed_max = 0
-    sequence_lengths = []
-    seqs_per_sample_counts = {}
-    for bc_data, read_data in izip(
-            parse_fastq(fastq_barcode_f, strict=False, phred_offset=phred_offset),
-            parse_fastq(fastq_read_f, strict=False, phred_offset=phred_offset)):
-        input_sequence_count += 1
-        # Confirm match between barcode and read headers
-        if strict_header_match and \
-           (not check_header_match_f(bc_data[header_index], read_data[header_index])):
-            raise FastqParseError("Headers of barcode and read do not match. Can't continue. "
-                                  "Confirm that the barcode fastq and read fastq that you are "
-                                  "passing match one another.")
-        else:
-            header = read_data[header_index]
-
-        # Grab the barcode sequence
-        if barcode_length:
-            # because thirteen cycles are sometimes used for
-            # techical reasons, this step looks only at the
-            # first tweleve bases. note that the barcode is
-            # rev-comp'ed after this step if requested since
-            # the thirteen base is a technical artefact, not
-            # barcode sequence.
-            barcode = bc_data[sequence_index][:barcode_length]
-        else:
-            barcode = bc_data[sequence_index]
-        if rev_comp_barcode:
-            barcode = str(DNA(barcode).rc())
-        # Grab the read sequence
-        sequence = read_data[1]
-        # Grab the read quality
-        quality = read_data[2]
-
-        # correct the barcode (if applicable) and map to sample id
-        num_barcode_errors, corrected_barcode, correction_attempted, sample_id = \
-            correct_barcode(
-                barcode,
-                barcode_to_sample_id,
-                barcode_correction_fn)
-        # skip samples with too many errors
-        if (num_barcode_errors > max_barcode_errors):
-            count_barcode_errors_exceed_max += 1
-            continue
-
-        # skip unassignable samples unless otherwise requested
-        if sample_id is None:
-            if not store_unassigned:
-                count_barcode_not_in_map += 1
-                continue
-            else:
-                sample_id = 'Unassigned'
-
-        quality_filter_result, sequence, quality =\
-            quality_filter_sequence(header,
-                                    sequence,
-                                    quality,
-                                    max_bad_run_length,
-                                    phred_quality_threshold,
-                                    min_per_read_length,
-                                    seq_max_N,
-                                    filter_bad_illumina_qual_digit)
-
-        # process quality result
-        if quality_filter_result != 0:
-            # if the quality filter didn't pass record why and
-            # move on to the next record
-            if quality_filter_result == 1:
-                count_too_short += 1
-            elif quality_filter_result == 2:
-                count_too_many_N += 1
-            elif quality_filter_result == 3:
-                count_bad_illumina_qual_digit += 1
-            else:
-                raise ValueError(
-                    "Unknown quality filter result: %d" %
-                    quality_filter_result)
-            continue
-
-        sequence_lengths.append(len(sequence))
-
-        try:
-            seqs_per_sample_counts[sample_id] += 1
-        except KeyError:
-            seqs_per_sample_counts[sample_id] = 1
-
-        if rev_comp:
-            sequence = str(DNA(sequence).rc())
-            quality = quality[::-1]
-
+    read_counts = _empty_fastq_counts()
+    demultiplex_params = {
+        'strict_header_match': strict_header_match,
+        'check_header_match_f': check_header_match_f,
+        'barcode_length': barcode_length,
+        'rev_comp_barcode': rev_comp_barcode,
+        'max_barcode_errors': max_barcode_errors,
+        'store_unassigned': store_unassigned,
+        'max_bad_run_length': max_bad_run_length,
+        'phred_quality_threshold': phred_quality_threshold,
+        'min_per_read_length': min_per_read_length,
+        'seq_max_N': seq_max_N,
+        'filter_bad_illumina_qual_digit': filter_bad_illumina_qual_digit,
+        'rev_comp': rev_comp}
+
+    if num_workers > 1:
+        demultiplexed_reads = _demultiplex_fastq_in_parallel(
+            fastq_barcode_f, fastq_read_f, read_counts, barcode_to_sample_id,
+            barcode_correction_fn, phred_offset, demultiplex_params,
+            num_workers, chunk_size)
+    else:
+        barcode_corrector = BarcodeCorrector(barcode_to_sample_id,
+                                             barcode_correction_fn)
+        demultiplexed_reads = demultiplex_fastq_records(
+            parse_fastq(fastq_barcode_f, strict=False,
+                        phred_offset=phred_offset),
+            parse_fastq(fastq_read_f, strict=False,
+                        phred_offset=phred_offset),
+            barcode_corrector, read_counts, **demultiplex_params)
+
+    for (sample_id, header, barcode, corrected_barcode, num_barcode_errors,
+         sequence, quality) in demultiplexed_reads:
         fasta_header = '%s_%s %s orig_bc=%s new_bc=%s bc_diffs=%d' %\
             (sample_id, seq_id, header, barcode,
              corrected_barcode, num_barcode_errors)
         yield fasta_header, sequence, quality, seq_id
         seq_id += 1
 
+    sequence_lengths = read_counts['sequence_lengths']
+    seqs_per_sample_counts = read_counts['seqs_per_sample_counts']
+
     # Add sample IDs with zero counts to dictionary for logging
     for curr_sample_id in barcode_to_sample_id.values():
         if curr_sample_id not in seqs_per_sample_counts.keys():
             seqs_per_sample_counts[curr_sample_id] = 0
 
     if log_f is not None:
-        log_str = format_split_libraries_fastq_log(count_barcode_not_in_map,
-                                                   count_too_short,
-                                                   count_too_many_N,
-                                                   count_bad_illumina_qual_digit,
-                                                   count_barcode_errors_exceed_max,
-                                                   input_sequence_count,
-                                                   sequence_lengths,
-                                                   seqs_per_sample_counts)
+        log_str = format_split_libraries_fastq_log(
+            read_counts['barcode_not_in_map'],
+            read_counts['too_short'],
+            read_counts['too_many_N'],
+            read_counts['bad_illumina_qual_digit'],
+            read_counts['barcode_errors_exceed_max'],
+            read_counts['input_sequence_count'],
+            sequence_lengths,
+            seqs_per_sample_counts)
         log_f.write(log_str)
 
     if len(sequence_lengths) and histogram_f is not None:
@@ -407,6 +591,257 @@ def process_fastq_single_end_read_file(fastq_read_f,
         histogram_f.write('\n--\n\n')
 
 
+def _empty_fastq_counts():
+    """Return the counters that demultiplex_fastq_records updates"""
+    return {'input_sequence_count': 0,
+            'barcode_not_in_map': 0,
+            'too_short': 0,
+            'too_many_N': 0,
+            'bad_illumina_qual_digit': 0,
+            'barcode_errors_exceed_max': 0,
+            'sequence_lengths': [],
+            'seqs_per_sample_counts': {}}
+
+
+def _merge_fastq_counts(counts, other_counts):
+    """Add the counters in other_counts to counts (in place)"""
+    for key, value in other_counts.items():
+        if key == 'sequence_lengths':
+            counts[key].extend(value)
+        elif key == 'seqs_per_sample_counts':
+            for sample_id, count in value.items():
+                try:
+                    counts[key][sample_id] += count
+                except KeyError:
+                    counts[key][sample_id] = count
+        else:
+            counts[key] += value
+
+
+def demultiplex_fastq_records(barcode_records,
+                              read_records,
+                              barcode_corrector,
+                              counts,
+                              strict_header_match,
+                              check_header_match_f,
+                              barcode_length,
+                              rev_comp_barcode,
+                              max_barcode_errors,
+                              store_unassigned,
+                              max_bad_run_length,
+                              phred_quality_threshold,
+                              min_per_read_length,
+                              seq_max_N,
+                              filter_bad_illumina_qual_digit,
+                              rev_comp,
+                              batch_size=1000):
+    """Barcode correct and quality filter parsed fastq records
+
+       Records are processed batch_size at a time so the quality filter can
+       be applied to a whole batch with quality_filter_sequences.
+
+       barcode_records, read_records: iterables of (header, seq, qual)
+        as yielded by parse_fastq
+       barcode_corrector: BarcodeCorrector (or any callable taking a
+        barcode and returning the same values as correct_barcode)
+       counts: dict of counters as created by _empty_fastq_counts, which
+        is updated as records are processed
+
+       yields (sample_id, header, barcode, corrected_barcode,
+               num_barcode_errors, sequence, quality) for each read that
+               passes filtering
+    """
+    header_index = 0
+    sequence_index = 1
+    quality_index = 2
+
+    sequence_lengths = counts['sequence_lengths']
+    seqs_per_sample_counts = counts['seqs_per_sample_counts']
+    records = izip(barcode_records, read_records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+
+        # reads which pass barcode correction, as (sample_id, header,
+        # barcode, corrected_barcode, num_barcode_errors) and the
+        # corresponding sequences and qualities
+        assigned_reads = []
+        sequences = []
+        qualities = []
+        for bc_data, read_data in batch:
+            counts['input_sequence_count'] += 1
+            # Confirm match between barcode and read headers
+            if strict_header_match and \
+               (not check_header_match_f(bc_data[header_index], read_data[header_index])):
+                raise FastqParseError("Headers of barcode and read do not match. Can't continue. "
+                                      "Confirm that the barcode fastq and read fastq that you are "
+                                      "passing match one another.")
+            else:
+                header = read_data[header_index]
+
+            # Grab the barcode sequence
+            if barcode_length:
+                # because thirteen cycles are sometimes used for
+                # techical reasons, this step looks only at the
+                # first tweleve bases. note that the barcode is
+                # rev-comp'ed after this step if requested since
+                # the thirteen base is a technical artefact, not
+                # barcode sequence.
+                barcode = bc_data[sequence_index][:barcode_length]
+            else:
+                barcode = bc_data[sequence_index]
+            if rev_comp_barcode:
+                barcode = str(DNA(barcode).rc())
+
+            # correct the barcode (if applicable) and map to sample id
+            num_barcode_errors, corrected_barcode, correction_attempted, sample_id = \
+                barcode_corrector(barcode)
+            # skip samples with too many errors
+            if (num_barcode_errors > max_barcode_errors):
+                counts['barcode_errors_exceed_max'] += 1
+                continue
+
+            # skip unassignable samples unless otherwise requested
+            if sample_id is None:
+                if not store_unassigned:
+                    counts['barcode_not_in_map'] += 1
+                    continue
+                else:
+                    sample_id = 'Unassigned'
+
+            assigned_reads.append((sample_id, header, barcode,
+                                   corrected_barcode, num_barcode_errors))
+            sequences.append(read_data[sequence_index])
+            qualities.append(read_data[quality_index])
+
+        quality_filter_results = quality_filter_sequences(
+            [read[1] for read in assigned_reads],
+            sequences,
+            qualities,
+            max_bad_run_length,
+            phred_quality_threshold,
+            min_per_read_length,
+            seq_max_N,
+            filter_bad_illumina_qual_digit)
+
+        for (sample_id, header, barcode, corrected_barcode,
+             num_barcode_errors), (quality_filter_result, sequence,
+                                   quality) in izip(assigned_reads,
+                                                    quality_filter_results):
+            # process quality result
+            if quality_filter_result != 0:
+                # if the quality filter didn't pass record why and
+                # move on to the next record
+                if quality_filter_result == 1:
+                    counts['too_short'] += 1
+                elif quality_filter_result == 2:
+                    counts['too_many_N'] += 1
+                elif quality_filter_result == 3:
+                    counts['bad_illumina_qual_digit'] += 1
+                else:
+                    raise ValueError(
+                        "Unknown quality filter result: %d" %
+                        quality_filter_result)
+                continue
+
+            sequence_lengths.append(len(sequence))
+
+            try:
+                seqs_per_sample_counts[sample_id] += 1
+            except KeyError:
+                seqs_per_sample_counts[sample_id] = 1
+
+            if rev_comp:
+                sequence = str(DNA(sequence).rc())
+                quality = quality[::-1]
+
+            yield (sample_id, header, barcode, corrected_barcode,
+                   num_barcode_errors, sequence, quality)
+
+
+def read_fastq_chunks(fastq_barcode_f, fastq_read_f, chunk_size):
+    """Yield (barcode lines, read lines) for chunk_size records at a time
+
+       Fastq records are assumed to be four lines long (as written by
+       Illumina's software), so each chunk is record-aligned. Lines are
+       returned unparsed so that parsing can happen in worker processes.
+    """
+    fastq_barcode_f = iter(fastq_barcode_f)
+    fastq_read_f = iter(fastq_read_f)
+    num_lines = 4 * chunk_size
+    while True:
+        read_lines = list(islice(fastq_read_f, num_lines))
+        if not read_lines:
+            break
+        barcode_lines = list(islice(fastq_barcode_f, len(read_lines)))
+        yield barcode_lines, read_lines
+        if len(read_lines) < num_lines or len(barcode_lines) < num_lines:
+            break
+
+# per-process state for the _demultiplex_fastq_chunk worker function
+_fastq_worker_state = {}
+
+
+def _init_fastq_worker(barcode_to_sample_id, barcode_correction_fn,
+                       phred_offset, demultiplex_params):
+    """Set up a worker process for _demultiplex_fastq_chunk"""
+    _fastq_worker_state['barcode_corrector'] = \
+        BarcodeCorrector(barcode_to_sample_id, barcode_correction_fn)
+    _fastq_worker_state['phred_offset'] = phred_offset
+    _fastq_worker_state['demultiplex_params'] = demultiplex_params
+
+
+def _demultiplex_fastq_chunk(chunk):
+    """Demultiplex one chunk of lines from read_fastq_chunks
+
+       returns the demultiplexed reads and the chunk's counters
+    """
+    barcode_lines, read_lines = chunk
+    phred_offset = _fastq_worker_state['phred_offset']
+    counts = _empty_fastq_counts()
+    reads = list(demultiplex_fastq_records(
+        parse_fastq(barcode_lines, strict=False, phred_offset=phred_offset),
+        parse_fastq(read_lines, strict=False, phred_offset=phred_offset),
+        _fastq_worker_state['barcode_corrector'],
+        counts,
+        **_fastq_worker_state['demultiplex_params']))
+    return reads, counts
+
+
+def _demultiplex_fastq_in_parallel(fastq_barcode_f,
+                                   fastq_read_f,
+                                   counts,
+                                   barcode_to_sample_id,
+                                   barcode_correction_fn,
+                                   phred_offset,
+                                   demultiplex_params,
+                                   num_workers,
+                                   chunk_size):
+    """Demultiplex chunks of reads in a pool of worker processes
+
+       Reads are yielded in input order, and each chunk's counters are
+       merged into counts as the chunk is yielded.
+    """
+    # check_header_match_f is a module-level function, so can be pickled
+    pool = Pool(num_workers,
+                _init_fastq_worker,
+                (barcode_to_sample_id, barcode_correction_fn,
+                 phred_offset, demultiplex_params))
+    try:
+        # imap returns results in the order that chunks were submitted
+        for reads, chunk_counts in pool.imap(
+                _demultiplex_fastq_chunk,
+                read_fastq_chunks(fastq_barcode_f, fastq_read_f, chunk_size)):
+            _merge_fastq_counts(counts, chunk_counts)
+            for read in reads:
+                yield read
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def make_histograms(lengths, binwidth=10):
     """Makes histogram data for pre and post lengths"""
     min_len = min(lengths)
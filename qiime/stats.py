@@ -33,6 +33,7 @@ from os.path import join
 from types import ListType
 from copy import deepcopy
 from itertools import combinations
+from multiprocessing import Pool
 
 from matplotlib import use
 use('Agg', warn=False)
@@ -45,11 +46,12 @@ from numpy import (argsort, array, ceil, empty, fill_diagonal, finfo,
                    log, mean, nan, nonzero, sqrt, std, take, tanh,
                    transpose, seterr as np_seterr, var, arange, corrcoef,
                    trace, ravel, float as np_float, finfo, asarray, isnan,
-                   isinf, abs)
+                   isinf, abs, triu_indices, intp, array_split, vstack,
+                   searchsorted, clip, errstate, true_divide)
 
-from numpy.random import permutation, shuffle, randint
+from numpy.random import permutation, shuffle, randint, RandomState
 from biom.table import Table
-from skbio.stats.distance import DistanceMatrix, mantel
+from skbio.stats.distance import DistanceMatrix
 from skbio.util import create_dir
 
 from qiime.format import format_p_value_for_num_iters
@@ -58,6 +60,10 @@ from qiime.util import MetadataMap, write_biom_table
 np_seterr(divide='warn')
 MACHEP = finfo(np_float).eps
 
+# approximate number of permuted values held in memory at once by
+# permuted_correlations and (by default) mc_t_two_sample
+PERMUTATION_BLOCK_SIZE = 2 ** 20
+
 # Top-level stats functions.
 
 tail_types = ['low', 'high', 'two-sided']
@@ -431,7 +437,7 @@ class MantelCorrelogram(CorrelationStats):
         else:
             raise ValueError("Alpha must be between 0 and 1.")
 
-    def __call__(self, num_perms=999):
+    def __call__(self, num_perms=999, jobs_to_start=1):
         """Runs a Mantel correlogram test over the current distance matrices.
 
         Returns a dict containing the results. The following keys are set:
@@ -449,6 +455,8 @@ class MantelCorrelogram(CorrelationStats):
         Arguments:
             num_perms - the number of permutations to use when calculating the
                 p-values
+            jobs_to_start - the number of processes over which to split the
+                permutations
 
         Note: This code is heavily based on the implementation of
         mantel.correlog in R's vegan package.
@@ -482,61 +490,60 @@ class MantelCorrelogram(CorrelationStats):
         # Create a model matrix for each distance class, then compute a Mantel
         # test using it and the original eco distance matrix. A model matrix
         # contains ones for each element that is in the current distance class,
-        # and zeros otherwise (zeros on the diagonal as well).
+        # and zeros otherwise (zeros on the diagonal as well). The diagonal of
+        # the distance class matrix is -1, so it never matches a class.
+        tested_classes = []
+        model_vectors = []
         for class_num in range(num_classes):
             results['class_index'].append(class_indices[class_num])
-            model_matrix = zeros([dm_size, dm_size], dtype=int)
-            for i in range(dm_size):
-                for j in range(dm_size):
-                    curr_ele = dist_class_matrix[i][j]
-                    if curr_ele == class_num and i != j:
-                        model_matrix[i][j] = 1
-            model_matrix = DistanceMatrix(model_matrix, geo_dm.ids)
+            model_matrix = (dist_class_matrix == class_num).astype(int)
 
             # Count the number of distances in the current distance class.
-            num_distances = int(model_matrix.data.sum())
+            num_distances = int(model_matrix.sum())
             results['num_dist'].append(num_distances)
-            if num_distances == 0:
-                results['mantel_r'].append(None)
-                results['mantel_p'].append(None)
-            else:
-                row_sums = model_matrix.data.sum(axis=1)
-                row_sums = map(int, row_sums)
-                has_zero_sum = 0 in row_sums
+            results['mantel_r'].append(None)
+            results['mantel_p'].append(None)
+            if num_distances > 0:
+                has_zero_sum = (model_matrix.sum(axis=1) == 0).any()
 
                 # Only stop running Mantel tests if we've gone through half of
                 # the distance classes and at least one row has a sum of zero
                 # (i.e. the sample doesn't have any distances that fall in the
                 # current class).
                 if not (class_num > ((num_classes // 2) - 1) and has_zero_sum):
-                    # Compute the correlation coefficient without performing
-                    # permutation tests in order to check its sign below.
-                    orig_stat, _, _ = mantel(
-                        model_matrix, eco_dm, method='pearson',
-                        permutations=0, strict=True)
-
-                    # Negate the Mantel r statistic because we are using
-                    # distance matrices, not similarity matrices (this is a
-                    # necessary step, see Legendre's Numerical Ecology
-                    # algorithm reference for more details).
-                    results['mantel_r'].append(-orig_stat)
-
-                    # Compute a one-tailed p-value in the direction of the
-                    # sign.
-                    if orig_stat < 0:
-                        tail_type = 'less'
-                    else:
-                        tail_type = 'greater'
-
-                    _, p_val, _ = mantel(
-                        model_matrix, eco_dm, method='pearson',
-                        permutations=num_perms, alternative=tail_type,
-                        strict=True)
-
-                    results['mantel_p'].append(p_val)
+                    tested_classes.append(class_num)
+                    model_vectors.append(
+                        DistanceMatrix(model_matrix, geo_dm.ids)
+                        .condensed_form())
+
+        if tested_classes:
+            # Permute the eco distance matrix once per permutation, and
+            # correlate it with the model matrices of all distance classes at
+            # the same time. The correlation is symmetric in the two matrices,
+            # so this is equivalent to permuting each model matrix.
+            orig_stats, perm_stats = permuted_correlations(
+                eco_dm, model_vectors, num_perms, jobs_to_start)
+
+            for i, class_num in enumerate(tested_classes):
+                orig_stat = orig_stats[i]
+
+                # Negate the Mantel r statistic because we are using
+                # distance matrices, not similarity matrices (this is a
+                # necessary step, see Legendre's Numerical Ecology
+                # algorithm reference for more details).
+                results['mantel_r'][class_num] = -orig_stat
+
+                # Compute a one-tailed p-value in the direction of the
+                # sign.
+                if num_perms == 0 or isnan(orig_stat):
+                    p_val = nan
+                elif orig_stat < 0:
+                    p_val = ((perm_stats[:, i] <= orig_stat).sum() + 1) / \
+                        (num_perms + 1)
                 else:
-                    results['mantel_r'].append(None)
-                    results['mantel_p'].append(None)
+                    p_val = ((perm_stats[:, i] >= orig_stat).sum() + 1) / \
+                        (num_perms + 1)
+                results['mantel_p'][class_num] = p_val
 
         # Correct p-values for multiple testing.
         results['mantel_p_corr'] = self._correct_p_values(results['mantel_p'])
@@ -630,22 +637,16 @@ class MantelCorrelogram(CorrelationStats):
                                      (0.5 * (next_bp - break_point)))
 
             # Create the matrix of distance classes. Every element in the
-            # matrix tells what distance class the original element belongs to.
-            dist_class_matrix = empty([size, size], dtype=int)
-            for i in range(size):
-                for j in range(size):
-                    if i != j:
-                        curr_ele = dm[i][j]
-                        bps = [(k - 1) for k, bp in enumerate(break_points)
-                               if bp >= curr_ele]
-                        min_bp = min(bps)
-
-                        # If we somehow got a negative breakpoint (possible
-                        # sometimes due to rounding error), put it in the first
-                        # distance class.
-                        dist_class_matrix[i][j] = min_bp if min_bp >= 0 else 0
-                    else:
-                        dist_class_matrix[i][j] = -1
+            # matrix tells what distance class the original element belongs to
+            # (i.e., one less than the index of the first breakpoint that is
+            # greater than or equal to it).
+            dist_class_matrix = searchsorted(break_points, dm.data,
+                                             side='left') - 1
+
+            # If we somehow got a negative breakpoint (possible sometimes due
+            # to rounding error), put it in the first distance class.
+            dist_class_matrix[dist_class_matrix < 0] = 0
+            fill_diagonal(dist_class_matrix, -1)
 
         return dist_class_matrix, class_indices
 
@@ -789,7 +790,7 @@ class PartialMantel(CorrelationStats):
         super(PartialMantel, self).__init__([dm1, dm2, cdm], num_dms=3,
                                             min_dm_size=3)
 
-    def __call__(self, num_perms=999):
+    def __call__(self, num_perms=999, jobs_to_start=1):
         """Runs a partial Mantel test on the current distance matrices.
 
         Returns a dict containing the results. The following keys are set:
@@ -800,6 +801,8 @@ class PartialMantel(CorrelationStats):
         Arguments:
             num_perms - the number of times to permute the distance matrix
                 while calculating the p-value
+            jobs_to_start - the number of processes over which to split the
+                permutations
 
         Credit: The code herein is based loosely on the implementation found in
         R's vegan package.
@@ -815,34 +818,21 @@ class PartialMantel(CorrelationStats):
         res['mantel_p'] = None
 
         dm1, dm2, cdm = self.DistanceMatrices
-        dm1_flat = dm1.condensed_form()
         dm2_flat = dm2.condensed_form()
         cdm_flat = cdm.condensed_form()
 
-        # Get the initial r-values before permuting.
-        rval1 = pearson(dm1_flat, dm2_flat)
-        rval2 = pearson(dm1_flat, cdm_flat)
+        # The correlation of the second and control matrices doesn't change
+        # when the first matrix is permuted.
         rval3 = pearson(dm2_flat, cdm_flat)
 
-        # Calculate the original test statistic (r-value).
-        orig_stat = corr(rval1, rval2, rval3)
-
-        # Calculate permuted r-values and p-values, storing them for use in the
-        # calculation of the final statistic.
-        perm_stats = []
-        numerator = 0
-        for i in range(0, num_perms):
-            # Permute the first distance matrix and calculate new r and
-            # p-values.
-            p1 = permute_2d(dm1, permutation(dm1.shape[0]))
-            dm1_perm = DistanceMatrix(p1, dm1.ids)
-            dm1_perm_flat = dm1_perm.condensed_form()
-            rval1 = pearson(dm1_perm_flat, dm2_flat)
-            rval2 = pearson(dm1_perm_flat, cdm_flat)
-            perm_stats.append(corr(rval1, rval2, rval3))
-
-            if perm_stats[-1] >= orig_stat:
-                numerator += 1
+        # Get the initial r-values and the r-values for every permutation of
+        # the first distance matrix, and calculate the test statistics.
+        orig, perms = permuted_correlations(dm1, [dm2_flat, cdm_flat],
+                                            num_perms, jobs_to_start)
+        orig_stat = corr(orig[0], orig[1], rval3)
+        perm_stats = corr(perms[:, 0], perms[:, 1], rval3)
+        numerator = (perm_stats >= orig_stat).sum()
+
         # Load the final statistics into the result dictionary.
         res['mantel_r'] = orig_stat
         res['mantel_p'] = (numerator + 1) / (num_perms + 1)
@@ -1309,7 +1299,7 @@ def t_two_sample(a, b, tails='two-sided', exp_diff=0):
 
 
 def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
-                    exp_diff=0):
+                    exp_diff=0, block_size=PERMUTATION_BLOCK_SIZE):
     """Performs a two-sample t-test with Monte Carlo permutations.
 
     x_items and y_items must be INDEPENDENT observations (sequences of
@@ -1333,6 +1323,10 @@ def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
             the list of t statistics obtained from permutations will be empty,
             and the nonparametric p-value will be NaN
         exp_diff - the expected difference in means (x_items - y_items)
+        block_size - the approximate number of permuted observations to hold
+            in memory at once. The permutations are generated and tested in
+            blocks of this size, so it trades memory for speed but does not
+            change the results
     """
     if permutations < 0:
         raise ValueError("Invalid number of permutations: %d. Must be greater "
@@ -1354,10 +1348,14 @@ def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
     perm_t_stats = []
     if permutations > 0 and not isnan(obs_t) and not isnan(param_p_val):
         perm_t_stats = zeros(permutations, dtype=float)
-        px, py = _permute_observations(x_items, y_items, permutations)
-        for i in range(permutations):
-            perm_t_stats[i] = t_two_sample(px[i], py[i], tails=tails,
-                                           exp_diff=exp_diff)[0]
+        start = 0
+        perms_per_block = max(1, block_size // (len(x_items) + len(y_items)))
+        for px, py in _iter_permuted_observations(x_items, y_items,
+                                                  permutations,
+                                                  perms_per_block):
+            perm_t_stats[start:start + len(px)] = \
+                _t_two_sample_batch(px, py, exp_diff)
+            start += len(px)
 
         # Compute nonparametric p-value based on the permuted t-test results.
         if tails == 'two-sided':
@@ -1371,8 +1369,45 @@ def mc_t_two_sample(x_items, y_items, tails='two-sided', permutations=999,
     return obs_t, param_p_val, perm_t_stats, nonparam_p_val
 
 
-def _permute_observations(x, y, num_perms):
-    """Return num_perms pairs of permuted vectors x,y.
+def _t_two_sample_batch(a, b, exp_diff=0):
+    """Returns the t statistics of t_two_sample for each row of a and b.
+
+    a and b are 2-D arrays with the same number of rows. The statistics are
+    computed in the same way as by t_two_sample (including the single
+    observation case), but for all rows at once. Statistics which are nan or
+    infinite are returned as nan.
+    """
+    a, b = asarray(a), asarray(b)
+    na, nb = a.shape[1], b.shape[1]
+    old_settings = np_seterr(divide='ignore', invalid='ignore')
+    try:
+        if na == 1 or nb == 1:
+            # as in t_one_observation
+            if na <= nb:
+                x, sample = a[:, 0], b
+            else:
+                x, sample = b[:, 0], a
+            n = sample.shape[1]
+            sample_std = std(sample, axis=1, ddof=1)
+            t = ((x - mean(sample, axis=1) - exp_diff) / sample_std /
+                 sqrt((n + 1) / n))
+            t[sample_std == 0] = nan
+        else:
+            # as in scipy.stats.ttest_ind with equal_var=True
+            a = a - exp_diff
+            df = na + nb - 2.0
+            svar = ((na - 1) * var(a, axis=1, ddof=1) +
+                    (nb - 1) * var(b, axis=1, ddof=1)) / df
+            denom = sqrt(svar * (1.0 / na + 1.0 / nb))
+            t = (mean(a, axis=1) - mean(b, axis=1)) / denom
+    finally:
+        np_seterr(**old_settings)
+    t[isnan(t) | isinf(t)] = nan
+    return t
+
+
+def _iter_permuted_observations(x, y, num_perms, block_size=None):
+    """Yields blocks of permuted vectors x,y.
 
     Parameters
     ----------
@@ -1380,13 +1415,17 @@ def _permute_observations(x, y, num_perms):
         Lists or arrays of values to be permuted.
     y : 1-D array-like
         Lists or arrays of values to be permuted.
+    num_perms : int
+        Total number of permutations to yield.
+    block_size : int, optional
+        Maximum number of permutations in each block. Defaults to the number
+        that keeps about PERMUTATION_BLOCK_SIZE values in memory.
 
     Returns
     -------
-    xs : list of arrays
-        Permuted vectors x
-    ys : list of arrays
-        Permuted vectors y
+    generator of (xs, ys)
+        2-D arrays with one permutation per row; the rows of xs have len(x)
+        values, and the rows of ys have len(y) values.
     """
     vals = hstack([array(x), array(y)])
     lenx = len(x)
@@ -1395,13 +1434,42 @@ def _permute_observations(x, y, num_perms):
     # observation orders in x and y for eg. the mc_t_two_sample test will fail
     # to produce the same results)
     vals.sort()
+    if block_size is None:
+        block_size = max(1, PERMUTATION_BLOCK_SIZE // max(vals.size, 1))
     inds = arange(vals.size)
-    xs, ys = [], []
-    for i in range(num_perms):
-        shuffle(inds)
-        xs.append(vals[inds[:lenx]])
-        ys.append(vals[inds[lenx:]])
-    return xs, ys
+    for start in range(0, num_perms, block_size):
+        # each permutation shuffles the previous one, so the permutations
+        # are drawn one at a time (but only their indices are stored)
+        perms = empty((min(block_size, num_perms - start), vals.size),
+                      dtype=intp)
+        for row in perms:
+            shuffle(inds)
+            row[:] = inds
+        permuted = vals.take(perms)
+        yield permuted[:, :lenx], permuted[:, lenx:]
+
+
+def _permute_observations(x, y, num_perms):
+    """Return num_perms pairs of permuted vectors x,y.
+
+    Parameters
+    ----------
+    x : 1-D array-like
+        Lists or arrays of values to be permuted.
+    y : 1-D array-like
+        Lists or arrays of values to be permuted.
+
+    Returns
+    -------
+    xs : 2-D array
+        Permuted vectors x, one per row
+    ys : 2-D array
+        Permuted vectors y, one per row
+    """
+    for xs, ys in _iter_permuted_observations(x, y, num_perms,
+                                              max(num_perms, 1)):
+        return xs, ys
+    return empty((0, len(x))), empty((0, len(y)))
 
 
 def t_one_observation(x, sample, tails='two-sided', exp_diff=0):
@@ -1973,6 +2041,110 @@ def permute_2d(m, p):
     return m[p][:, p]
 
 
+def _center_rows(vectors):
+    """Centers each row of vectors on its mean."""
+    vectors = asarray(vectors, dtype=float)
+    return vectors - vectors.mean(axis=1)[:, None]
+
+
+def _permutation_kernel(data, centered, perms):
+    """Correlations of the permuted condensed forms of data with vectors.
+
+    data is a square distance matrix and centered a k x m matrix of centered
+    condensed vectors (see _center_rows); perms is a list of permutations of
+    the rows/columns of data. Returns a len(perms) x k array of Pearson
+    correlations.
+
+    The correlations are computed in the same order of operations as
+    numpy.corrcoef (and so pearson), so that a permuted statistic that
+    equals the observed one in exact arithmetic compares equal to it as it
+    did when each permutation was correlated with pearson.
+    """
+    n = data.shape[0]
+    rows, cols = triu_indices(n, 1)
+    flat = data.ravel()
+    scale = true_divide(1, len(rows) - 1)
+    result = empty((len(perms), centered.shape[0]))
+    block_size = max(1, PERMUTATION_BLOCK_SIZE // max(len(rows), 1))
+    with errstate(divide='ignore', invalid='ignore'):
+        # correlations with a constant vector are undefined (nan)
+        stds = sqrt((centered * centered).sum(axis=1) * scale)
+        for start in range(0, len(perms), block_size):
+            block = asarray(perms[start:start + block_size], dtype=intp)
+            indices = (block * n).take(rows, axis=1)
+            indices += block.take(cols, axis=1)
+            x = flat.take(indices)
+            x -= x.mean(axis=1)[:, None]
+            x_stds = sqrt((x * x).sum(axis=1) * scale)
+            for i, vector in enumerate(centered):
+                result[start:start + len(block), i] = \
+                    (x * vector).sum(axis=1) * scale / x_stds / stds[i]
+    return clip(result, -1, 1, out=result)
+
+
+def _init_permutation_worker(data, centered):
+    global _permutation_worker_args
+    _permutation_worker_args = (data, centered)
+
+
+def _permutation_worker(task):
+    num_perms, perm_seed = task
+    data, centered = _permutation_worker_args
+    state = RandomState(perm_seed)
+    n = data.shape[0]
+    perms = [state.permutation(n) for i in range(num_perms)]
+    return _permutation_kernel(data, centered, perms)
+
+
+def permuted_correlations(dm, vectors, num_perms, jobs_to_start=1):
+    """Correlations of a permuted distance matrix with fixed vectors.
+
+    Computes the Pearson correlation of the condensed form of dm (a
+    DistanceMatrix or square array) with each of vectors after permuting the
+    rows and columns of dm, as in a Mantel test, for num_perms random
+    permutations. The index map of the condensed form and the centered
+    vectors are computed once, and the correlations are computed for a block
+    of permutations at a time.
+
+    Returns a tuple of the observed correlations (i.e., of the unpermuted
+    matrix with each vector) and a num_perms x len(vectors) array of the
+    permuted correlations. The observed correlations are computed in the
+    same way as the permuted ones, so a permutation which leaves the
+    condensed form unchanged gives exactly the observed values.
+
+    Arguments:
+        dm - the DistanceMatrix (or square array) to permute
+        vectors - list of condensed vectors (e.g. as returned by
+            DistanceMatrix.condensed_form) to correlate with dm
+        num_perms - the number of permutations
+        jobs_to_start - the number of processes over which to split the
+            permutations. If greater than 1, the permutations are drawn from
+            seeds taken from numpy's random state in this process
+    """
+    data = asarray(getattr(dm, 'data', dm), dtype=float)
+    centered = _center_rows(vectors)
+    n = data.shape[0]
+    orig = _permutation_kernel(data, centered, [arange(n)])[0]
+
+    if jobs_to_start <= 1 or num_perms < 2:
+        perms = [permutation(n) for i in range(num_perms)]
+        return orig, _permutation_kernel(data, centered, perms)
+
+    jobs_to_start = min(jobs_to_start, num_perms)
+    tasks = [(len(chunk), randint(0, 2 ** 31 - 1))
+             for chunk in array_split(arange(num_perms), jobs_to_start)]
+    pool = Pool(jobs_to_start, _init_permutation_worker, (data, centered))
+    try:
+        results = pool.map(_permutation_worker, tasks)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return orig, vstack(results)
+
+
 def is_symmetric_and_hollow(matrix):
     """Return True if matrix is symmetric and hollow, otherwise False."""
     return (matrix.T == matrix).all() and (trace(matrix) == 0)
@@ -18,8 +18,9 @@ __email__ = "gregcaporaso@gmail.com"
 A lot of this might migrate into cogent at some point.
 """
 
-from os import getenv, listdir, close
-from os.path import abspath, basename, exists, dirname, join, splitext, isfile
+from os import getenv, listdir, close, stat
+from os.path import (abspath, basename, exists, dirname, join, splitext,
+                     isfile, expandvars)
 from collections import defaultdict
 from gzip import open as gz_open
 from sys import stderr
@@ -31,51 +32,53 @@ from itertools import repeat, izip
 from tempfile import mkstemp
 from functools import partial
 
-from numpy import (array, zeros, shape, vstack, ndarray, asarray,
-                   float, where, isnan, std, sqrt, ravel, mean, median,
-                   sum as np_sum, nan, sort)
-from numpy.ma import MaskedArray
-from numpy.ma.extras import apply_along_axis
+from numpy import (array, zeros, ndarray, asarray, float, where, isnan, std,
+                   sqrt, ravel, mean, median, nan, sort, empty, memmap,
+                   ascontiguousarray)
 
-from biom.util import compute_counts_per_sample_stats, biom_open, HAVE_H5PY
-from biom import load_table
-from biom.parse import parse_biom_table
-from biom.table import Table
-
-from cogent.parse.tree import DndParser
-from cogent.cluster.procrustes import procrustes
-
-from skbio.util import remove_files, create_dir
-from skbio.format.sequences import format_fastq_record
 from burrito.util import ApplicationError, CommandLineApplication, FilePath
 from burrito.util import which
-from skbio.sequence import DNASequence
-from skbio.parse.sequences import parse_fasta
-from skbio.parse.sequences import FastaIterator, FastqIterator
-
-from bfillings.blast import Blastall, BlastResult
-from bfillings.formatdb import (build_blast_db_from_fasta_path,
-                             build_blast_db_from_fasta_file)
-
 
 from qcli import make_option, qcli_system_call, parse_command_line_parameters
 
 from qiime import __version__ as qiime_library_version
-from qiime.parse import (parse_qiime_config_files,
-                         parse_coords,
-                         parse_newick,
-                         fields_to_dict,
-                         PhyloNode,
-                         parse_mapping_file,
-                         parse_denoiser_mapping,
-                         parse_fastq,
-                         mapping_file_to_dict)
-
-# for backward compatibility - compute_seqs_per_library_stats has
-# been removed in favor of biom.util.compute_counts_per_sample_stats,
-# which has the same interface as the former
-# qiime.util.compute_seqs_per_library_stats
-compute_seqs_per_library_stats = compute_counts_per_sample_stats
+
+# Every script imports this module, and many (including the jobs started by
+# the parallel scripts) only need a few functions from it. Importing
+# scikit-bio, biom, PyCogent, bfillings.blast or qiime.parse takes up to a
+# second and a half, so they are imported by the functions that use them
+# rather than here. Use print_qiime_startup_profile.py to check what a
+# script's imports cost.
+
+
+def compute_seqs_per_library_stats(otu_table, binary_counts=False):
+    """Return summary statistics of the counts per sample in otu_table
+
+    For backward compatibility - compute_seqs_per_library_stats has been
+    removed in favor of biom.util.compute_counts_per_sample_stats, which has
+    the same interface as the former qiime.util.compute_seqs_per_library_stats
+    """
+    from biom.util import compute_counts_per_sample_stats
+    return compute_counts_per_sample_stats(otu_table, binary_counts)
+
+
+def create_dir(dir_name, fail_on_exist=False, handle_errors_externally=False):
+    """Create a directory safely and fail meaningfully
+
+    This is skbio.util.create_dir, which is imported when it is first needed.
+    """
+    from skbio.util import create_dir as skbio_create_dir
+    return skbio_create_dir(dir_name, fail_on_exist, handle_errors_externally)
+
+
+def remove_files(list_of_filepaths, error_on_missing=True):
+    """Remove list of filepaths, optionally raising an error if any are missing
+
+    This is skbio.util.remove_files, which is imported when it is first
+    needed.
+    """
+    from skbio.util import remove_files as skbio_remove_files
+    return skbio_remove_files(list_of_filepaths, error_on_missing)
 
 
 class TreeMissingError(IOError):
@@ -186,6 +189,7 @@ class FunctionWithParams(object):
 
     def getTree(self, tree_source):
         """Returns parsed tree from putative tree source"""
+        from qiime.parse import parse_newick, PhyloNode
         if isinstance(tree_source, PhyloNode):
             tree = tree_source  # accept tree object directly for tests
         elif tree_source:
@@ -225,6 +229,8 @@ class FunctionWithParams(object):
 
     def getBiomData(self, data):
         """returns a biom object regardless of whether path or object given"""
+        from biom import load_table
+        from biom.table import Table
         try:
             if isfile(data):
                 return load_table(data)
@@ -254,6 +260,7 @@ class FunctionWithParams(object):
 
 def trim_fasta(fasta_lines, output_length):
     """trim fasta seqs to output_length bases """
+    from skbio.parse.sequences import parse_fasta
     for seq_id, seq in parse_fasta(fasta_lines):
         yield '>%s\n%s\n' % (seq_id, seq[:output_length])
 
@@ -307,8 +314,56 @@ def get_qiime_temp_dir():
     return result
 
 
+def parse_qiime_config_file(qiime_config_file):
+    """ Parse lines in a qiime_config file
+    """
+    result = {}
+    for line in qiime_config_file:
+        line = line.strip()
+        # ignore blank lines or lines beginning with '#'
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        param_id = fields[0]
+        param_value = expandvars(' '.join(fields[1:])) or None
+        result[param_id] = param_value
+    return result
+
+
+def parse_qiime_config_files(qiime_config_files):
+    """ Parse files in (ordered!) list of qiime_config_files
+
+        The order of files must be least important to most important.
+         Values defined in earlier files will be overwritten if the same
+         values are defined in later files.
+    """
+    # The qiime_config object is a default dict: if keys are not
+    # present, none is returned
+    def return_none():
+        return None
+    results = defaultdict(return_none)
+
+    for qiime_config_file in qiime_config_files:
+        try:
+            results.update(parse_qiime_config_file(qiime_config_file))
+        except IOError:
+            pass
+
+    return results
+
+
+# the most recently parsed qiime_config, keyed by the paths, modification
+# times and sizes of the files it was read from
+_qiime_config_cache = {}
+
+
 def load_qiime_config():
-    """Return default parameters read in from file"""
+    """Return default parameters read in from file
+
+    The parsed files are cached until one of them changes, so calling this
+    repeatedly (e.g., for default option values) doesn't re-read them. Each
+    call returns a new copy, which the caller is free to modify.
+    """
 
     qiime_config_filepaths = []
     qiime_project_dir = get_qiime_project_dir()
@@ -324,16 +379,33 @@ def load_qiime_config():
         qiime_config_home_filepath = home_dir + '/.qiime_config'
         qiime_config_filepaths.append(qiime_config_home_filepath)
 
-    qiime_config_files = []
+    cache_key = []
     for qiime_config_filepath in qiime_config_filepaths:
-        if exists(qiime_config_filepath):
-            qiime_config_files.append(open(qiime_config_filepath))
+        try:
+            file_stat = stat(qiime_config_filepath)
+        except OSError:
+            continue
+        cache_key.append((qiime_config_filepath, file_stat.st_mtime,
+                          file_stat.st_size))
+    cache_key = tuple(cache_key)
 
-    return parse_qiime_config_files(qiime_config_files)
+    try:
+        qiime_config = _qiime_config_cache[cache_key]
+    except KeyError:
+        qiime_config_files = [open(qiime_config_filepath)
+                              for qiime_config_filepath, mtime, size
+                              in cache_key]
+        qiime_config = parse_qiime_config_files(qiime_config_files)
+        for qiime_config_file in qiime_config_files:
+            qiime_config_file.close()
+        _qiime_config_cache.clear()
+        _qiime_config_cache[cache_key] = qiime_config
+
+    return qiime_config.copy()
 
 
 def qiime_blast_seqs(seqs,
-                     blast_constructor=Blastall,
+                     blast_constructor=None,
                      blast_program='blastn',
                      blast_db=None,
                      refseqs=None,
@@ -348,8 +420,15 @@ def qiime_blast_seqs(seqs,
 
     seqs: a list (or object with list-like interace) of (seq_id, seq)
      tuples (e.g., the output of parse_fasta)
+    blast_constructor: the application controller class (default:
+     bfillings.blast.Blastall)
 
     """
+    from bfillings.blast import Blastall, BlastResult
+    from bfillings.formatdb import (build_blast_db_from_fasta_path,
+                                    build_blast_db_from_fasta_file)
+    if blast_constructor is None:
+        blast_constructor = Blastall
 
     assert blast_db or refseqs_fp or refseqs, \
         'Must provide either a blast_db or a fasta ' +\
@@ -403,7 +482,7 @@ def qiime_blast_seqs(seqs,
 
 
 def qiime_blastx_seqs(seqs,
-                      blast_constructor=Blastall,
+                      blast_constructor=None,
                       blast_db=None,
                       refseqs=None,
                       refseqs_fp=None,
@@ -492,6 +571,7 @@ def write_seqs_to_fastq(fp, seqs, write_mode='w'):
         seqs: list of (seq_id,seq,qual_id,qual) tuples
     """
     with open(fp, write_mode) as f:
+        from skbio.format.sequences import format_fastq_record
         for s in seqs:
             f.write(format_fastq_record(s[0], s[1], s[3]))
 
@@ -507,7 +587,7 @@ def get_generated_by_for_biom_tables():
 
 
 def write_biom_table(biom_table, biom_table_fp, compress=True,
-                     write_hdf5=HAVE_H5PY):
+                     write_hdf5=None):
     """Writes a BIOM table to the specified filepath
 
     Parameters
@@ -525,6 +605,9 @@ def write_biom_table(biom_table, biom_table_fp, compress=True,
         not installed. If ``True`` the output biom table will be written as an
         HDF5 binary file, otherwise it will be a JSON string.
     """
+    from biom.util import biom_open, HAVE_H5PY
+    if write_hdf5 is None:
+        write_hdf5 = HAVE_H5PY
     generated_by = get_generated_by_for_biom_tables()
 
     if write_hdf5:
@@ -561,6 +644,7 @@ def split_sequence_file_on_sample_ids_to_files(seqs,
           hitting errors arising from too many files being open when working
           with large numbers of samples ids (e.g. > 1024 on linux)
     """
+    from skbio.parse.sequences import FastaIterator, FastqIterator
     create_dir(output_dir)
     file_lookup = {}
     all_fps = []
@@ -814,25 +898,50 @@ def convert_OTU_table_relative_abundance(otu_table):
     return output
 
 
+class PCoAFiles(object):
+
+    """Sequence of parsed PCoA files, which are read one at a time
+
+    Iterating yields the result of parse_coords for each file, in order.
+    Only the file currently being iterated over is held in memory, and the
+    files are read again each time the sequence is iterated over.
+    """
+
+    def __init__(self, pcoa_fps):
+        self.pcoa_fps = list(pcoa_fps)
+
+    def __len__(self):
+        return len(self.pcoa_fps)
+
+    def __iter__(self):
+        from qiime.parse import parse_coords
+        for pcoa_fp in self.pcoa_fps:
+            try:
+                f = open(pcoa_fp, 'U')
+                pcoa_res = parse_coords(f)
+                f.close()
+            except IOError as err:
+                stderr.write('error loading support pcoa ' +
+                             basename(pcoa_fp) + '\n')
+                exit(1)
+            yield pcoa_res
+
+
 def load_pcoa_files(pcoa_dir):
     """loads PCoA files from filepaths
+
+    Returns the first PCoA (the master) and a PCoAFiles sequence of all of
+    the PCoAs (including the master), which are parsed as they are needed.
     """
-    support_pcoas = []
+    from qiime.parse import parse_coords
     pcoa_filenames = listdir(pcoa_dir)
     # ignore invisible files like .DS_Store
     pcoa_filenames = [fname for fname in pcoa_filenames if not
                       fname.startswith('.')]
     master_pcoa = open(join(pcoa_dir, pcoa_filenames[0]), 'U')
     master_pcoa = parse_coords(master_pcoa)
-    for fname in pcoa_filenames:
-        try:
-            f = open(join(pcoa_dir, fname), 'U')
-            pcoa_res = parse_coords(f)
-            support_pcoas.append(pcoa_res)
-            f.close()
-        except IOError as err:
-            stderr.write('error loading support pcoa ' + fname + '\n')
-            exit(1)
+    support_pcoas = PCoAFiles([join(pcoa_dir, fname)
+                               for fname in pcoa_filenames])
     return master_pcoa, support_pcoas
 
 
@@ -844,34 +953,36 @@ def summarize_pcoas(master_pcoa, support_pcoas,
     The choices are:
         IQR: the Interquartile Range
         ideal fourths: Ideal fourths method as implemented in scipy
+
+    support_pcoas can be any iterable (e.g. a PCoAFiles sequence): the
+    support pcoas are fitted to the master and summarized one at a time.
     """
-    if apply_procrustes:
-        # perform procrustes before averaging
-        support_pcoas = [list(sp) for sp in support_pcoas]
-        master_pcoa = list(master_pcoa)
-        for i, pcoa in enumerate(support_pcoas):
-            master_std, pcoa_std, m_squared = procrustes(
-                master_pcoa[1], pcoa[1])
-            support_pcoas[i][1] = pcoa_std
-        master_pcoa[1] = master_std
-
-    m_matrix = master_pcoa[1]
-    m_eigvals = master_pcoa[2]
-    m_names = master_pcoa[0]
-    jn_flipped_matrices = []
-    all_eigvals = []
-    for rep in support_pcoas:
-        matrix = rep[1]
-        eigvals = rep[2]
-        all_eigvals.append(eigvals)
-        jn_flipped_matrices.append(_flip_vectors(matrix, m_matrix))
+    # running sum and count of the eigvals of the support pcoas
+    eigval_totals = [0, 0]
+
+    def flipped_matrices():
+        from cogent.cluster.procrustes import procrustes
+        for pcoa in support_pcoas:
+            matrix = pcoa[1]
+            m_matrix = master_pcoa[1]
+            if apply_procrustes:
+                # perform procrustes before averaging
+                m_matrix, matrix, m_squared = procrustes(m_matrix, matrix)
+            eigval_totals[0] = eigval_totals[0] + pcoa[2]
+            eigval_totals[1] += 1
+            yield _flip_vectors(matrix, m_matrix)
+
     matrix_average, matrix_low, matrix_high = _compute_jn_pcoa_avg_ranges(
-        jn_flipped_matrices, method)
+        flipped_matrices(), method)
     # compute average eigvals
-    all_eigvals_stack = vstack(all_eigvals)
-    eigval_sum = np_sum(all_eigvals_stack, axis=0)
-    eigval_average = eigval_sum / float(len(all_eigvals))
-    return matrix_average, matrix_low, matrix_high, eigval_average, m_names
+    eigval_average = eigval_totals[0] / float(eigval_totals[1])
+    return matrix_average, matrix_low, matrix_high, eigval_average, \
+        master_pcoa[0]
+
+
+# approximate number of values summarized at once by
+# _compute_jn_pcoa_avg_ranges
+JN_PCOA_BLOCK_SIZE = 2 ** 22
 
 
 def _compute_jn_pcoa_avg_ranges(jn_flipped_matrices, method):
@@ -884,32 +995,69 @@ def _compute_jn_pcoa_avg_ranges(jn_flipped_matrices, method):
     method: the method by which to calculate the range
         IQR: Interquartile Range
         ideal fourths: Ideal fourths method as implemented in scipy
+
+    jn_flipped_matrices can be any iterable of equally shaped matrices. They
+    are written one at a time to a temporary file, and the summaries are
+    computed over a memory-mapped view of it, a block of matrix elements at
+    a time.
     """
-    x, y = shape(jn_flipped_matrices[0])
-    all_flat_matrices = [matrix.ravel() for matrix in jn_flipped_matrices]
-    summary_matrix = vstack(all_flat_matrices)
-    matrix_sum = np_sum(summary_matrix, axis=0)
-    matrix_average = matrix_sum / float(len(jn_flipped_matrices))
-    matrix_average = matrix_average.reshape(x, y)
-    if method == 'IQR':
-        result = matrix_IQR(summary_matrix)
-        matrix_low = result[0].reshape(x, y)
-        matrix_high = result[1].reshape(x, y)
-    elif method == 'ideal_fourths':
-        result = idealfourths(summary_matrix, axis=0)
-        matrix_low = result[0].reshape(x, y)
-        matrix_high = result[1].reshape(x, y)
-    elif method == "sdev":
-        # calculate std error for each sample in each dimension
-        sdevs = zeros(shape=[x, y])
-        for j in xrange(y):
-            for i in xrange(x):
-                vals = array([pcoa[i][j] for pcoa in jn_flipped_matrices])
-                sdevs[i, j] = vals.std(ddof=1)
-        matrix_low = -sdevs / 2
-        matrix_high = sdevs / 2
-
-    return matrix_average, matrix_low, matrix_high
+    if method not in ('IQR', 'ideal_fourths', 'sdev'):
+        raise ValueError("Unknown method: %s" % method)
+
+    fd, stack_fp = mkstemp(dir=get_qiime_temp_dir(),
+                           prefix='qiime_jn_pcoas_', suffix='.bin')
+    close(fd)
+    try:
+        matrix_shape = None
+        num_matrices = 0
+        stack_f = open(stack_fp, 'wb')
+        for matrix in jn_flipped_matrices:
+            matrix = asarray(matrix, dtype=float)
+            if matrix_shape is None:
+                matrix_shape = matrix.shape
+            elif matrix.shape != matrix_shape:
+                raise ValueError("All PCoA matrices must have the same "
+                                 "shape.")
+            stack_f.write(matrix.tostring())
+            num_matrices += 1
+        stack_f.close()
+        if num_matrices == 0:
+            raise ValueError("Must provide at least one PCoA matrix.")
+
+        x, y = matrix_shape
+        stack = memmap(stack_fp, dtype=float, mode='r',
+                       shape=(num_matrices, x * y))
+        matrix_average = empty(x * y)
+        matrix_low = empty(x * y)
+        matrix_high = empty(x * y)
+        block_size = max(1, JN_PCOA_BLOCK_SIZE // num_matrices)
+        for start in range(0, x * y, block_size):
+            end = start + block_size
+            summary_matrix = array(stack[:, start:end])
+            # add up the rows one at a time (as numpy does for a wide
+            # matrix), so the result doesn't depend on the block size
+            matrix_sum = summary_matrix[0].copy()
+            for row in summary_matrix[1:]:
+                matrix_sum += row
+            matrix_average[start:end] = matrix_sum / float(num_matrices)
+            if method == 'IQR':
+                matrix_low[start:end], matrix_high[start:end] = \
+                    matrix_IQR(summary_matrix)
+            elif method == 'ideal_fourths':
+                matrix_low[start:end], matrix_high[start:end] = \
+                    idealfourths(summary_matrix, axis=0)
+            elif method == "sdev":
+                # calculate std error for each sample in each dimension
+                sdevs = ascontiguousarray(summary_matrix.T).std(axis=1,
+                                                                ddof=1)
+                matrix_low[start:end] = -sdevs / 2
+                matrix_high[start:end] = sdevs / 2
+        del stack
+    finally:
+        remove_files([stack_fp], error_on_missing=False)
+
+    return (matrix_average.reshape(x, y), matrix_low.reshape(x, y),
+            matrix_high.reshape(x, y))
 
 
 def _flip_vectors(jn_matrix, m_matrix):
@@ -981,6 +1129,8 @@ def idealfourths(data, axis=None):
         k = n - j
         qup = (1 - h) * x[k] + h * x[k - 1]
         return [qlo, qup]
+    from numpy.ma import MaskedArray
+    from numpy.ma.extras import apply_along_axis
     data = sort(data, axis=axis).view(MaskedArray)
     if (axis is None):
         return _idf(data)
@@ -1005,6 +1155,7 @@ def degap_fasta_aln(seqs):
 
     seqs: list of label,seq pairs
     """
+    from skbio.sequence import DNASequence
 
     for (label, seq) in seqs:
         yield DNASequence(seq, id=label).degap()
@@ -1261,6 +1412,7 @@ def inflate_denoiser_output(
 
 
     """
+    from qiime.parse import parse_denoiser_mapping
     id_lookup = parse_denoiser_mapping(denoiser_map)
     flowgram_to_seq_id_lookup = flowgram_id_to_seq_id_map(raw_seqs)
     for id_, seq in centroid_seqs:
@@ -1279,22 +1431,28 @@ def inflate_denoiser_output(
 # Functions for counting sequences in fasta files
 
 
-def count_seqs(fasta_filepath, parser=parse_fasta):
+def count_seqs(fasta_filepath, parser=None):
     """ Count the sequences in fasta_filepath
 
         fasta_filepath: string indicating the full path to the file
+        parser: function yielding the records in the file (default:
+         parse_fasta)
     """
     # Open the file and pass it to py_count_seqs_from_file -- wrapping
     # this makes for easier unit testing
     return count_seqs_from_file(open(fasta_filepath, 'U'), parser=parser)
 
 
-def count_seqs_from_file(fasta_file, parser=parse_fasta):
+def count_seqs_from_file(fasta_file, parser=None):
     """Return number of sequences in fasta_file (no format checking performed)
 
         fasta_file: an open file object
+        parser: function yielding the records in the file (default:
+         parse_fasta)
 
     """
+    if parser is None:
+        from skbio.parse.sequences import parse_fasta as parser
     result = 0
     lens = []
     for record in parser(fasta_file):
@@ -1315,6 +1473,9 @@ def count_seqs_in_filepaths(fasta_filepaths, seq_counter=count_seqs):
          (default: count_seqs) -- this is parameterized to
          facilitate unit testing
     """
+    from cogent.parse.tree import DndParser
+    from skbio.parse.sequences import parse_fasta
+    from qiime.parse import parse_fastq, PhyloNode
     total = 0
     counts = []
     inaccessible_filepaths = []
@@ -1502,6 +1663,7 @@ def subsample_fasta(input_fasta_fp,
 
     output_fasta = open(output_fp, "w")
 
+    from skbio.parse.sequences import parse_fasta
     for label, seq in parse_fasta(input_fasta):
         if random() < percent_subsample:
             output_fasta.write('>%s\n%s\n' % (label, seq))
@@ -1523,6 +1685,7 @@ def subsample_fastq(input_fastq_fp,
     input_fastq = open(input_fastq_fp, "U")
     output_fastq = open(output_fp, "w")
 
+    from qiime.parse import parse_fastq
     for label, seq, qual in parse_fastq(input_fastq, strict=False):
         if random() < percent_subsample:
             output_fastq.write(
@@ -1546,6 +1709,7 @@ def subsample_fastqs(input_fastq1_fp,
     input_fastq2 = open(input_fastq2_fp, "U")
     output_fastq2 = open(output_fastq2_fp, "w")
 
+    from qiime.parse import parse_fastq
     for fastq1, fastq2 in izip(parse_fastq(input_fastq1, strict=False),
                                parse_fastq(input_fastq2, strict=False)):
         label1, seq1, qual1 = fastq1
@@ -1570,6 +1734,7 @@ def summarize_otu_sizes_from_otu_map(otu_map_f):
         This is useful for determining number of singletons, doubletons, etc
          from an OTU map.
     """
+    from qiime.parse import fields_to_dict
     result = {}
     for otu_id, seq_ids in fields_to_dict(otu_map_f).items():
         otu_size = len(seq_ids)
@@ -1609,6 +1774,7 @@ class MetadataMap():
             case_insensitive - a boolean to uppercase non required mapping file
                 headers
         """
+        from qiime.parse import parse_mapping_file, mapping_file_to_dict
         mapping_data, header, comments = parse_mapping_file(lines)
         if case_insensitive:
             req_header = set(MetadataMap.req_header_prefix + MetadataMap.req_header_suffix)
@@ -185,6 +185,19 @@ def run_beta_diversity_through_plots(otu_table_fp,
     return dm_fps
 
 
+def runs_alpha_rarefaction_on_cluster(parallel, qiime_config):
+    """ Return True if run_alpha_rarefaction submits jobs to a cluster
+
+        This is the case when running in parallel with the cluster_jobs
+         parallel_executor. The rarefied OTU tables and their alpha diversity
+         are then computed by the parallel scripts and written to disk (so
+         retain_intermediate_files has an effect); otherwise they are
+         computed in memory by compute_alpha_rarefaction.py.
+    """
+    return parallel and \
+        qiime_config.get('parallel_executor', 'cluster_jobs') == 'cluster_jobs'
+
+
 def run_alpha_rarefaction(otu_table_fp,
                           mapping_fp,
                           output_dir,
@@ -209,6 +222,13 @@ def run_alpha_rarefaction(otu_table_fp,
           3) Collate alpha diversity results;
           4) Generate alpha rarefaction plots.
 
+        Steps 1-3 are run as one step in memory with
+         compute_alpha_rarefaction.py (in jobs_to_start processes if
+         parallel), unless runs_alpha_rarefaction_on_cluster is True, in
+         which case they are run with parallel_multiple_rarefactions.py,
+         parallel_alpha_diversity.py and collate_alpha.py.
+         retain_intermediate_files only has an effect in that case.
+
     """
     # Prepare some variables for the later steps
     otu_table_dir, otu_table_filename = split(otu_table_fp)
@@ -234,68 +254,42 @@ def run_alpha_rarefaction(otu_table_fp,
     step = int((max_rare_depth - min_rare_depth) / num_steps) or 1
     max_rare_depth = int(max_rare_depth)
 
-    rarefaction_dir = '%s/rarefaction/' % output_dir
-    create_dir(rarefaction_dir)
-    try:
-        params_str = get_params_str(params['multiple_rarefactions'])
-    except KeyError:
-        params_str = ''
-    if parallel:
-        params_str += ' %s' % get_params_str(params['parallel'])
-        # Build the rarefaction command
-        rarefaction_cmd = \
-            'parallel_multiple_rarefactions.py -T -i %s -m %s -x %s -s %s -o %s %s' %\
-            (otu_table_fp, min_rare_depth, max_rare_depth, step,
-             rarefaction_dir, params_str)
-    else:
-        # Build the rarefaction command
-        rarefaction_cmd = \
-            'multiple_rarefactions.py -i %s -m %s -x %s -s %s -o %s %s' %\
-            (otu_table_fp, min_rare_depth, max_rare_depth, step,
-             rarefaction_dir, params_str)
-    commands.append([('Alpha rarefaction', rarefaction_cmd)])
-
-    # Prep the alpha diversity command
-    alpha_diversity_dir = '%s/alpha_div/' % output_dir
-    create_dir(alpha_diversity_dir)
-    try:
-        params_str = get_params_str(params['alpha_diversity'])
-    except KeyError:
-        params_str = ''
-    if tree_fp:
-        params_str += ' -t %s' % tree_fp
-    if parallel:
-        params_str += ' %s' % get_params_str(params['parallel'])
-        # Build the alpha diversity command
-        alpha_diversity_cmd = \
-            "parallel_alpha_diversity.py -T -i %s -o %s %s" %\
-            (rarefaction_dir, alpha_diversity_dir, params_str)
-    else:
-        # Build the alpha diversity command
-        alpha_diversity_cmd = \
-            "alpha_diversity.py -i %s -o %s %s" %\
-            (rarefaction_dir, alpha_diversity_dir, params_str)
-
-    commands.append(
-        [('Alpha diversity on rarefied OTU tables', alpha_diversity_cmd)])
-
-    # Prep the alpha diversity collation command
     alpha_collated_dir = '%s/alpha_div_collated/' % output_dir
-    create_dir(alpha_collated_dir)
-    try:
-        params_str = get_params_str(params['collate_alpha'])
-    except KeyError:
-        params_str = ''
-    # Build the alpha diversity collation command
-    alpha_collated_cmd = 'collate_alpha.py -i %s -o %s %s' %\
-        (alpha_diversity_dir, alpha_collated_dir, params_str)
-    commands.append([('Collate alpha', alpha_collated_cmd)])
-
-    if not retain_intermediate_files:
-        commands.append([('Removing intermediate files',
-                          'rm -r %s %s' % (rarefaction_dir, alpha_diversity_dir))])
+    if runs_alpha_rarefaction_on_cluster(parallel, qiime_config):
+        commands.extend(_get_cluster_alpha_rarefaction_commands(
+            otu_table_fp, output_dir, alpha_collated_dir, params, tree_fp,
+            min_rare_depth, max_rare_depth, step, retain_intermediate_files))
     else:
-        commands.append([('Skipping removal of intermediate files.', '')])
+        # Rarefy, compute alpha diversity and collate the results in one
+        # step, without writing the rarefied OTU tables and per-table alpha
+        # diversity results
+        create_dir(alpha_collated_dir)
+        try:
+            params_str = get_params_str(params['multiple_rarefactions'])
+        except KeyError:
+            params_str = ''
+        try:
+            params_str += ' %s' % get_params_str(params['alpha_diversity'])
+        except KeyError:
+            pass
+        # compute_alpha_rarefaction.py takes collate_alpha.py's options
+        try:
+            params_str += ' %s' % get_params_str(params['collate_alpha'])
+        except KeyError:
+            pass
+        if tree_fp:
+            params_str += ' -t %s' % tree_fp
+        if parallel:
+            try:
+                jobs_to_start = params['parallel']['jobs_to_start']
+            except KeyError:
+                jobs_to_start = qiime_config['jobs_to_start']
+            params_str += ' -O %s' % jobs_to_start
+        alpha_rarefaction_cmd = \
+            'compute_alpha_rarefaction.py -i %s -m %s -x %s -s %s -o %s %s' %\
+            (otu_table_fp, min_rare_depth, max_rare_depth, step,
+             alpha_collated_dir, params_str)
+        commands.append([('Alpha rarefaction', alpha_rarefaction_cmd)])
 
     # Prep the make rarefaction plot command(s)
     try:
@@ -345,6 +339,72 @@ def run_alpha_rarefaction(otu_table_fp,
 run_qiime_alpha_rarefaction = run_alpha_rarefaction
 
 
+def _get_cluster_alpha_rarefaction_commands(otu_table_fp,
+                                            output_dir,
+                                            alpha_collated_dir,
+                                            params,
+                                            tree_fp,
+                                            min_rare_depth,
+                                            max_rare_depth,
+                                            step,
+                                            retain_intermediate_files):
+    """ Return the commands which compute alpha rarefaction on a cluster
+
+        The rarefied OTU tables and their alpha diversity are computed by
+         the parallel scripts, which submit their jobs with cluster_jobs_fp,
+         and then collated with collate_alpha.py.
+    """
+    commands = []
+    rarefaction_dir = '%s/rarefaction/' % output_dir
+    create_dir(rarefaction_dir)
+    try:
+        params_str = get_params_str(params['multiple_rarefactions'])
+    except KeyError:
+        params_str = ''
+    params_str += ' %s' % get_params_str(params['parallel'])
+    # Build the rarefaction command
+    rarefaction_cmd = \
+        'parallel_multiple_rarefactions.py -T -i %s -m %s -x %s -s %s -o %s %s' %\
+        (otu_table_fp, min_rare_depth, max_rare_depth, step,
+         rarefaction_dir, params_str)
+    commands.append([('Alpha rarefaction', rarefaction_cmd)])
+
+    # Prep the alpha diversity command
+    alpha_diversity_dir = '%s/alpha_div/' % output_dir
+    create_dir(alpha_diversity_dir)
+    try:
+        params_str = get_params_str(params['alpha_diversity'])
+    except KeyError:
+        params_str = ''
+    if tree_fp:
+        params_str += ' -t %s' % tree_fp
+    params_str += ' %s' % get_params_str(params['parallel'])
+    # Build the alpha diversity command
+    alpha_diversity_cmd = \
+        "parallel_alpha_diversity.py -T -i %s -o %s %s" %\
+        (rarefaction_dir, alpha_diversity_dir, params_str)
+    commands.append(
+        [('Alpha diversity on rarefied OTU tables', alpha_diversity_cmd)])
+
+    # Prep the alpha diversity collation command
+    create_dir(alpha_collated_dir)
+    try:
+        params_str = get_params_str(params['collate_alpha'])
+    except KeyError:
+        params_str = ''
+    # Build the alpha diversity collation command
+    alpha_collated_cmd = 'collate_alpha.py -i %s -o %s %s' %\
+        (alpha_diversity_dir, alpha_collated_dir, params_str)
+    commands.append([('Collate alpha', alpha_collated_cmd)])
+
+    if not retain_intermediate_files:
+        commands.append([('Removing intermediate files',
+                          'rm -r %s %s' % (rarefaction_dir, alpha_diversity_dir))])
+    else:
+        commands.append([('Skipping removal of intermediate files.', '')])
+    return commands
+
+
 def run_jackknifed_beta_diversity(otu_table_fp,
                                   tree_fp,
                                   seqs_per_sample,
@@ -13,6 +13,7 @@ __email__ = "gregcaporaso@gmail.com"
 from qiime.util import parse_command_line_parameters, get_options_lookup
 from qiime.util import make_option
 from os import makedirs
+from sys import stderr
 from qiime.util import load_qiime_config
 from qiime.parse import parse_qiime_parameters
 from qiime.workflow.util import (print_commands,
@@ -20,7 +21,8 @@ from qiime.workflow.util import (print_commands,
                                  print_to_stdout,
                                  no_status_updates,
                                  validate_and_set_jobs_to_start)
-from qiime.workflow.downstream import run_alpha_rarefaction
+from qiime.workflow.downstream import (run_alpha_rarefaction,
+                                       runs_alpha_rarefaction_on_cluster)
 
 qiime_config = load_qiime_config()
 
@@ -29,7 +31,9 @@ script_info = {}
 script_info[
     'brief_description'] = """A workflow script for performing alpha rarefaction"""
 script_info['script_description'] = """
-The steps performed by this script are: Generate rarefied OTU tables; compute alpha diversity metrics for each rarefied OTU table; collate alpha diversity results; and generate alpha rarefaction plots."""
+The steps performed by this script are: Generate rarefied OTU tables; compute alpha diversity metrics for each rarefied OTU table; collate alpha diversity results; and generate alpha rarefaction plots.
+
+The first three steps are performed in memory by compute_alpha_rarefaction.py, without writing the rarefied OTU tables or their alpha diversity to disk. When running in parallel (-a) with the cluster_jobs parallel_executor (see print_qiime_config.py), they are instead performed by parallel_multiple_rarefactions.py, parallel_alpha_diversity.py and collate_alpha.py, which submit their jobs to the cluster."""
 script_info['script_usage'] = []
 script_info['script_usage'].append(
     ("""Example""",
@@ -78,9 +82,12 @@ script_info['optional_options'] = [
                 help='the upper limit of rarefaction depths ' +
                 '[default: median sequence/sample count]'),
     options_lookup['jobs_to_start_workflow'],
-    make_option('--retain_intermediate_files', action='store_true', help='retain '
-                'intermediate files: rarefied OTU tables (rarefaction) and alpha diversity '
-                'results (alpha_div). By default these will be erased [default: %default]',
+    make_option('--retain_intermediate_files', action='store_true', help='DEPRECATED: '
+                'retain intermediate files: rarefied OTU tables (rarefaction) and alpha '
+                'diversity results (alpha_div). These are only written when running in '
+                'parallel (-a) with the cluster_jobs parallel_executor, so this option '
+                'has no effect otherwise. By default these will be erased '
+                '[default: %default]',
                 default=False),
 ]
 script_info['version'] = __version__
@@ -101,6 +108,12 @@ def main():
     min_rare_depth = opts.min_rare_depth
     max_rare_depth = opts.max_rare_depth
     retain_intermediate_files = opts.retain_intermediate_files
+    if retain_intermediate_files and \
+            not runs_alpha_rarefaction_on_cluster(parallel, qiime_config):
+        stderr.write("Warning: --retain_intermediate_files is deprecated, and "
+                     "has no effect unless running in parallel (-a) with the "
+                     "cluster_jobs parallel_executor: no intermediate files "
+                     "are written.\n")
 
     if opts.parameter_fp:
         try:
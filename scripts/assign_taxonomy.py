@@ -17,12 +17,12 @@ from qiime.util import (parse_command_line_parameters,
                         load_qiime_config,
                         remove_files)
 from os import mkdir, close
-from os.path import split, splitext, isfile
+from os.path import split, splitext, isfile, join
 from tempfile import mkstemp
 from qiime.assign_taxonomy import (
     BlastTaxonAssigner, MothurTaxonAssigner, RdpTaxonAssigner,
     RtaxTaxonAssigner, validate_rdp_version, UclustConsensusTaxonAssigner,
-    SortMeRNATaxonAssigner)
+    SortMeRNATaxonAssigner, NaiveBayesTaxonAssigner)
 
 assignment_method_constructors = {
     'blast': BlastTaxonAssigner,
@@ -30,7 +30,8 @@ assignment_method_constructors = {
     'rdp': RdpTaxonAssigner,
     'rtax': RtaxTaxonAssigner,
     'uclust': UclustConsensusTaxonAssigner,
-    'sortmerna': SortMeRNATaxonAssigner
+    'sortmerna': SortMeRNATaxonAssigner,
+    'naive_bayes': NaiveBayesTaxonAssigner
 }
 
 assignment_method_choices = [
@@ -39,7 +40,8 @@ assignment_method_choices = [
     'rtax',
     'mothur',
     'uclust',
-    'sortmerna']
+    'sortmerna',
+    'naive_bayes']
 
 options_lookup = get_options_lookup()
 
@@ -49,7 +51,7 @@ script_info = {}
 script_info['brief_description'] = """Assign taxonomy to each sequence"""
 script_info['script_description'] = """Contains code for assigning taxonomy, using several techniques.
 
-Given a set of sequences, %prog attempts to assign the taxonomy of each sequence. Currently the methods implemented are assignment with BLAST, the RDP classifier, RTAX, mothur, and uclust. The output of this step is an observation metadata mapping file of input sequence identifiers (1st column of output file) to taxonomy (2nd column) and quality score (3rd column). There may be method-specific information in subsequent columns.
+Given a set of sequences, %prog attempts to assign the taxonomy of each sequence. Currently the methods implemented are assignment with BLAST, the RDP classifier, QIIME's naive Bayes classifier, RTAX, mothur, and uclust. The output of this step is an observation metadata mapping file of input sequence identifiers (1st column of output file) to taxonomy (2nd column) and quality score (3rd column). There may be method-specific information in subsequent columns.
 
 Reference data sets and id-to-taxonomy maps for 16S rRNA sequences can be found in the Greengenes reference OTU builds. To get the latest build of the Greengenes OTUs (and other marker gene OTU collections), follow the "Resources" link from http://qiime.org. After downloading and unzipping you can use the following files as -r and -t, where <otus_dir> is the name of the new directory after unzipping the reference OTUs tgz file.
 
@@ -82,6 +84,11 @@ script_info['script_usage'].append(
      """Optionally, the user could changed the E-value ("-e"), using the following command:""",
      """%prog -i repr_set_seqs.fasta -r ref_seq_set.fna -t id_to_taxonomy.txt -e 0.01 -m blast"""))
 
+script_info['script_usage'].append(
+    ("""""",
+     """To run 4 blast processes at a time (e.g., on a machine with 4 cores), you can run the following command:""",
+     """%prog -i repr_set_seqs.fasta -r ref_seq_set.fna -t id_to_taxonomy.txt -m blast --blast_jobs_to_start 4"""))
+
 script_info['script_usage'].append(("""Assignment with the RDP Classifier:""", """The RDP Classifier program (Wang, Garrity, Tiedje, & Cole, 2007) assigns taxonomies by matching sequence segments of length 8 to a database of previously assigned sequences. It uses a naive bayesian algorithm, which means that for each potential assignment, it attempts to calculate the probability of the observed matches, assuming that the assignment is correct and that the sequence segments are completely independent. The RDP Classifier is distributed with a pre-built database of assigned sequence, which is used by default. The quality scores provided by the RDP classifier are confidence values.
 
 Note: If a reference set of sequences and taxonomy to id assignment file are provided, the script will use them to generate a new training dataset for the RDP Classifier on-the-fly.  Because of the RDP Classifier's implementation, all lineages in the training dataset must contain the same number of ranks.
@@ -93,6 +100,17 @@ script_info['script_usage'].append(
      """Alternatively, the user could change the minimum confidence score ("-c"), using the following command:""",
      """%prog -i repr_set_seqs.fasta -m rdp -c 0.85"""))
 
+script_info['script_usage'].append(("""Assignment with the naive Bayes classifier:""", """The naive Bayes classifier is QIIME's own implementation of the RDP Classifier's method, which runs without Java. Its model is trained on a reference set of sequences and a taxonomy to id assignment file, which (unlike with the RDP Classifier) may have lineages of different depths. As with the RDP Classifier, the quality scores are confidence values.
+
+If --naive_bayes_model_dir is passed, the trained model is written to that directory, and later runs with the same directory reuse it instead of training a new one. Once trained, the model can be used without -r and -t. The sequences can be classified in several processes with --naive_bayes_jobs_to_start.
+
+To train a model, keep it in "nb_model", and assign the representative sequence set using 4 processes, you can run the following command:""", """%prog -i repr_set_seqs.fasta -m naive_bayes -r ref_seq_set.fna -t id_to_taxonomy.txt --naive_bayes_model_dir nb_model --naive_bayes_jobs_to_start 4"""))
+
+script_info['script_usage'].append(
+    ("""""",
+     """To assign taxonomy again with the trained model, you can run the following command:""",
+     """%prog -i repr_set_seqs.fasta -m naive_bayes --naive_bayes_model_dir nb_model"""))
+
 script_info['script_usage'].append(("""Assignment with RTAX:""", """
 Taxonomy assignments are made by searching input sequences against a fasta database of pre-assigned reference sequences. All matches are collected which match the query within 0.5% identity of the best match.  A taxonomy assignment is made to the lowest rank at which more than half of these hits agree.  Note that both unclustered read fasta files are required as inputs in addition to the representative sequence file.
 
@@ -198,8 +216,8 @@ script_info['optional_options'] = [
                 help='Database to blast against.  Must provide either --blast_db or '
                 '--reference_seqs_db for assignment with blast [default: %default]'),
     make_option('-c', '--confidence', type='float',
-                help='Minimum confidence to record an assignment, only used for rdp '
-                'and mothur methods [default: %default]', default=0.80),
+                help='Minimum confidence to record an assignment, only used for rdp, '
+                'naive_bayes and mothur methods [default: %default]', default=0.80),
     make_option('--min_consensus_fraction', type='float',
                 help=('Minimum fraction of database hits that must have a '
                       'specific taxonomic assignment to assign that taxonomy '
@@ -217,9 +235,22 @@ script_info['optional_options'] = [
     make_option('--rdp_max_memory', default=4000, type='int',
                 help='Maximum memory allocation, in MB, for Java virtual machine when '
                 'using the rdp method.  Increase for large training sets [default: %default]'),
+    make_option('--naive_bayes_model_dir', type='string',
+                help='Directory to keep the trained model in when using the '
+                'naive_bayes method. If it contains a model, that model is used '
+                '(and -r and -t are optional); otherwise the model trained on -r '
+                'and -t is written to it [default: train a model for this run '
+                'only]'),
+    make_option('--naive_bayes_jobs_to_start', type='int', default=1,
+                help='Number of processes to classify sequences in when using '
+                'the naive_bayes method [default: %default]'),
     make_option('-e', '--blast_e_value', type='float',
                 help='Maximum e-value to record an assignment, only used for blast '
                 'method [default: %default]', default=0.001),
+    make_option('--blast_jobs_to_start', type='int', default=1,
+                help='Number of blast processes to run at a time when using the '
+                'blast method, each on a batch of 1000 sequences '
+                '[default: %default]'),
     make_option('-o', '--output_dir', type='new_dirpath',
                 help='Path to store result file ' +
                 '[default: <ASSIGNMENT_METHOD>_assigned_taxonomy]')
@@ -265,6 +296,8 @@ def main():
             option_parser.error('Either a blast db (via -b) or a collection '
                                 'of reference sequences (via -r) must be '
                                 'passed to assign taxonomy using blast.')
+        if opts.blast_jobs_to_start < 1:
+            option_parser.error('--blast_jobs_to_start must be 1 or greater.')
 
     if assignment_method == 'rdp':
         try:
@@ -286,6 +319,19 @@ def main():
         else:
             pass
 
+    if assignment_method == 'naive_bayes':
+        if opts.naive_bayes_jobs_to_start < 1:
+            option_parser.error('--naive_bayes_jobs_to_start must be 1 or '
+                                'greater.')
+        if not (opts.id_to_taxonomy_fp and opts.reference_seqs_fp):
+            if opts.naive_bayes_model_dir is None or \
+                    not isfile(join(opts.naive_bayes_model_dir, 'model.json')):
+                option_parser.error(
+                    'Naive Bayes classification requires both a filepath for '
+                    'reference sequences (via -r) and an id_to_taxonomy file '
+                    '(via -t), unless --naive_bayes_model_dir contains a '
+                    'trained model.')
+
     if assignment_method == 'uclust':
         if opts.id_to_taxonomy_fp is None:
             option_parser.error('--id_to_taxonomy_fp is required when '
@@ -343,6 +389,7 @@ def main():
         else:
             params['reference_seqs_filepath'] = opts.reference_seqs_fp
         params['Max E value'] = opts.blast_e_value
+        params['jobs_to_start'] = opts.blast_jobs_to_start
 
     elif assignment_method == 'mothur':
         params['Confidence'] = opts.confidence
@@ -375,6 +422,13 @@ def main():
             'training_data_properties_fp'] = opts.training_data_properties_fp
         params['max_memory'] = "%sM" % opts.rdp_max_memory
 
+    elif assignment_method == 'naive_bayes':
+        params['Confidence'] = opts.confidence
+        params['id_to_taxonomy_fp'] = opts.id_to_taxonomy_fp
+        params['reference_sequences_fp'] = opts.reference_seqs_fp
+        params['model_dir'] = opts.naive_bayes_model_dir
+        params['jobs_to_start'] = opts.naive_bayes_jobs_to_start
+
     elif assignment_method == 'rtax':
         params['id_to_taxonomy_fp'] = opts.id_to_taxonomy_fp
         params['reference_sequences_fp'] = opts.reference_seqs_fp
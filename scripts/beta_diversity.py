@@ -76,6 +76,12 @@ script_info['optional_options'] = [
                 help='Compute for only these rows of the distance matrix.' +
                 ' User should pass a list of sample names (e.g. "s1,s3")' +
                 ' [default: %default; full n x n matrix is generated]'),
+    make_option('-b', '--binary_rows', action='store_true', default=False,
+                help='Write the rows computed with -r in binary format (a'
+                ' .npy file of the distances and an _ids.txt file of the row'
+                ' and column sample ids) rather than as text. This is used by'
+                ' parallel_beta_diversity.py to assemble the full matrix'
+                ' without re-parsing text [default: %default]'),
     make_option('-o', '--output_dir',
                 help="Output directory. One will be created if it doesn't exist.",
                 type='new_dirpath'),
@@ -102,6 +108,7 @@ script_info['optional_options'] = [
 ]
 script_info['option_label'] = {'input_path': 'OTU table filepath',
                                'rows': 'List of samples for compute',
+                               'binary_rows': 'Write rows in binary format',
                                'metrics': 'Metrics to use',
                                'show_metrics': 'Show metrics',
                                'tree_path': 'Newick tree filepath',
@@ -142,7 +149,8 @@ def main():
                            opts.tree_path, opts.rows, full_tree=opts.full_tree)
     elif os.path.isfile(opts.input_path):
         single_file_beta(opts.input_path, opts.metrics, opts.tree_path,
-                         opts.output_dir, opts.rows, full_tree=opts.full_tree)
+                         opts.output_dir, opts.rows, full_tree=opts.full_tree,
+                         binary_rows=opts.binary_rows)
     else:
         stderr.write("io error, input path not valid.  Does it exist?")
         exit(1)
@@ -109,6 +109,10 @@ script_info['optional_options'] = [
     make_option('-s', '--sample_id_map_fp', type='existing_filepath',
                 help='Map of original sample ids to new sample ids [default: '
                 '%default]', default=None),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of processes over which to split the '
+                'permutations. Only applies when method is partial_mantel or '
+                'mantel_corr [default: %default]'),
     # Standard Mantel specific, i.e., method == mantel
     make_option('-t', '--tail_type',
                 help='the type of tail test to perform when calculating the p-value. '
@@ -180,6 +184,8 @@ def main():
     if opts.sample_id_map_fp:
         sample_id_map = dict([(k, v[0])
                               for k, v in fields_to_dict(open(opts.sample_id_map_fp, "U")).items()])
+    if opts.jobs_to_start < 1:
+        option_parser.error("jobs_to_start must be at least 1")
     input_dm_fps = opts.input_dms
     distmats = [parse_distmat(open(dm_fp, 'U')) for dm_fp in input_dm_fps]
 
@@ -195,14 +201,16 @@ def main():
                        distmats, opts.num_permutations, opts.tail_type,
                        comment_mantel_pmantel, control_dm_fp=opts.control_dm,
                        control_dm=parse_distmat(open(opts.control_dm, 'U')),
-                       sample_id_map=sample_id_map))
+                       sample_id_map=sample_id_map,
+                       jobs_to_start=opts.jobs_to_start))
     elif opts.method == 'mantel_corr':
         output_f = open(path.join(opts.output_dir,
                         'mantel_correlogram_results.txt'), 'w')
         result_str, correlogram_fps, correlograms = run_mantel_correlogram(
             input_dm_fps, distmats, opts.num_permutations, comment_corr,
             opts.alpha, sample_id_map=sample_id_map,
-            variable_size_distance_classes=opts.variable_size_distance_classes)
+            variable_size_distance_classes=opts.variable_size_distance_classes,
+            jobs_to_start=opts.jobs_to_start)
 
         output_f.write(result_str)
         for corr_fp, corr in zip(correlogram_fps, correlograms):
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent", "Justin Kuczynski"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from functools import partial
+
+from skbio.stats import subsample
+
+from qiime.util import (make_option, parse_command_line_parameters,
+                        create_dir)
+from qiime.alpha_diversity import (single_file_alpha_rarefaction,
+                                   list_known_metrics)
+
+script_info = {}
+script_info['brief_description'] = """Compute collated alpha diversity of rarefied OTU tables in a single step"""
+script_info['script_description'] = """This script rarefies an OTU table at a series of depths, computes alpha diversity for each rarefied table, and writes the collated alpha diversity tables. It gives the same result as running multiple_rarefactions.py, alpha_diversity.py and collate_alpha.py in turn, but the rarefied OTU tables and the alpha diversity of each are kept in memory rather than written to (and read back from) disk, which is considerably faster for large numbers of samples, depths or iterations. The rarefied tables can optionally be computed in several processes on the local machine."""
+script_info['script_usage'] = []
+script_info['script_usage'].append(
+    ("""Example:""",
+     """Rarefy otu_table.biom at 10 (-m) through 140 (-x) sequences per sample in steps of 10 (-s), performing 2 iterations at each depth (-n), and write the collated chao1 and PD_whole_tree tables to collated_alpha/ (-o):""",
+     """%prog -i otu_table.biom -m 10 -x 140 -s 10 -n 2 --metrics chao1,PD_whole_tree -t rep_set.tre -o collated_alpha/"""))
+script_info['output_description'] = """The output directory contains one file per metric (e.g. chao1.txt, PD_whole_tree.txt), in the format written by collate_alpha.py, which can be passed to make_rarefaction_plots.py."""
+
+script_info['required_options'] = [
+    make_option('-i', '--input_path',
+                help='Input OTU table filepath.',
+                type='existing_filepath'),
+    make_option('-o', '--output_path',
+                help="Output directory.",
+                type='new_dirpath'),
+    make_option('-m', '--min', type='int',
+                help='Minimum number of seqs/sample for rarefaction.'),
+    make_option('-x', '--max', type='int',
+                help='Maximum number of seqs/sample (inclusive) for rarefaction. '),
+    make_option('-s', '--step', type='int',
+                help='Size of each steps between the min/max of' +
+                ' seqs/sample (e.g. min, min+step... for level <= max).')
+]
+script_info['optional_options'] = [
+    make_option('-n', '--num-reps', dest='num_reps', default=10, type='int',
+                help='The number of iterations at each step. [default: %default]'),
+    make_option('--metrics', type='multiple_choice',
+                mchoices=list_known_metrics(),
+                default='PD_whole_tree,chao1,observed_otus',
+                help='Alpha-diversity metric(s) to use. A comma-separated list should' +
+                ' be provided when multiple metrics are specified. [default: %default]'),
+    make_option('-t', '--tree_path', default=None,
+                help='Input newick tree filepath.' +
+                ' [default: %default; REQUIRED for phylogenetic metrics]',
+                type='existing_filepath'),
+    make_option('--subsample_multinomial', default=False, action='store_true',
+                help='subsample using subsampling with replacement [default: %default]'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of processes to compute the rarefied OTU tables' +
+                ' in [default: %default]'),
+    make_option('-e', '--example_path', type='existing_filepath',
+                help='example alpha_diversity analysis file, containing all' +
+                ' samples and all metrics to be included in the collated' +
+                ' result, as with collate_alpha.py [default: the samples in' +
+                ' the shallowest rarefied table, and the metrics passed' +
+                ' with --metrics]'),
+    # accepted so that multiple_rarefactions.py parameters can be passed
+    # through unchanged; neither affects alpha diversity
+    make_option('--lineages_included', default=False, action="store_true",
+                help='Ignored; accepted for compatibility with' +
+                ' multiple_rarefactions.py parameters. [default: %default]'),
+    make_option('-k', '--keep_empty_otus', default=False, action='store_true',
+                help='Ignored; accepted for compatibility with' +
+                ' multiple_rarefactions.py parameters. [default: %default]')
+]
+
+script_info['option_label'] = {'input_path': 'OTU table filepath',
+                               'output_path': 'Output directory',
+                               'min': 'Min # of seqs/sample',
+                               'max': 'Max # of seqs/sample',
+                               'step': 'Step size',
+                               'num-reps': '# of iterations',
+                               'tree_path': 'Tree filepath'}
+
+script_info['version'] = __version__
+
+
+def main():
+    option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    if opts.step <= 0:
+        option_parser.error("step must be greater than 0")
+    if opts.jobs_to_start < 1:
+        option_parser.error("jobs_to_start must be at least 1")
+
+    if opts.subsample_multinomial:
+        subsample_f = partial(subsample, replace=True)
+    else:
+        subsample_f = subsample
+
+    create_dir(opts.output_path, fail_on_exist=False)
+    try:
+        single_file_alpha_rarefaction(opts.input_path, opts.metrics,
+                                      opts.output_path, opts.min, opts.max,
+                                      opts.step, opts.num_reps,
+                                      opts.tree_path, subsample_f,
+                                      opts.jobs_to_start, opts.example_path)
+    except ValueError as e:
+        option_parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main()
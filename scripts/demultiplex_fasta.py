@@ -128,6 +128,10 @@ script_info['optional_options'] = [
                 'label, such as ">FLP3FBN01ELBSX", where "FLP3FBN01" is generated ' +
                 'from the run ID, use "-j run_prefix" and set the run prefix to ' +
                 'be used as the data under the column headerr "run_prefix". ' +
+                ' [default: %default]'),
+
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='Number of processes to demultiplex sequences in. ' +
                 ' [default: %default]')]
 
 
@@ -148,6 +152,7 @@ def main():
     disable_bc_correction = opts.disable_bc_correction
     added_demultiplex_field = opts.added_demultiplex_field
     save_barcode_frequencies = opts.save_barcode_frequencies
+    jobs_to_start = opts.jobs_to_start
 
     # Test filepaths
     try:
@@ -207,12 +212,16 @@ def main():
     if barcode_type == 'variable_length' or barcode_type == 0:
         save_barcode_frequencies = False
 
+    if jobs_to_start < 1:
+        option_parser.error("jobs_to_start must be 1 or greater.")
+
     create_dir(output_dir)
 
     process_files_and_demultiplex_sequences(mapping_file, fasta_files,
                                             qual_files, output_dir, keep_barcode, barcode_type, max_bc_errors,
                                             start_index, write_unassigned_reads, disable_bc_correction,
-                                            added_demultiplex_field, save_barcode_frequencies)
+                                            added_demultiplex_field, save_barcode_frequencies,
+                                            jobs_to_start)
 
 if __name__ == "__main__":
     main()
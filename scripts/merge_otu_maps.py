@@ -12,6 +12,7 @@ __email__ = "gregcaporaso@gmail.com"
 
 from qiime.util import make_option
 from qiime.pick_otus import map_otu_map_files
+from qiime.dereplicate import MAX_SEQ_IDS_IN_MEMORY
 from qiime.format import write_otu_map
 from qiime.util import parse_command_line_parameters
 
@@ -64,7 +65,12 @@ script_info['required_options'] = [
 
 script_info['optional_options'] = [
     make_option('-f', '--failures_fp', type='existing_filepath',
-                help='failures filepath, if applicable')
+                help='failures filepath, if applicable'),
+    make_option('--max_seq_ids_in_memory', type='int',
+                default=MAX_SEQ_IDS_IN_MEMORY,
+                help=('maximum number of sequence identifiers to hold in '
+                      'memory while merging the OTU maps before writing them '
+                      'to temporary files [default: %default]'))
 ]
 
 script_info['version'] = __version__
@@ -83,7 +89,9 @@ def main():
         failures_f = None
 
     try:
-        result = map_otu_map_files(otu_files, failures_file=failures_f)
+        result = map_otu_map_files(
+            otu_files, failures_file=failures_f,
+            max_seq_ids_in_memory=opts.max_seq_ids_in_memory)
     except KeyError as e:
         print ('Some keys do not map (' + str(e) + ') -- is the order of'
                ' your OTU maps equivalent to the order in which the OTU pickers'
@@ -96,7 +104,8 @@ def main():
         of.write('\n'.join(result))
         of.close()
     else:
-        write_otu_map(result.items(), output_fp)
+        with result:
+            write_otu_map(result.iteritems(), output_fp)
 
 
 if __name__ == "__main__":
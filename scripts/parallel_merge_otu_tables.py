@@ -19,16 +19,16 @@ from subprocess import check_call, CalledProcessError
 from cogent.core.tree import TreeNode
 from random import choice
 from time import sleep, time
-from qiime.parallel.merge_otus import start_job, local_job, torque_job, \
+from qiime.parallel.merge_otus import start_job, torque_job, \
     job_complete, initial_has_dependencies, initial_nodes_to_merge, \
-    mergeorder, mergetree
+    mergeorder, mergetree, run_merge_tree
 qiime_config = load_qiime_config()
 options_lookup = get_options_lookup()
 
 script_info = {}
 script_info['brief_description'] = """Parallel merge BIOM tables"""
 script_info[
-    'script_description'] = """This script works like the merge_otu_tables.py script, but is intended to make use of multicore/multiprocessor environments to perform analyses in parallel."""
+    'script_description'] = """This script works like the merge_otu_tables.py script, but is intended to make use of multicore/multiprocessor environments to perform analyses in parallel. The tables are merged pairwise, following a balanced merge tree. By default the merges are run in a pool of jobs_to_start local processes, each starting as soon as both of its input tables are available; pass -C to submit each merge to a torque cluster instead."""
 script_info['script_usage'] = []
 script_info['script_usage'].append(
     ("""Example""",
@@ -46,6 +46,7 @@ script_info['required_options'] = [
 script_info['optional_options'] = [
     make_option('-C', '--cluster', action='store_true', default=False,
                 help="Submit to a torque cluster"),
+    options_lookup['jobs_to_start'],
     options_lookup['seconds_to_sleep'],
     options_lookup['job_prefix']]
 script_info['version'] = __version__
@@ -123,6 +124,13 @@ def main():
     wrapper_log_output.write('\n\n')
     wrapper_log_output.flush()
 
+    if not opts.cluster:
+        # merge the tables in a local process pool, starting each merge as
+        # soon as its inputs are available
+        run_merge_tree(tree, opts.jobs_to_start, wrapper_log_output, verbose)
+        os.rename(tree.FilePath, "%s/%s" % (output_dir, "merged.biom"))
+        return
+
     to_process = initial_nodes_to_merge(tree)
     has_dependencies = initial_has_dependencies(tree, to_process)
 
@@ -132,12 +140,8 @@ def main():
     while not tree.Processed:
         # check if we have nodes to process, if so, shoot them off
         for node in to_process:
-            if opts.cluster:
-                start_job(node, merge_otus_serial_script,
-                          qiime_config['torque_queue'], wrap_call=torque_job)
-            else:
-                start_job(node, merge_otus_serial_script,
-                          qiime_config['torque_queue'], wrap_call=local_job)
+            start_job(node, merge_otus_serial_script,
+                      qiime_config['torque_queue'], wrap_call=torque_job)
 
             wrapper_log_output.write(node.FullCommand)
             wrapper_log_output.write('\n')
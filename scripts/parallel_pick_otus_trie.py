@@ -14,7 +14,7 @@ __email__ = "jens.reeder@gmail.com"
 from qiime.util import (parse_command_line_parameters,
                         get_options_lookup,
                         make_option)
-from qiime.parallel.pick_otus import ParallelPickOtusTrie
+from qiime.parallel.pick_otus import ParallelPickOtusTrie, fit_cost_model
 
 options_lookup = get_options_lookup()
 
@@ -49,6 +49,14 @@ script_info['optional_options'] = [
                 +
                 'Must be smaller than the shortest seq in input! [default: %default]',
                 default=5),
+    make_option('-c', '--cost_model_fp', action='store',
+                type='existing_filepath', help='job_costs.txt file written '
+                'by a previous run with -R and the multiprocessing '
+                'parallel_executor. The run times in it are used to estimate '
+                'the cost of each prefix from its number of sequences and '
+                'bases, so the jobs finish at similar times [default: '
+                'estimate the cost of each prefix by its number of bases]',
+                default=None),
     options_lookup['jobs_to_start'],
     options_lookup['retain_temp_files'],
     options_lookup['suppress_submit_jobs'],
@@ -68,7 +76,13 @@ def main():
     # create dict of command-line options
     params = eval(str(opts))
 
+    if opts.cost_model_fp:
+        cost_model = fit_cost_model(open(opts.cost_model_fp, 'U'))
+    else:
+        cost_model = None
+
     parallel_runner = ParallelPickOtusTrie(
+        cost_model=cost_model,
         cluster_jobs_fp=opts.cluster_jobs_fp,
         jobs_to_start=opts.jobs_to_start,
         retain_temp_files=opts.retain_temp_files,
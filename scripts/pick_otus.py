@@ -22,6 +22,7 @@ from qiime.util import (parse_command_line_parameters, create_dir)
 from qiime.sort import sort_fasta_by_abundance
 from qiime.pick_otus  import otu_picking_method_constructors,\
     otu_picking_method_choices, MothurOtuPicker
+from qiime.dereplicate import MAX_SEQ_IDS_IN_MEMORY
 
 script_info = {}
 script_info['brief_description'] = """OTU picking"""
@@ -377,6 +378,13 @@ script_info['optional_options'] = [
                 help="Don't collapse exact matches before calling "
                   "sortmerna, sumaclust or uclust [default: %default]"),
 
+    make_option('--max_seq_ids_in_memory', type='int',
+                default=MAX_SEQ_IDS_IN_MEMORY,
+                help="maximum number of sequence identifiers to hold in "
+                "memory when collapsing exact matches (or prefixes, with "
+                "cdhit) before writing them to temporary files "
+                "[default: %default]"),
+
     make_option('-d', '--save_uc_files', default=True, action='store_false',
                 help="Enable preservation of intermediate uclust (.uc) files "
                       "that are used to generate clusters via uclust.  Also enables "
@@ -510,6 +518,7 @@ def main():
     save_uc_files = opts.save_uc_files
     prefilter_identical_sequences =\
         not opts.suppress_prefilter_exact_match
+    max_seq_ids_in_memory = opts.max_seq_ids_in_memory
     derep_fullseq = opts.derep_fullseq
     chimeras_retention = opts.non_chimeras_retention
     verbose = opts.verbose
@@ -753,7 +762,8 @@ def main():
     # cd-hit
     if otu_picking_method == 'cdhit':
         params = {'Similarity': similarity,
-                  '-M': opts.max_cdhit_memory}
+                  '-M': opts.max_cdhit_memory,
+                  'max_seq_ids_in_memory': max_seq_ids_in_memory}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
                    result_path=result_path, log_path=log_path,
@@ -778,7 +788,9 @@ def main():
                   'stable_sort': uclust_stable_sort,
                   'save_uc_files': save_uc_files,
                   'output_dir': output_dir,
-                  'prefilter_identical_sequences': prefilter_identical_sequences}
+                  'prefilter_identical_sequences':
+                  prefilter_identical_sequences,
+                  'max_seq_ids_in_memory': max_seq_ids_in_memory}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
                    result_path=result_path, log_path=log_path, HALT_EXEC=False)
@@ -909,6 +921,7 @@ def main():
                   'output_dir': output_dir,
                   'prefilter_identical_sequences':
                   prefilter_identical_sequences,
+                  'max_seq_ids_in_memory': max_seq_ids_in_memory,
                   'chimeras_retention': chimeras_retention}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath, refseqs_fp,
@@ -957,7 +970,8 @@ def main():
                   'best': sortmerna_best_N_alignments,
                   'max_pos': sortmerna_max_pos,
                   'prefilter_identical_sequences':
-                  prefilter_identical_sequences}
+                  prefilter_identical_sequences,
+                  'max_seq_ids_in_memory': max_seq_ids_in_memory}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
                    result_path=result_path, log_path=log_path,
@@ -972,6 +986,7 @@ def main():
                   'l': sumaclust_l,
                   'prefilter_identical_sequences':
                   prefilter_identical_sequences,
+                  'max_seq_ids_in_memory': max_seq_ids_in_memory,
                   'denovo_otu_id_prefix': denovo_otu_id_prefix}
         otu_picker = otu_picker_constructor(params)
         otu_picker(input_seqs_filepath,
@@ -11,13 +11,14 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 from qiime.util import make_option
-from qiime.parallel.poller import poller, get_function_handle
+from qiime.parallel.poller import (poller, watching_poller,
+                                   get_function_handle)
 from qiime.util import parse_command_line_parameters
 
 script_info = {}
 script_info['brief_description'] = """Poller for parallel QIIME scripts."""
 script_info[
-    'script_description'] = """Script for polling parallel runs to check completion."""
+    'script_description'] = """Script for polling parallel runs to check completion. When the default check_run_complete_f is used, the directories containing the expected files are watched (with inotify where available, otherwise by checking only the files that are still pending every time_to_sleep seconds), so completed runs are processed as soon as their last output file is moved into place."""
 script_info['script_usage'] = [(
     "Poller example",
     "Runs the poller, which checks for the existence of two input files "
@@ -53,12 +54,34 @@ script_info['optional_options'] = [
                 ' [default: %default]'),
     make_option('-t', '--time_to_sleep', type='int',
                 help='time to wait between calls to status_callback_f'
-                ' (in seconds) [default: %default]', default=3)
+                ' (in seconds) [default: %default]', default=3),
+    make_option('-l', '--completion_times_fp',
+                help='path to write the time at which each expected file was '
+                'detected, in seconds since the poller started; only used with'
+                ' the default check_run_complete_f [default: %default]')
 ]
 
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    if opts.check_run_complete_f == \
+            'qiime.parallel.poller.basic_check_run_complete_f':
+        if opts.completion_times_fp:
+            completion_times_f = open(opts.completion_times_fp, 'w')
+        else:
+            completion_times_f = None
+        watching_poller(list(open(opts.check_run_complete_file)),
+                        get_function_handle(opts.process_run_results_f),
+                        get_function_handle(opts.clean_up_f),
+                        list(open(opts.process_run_results_file)),
+                        list(open(opts.clean_up_file)),
+                        seconds_to_sleep=opts.time_to_sleep,
+                        completion_times_f=completion_times_f)
+        if completion_times_f is not None:
+            completion_times_f.close()
+        return
+
     poller(get_function_handle(opts.check_run_complete_f),
            get_function_handle(opts.process_run_results_f),
            get_function_handle(opts.clean_up_f),
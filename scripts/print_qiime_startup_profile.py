@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from os.path import exists, join
+
+from qiime.util import (parse_command_line_parameters,
+                        make_option,
+                        get_qiime_scripts_dir)
+from qiime.import_profiler import (profile_import_subprocess,
+                                   format_import_profile)
+
+script_info = {}
+script_info['brief_description'] = ("Print the time taken to import QIIME "
+                                    "modules and scripts")
+script_info['script_description'] = (
+    "Each target (a module name, or a script name or filepath) is imported in "
+    "a new python interpreter, and the time taken to import each of the "
+    "modules that are loaded is reported. This is useful for finding out why "
+    "a script is slow to start, which matters when the parallel scripts start "
+    "many short jobs. For scripts, only the top level of the script is run "
+    "(i.e., its imports), not its main function. The cumulative time of a "
+    "module includes the time taken to import the modules that it imports, "
+    "and its self time doesn't. Nested imports are indented.")
+script_info['script_usage'] = [
+    ("",
+     "Print the 25 slowest imports of the qiime.util module.",
+     "%prog"),
+    ("",
+     "Print the 10 slowest imports of pick_otus.py and qiime.parse, "
+     "including only the modules that they import directly.",
+     "%prog -t pick_otus.py,qiime.parse -n 10 -d 1")]
+script_info['output_description'] = (
+    "The total import time and the slowest imports of each target are "
+    "written to stdout.")
+script_info['required_options'] = []
+script_info['optional_options'] = [
+    make_option('-t', '--targets', type='string', default='qiime.util',
+                help='the modules and scripts to profile (comma-separated). '
+                'Scripts are given by their filepath, or by their name if '
+                'they are in the QIIME scripts directory [default: %default]'),
+    make_option('-n', '--num_modules', type='int', default=25,
+                help='the number of imports to print for each target, or 0 '
+                'to print all of them [default: %default]'),
+    make_option('-d', '--max_depth', type='int', default=None,
+                help='only print imports nested at most this deep (1 is the '
+                'modules imported by the target itself) [default: print all '
+                'imports]'),
+]
+script_info['version'] = __version__
+
+
+def main():
+    option_parser, opts, args =\
+        parse_command_line_parameters(**script_info)
+
+    if opts.num_modules < 0:
+        option_parser.error("num_modules must be 0 or greater.")
+    num_modules = opts.num_modules or None
+
+    for target in opts.targets.split(','):
+        if target.endswith('.py') and not exists(target):
+            target = join(get_qiime_scripts_dir(), target)
+        try:
+            total_time, records = profile_import_subprocess(target)
+        except ImportError as e:
+            option_parser.error(str(e))
+        print '\n'.join(format_import_profile(target, total_time, records,
+                                              num_modules, opts.max_depth))
+        print
+
+
+if __name__ == "__main__":
+    main()
@@ -15,7 +15,7 @@ __email__ = "wdwvt1@gmail.com"
 from sys import stdout
 
 from qiime.parse import parse_newick, PhyloNode
-from qiime.relatedness_library import nri, nti
+from qiime.relatedness_library import nri, nti, NullModel
 from qiime.util import parse_command_line_parameters, make_option
 
 script_info = {}
@@ -64,7 +64,10 @@ script_info['optional_options'] = [
                      '[default: %default]'),
     make_option('-o', '--output_fp', type="new_filepath",
                 help="path where output will be written [default: print to "
-                     "screen]", default=None)]
+                     "screen]", default=None),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='number of processes over which to split the random '
+                     'draws [default: %default]')]
 script_info['version'] = __version__
 script_info['help_on_no_arguments'] = True
 
@@ -119,10 +122,16 @@ def main():
             option_parser.error("Unknown method: %s; valid methods are: %s" %
                                 (method, ', '.join(method_lookup.keys())))
 
+    if opts.jobs_to_start < 1:
+        option_parser.error('jobs_to_start must be at least 1')
+
+    # the methods share the random draws
+    null_model = NullModel(tip_dists, opts.iters, opts.jobs_to_start)
     for method in methods:
         print >> fd, method + ':', method_lookup[method](tip_dists, all_ids,
                                                          group_ids,
-                                                         iters=opts.iters)
+                                                         iters=opts.iters,
+                                                         null_model=null_model)
 
     fd.close()
 
@@ -136,7 +136,12 @@ script_info['optional_options'] = [
                 choices=['33', '64'], help="the ascii offset to use when "
                 "decoding phred scores (either 33 or 64). Warning: in most "
                 "cases you don't need to pass this value "
-                "[default: determined automatically]")
+                "[default: determined automatically]"),
+    make_option('--num_workers', default=1, type='int',
+                help='number of processes to use for barcode correction and '
+                'quality filtering. Reads are processed in chunks and output '
+                'is identical regardless of the number of processes '
+                '[default: %default]'),
     # NEED TO FIX THIS FUNCTIONALITY - CURRENTLY READING THE WRONG FIELD
     # make_option('--filter_bad_illumina_qual_digit',
     #    action='store_true',
@@ -173,6 +178,7 @@ def main():
     store_demultiplexed_fastq = opts.store_demultiplexed_fastq
     barcode_type = opts.barcode_type
     max_barcode_errors = opts.max_barcode_errors
+    num_workers = opts.num_workers
 
     # if this is not a demultiplexed run,
     if barcode_type == 'not-barcoded':
@@ -201,6 +207,9 @@ def main():
             option_parser.error(
                 "If --phred_offset is provided, it must be a valid integer.")
 
+    if num_workers < 1:
+        option_parser.error('--num_workers must be at least 1.')
+
     if opts.last_bad_quality_char is not None:
         option_parser.error('--last_bad_quality_char is no longer supported. '
                             'Use -q instead (see option help text by passing -h)')
@@ -326,7 +335,8 @@ def main():
                 log_f=log_f, histogram_f=histogram_f,
                 barcode_correction_fn=barcode_correction_fn,
                 max_barcode_errors=max_barcode_errors,
-                phred_offset=phred_offset)
+                phred_offset=phred_offset,
+                num_workers=num_workers)
         else:
             seq_generator = process_fastq_single_end_read_file_no_barcode(
                 sequence_read_f, sample_ids[i],
@@ -338,7 +348,8 @@ def main():
                 start_seq_id=start_seq_id,
                 filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
                 log_f=log_f, histogram_f=histogram_f,
-                phred_offset=phred_offset)
+                phred_offset=phred_offset,
+                num_workers=num_workers)
 
         for fasta_header, sequence, quality, seq_id in seq_generator:
             output_f.write('>%s\n%s\n' % (fasta_header, sequence))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Benchmark the quality filtering of split_libraries_fastq.
+
+Synthetic reads are quality filtered by:
+
+  quality_filter_sequence: one read at a time, as
+      demultiplex_fastq_records did previously
+  quality_filter_sequences: in batches of --batch_size reads, as
+      demultiplex_fastq_records does now
+  quality_filter_sequences, one call: all of the reads at once
+
+and the throughput of each is reported in reads per second. The results of
+the batched filters are checked against quality_filter_sequence.
+"""
+from __future__ import division
+
+from time import time
+
+from numpy.random import RandomState
+
+from qiime.split_libraries_fastq import (quality_filter_sequence,
+                                         quality_filter_sequences)
+from qiime.util import parse_command_line_parameters, make_option
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+script_info = {}
+script_info['brief_description'] = ("Benchmark the quality filtering of "
+                                    "split_libraries_fastq")
+script_info['script_description'] = (
+    "Generates synthetic reads whose quality drops off towards the end of "
+    "some of them, then quality filters them one read at a time with "
+    "quality_filter_sequence, in batches with quality_filter_sequences, and "
+    "with a single call to quality_filter_sequences. The throughput of each "
+    "is printed in reads per second, and the batched results are checked "
+    "against the per-read ones.")
+script_info['script_usage'] = [
+    ("", "Benchmark 100,000 reads of 150 bases:", "%prog"),
+    ("", "Benchmark 1,000,000 reads of 250 bases, filtered in batches of "
+     "10,000:",
+     "%prog --num_reads 1000000 --read_length 250 --batch_size 10000")]
+script_info['output_description'] = (
+    "The run time and reads per second of each quality filter.")
+script_info['required_options'] = []
+script_info['optional_options'] = [
+    make_option('--num_reads', type='int', default=100000,
+                help='number of reads to filter [default: %default]'),
+    make_option('--read_length', type='int', default=150,
+                help='length of each read [default: %default]'),
+    make_option('--batch_size', type='int', default=1000,
+                help='number of reads filtered per call to '
+                'quality_filter_sequences [default: %default]'),
+    make_option('-r', '--max_bad_run_length', type='int', default=3,
+                help='max number of consecutive low quality base calls '
+                'allowed before truncating a read [default: %default]'),
+    make_option('-p', '--min_per_read_length_fraction', type='float',
+                default=0.75,
+                help='min number of consecutive high quality base calls to '
+                'include a read, as a fraction of the read length '
+                '[default: %default]'),
+    make_option('-n', '--sequence_max_n', type='int', default=0,
+                help='maximum number of N characters allowed in a read '
+                '[default: %default]'),
+    make_option('-q', '--phred_quality_threshold', type='int', default=3,
+                help='the maximum unacceptable Phred quality score '
+                '[default: %default]'),
+    make_option('--seed', type='int', default=0,
+                help='seed for generating the reads [default: %default]'),
+]
+script_info['version'] = __version__
+script_info['help_on_no_arguments'] = False
+
+
+def make_reads(num_reads, read_length, seed=0):
+    """Return lists of headers, sequences and quality score arrays
+
+    Quality scores are drawn from 20-40, except in the last part of about a
+    third of the reads where they drop to 2, and about 1 base in 1000 is an
+    N.
+    """
+    rand = RandomState(seed)
+    bases = rand.choice(list('ACGT'), (num_reads, read_length))
+    bases[rand.random_sample((num_reads, read_length)) < 0.001] = 'N'
+    quals = rand.randint(20, 41, (num_reads, read_length))
+    for i in rand.choice(num_reads, num_reads // 3, replace=False):
+        quals[i, rand.randint(read_length):] = 2
+    headers = ['read%d' % i for i in range(num_reads)]
+    sequences = [''.join(b) for b in bases]
+    return headers, sequences, list(quals)
+
+
+def filter_per_read(headers, sequences, qualities, params):
+    return [quality_filter_sequence(h, s, q, *params)
+            for h, s, q in zip(headers, sequences, qualities)]
+
+
+def filter_batches(headers, sequences, qualities, params, batch_size):
+    results = []
+    for start in range(0, len(sequences), batch_size):
+        end = start + batch_size
+        results.extend(quality_filter_sequences(headers[start:end],
+                                                sequences[start:end],
+                                                qualities[start:end],
+                                                *params))
+    return results
+
+
+def same_results(results, expected):
+    """Return True if the quality filter results are identical"""
+    if len(results) != len(expected):
+        return False
+    for (status, seq, qual), (exp_status, exp_seq, exp_qual) in \
+            zip(results, expected):
+        if status != exp_status or seq != exp_seq or \
+           list(qual) != list(exp_qual):
+            return False
+    return True
+
+
+def main():
+    option_parser, opts, args =\
+        parse_command_line_parameters(**script_info)
+
+    headers, sequences, qualities = make_reads(opts.num_reads,
+                                               opts.read_length, opts.seed)
+    params = (opts.max_bad_run_length,
+              opts.phred_quality_threshold,
+              int(opts.read_length * opts.min_per_read_length_fraction),
+              opts.sequence_max_n,
+              False)
+    filters = [
+        ('quality_filter_sequence',
+         lambda: filter_per_read(headers, sequences, qualities, params)),
+        ('quality_filter_sequences, %d/call' % opts.batch_size,
+         lambda: filter_batches(headers, sequences, qualities, params,
+                                opts.batch_size)),
+        ('quality_filter_sequences, one call',
+         lambda: quality_filter_sequences(headers, sequences, qualities,
+                                          *params)),
+    ]
+
+    expected = None
+    print '%-40s  %10s  %12s  %10s' % ('filter', 'time (s)', 'reads/s',
+                                       'identical')
+    for name, f in filters:
+        start_time = time()
+        results = f()
+        run_time = time() - start_time
+        if expected is None:
+            expected = results
+        print '%-40s  %10.2f  %12.0f  %10s' % (
+            name, run_time, opts.num_reads / run_time,
+            same_results(results, expected))
+
+
+if __name__ == "__main__":
+    main()
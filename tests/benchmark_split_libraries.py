@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""Benchmark the memory used by split_libraries' preprocess.
+
+Synthetic 454 runs of increasing size are demultiplexed by preprocess, each
+in a new process, while a thread samples the process' resident set size.
+The peak RSS over the process' RSS before the run is reported for:
+
+  preprocess: the whole run, which still keeps a few values per read (ids
+      and lengths) for the log and histograms
+  streaming: reading each quality record in turn through
+      StreamingQualScores, which should stay flat as the input grows
+  parse_qual_scores: parsing every quality score into one
+      {seq_id: qual_scores} dict, which preprocess did previously
+"""
+from __future__ import division
+
+from gzip import GzipFile
+from multiprocessing import Process, Queue
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Event, Thread
+from time import time
+
+from numpy.random import RandomState
+from skbio.parse.sequences import parse_fasta
+
+from qiime.golay import encode
+from qiime.parse import parse_qual_scores
+from qiime.split_libraries import (get_infile, preprocess,
+                                   StreamingQualScores)
+from qiime.util import (parse_command_line_parameters, make_option,
+                        get_qiime_temp_dir)
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+script_info = {}
+script_info['brief_description'] = ("Benchmark the memory used by "
+                                    "split_libraries' preprocess")
+script_info['script_description'] = (
+    "Writes synthetic 454 runs (fasta, qual and mapping files) of each "
+    "requested size to a temporary directory, then runs preprocess, "
+    "StreamingQualScores and parse_qual_scores over them, each in a new "
+    "process. The run time and peak resident set size growth of each are "
+    "printed, so that the memory use of preprocess can be checked to grow "
+    "with the number of reads only as much as its log and histograms "
+    "require.")
+script_info['script_usage'] = [
+    ("", "Benchmark the default run sizes:", "%prog"),
+    ("", "Benchmark gzipped runs of 100,000 and 200,000 reads:",
+     "%prog --num_reads 100000,200000 --gzip")]
+script_info['output_description'] = (
+    "A table with one row per run size, giving the run time and peak RSS "
+    "growth of preprocess, StreamingQualScores and parse_qual_scores.")
+script_info['required_options'] = []
+script_info['optional_options'] = [
+    make_option('--num_reads',
+                help='comma-separated numbers of reads to benchmark '
+                '[default: %default]',
+                default='10000,20000,40000,80000'),
+    make_option('--gzip', action='store_true', default=False,
+                help='gzip the fasta and qual files [default: %default]'),
+    make_option('--sampling_interval', type='float', default=0.01,
+                help='seconds between RSS samples [default: %default]'),
+]
+script_info['version'] = __version__
+script_info['help_on_no_arguments'] = False
+
+PRIMER = 'CATGCTGCCTCCCGTAGGAGT'
+NUM_SAMPLES = 16
+
+
+def get_rss():
+    """Return the resident set size of this process, in bytes"""
+    f = open('/proc/self/statm')
+    resident_pages = int(f.read().split()[1])
+    f.close()
+    return resident_pages * 4096
+
+
+class RSSSampler(Thread):
+
+    """Samples the RSS of this process until stopped"""
+
+    def __init__(self, interval):
+        Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = get_rss()
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.peak = max(self.peak, get_rss())
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, get_rss())
+
+
+def write_run(working_dir, num_reads, gzip, seed=0):
+    """Write a mapping, fasta and qual file for a synthetic 454 run
+
+    Reads are a barcode and the primer followed by 250-450 random bases.
+    Returns the mapping file path and the lists of fasta and qual file paths.
+    """
+    rand = RandomState(seed)
+    barcodes = [encode([int(b) for b in '{0:012b}'.format(i + 1)])
+                for i in range(NUM_SAMPLES)]
+    mapping_fp = join(working_dir, 'map.txt')
+    mapping_f = open(mapping_fp, 'w')
+    mapping_f.write('#SampleID\tBarcodeSequence\tLinkerPrimerSequence\t'
+                    'Description\n')
+    for i, barcode in enumerate(barcodes):
+        mapping_f.write('S%d\t%s\t%s\tS%d\n' % (i, barcode, PRIMER, i))
+    mapping_f.close()
+
+    suffix = '.gz' if gzip else ''
+    fasta_fp = join(working_dir, 'reads.fna' + suffix)
+    qual_fp = join(working_dir, 'reads.qual' + suffix)
+    if gzip:
+        fasta_f, qual_f = GzipFile(fasta_fp, 'w'), GzipFile(qual_fp, 'w')
+    else:
+        fasta_f, qual_f = open(fasta_fp, 'w'), open(qual_fp, 'w')
+    for i in range(num_reads):
+        length = rand.randint(250, 451)
+        seq = barcodes[rand.randint(NUM_SAMPLES)] + PRIMER + \
+            ''.join(rand.choice(list('ACGT'), length))
+        quals = rand.randint(20, 41, len(seq))
+        fasta_f.write('>read%d\n%s\n' % (i, seq))
+        qual_f.write('>read%d\n' % i)
+        for start in range(0, len(quals), 60):
+            qual_f.write(' '.join(map(str, quals[start:start + 60])))
+            qual_f.write('\n')
+    fasta_f.close()
+    qual_f.close()
+    return mapping_fp, [fasta_fp], [qual_fp]
+
+
+def run_preprocess(mapping_fp, fasta_fps, qual_fps, output_dir):
+    preprocess(fasta_fps, qual_fps, mapping_fp, dir_prefix=output_dir,
+               min_seq_len=200, max_seq_len=1000)
+
+
+def run_streaming_qual_scores(mapping_fp, fasta_fps, qual_fps, output_dir):
+    qual_files = map(get_infile, qual_fps)
+    qual_scores = StreamingQualScores(qual_files)
+    for fasta_fp in fasta_fps:
+        fasta_file = get_infile(fasta_fp)
+        for seq_id, seq in parse_fasta(fasta_file):
+            qual_scores.get(seq_id.split()[0])
+        fasta_file.close()
+    for qual_file in qual_files:
+        qual_file.close()
+
+
+def run_parse_qual_scores(mapping_fp, fasta_fps, qual_fps, output_dir):
+    qual_files = map(get_infile, qual_fps)
+    parse_qual_scores(qual_files)
+    for qual_file in qual_files:
+        qual_file.close()
+
+
+def _measure(f, args, interval, results):
+    sampler = RSSSampler(interval)
+    start_rss = sampler.peak
+    sampler.start()
+    start_time = time()
+    f(*args)
+    run_time = time() - start_time
+    sampler.stop()
+    results.put((run_time, start_rss, sampler.peak))
+
+
+def measure(f, args, interval):
+    """Run f(*args) in a new process and return (run time, peak RSS growth)
+    """
+    results = Queue()
+    p = Process(target=_measure, args=(f, args, interval, results))
+    p.start()
+    run_time, start_rss, peak_rss = results.get()
+    p.join()
+    return run_time, peak_rss - start_rss
+
+
+def main():
+    option_parser, opts, args =\
+        parse_command_line_parameters(**script_info)
+
+    mb = 1024 * 1024
+    print '%10s  %20s  %20s  %20s' % ('reads', 'preprocess', 'streaming',
+                                      'parse_qual_scores')
+    for num_reads in map(int, opts.num_reads.split(',')):
+        working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                              prefix='benchmark_split_libraries_')
+        try:
+            mapping_fp, fasta_fps, qual_fps = write_run(working_dir,
+                                                        num_reads, opts.gzip)
+            args = (mapping_fp, fasta_fps, qual_fps, working_dir)
+            results = [measure(f, args, opts.sampling_interval)
+                       for f in (run_preprocess, run_streaming_qual_scores,
+                                 run_parse_qual_scores)]
+        finally:
+            rmtree(working_dir)
+        print '%10d  %20s  %20s  %20s' % ((num_reads,) + tuple(
+            ['%.1f s / +%.0f MB' % (t, rss / mb) for t, rss in results]))
+
+
+if __name__ == "__main__":
+    main()
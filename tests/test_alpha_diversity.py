@@ -11,21 +11,25 @@ __email__ = "justinak@gmail.com"
 """Contains tests for performing alpha diversity analyses within each sample."""
 
 from os import makedirs, close
-from os.path import exists
+from os.path import exists, join
 from shutil import rmtree
-from tempfile import mkstemp
+from tempfile import mkstemp, mkdtemp
 from unittest import TestCase, main
 
 from biom.table import Table
 from cogent.maths.unifrac.fast_unifrac import PD_whole_tree
 from numpy import array
+from numpy.random import seed
 from numpy.testing import assert_almost_equal
 from skbio.diversity.alpha import observed_otus, osd
 from skbio.util import remove_files
 
 from qiime.alpha_diversity import (AlphaDiversityCalc, AlphaDiversityCalcs,
-                                   single_file_cup)
+                                   single_file_cup,
+                                   rarefaction_alpha_diversity,
+                                   single_file_alpha_rarefaction)
 from qiime.parse import parse_newick
+from qiime.rarefaction import get_rare_data
 from qiime.util import load_qiime_config, write_biom_table
 
 
@@ -177,6 +181,112 @@ class AlphaDiversityCalcsTests(AlphaDiversitySharedSetUpTests):
         self.assertEqual(len(results[2]), 5)
 
 
+class AlphaRarefactionTests(AlphaDiversitySharedSetUpTests):
+
+    """Tests of the in-memory alpha rarefaction functions"""
+
+    def setUp(self):
+        super(AlphaRarefactionTests, self).setUp()
+        self.otu_table = Table(data=array([[20, 0, 10, 5],
+                                           [1, 1, 1, 1],
+                                           [3, 8, 0, 9],
+                                           [0, 6, 6, 6]]).T,
+                               sample_ids=list('WXYZ'),
+                               observation_ids=list('abcd'))
+
+    def test_rarefaction_alpha_diversity(self):
+        """rarefaction_alpha_diversity matches rarefying table by table"""
+        seed(0)
+        actual = rarefaction_alpha_diversity(
+            self.otu_table, ['observed_otus', 'PD_whole_tree', 'osd'],
+            [2, 4, 10, 100], 3, self.tree1)
+        # depth 100 leaves no samples
+        self.assertEqual([(r[0], r[1]) for r in actual],
+                         [(2, 0), (2, 1), (2, 2), (4, 0), (4, 1), (4, 2),
+                          (10, 0), (10, 1), (10, 2)])
+
+        seed(0)
+        calcs = AlphaDiversityCalcs(
+            [AlphaDiversityCalc(observed_otus),
+             AlphaDiversityCalc(PD_whole_tree, is_phylogenetic=True),
+             AlphaDiversityCalc(osd)])
+        for depth, rep, sample_ids, data, calc_names in actual:
+            expected_data, expected_sample_ids, expected_calc_names = \
+                calcs.getResult(get_rare_data(self.otu_table, depth),
+                                self.tree1)
+            self.assertEqual(sample_ids, list(expected_sample_ids))
+            self.assertEqual(calc_names, expected_calc_names)
+            assert_almost_equal(data, expected_data)
+        # samples with fewer sequences than the depth are omitted
+        self.assertEqual(actual[-1][2], ['W', 'Y', 'Z'])
+
+    def test_rarefaction_alpha_diversity_parallel(self):
+        """rarefaction_alpha_diversity gives the same shaped results in
+        several processes"""
+        actual = rarefaction_alpha_diversity(self.otu_table,
+                                             ['observed_otus'], [2, 4, 35],
+                                             2, jobs_to_start=3)
+        self.assertEqual([(r[0], r[1], r[2]) for r in actual],
+                         [(2, 0, list('WXYZ')), (2, 1, list('WXYZ')),
+                          (4, 0, list('WXYZ')), (4, 1, list('WXYZ')),
+                          (35, 0, ['W']), (35, 1, ['W'])])
+        # rarefying to the sample's total count is deterministic
+        self.assertEqual(actual[-1][3].tolist(), [[3.0]])
+
+    def test_rarefaction_alpha_diversity_invalid_metric(self):
+        """rarefaction_alpha_diversity raises ValueError for bad metrics"""
+        self.assertRaises(ValueError, rarefaction_alpha_diversity,
+                          self.otu_table, ['not_a_metric'], [2], 1)
+        self.assertRaises(ValueError, rarefaction_alpha_diversity,
+                          self.otu_table, ['PD_whole_tree'], [2], 1)
+
+    def test_single_file_alpha_rarefaction(self):
+        """single_file_alpha_rarefaction writes collated alpha diversity"""
+        output_dir = mkdtemp(dir=self.tmp_dir,
+                             prefix='alpha_diversity_tests')
+        self.dirs_to_remove.append(output_dir)
+        write_biom_table(self.otu_table, self.otu_table1_fp)
+        single_file_alpha_rarefaction(self.otu_table1_fp,
+                                      'observed_otus,chao1', output_dir,
+                                      3, 33, 15, num_reps=2)
+        lines = list(open(join(output_dir, 'observed_otus.txt'), 'U'))
+        self.assertEqual(lines[0].rstrip('\n').split('\t'),
+                         ['', 'sequences per sample', 'iteration',
+                          'W', 'X', 'Y', 'Z'])
+        self.assertEqual([line.split('\t')[0] for line in lines[1:]],
+                         ['alpha_rarefaction_3_0.txt',
+                          'alpha_rarefaction_3_1.txt',
+                          'alpha_rarefaction_18_0.txt',
+                          'alpha_rarefaction_18_1.txt',
+                          'alpha_rarefaction_33_0.txt',
+                          'alpha_rarefaction_33_1.txt'])
+        # X has fewer than 18 sequences, and Z has exactly 18
+        self.assertEqual(lines[3].split('\t')[1:3], ['18', '0'])
+        self.assertEqual(lines[3].split('\t')[4], 'n/a')
+        self.assertEqual(lines[3].rstrip('\n').split('\t')[6], '3.0')
+        self.assertTrue(exists(join(output_dir, 'chao1.txt')))
+
+    def test_single_file_alpha_rarefaction_example_fp(self):
+        """single_file_alpha_rarefaction writes the example's samples/metrics"""
+        output_dir = mkdtemp(dir=self.tmp_dir,
+                             prefix='alpha_diversity_tests')
+        self.dirs_to_remove.append(output_dir)
+        write_biom_table(self.otu_table, self.otu_table1_fp)
+        example_fp = join(output_dir, 'example.txt')
+        example_f = open(example_fp, 'w')
+        example_f.write('\tobserved_otus\nZ\t1.0\nW\t2.0\nY\t1.0\nX\t1.0\n')
+        example_f.close()
+        single_file_alpha_rarefaction(self.otu_table1_fp,
+                                      'observed_otus,chao1', output_dir,
+                                      3, 3, 1, num_reps=1,
+                                      example_fp=example_fp)
+        lines = list(open(join(output_dir, 'observed_otus.txt'), 'U'))
+        self.assertEqual(lines[0].rstrip('\n').split('\t'),
+                         ['', 'sequences per sample', 'iteration',
+                          'Z', 'W', 'Y', 'X'])
+        self.assertFalse(exists(join(output_dir, 'chao1.txt')))
+
+
 class SingleFileCUPTests(TestCase):
     def setUp(self):
         self.files_to_remove = []
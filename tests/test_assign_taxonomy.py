@@ -32,13 +32,15 @@ from bfillings.rdp_classifier import train_rdp_classifier
 from bfillings.formatdb import build_blast_db_from_fasta_path
 from bfillings.sortmerna_v2 import (build_database_sortmerna, sortmerna_map)
 
+import qiime.assign_taxonomy
 from qiime.util import get_qiime_temp_dir
 from qiime.test import initiate_timeout, disable_timeout
 
 from qiime.assign_taxonomy import (
     TaxonAssigner, BlastTaxonAssigner, RdpTaxonAssigner, RtaxTaxonAssigner,
     RdpTrainingSet, RdpTree, _QIIME_RDP_TAXON_TAG, validate_rdp_version,
-    MothurTaxonAssigner, UclustConsensusTaxonAssigner, SortMeRNATaxonAssigner)
+    MothurTaxonAssigner, UclustConsensusTaxonAssigner, SortMeRNATaxonAssigner,
+    NaiveBayesTaxonAssigner)
 from sys import stderr
 
 
@@ -451,7 +453,8 @@ class BlastTaxonAssignerTests(TestCase):
         # default parameters correctly initialized
         default_params = {'Min percent identity': 90.0,
                           'Max E value': 1e-30,
-                          'Application': 'blastn/megablast'}
+                          'Application': 'blastn/megablast',
+                          'jobs_to_start': 1}
         self.assertEqual(p.Params, default_params)
 
     def test_parse_id_to_taxonomy_file(self):
@@ -566,6 +569,38 @@ class BlastTaxonAssignerTests(TestCase):
 
         self.assertEqual(actual, self.expected1)
 
+    def test_call_closes_result_file_on_error(self):
+        """BlastTaxonAssigner.__call__ closes result_path if a batch fails
+        """
+        opened_files = []
+
+        def tracking_open(*args):
+            f = open(*args)
+            opened_files.append(f)
+            return f
+
+        def failing_seqs_to_taxonomy(*args):
+            raise ApplicationError("blast failed")
+
+        fd, result_fp = mkstemp(prefix='BlastTaxonAssignerTests_',
+                                suffix='.txt')
+        close(fd)
+        self._paths_to_clean_up.append(result_fp)
+
+        p = BlastTaxonAssigner({'blast_db': 'unused',
+                                'id_to_taxonomy_filepath': self.id_to_taxonomy_fp})
+        p._seqs_to_taxonomy = failing_seqs_to_taxonomy
+        qiime.assign_taxonomy.open = tracking_open
+        try:
+            self.assertRaises(ApplicationError, p, self.input_seqs_fp,
+                              result_path=result_fp)
+        finally:
+            del qiime.assign_taxonomy.open
+
+        result_files = [f for f in opened_files if f.name == result_fp]
+        self.assertEqual(len(result_files), 1)
+        self.assertTrue(result_files[0].closed)
+
     def test_call_alt_input_types(self):
         """BlastTaxonAssigner.__call__ functions w alt input types """
         p = BlastTaxonAssigner({
@@ -635,6 +670,38 @@ class BlastTaxonAssignerTests(TestCase):
 
         self.assertEqual(actual, self.expected1)
 
+    def test_call_jobs_to_start(self):
+        """BlastTaxonAssigner.__call__ functions w several blast processes
+        """
+        # the reference and the database built from it are kept in their
+        # own directory, so they're removed even if building the database
+        # fails part way
+        working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                              prefix='BlastTaxonAssignerTests_')
+        try:
+            reference_seqs_fp = join(working_dir, 'refs.fasta')
+            copy_file(self.reference_seqs_fp, reference_seqs_fp)
+            p = BlastTaxonAssigner({
+                'reference_seqs_filepath': reference_seqs_fp,
+                'id_to_taxonomy_filepath': self.id_to_taxonomy_fp,
+                'jobs_to_start': 2})
+            p.SeqsPerBlastRun = 2
+            self.assertEqual(p(self.input_seqs_fp), self.expected1)
+        finally:
+            rmtree(working_dir)
+
+    def test_iter_seq_batches(self):
+        """BlastTaxonAssigner._iter_seq_batches: functions as expected
+        """
+        p = BlastTaxonAssigner({})
+        p.SeqsPerBlastRun = 4
+        self.assertEqual(list(p._iter_seq_batches(self.test_seqs)),
+                         [self.test_seqs[:4], self.test_seqs[4:]])
+        p.SeqsPerBlastRun = 3
+        self.assertEqual(list(p._iter_seq_batches(self.test_seqs)),
+                         [self.test_seqs[:3], self.test_seqs[3:]])
+        self.assertEqual(list(p._iter_seq_batches([])), [])
+
     def test_call_output_to_file(self):
         """BlastTaxonAssigner.__call__ functions w output to file
         """
@@ -693,6 +760,7 @@ class BlastTaxonAssignerTests(TestCase):
             'Min percent identity:90.0',
             'Application:blastn/megablast',
             'Max E value:1e-30',
+            'jobs_to_start:1',
             'Result path: None, returned as dict.',
             'blast_db:%s' % str(self.reference_seqs_fp),
             'id_to_taxonomy_filepath:%s' % self.id_to_taxonomy_fp,
@@ -1783,6 +1851,76 @@ class RdpTreeTests(TestCase):
         self.assertEqual(t.get_rdp_taxonomy(), expected)
 
 
+class NaiveBayesTaxonAssignerTests(TestCase):
+
+    """Tests for the naive Bayes taxonomy assigner."""
+
+    def setUp(self):
+        self.working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                                   prefix='NaiveBayesTaxonAssignerTest_')
+        self.seqs_fp = join(self.working_dir, 'seqs.fasta')
+        open(self.seqs_fp, 'w').write(rdp_test1_fasta)
+        self.id_to_taxonomy_fp = join(self.working_dir, 'id_to_taxonomy.txt')
+        open(self.id_to_taxonomy_fp, 'w').write(rdp_id_to_taxonomy)
+        self.reference_seqs_fp = join(self.working_dir, 'refs.fasta')
+        open(self.reference_seqs_fp, 'w').write(rdp_reference_seqs)
+        self.params = {'id_to_taxonomy_fp': self.id_to_taxonomy_fp,
+                       'reference_sequences_fp': self.reference_seqs_fp}
+
+    def tearDown(self):
+        rmtree(self.working_dir)
+
+    def test_init(self):
+        """NaiveBayesTaxonAssigner.__init__ should set default params"""
+        app = NaiveBayesTaxonAssigner({})
+        self.assertEqual(app.Name, 'NaiveBayesTaxonAssigner')
+        self.assertEqual(app.Params['Confidence'], 0.80)
+        self.assertEqual(app.Params['jobs_to_start'], 1)
+
+    def test_call(self):
+        """NaiveBayesTaxonAssigner.__call__ trains on the refs and assigns"""
+        app = NaiveBayesTaxonAssigner(self.params)
+        self.assertEqual(app(self.seqs_fp), nb_test1_expected_dict)
+
+        # more processes give the same result
+        self.params['jobs_to_start'] = 2
+        app = NaiveBayesTaxonAssigner(self.params)
+        self.assertEqual(app(self.seqs_fp), nb_test1_expected_dict)
+
+    def test_call_result_path(self):
+        """NaiveBayesTaxonAssigner.__call__ writes results and log"""
+        result_fp = join(self.working_dir, 'results.txt')
+        log_fp = join(self.working_dir, 'results.log')
+        app = NaiveBayesTaxonAssigner(self.params)
+        self.assertEqual(app(self.seqs_fp, result_fp, log_fp), None)
+        self.assertEqual(open(result_fp).read().splitlines(),
+                         nb_test1_expected_lines)
+        self.assertTrue(open(log_fp).read().startswith(
+            'NaiveBayesTaxonAssigner parameters:'))
+
+    def test_call_model_dir(self):
+        """NaiveBayesTaxonAssigner.__call__ reuses a trained model"""
+        model_dir = join(self.working_dir, 'model')
+        self.params['model_dir'] = model_dir
+        app = NaiveBayesTaxonAssigner(self.params)
+        self.assertEqual(app(self.seqs_fp), nb_test1_expected_dict)
+        self.assertTrue(exists(join(model_dir, 'model.json')))
+
+        # the trained model can be used without the reference files
+        app = NaiveBayesTaxonAssigner({'model_dir': model_dir})
+        self.assertEqual(app(self.seqs_fp), nb_test1_expected_dict)
+
+        # but not with a different taxonomy
+        open(self.id_to_taxonomy_fp, 'w').write(rdp_id_to_taxonomy2)
+        app = NaiveBayesTaxonAssigner(self.params)
+        self.assertRaises(ValueError, app, self.seqs_fp)
+
+    def test_call_no_refs(self):
+        """NaiveBayesTaxonAssigner.__call__ requires refs or a model"""
+        app = NaiveBayesTaxonAssigner({})
+        self.assertRaises(ValueError, app, self.seqs_fp)
+
+
 rdp_test1_fasta = \
     """>X67228 some description
 aacgaacgctggcggcaggcttaacacatgcaagtcgaacgctccgcaaggagagtggcagacgggtgagtaacgcgtgggaatctacccaaccctgcggaatagctctgggaaactggaattaataccgcatacgccctacgggggaaagatttatcggggatggatgagcccgcgttggattagctagttggtggggtaaaggcctaccaaggcgacgatccatagctggtctgagaggatgatcagccacattgggactgagacacggcccaaa
@@ -1828,6 +1966,20 @@ rdp_trained_test2_expected_dict = {
     'EF503697': ('Bacteria;Proteobacteria', 0.93000000000000005),
 }
 
+nb_test1_expected_dict = {
+    'X67228 some description':
+    ('Bacteria;Proteobacteria;Alphaproteobacteria;Rhizobiales;Rhizobiaceae;Rhizobium',
+     1.0),
+    'EF503697': ('Bacteria;Proteobacteria', 0.98),
+}
+
+nb_test1_expected_lines = [
+    "\t".join(["X67228 some description",
+               "Bacteria;Proteobacteria;Alphaproteobacteria;Rhizobiales;"
+               "Rhizobiaceae;Rhizobium",
+               "1.000"]),
+    "\t".join(['EF503697', 'Bacteria;Proteobacteria', '0.980'])]
+
 rdp_id_to_taxonomy = \
     """X67228	Bacteria;Proteobacteria;Alphaproteobacteria;Rhizobiales;Rhizobiaceae;Rhizobium
 X73443	Bacteria;Firmicutes;Clostridia;Clostridiales;Clostridiaceae;Clostridium
@@ -22,6 +22,7 @@ from biom.util import biom_open
 import numpy as np
 import numpy.testing as npt
 from skbio.util import remove_files
+from scipy.sparse import csr_matrix
 from cogent.core.tree import PhyloNode
 from cogent.maths.distance_transform import dist_chisq
 
@@ -29,7 +30,9 @@ from qiime.util import load_qiime_config, write_biom_table
 from qiime.parse import parse_newick, parse_distmat, parse_matrix
 from qiime.beta_diversity import BetaDiversityCalc, single_file_beta,\
     list_known_nonphylogenetic_metrics, list_known_phylogenetic_metrics,\
-    single_object_beta
+    single_object_beta, get_nonphylogenetic_metric,\
+    get_nonphylogenetic_row_metric, load_sample_matrix, iter_beta_diversity,\
+    write_distance_matrix_rows, load_distance_matrix_rows
 from qiime.beta_metrics import dist_unweighted_unifrac
 
 
@@ -268,6 +271,32 @@ class BetaDiversityCalcTests(TestCase):
         self.single_file_beta(missing_otu_table, missing_tree,
                               missing_sams=['M'], use_metric_list=True)
 
+    def test_single_file_beta_binary_rows(self):
+        """single_file_beta writes rows in binary format on request"""
+        output_dir = mkdtemp(dir=self.tmp_dir, prefix='test_bdiv_binary_')
+        self.folders_to_remove.append(output_dir)
+        in_basename = os.path.splitext(os.path.split(self.l19_fp)[1])[0]
+        single_file_beta(self.l19_fp, 'bray_curtis', None, output_dir)
+        sams, dmtx = parse_distmat(open(os.path.join(
+            output_dir, 'bray_curtis_%s.txt' % in_basename)))
+
+        single_file_beta(self.l19_fp, 'bray_curtis', None, output_dir,
+                         rowids='sam3,sam1', binary_rows=True)
+        row_ids, col_ids, rows = load_distance_matrix_rows(os.path.join(
+            output_dir, 'bray_curtis_%s.npy' % in_basename))
+        self.assertEqual(row_ids, ['sam3', 'sam1'])
+        self.assertEqual(col_ids, sams)
+        npt.assert_almost_equal(rows, dmtx[[2, 0]])
+
+    def test_write_distance_matrix_rows_invalid(self):
+        """write_distance_matrix_rows requires one row per row id"""
+        fd, rows_fp = mkstemp(dir=self.tmp_dir, prefix='test_bdiv_rows_',
+                              suffix='.npy')
+        os.close(fd)
+        self.files_to_remove.append(rows_fp)
+        self.assertRaises(ValueError, write_distance_matrix_rows, rows_fp,
+                          [[0.0, 1.0]], ['s1', 's2'], ['s1', 's2'])
+
     def single_object_beta(self, otu_table, metric, tree_string,
                            missing_sams=None):
         """ running single_file_beta should give same result using --rows"""
@@ -369,6 +398,84 @@ class BetaDiversityCalcTests(TestCase):
         self.single_file_beta(missing_otu_table, missing_tree,
                               missing_sams=['M'])
 
+class OneVsAllTests(TestCase):
+
+    """Tests of the vectorized one-vs-all beta diversity functions"""
+
+    def setUp(self):
+        np.random.seed(0)
+        self.datamtx = np.random.poisson(0.7, (12, 30)).astype(float)
+        # include empty samples and identical samples
+        self.datamtx[3] = 0
+        self.datamtx[7] = 0
+        self.datamtx[5] = self.datamtx[4]
+
+    def test_one_vs_all_matches_full_matrix(self):
+        """one_vs_all functions give the rows of the cogent metrics"""
+        sparse_datamtx = csr_matrix(self.datamtx)
+        metrics = ['euclidean', 'manhattan', 'bray_curtis', 'soergel',
+                   'kulczynski', 'canberra', 'binary_jaccard',
+                   'binary_sorensen_dice', 'binary_hamming',
+                   'binary_euclidean']
+        for metric in metrics:
+            metric_f = get_nonphylogenetic_metric(metric)
+            row_metric = get_nonphylogenetic_row_metric(metric_f)
+            expected = metric_f(self.datamtx)
+            for i in range(len(self.datamtx)):
+                npt.assert_almost_equal(row_metric(sparse_datamtx, i),
+                                        expected[i])
+
+    def test_one_vs_all_identical_large_counts(self):
+        """identical rows with large counts are exactly 0 apart"""
+        datamtx = np.random.poisson(1e9, (4, 50)).astype(float)
+        datamtx[:, ::3] = 0
+        datamtx[2] = datamtx[0]
+        datamtx[3] = datamtx[0]
+        datamtx[3, 1] += 1
+        sparse_datamtx = csr_matrix(datamtx)
+        for metric in ['euclidean', 'manhattan']:
+            row_metric = get_nonphylogenetic_row_metric(
+                get_nonphylogenetic_metric(metric))
+            obs = row_metric(sparse_datamtx, 0)
+            self.assertEqual(obs[2], 0.0)
+            self.assertEqual(obs[3], 1.0)
+
+    def test_get_nonphylogenetic_row_metric_missing(self):
+        """get_nonphylogenetic_row_metric raises AttributeError if missing"""
+        self.assertRaises(AttributeError, get_nonphylogenetic_row_metric,
+                          get_nonphylogenetic_metric('chisq'))
+
+    def test_one_vs_all_negative(self):
+        """one_vs_all functions reject negative counts as cogent does"""
+        self.datamtx[0, 0] = -1
+        sparse_datamtx = csr_matrix(self.datamtx)
+        row_metric = get_nonphylogenetic_row_metric(
+            get_nonphylogenetic_metric('bray_curtis'))
+        self.assertRaises(ValueError, row_metric, sparse_datamtx, 1)
+
+    def test_iter_beta_diversity(self):
+        """iter_beta_diversity computes several metrics in one pass"""
+        table = Table(self.datamtx.T, ['O%d' % i for i in range(30)],
+                      ['S%d' % i for i in range(12)])
+        self.assertEqual(load_sample_matrix(table).nnz,
+                         (self.datamtx != 0).sum())
+        metrics = ['bray_curtis', 'chisq', 'pearson']
+        results = list(iter_beta_diversity(table, metrics))
+        self.assertEqual([m for m, d in results], metrics)
+        for metric, dissims in results:
+            expected = get_nonphylogenetic_metric(metric)(self.datamtx)
+            npt.assert_almost_equal(dissims, expected)
+            # the full matrices are exactly symmetric
+            npt.assert_equal(dissims, np.asarray(dissims).T)
+
+        warnings.filterwarnings('ignore', 'dissimilarity dist_chisq is not\
+ parallelized, calculating the whole matrix...')
+        row_results = list(iter_beta_diversity(table, metrics,
+                                               rowids=['S7', 'S1']))
+        for (metric, dissims), (metric, row_dissims) in zip(results,
+                                                             row_results):
+            npt.assert_almost_equal(row_dissims, dissims[[7, 1]])
+
 l19_otu_table = """{"rows": [{"id": "tax1", "metadata": {}}, {"id": "tax2",\
  "metadata": {}}, {"id": "tax3", "metadata": {}}, {"id": "tax4", "metadata":\
  {}}, {"id": "endbigtaxon", "metadata": {}}, {"id": "tax6", "metadata": {}},\
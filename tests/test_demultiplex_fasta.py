@@ -25,7 +25,8 @@ from qiime.demultiplex_fasta import (
     get_added_demultiplex_field, get_exact_bc_matches, attempt_bc_correction,
     get_curr_bc_added_field, get_demultiplex_data, write_qual_line,
     write_fasta_line, get_label_line, initialize_log_data,
-    get_output_ids, assign_seqs, process_files_and_demultiplex_sequences
+    get_output_ids, assign_seqs, process_files_and_demultiplex_sequences,
+    iter_chunks, SequenceDemultiplexer
 )
 
 
@@ -1536,6 +1537,91 @@ class TopLevelTests(TestCase):
         self.assertEqual(seq_counts, expected_seq_counts)
         self.assertEqual(corrected_bc_count, expected_corrected_bc_count)
 
+    def test_assign_seqs_jobs_to_start(self):
+        """ Demultiplexing in several processes gives the same results """
+
+        ids_bcs_added_field = {('AACTCGTCGATG', ''): 's1',
+                               ('AGCAGCACTTGT', ''): 's2', ('ACCGCAGAGTCA', ''): 's3'}
+        bc_lens = [12]
+        all_bcs = ['AACTCGTCGATG', 'AGCAGCACTTGT', 'ACCGCAGAGTCA']
+        fasta_files = [self.valid_fasta_file_with_bc_errors,
+                       self.valid_fasta_file_no_errors]
+        qual_files = [self.valid_qual_file_no_errors,
+                      self.valid_qual_file_no_errors]
+
+        results = []
+        for jobs_to_start, chunk_size in [(1, 10000), (1, 2), (3, 1)]:
+            file_data = {}
+            file_data['fasta_files'] = fasta_files
+            file_data['qual_files'] = qual_files
+            file_data['demultiplexed_seqs_f'] = FakeOutFile()
+            file_data['demultiplexed_qual_f'] = FakeOutFile()
+            file_data['unassigned_seqs_f'] = FakeOutFile()
+            file_data['unassigned_qual_f'] = FakeOutFile()
+            log_data, bc_freqs, seq_counts, corrected_bc_count =\
+                assign_seqs(file_data, ids_bcs_added_field, bc_lens, all_bcs,
+                            False, 'golay_12', 1.5, 1000, True, False, None,
+                            jobs_to_start, chunk_size)
+            results.append((file_data['demultiplexed_seqs_f'].data,
+                            file_data['demultiplexed_qual_f'].data,
+                            file_data['unassigned_seqs_f'].data,
+                            file_data['unassigned_qual_f'].data,
+                            log_data, bc_freqs, seq_counts,
+                            corrected_bc_count))
+
+        self.assertEqual(results[0][6], 6)
+        self.assertEqual(results[0][7], [2, 0])
+        self.assertTrue('>s3_1001 EFGH0002' in results[0][0])
+        self.assertTrue('>s2_1005 IJKL0003' in results[0][0])
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+    def test_iter_chunks(self):
+        """ iter_chunks splits records into enumerated chunks """
+
+        self.assertEqual(list(iter_chunks(['a', 'b', 'c', 'd', 'e'], 2, 10)),
+                         [(['a', 'b'], 10), (['c', 'd'], 12), (['e'], 14)])
+        self.assertEqual(list(iter_chunks(['a', 'b'], 2)), [(['a', 'b'], 1)])
+        self.assertEqual(list(iter_chunks([], 2)), [])
+
+    def test_sequence_demultiplexer(self):
+        """ SequenceDemultiplexer matches get_demultiplex_data """
+
+        ids_bcs_added_field = {("AACTCGT", "1"): "s1",
+                               ("AGCAGCACTTGT", "2"): "s2", ("AGCAG", "1"): "s3"}
+        bc_lens = [12, 7, 5]
+        all_bcs = ["AACTCGT", "AGCAGCACTTGT", "AGCAG"]
+        demultiplexer = SequenceDemultiplexer(
+            ids_bcs_added_field, bc_lens, all_bcs,
+            barcode_type="variable_length", disable_bc_correction=True,
+            added_demultiplex_field='region')
+        for fasta_label in ["123ABC region=1 length=255",
+                            "123ABC region=2 length=255",
+                            "123ABC region=3 length=255"]:
+            for fasta_seq in ["AGCAGCACTTGTACAGATTAGACC",
+                              "AACTCGTAGATTAGACC", "TTTTTTTTTTTTTTTT"]:
+                self.assertEqual(
+                    demultiplexer.demultiplex(fasta_label, fasta_seq),
+                    get_demultiplex_data(ids_bcs_added_field, fasta_label,
+                                         fasta_seq, bc_lens, all_bcs,
+                                         "variable_length", 1.5, True,
+                                         'region'))
+
+        ids_bcs_added_field = {("AACTCGTCGATG", ""): "s1",
+                               ("AGCAGCACTTGT", ""): "s2", ("ACAGAGTCGGCT", ""): "s3"}
+        all_bcs = ["AACTCGTCGATG", "AGCAGCACTTGT", "ACAGAGTCGGCT"]
+        demultiplexer = SequenceDemultiplexer(ids_bcs_added_field, [12],
+                                              all_bcs)
+        self.assertEqual(
+            demultiplexer.demultiplex("123ABC",
+                                      "TGCAGCACTTGTACAGATTAGACCGAG"),
+            ("TGCAGCACTTGT", "AGCAGCACTTGT", 1, None))
+        self.assertEqual(demultiplexer.correct_bc("TGCAGCACTTGT"),
+                         ("AGCAGCACTTGT", 1))
+        self.assertEqual(demultiplexer.correct_bc("AACTCGTCGATG"),
+                         ("AACTCGTCGATG", 0))
+        self.assertEqual(len(demultiplexer._bc_corrections), 4)
+
     def test_demultiplex_sequences_default_settings(self):
         """ Overall functionality test """
 
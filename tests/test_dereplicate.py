@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent", "Jens Reeder"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from os.path import exists
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+from qiime.util import get_qiime_temp_dir
+from qiime.dereplicate import (DereplicatedSeqIdMap, dereplicate_exact_matches,
+                               dereplicate_exact_prefixes,
+                               seq_id_map_from_otus)
+
+
+class DereplicateTests(TestCase):
+
+    """Tests of the dereplication functions"""
+
+    def setUp(self):
+        self.seqs = [('s1 comment1', 'ACCTTGTTACTTT'),
+                     ('s2 comment2', 'ACCTTGTTACTTTC'),
+                     ('s3 comment3', 'ACCTTGTTACTTTCC'),
+                     ('s4 comment4', 'ACCTTGTTACTTT'),
+                     ('s5 comment5', 'ACCTTGTTACTTTCC'),
+                     ('s6 comment6', 'ACCTTGTTACTTT')]
+        self.working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                                   prefix='qiime_dereplicate_tests_')
+
+    def tearDown(self):
+        rmtree(self.working_dir)
+
+    def test_dereplicate_exact_matches(self):
+        """dereplicate_exact_matches collapses identical sequences"""
+        expected_seqs = [('QiimeExactMatch.s1', 'ACCTTGTTACTTT'),
+                         ('QiimeExactMatch.s2', 'ACCTTGTTACTTTC'),
+                         ('QiimeExactMatch.s3', 'ACCTTGTTACTTTCC')]
+        expected_map = {'QiimeExactMatch.s1': ['s1', 's4', 's6'],
+                        'QiimeExactMatch.s2': ['s2'],
+                        'QiimeExactMatch.s3': ['s3', 's5']}
+        # the result is the same whether or not the map is spilled to disk
+        for max_seq_ids_in_memory in (1, 2, 100):
+            seqs, seq_id_map = dereplicate_exact_matches(
+                self.seqs, max_seq_ids_in_memory, self.working_dir)
+            self.assertEqual(seqs, expected_seqs)
+            self.assertEqual(seq_id_map, expected_map)
+            self.assertEqual(seq_id_map.spilled, max_seq_ids_in_memory < 100)
+            self.assertEqual(seq_id_map.count('QiimeExactMatch.s1'), 3)
+
+    def test_dereplicate_exact_prefixes(self):
+        """dereplicate_exact_prefixes collapses to the longest sequence"""
+        seqs = [('s1', 'ACGTAA'),
+                ('s2', 'ACGTACA'),
+                ('s3', 'ACGTAG'),
+                ('s4', 'ACGTAT'),
+                ('s5', 'ACCTCA'),
+                ('s6', 'ACGTCC')]
+        for max_seq_ids_in_memory in (1, 100):
+            actual_seqs, seq_id_map = dereplicate_exact_prefixes(
+                seqs, 4, max_seq_ids_in_memory, self.working_dir)
+            self.assertEqual(actual_seqs, [('s2', 'ACGTACA'),
+                                           ('s5', 'ACCTCA')])
+            self.assertEqual(seq_id_map, {'s2': ['s1', 's2', 's3', 's4',
+                                                 's6'],
+                                          's5': ['s5']})
+
+    def test_expand(self):
+        """expand maps clusters of names to the full seq_ids"""
+        for max_seq_ids_in_memory in (1, 100):
+            seqs, seq_id_map = dereplicate_exact_matches(
+                self.seqs, max_seq_ids_in_memory, self.working_dir)
+            clusters = [['QiimeExactMatch.s3', 'QiimeExactMatch.s1'],
+                        ['QiimeExactMatch.s2'],
+                        []]
+            self.assertEqual(seq_id_map.expand(clusters),
+                             [['s3', 's5', 's1', 's4', 's6'], ['s2'], []])
+            self.assertRaises(KeyError, seq_id_map.expand, [['s1']])
+
+    def test_close(self):
+        """close removes spilled data"""
+        m = DereplicatedSeqIdMap(max_seq_ids_in_memory=2,
+                                 num_partitions=3,
+                                 working_dir=self.working_dir)
+        for i in range(5):
+            m.add(m.new_cluster(), 's%d' % i)
+        m.set_names(['c%d' % i for i in range(5)])
+        spill_dir = m._spill_dir
+        self.assertTrue(exists(spill_dir))
+        self.assertEqual(m['c4'], ['s4'])
+        m.close()
+        self.assertFalse(exists(spill_dir))
+        self.assertFalse(m.spilled)
+
+    def test_context_manager(self):
+        """close is called on leaving a with block"""
+        with DereplicatedSeqIdMap(max_seq_ids_in_memory=1,
+                                  working_dir=self.working_dir) as m:
+            m.add(m.new_cluster(), 's0')
+            spill_dir = m._spill_dir
+            self.assertTrue(exists(spill_dir))
+        self.assertFalse(exists(spill_dir))
+
+    def test_seq_id_map_from_otus(self):
+        """seq_id_map_from_otus loads OTUs, including empty ones"""
+        otus = [('0', ['s1', 's2']), ('1', []), ('2', ['s3'])]
+        for max_seq_ids_in_memory in (1, 100):
+            seq_id_map = seq_id_map_from_otus(otus, max_seq_ids_in_memory,
+                                              self.working_dir)
+            self.assertEqual(seq_id_map, dict(otus))
+            seq_id_map.close()
+
+    def test_remap(self):
+        """remap maps OTUs of cluster names to their seq_ids in order"""
+        otus = [('0', ['s1', 's2', 's5']), ('1', ['s3', 's4']),
+                ('2', ['s6', 's7', 's8'])]
+        for max_seq_ids_in_memory in (1, 100):
+            seq_id_map = seq_id_map_from_otus(otus, max_seq_ids_in_memory,
+                                              self.working_dir)
+            remapped = seq_id_map.remap([('110', ['2', '0']),
+                                         ('221', ['1'])])
+            self.assertEqual(remapped.spilled, max_seq_ids_in_memory < 100)
+            self.assertEqual(remapped, {'110': ['s6', 's7', 's8',
+                                                's1', 's2', 's5'],
+                                        '221': ['s3', 's4']})
+            self.assertEqual(remapped.count('110'), 6)
+            # the remapped map can be remapped again
+            remapped2 = remapped.remap([('a', ['221', '110'])])
+            self.assertEqual(remapped2['a'], ['s3', 's4', 's6', 's7', 's8',
+                                              's1', 's2', 's5'])
+            self.assertRaises(KeyError, seq_id_map.remap, [('a', ['110'])])
+            for m in (seq_id_map, remapped, remapped2):
+                m.close()
+
+    def test_set_names_invalid(self):
+        """set_names requires one name per cluster"""
+        m = DereplicatedSeqIdMap()
+        m.new_cluster()
+        self.assertRaises(ValueError, m.set_names, ['a', 'b'])
+
+
+if __name__ == "__main__":
+    main()
@@ -75,6 +75,31 @@ class GolayTests(TestCase):
             err_bc = 'C' + bc[1:]
             self.assertEqual(golay.decode(err_bc), (bc, 2))
 
+    def test_decode_many(self):
+        """ decode_many should match decode for every input"""
+        seqs = ['AGCACGAGCCTA',
+                'CGCACGAGCCTA',
+                'CCAGTGTATGCA',
+                'CCTGTGTATGCA',
+                'AAAAAAAAAAAA',
+                'ACGTACGTACGT',
+                'GGAGACAAGGGT']
+        for decoded, seq in zip(golay.decode_many(seqs), seqs):
+            self.assertEqual(decoded, golay.decode(seq))
+
+        nt_to_bits = {"A": "00", "C": "01", "T": "10", "G": "11"}
+        for decoded, seq in zip(golay.decode_many(seqs, nt_to_bits), seqs):
+            self.assertEqual(decoded, golay.decode(seq, nt_to_bits))
+
+        self.assertEqual(golay.decode_many([]), [])
+
+    def test_decode_many_invalid(self):
+        """ decode_many should handle invalid seqs as decode does"""
+        self.assertRaises(KeyError, golay.decode_many,
+                          ['AGCACGAGCCTA', 'AGCACGNGCCTA'])
+        self.assertRaises(ValueError, golay.decode_many,
+                          ['AGCACGAGCCTA', 'AGCACG'])
+
     def test_G_H(self):
         """ generator and parity check matrices should be s.t. G dot H.T = zeros
         """
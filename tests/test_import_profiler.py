@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from unittest import TestCase, main
+
+from qiime.import_profiler import (ImportTimer, profile_import_subprocess,
+                                   format_import_profile)
+
+
+class ImportProfilerTests(TestCase):
+
+    """Tests of the import profiling functions"""
+
+    def test_import_timer(self):
+        """ImportTimer records nested timings"""
+        timer = ImportTimer()
+        timer.time('outer', timer.time, 'inner', lambda: None)
+        self.assertEqual([r[0] for r in timer.records], ['outer', 'inner'])
+        self.assertEqual([r[3] for r in timer.records], [0, 1])
+        outer, inner = timer.records
+        self.assertAlmostEqual(outer[1], outer[2] + inner[1])
+
+    def test_profile_import_subprocess(self):
+        """profile_import_subprocess records the modules a target loads"""
+        total_time, records = profile_import_subprocess('qiime.util')
+        names = [r[0] for r in records]
+        self.assertEqual(names[0], 'qiime.util')
+        self.assertEqual(records[0][3], 0)
+        self.assertTrue('numpy' in names)
+        # qiime.util doesn't load its heavy dependencies until they're used
+        self.assertFalse('skbio' in names)
+        self.assertFalse('qiime.parse' in names)
+        self.assertTrue(total_time >= records[0][1])
+
+        self.assertRaises(ImportError, profile_import_subprocess,
+                          'qiime.not_a_module')
+
+    def test_format_import_profile(self):
+        """format_import_profile lists the slowest imports"""
+        records = [('a', 0.003, 0.001, 0), ('b', 0.0015, 0.0015, 1),
+                   ('c', 0.0005, 0.0005, 1)]
+        self.assertEqual(format_import_profile('a', 0.004, records, 2),
+                         ['Import time of a: 4.0 ms (3 imports)',
+                          'cumul (ms)  self (ms)  module',
+                          '       3.0        1.0  a',
+                          '       1.5        1.5    b'])
+        self.assertEqual(
+            format_import_profile('a', 0.004, records, max_depth=0)[2:],
+            ['       3.0        1.0  a'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from os import listdir
+from os.path import exists, getmtime, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+from numpy.random import RandomState
+from numpy.testing import assert_array_equal
+
+from qiime.util import get_qiime_temp_dir
+from qiime.reference_db_cache import get_reference_db_cache
+from qiime.naive_bayes import (NaiveBayesModel, classify_seqs,
+                               get_naive_bayes_model, seq_to_words,
+                               train_naive_bayes_model, truncate_lineage)
+
+
+class NaiveBayesTests(TestCase):
+
+    """Tests of the naive Bayes classifier"""
+
+    def setUp(self):
+        self.working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                                   prefix='qiime_naive_bayes_tests_')
+        # two sequences from each of three genera, where the genera in the
+        # same family share the first half of their sequences
+        rand = RandomState(42)
+
+        def random_seq(length):
+            return ''.join(rand.choice(list('ACGT'), length))
+        family1 = random_seq(100)
+        genus_seqs = [family1 + random_seq(100), family1 + random_seq(100),
+                      random_seq(200)]
+        self.ref_seqs = []
+        for genus_seq in genus_seqs:
+            for i in range(2):
+                seq = list(genus_seq)
+                seq[rand.randint(len(seq))] = 'N'
+                self.ref_seqs.append(''.join(seq))
+        self.lineages = [('k__B', 'p__P', 'g__A'), ('k__B', 'p__P', 'g__B'),
+                         ('k__B', 'p__Q', 'g__C')]
+        self.ref_fp = self._write_file(
+            'refs.fasta', ''.join(['>r%d\n%s\n' % (i, seq)
+                                   for i, seq in enumerate(self.ref_seqs)]) +
+            '>not_in_taxonomy\n%s\n' % random_seq(200))
+        self.taxonomy_fp = self._write_file(
+            'taxonomy.txt', ''.join(['r%d\t%s\n' % (i, ';'.join(
+                self.lineages[i // 2])) for i in range(6)]))
+
+    def tearDown(self):
+        rmtree(self.working_dir)
+
+    def _write_file(self, fn, data):
+        fp = join(self.working_dir, fn)
+        f = open(fp, 'w')
+        f.write(data)
+        f.close()
+        return fp
+
+    def test_seq_to_words(self):
+        """seq_to_words encodes words 2 bits per base, skipping non-bases"""
+        assert_array_equal(seq_to_words('ACGTNACGTAC', 4), [27, 27, 108, 177])
+        assert_array_equal(seq_to_words('acgu', 4), [27])
+        assert_array_equal(seq_to_words('ACG', 4), [])
+        assert_array_equal(seq_to_words('AC-GT', 2), [1, 11])
+
+    def test_train_naive_bayes_model(self):
+        """train_naive_bayes_model writes a model of each distinct lineage"""
+        model_dir = join(self.working_dir, 'model')
+        result_dir, files = train_naive_bayes_model(
+            self.ref_fp, self.taxonomy_fp, model_dir, word_size=6)
+        self.assertEqual(result_dir, model_dir)
+        self.assertEqual(sorted(listdir(model_dir)),
+                         sorted([fp.split('/')[-1] for fp in files]))
+
+        model = NaiveBayesModel(model_dir)
+        self.assertEqual(model.word_size, 6)
+        self.assertEqual(model.lineages, self.lineages)
+        self.assertEqual(model.word_log_probs.shape, (4 ** 6, 3))
+        # the genera in the same family share the family's taxon index
+        self.assertEqual(model.genus_taxa[0, 1], model.genus_taxa[1, 1])
+        self.assertNotEqual(model.genus_taxa[0, 2], model.genus_taxa[1, 2])
+        self.assertNotEqual(model.genus_taxa[0, 1], model.genus_taxa[2, 1])
+
+    def test_train_naive_bayes_model_no_seqs(self):
+        """train_naive_bayes_model raises an error if no refs have taxonomy"""
+        taxonomy_fp = self._write_file('other_taxonomy.txt', 'x\tk__B\n')
+        self.assertRaises(ValueError, train_naive_bayes_model, self.ref_fp,
+                          taxonomy_fp, join(self.working_dir, 'model'))
+
+    def test_classify(self):
+        """NaiveBayesModel.classify assigns references to their lineages"""
+        model_dir, _ = train_naive_bayes_model(
+            self.ref_fp, self.taxonomy_fp, join(self.working_dir, 'model'))
+        model = NaiveBayesModel(model_dir)
+        seqs = self.ref_seqs + ['ACGTACGT']
+        results = model.classify(seqs)
+        for i in range(6):
+            self.assertEqual(results[i], (self.lineages[i // 2],
+                                          [1.0, 1.0, 1.0]))
+        # too few words to classify
+        self.assertEqual(results[6], (None, None))
+
+        # the result of a sequence doesn't depend on the others passed
+        self.assertEqual(model.classify(seqs[3:], start_index=3),
+                         results[3:])
+
+        # the half of a sequence shared by its family identifies the family
+        lineage, confidences = model.classify([self.ref_seqs[0][:100]])[0]
+        self.assertEqual(lineage[:2], ('k__B', 'p__P'))
+        self.assertEqual(confidences[:2], [1.0, 1.0])
+
+    def test_classify_seqs(self):
+        """classify_seqs gives the same results in several processes"""
+        model_dir, _ = train_naive_bayes_model(
+            self.ref_fp, self.taxonomy_fp, join(self.working_dir, 'model'))
+        seqs = self.ref_seqs + [self.ref_seqs[0][:100], 'ACGT']
+        expected = NaiveBayesModel(model_dir).classify(seqs)
+        self.assertEqual(classify_seqs(model_dir, seqs), expected)
+        self.assertEqual(classify_seqs(model_dir, seqs, jobs_to_start=2,
+                                       chunk_size=3), expected)
+
+    def test_truncate_lineage(self):
+        """truncate_lineage reports assignments as the RDP wrapper does"""
+        lineage = ('k__B', 'p__P', 'g__A')
+        self.assertEqual(truncate_lineage(lineage, [1.0, 0.9, 0.85], 0.8),
+                         ('k__B;p__P;g__A', 0.85))
+        self.assertEqual(truncate_lineage(lineage, [1.0, 0.9, 0.5], 0.8),
+                         ('k__B;p__P', 0.9))
+        self.assertEqual(truncate_lineage(lineage, [0.7, 0.6, 0.5], 0.8),
+                         ('Unclassified', 1.0))
+        self.assertEqual(truncate_lineage(None, None, 0.8),
+                         ('Unassignable', 1.0))
+
+    def test_get_naive_bayes_model(self):
+        """get_naive_bayes_model trains a model once per model_dir"""
+        model_dir = join(self.working_dir, 'model')
+        self.assertEqual(get_naive_bayes_model(self.ref_fp, self.taxonomy_fp,
+                                               model_dir),
+                         (model_dir, []))
+        info_fp = join(model_dir, 'model.json')
+        mtime = getmtime(info_fp)
+        self.assertEqual(get_naive_bayes_model(self.ref_fp, self.taxonomy_fp,
+                                               model_dir),
+                         (model_dir, []))
+        self.assertEqual(getmtime(info_fp), mtime)
+
+        # a model trained on different references isn't reused
+        taxonomy_fp = self._write_file('other_taxonomy.txt', 'r0\tk__B\n')
+        self.assertRaises(ValueError, get_naive_bayes_model, self.ref_fp,
+                          taxonomy_fp, model_dir)
+        self.assertRaises(ValueError, get_naive_bayes_model, self.ref_fp,
+                          self.taxonomy_fp, model_dir, word_size=7)
+
+    def test_get_naive_bayes_model_temp_dir(self):
+        """get_naive_bayes_model trains in a temp dir with no cache"""
+        model_dir, dirs_to_remove = get_naive_bayes_model(
+            self.ref_fp, self.taxonomy_fp, qiime_config={})
+        self.assertEqual(dirs_to_remove, [model_dir])
+        self.assertEqual(NaiveBayesModel(model_dir).lineages, self.lineages)
+        rmtree(model_dir)
+
+    def test_get_naive_bayes_model_cache(self):
+        """get_naive_bayes_model keeps models in the reference db cache"""
+        cache_dir = join(self.working_dir, 'cache')
+        qiime_config = {'reference_db_cache_dir': cache_dir}
+        model_dir, dirs_to_remove = get_naive_bayes_model(
+            self.ref_fp, self.taxonomy_fp, qiime_config=qiime_config)
+        self.assertEqual(dirs_to_remove, [])
+        self.assertTrue(model_dir.startswith(cache_dir))
+        self.assertTrue(exists(join(model_dir, 'model.json')))
+        self.assertEqual(get_naive_bayes_model(self.ref_fp, self.taxonomy_fp,
+                                               qiime_config=qiime_config),
+                         (model_dir, []))
+        get_reference_db_cache(qiime_config).close()
+
+
+if __name__ == "__main__":
+    main()
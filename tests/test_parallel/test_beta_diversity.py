@@ -14,18 +14,23 @@ __email__ = "gregcaporaso@gmail.com"
 from glob import glob
 from shutil import rmtree
 from os import close
+from StringIO import StringIO
 from os.path import exists, join
 from tempfile import mkstemp, mkdtemp
 
-from skbio.util import remove_files
+from skbio.util import remove_files, create_dir
 from unittest import TestCase, main
+from numpy import array
 from numpy.testing import assert_almost_equal
 from biom.parse import parse_biom_table
 from qiime.parse import parse_distmat
 from qiime.util import get_qiime_temp_dir
 from qiime.test import initiate_timeout, disable_timeout
+from qiime.format import format_distance_matrix
+from qiime.beta_diversity import single_file_beta, write_distance_matrix_rows
 from qiime.parallel.beta_diversity import (ParallelBetaDiversitySingle,
-                                           ParallelBetaDiversityMultiple)
+                                           ParallelBetaDiversityMultiple,
+                                           write_distance_matrix_from_rows)
 
 
 class ParallelBetaDiversityTests(TestCase):
@@ -109,6 +114,31 @@ class ParallelBetaDiversitySingleTests(ParallelBetaDiversityTests):
             dm_sample_ids = parse_distmat(open(dm_fp))[0]
             self.assertItemsEqual(dm_sample_ids, input_sample_ids)
 
+    def test_parallel_beta_diversity_multiprocessing(self):
+        """ parallel beta diveristy functions with in-process executor """
+        params = {'metrics': 'weighted_unifrac,unweighted_unifrac',
+                  'tree_path': self.tree_fp,
+                  'jobs_to_start': 3,
+                  'full_tree': False
+                  }
+        app = ParallelBetaDiversitySingle(jobs_to_start=2,
+                                          parallel_executor='multiprocessing')
+        r = app(self.input1_fp,
+                self.test_out,
+                params,
+                job_prefix='BTEST',
+                poll_directly=True,
+                suppress_submit_jobs=False)
+        input_sample_ids = parse_biom_table(
+            open(self.input1_fp, 'U')).ids()
+        dm_fps = glob(join(self.test_out, '*weighted_unifrac*'))
+        self.assertEqual(len(dm_fps), 2)
+        for dm_fp in dm_fps:
+            dm_sample_ids = parse_distmat(open(dm_fp))[0]
+            self.assertItemsEqual(dm_sample_ids, input_sample_ids)
+        # the temporary working directory is cleaned up
+        self.assertFalse(exists(join(self.test_out, 'BTEST')))
+
     def test_parallel_beta_diversity_wo_tree(self):
         """ parallel beta diveristy functions in single file mode """
         params = {'metrics': 'bray_curtis',
@@ -131,6 +161,73 @@ class ParallelBetaDiversitySingleTests(ParallelBetaDiversityTests):
             self.assertItemsEqual(dm_sample_ids, input_sample_ids)
 
 
+    def test_parallel_beta_diversity_matches_serial(self):
+        """ parallel beta diversity gives the serial distance matrix """
+        params = {'metrics': 'bray_curtis',
+                  'tree_path': None,
+                  'jobs_to_start': 3,
+                  'full_tree': False
+                  }
+        app = ParallelBetaDiversitySingle()
+        r = app(self.input1_fp,
+                self.test_out,
+                params,
+                job_prefix='BTEST',
+                poll_directly=True,
+                suppress_submit_jobs=False)
+        dm_fp = glob(join(self.test_out, 'bray_curtis*'))[0]
+        serial_dir = join(self.test_out, 'serial')
+        create_dir(serial_dir)
+        single_file_beta(self.input1_fp, 'bray_curtis', None, serial_dir)
+        serial_dm_fp = glob(join(serial_dir, 'bray_curtis*'))[0]
+        self.assertEqual(open(dm_fp).read(), open(serial_dm_fp).read())
+        # only the assembled distance matrix is left in the output directory
+        self.assertEqual(glob(join(self.test_out, '*.npy')), [])
+
+
+class WriteDistanceMatrixFromRowsTests(TestCase):
+
+    def setUp(self):
+        self.test_out = mkdtemp(dir=get_qiime_temp_dir(),
+                                prefix='qiime_parallel_tests_',
+                                suffix='')
+        self.labels = ['s1', 's2', 's3']
+        self.dm = array([[0.0, 0.1, 1. / 3],
+                         [0.1, 0.0, 0.25],
+                         [1. / 3, 0.25, 0.0]])
+
+    def tearDown(self):
+        rmtree(self.test_out)
+
+    def test_write_distance_matrix_from_rows(self):
+        """ binary rows are assembled into a text distance matrix """
+        # the components can list the rows in any order
+        fp1 = join(self.test_out, 'bray_curtis_t_0.npy')
+        write_distance_matrix_rows(fp1, [self.dm[2], self.dm[0]],
+                                   ['s3', 's1'], self.labels)
+        fp2 = join(self.test_out, 'bray_curtis_t_1.npy')
+        write_distance_matrix_rows(fp2, [self.dm[1]], ['s2'], self.labels)
+        output_f = StringIO()
+        write_distance_matrix_from_rows([fp1, fp2], output_f)
+        self.assertEqual(output_f.getvalue(),
+                         format_distance_matrix(self.labels, self.dm))
+
+    def test_write_distance_matrix_from_rows_invalid(self):
+        """ missing or inconsistent components raise ValueError """
+        fp1 = join(self.test_out, 'bray_curtis_t_0.npy')
+        write_distance_matrix_rows(fp1, self.dm[:2], ['s1', 's2'],
+                                   self.labels)
+        self.assertRaises(ValueError, write_distance_matrix_from_rows,
+                          [fp1], StringIO())
+        fp2 = join(self.test_out, 'bray_curtis_t_1.npy')
+        write_distance_matrix_rows(fp2, [self.dm[2][::-1]], ['s3'],
+                                   self.labels[::-1])
+        self.assertRaises(ValueError, write_distance_matrix_from_rows,
+                          [fp1, fp2], StringIO())
+        self.assertRaises(ValueError, write_distance_matrix_from_rows,
+                          [], StringIO())
+
+
 class ParallelBetaDiversityMultipleTests(ParallelBetaDiversityTests):
 
     def test_parallel_beta_diversity(self):
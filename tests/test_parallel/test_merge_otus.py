@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 
 from unittest import TestCase, main
+from os.path import join
+from shutil import rmtree
+from StringIO import StringIO
+from tempfile import mkdtemp
+from biom import load_table
+from biom.table import Table
+from numpy import array
+import qiime.parallel.merge_otus
+from qiime.util import get_qiime_temp_dir, write_biom_table
 from qiime.parallel.merge_otus import mergetree, mergeorder, \
     initial_nodes_to_merge, initial_has_dependencies, job_complete, \
-    torque_job, local_job, start_job, JobError, reset_internal_count
+    torque_job, start_job, JobError, reset_internal_count, \
+    merge_tables_job, run_merge_tree
 import os
 
 __author__ = "Daniel McDonald"
@@ -109,11 +119,79 @@ class MergeTests(TestCase):
         start_job(t.Children[0], 'y', 'ignored', torque_job, False)
         self.assertEqual(t.Children[0].FullCommand, exp)
 
-    def test_local_job(self):
-        """fire off a local job"""
-        exp = "abc; echo $? > xyz"
-        obs = local_job('abc', 'xyz', 'notused', 'notused')
-        self.assertEqual(obs, exp)
+
+class RunMergeTreeTests(TestCase):
+
+    def setUp(self):
+        reset_internal_count()
+        self.working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                                   prefix='qiime_parallel_merge_otus_tests_')
+        self.input_fps = []
+        for i in range(5):
+            # every table shares the OTU o0 and has an OTU of its own
+            t = Table(array([[i + 1], [2 * i + 1]]), ['o0', 'o%d' % (i + 1)],
+                      ['s%d' % i])
+            fp = join(self.working_dir, 't%d.biom' % i)
+            write_biom_table(t, fp)
+            self.input_fps.append(fp)
+
+    def tearDown(self):
+        rmtree(self.working_dir)
+
+    def test_merge_tables_job(self):
+        """merge a list of tables into one"""
+        output_fp = join(self.working_dir, 'merged.biom')
+        name, error, run_time = merge_tables_job('x', self.input_fps[:3],
+                                                 output_fp)
+        self.assertEqual(name, 'x')
+        self.assertEqual(error, None)
+        self.assertTrue(run_time >= 0)
+        t = load_table(output_fp)
+        self.assertItemsEqual(t.ids(), ['s0', 's1', 's2'])
+        self.assertEqual(t.get_value_by_ids('o0', 's2'), 3)
+
+        name, error, run_time = merge_tables_job(
+            'x', [join(self.working_dir, 'missing.biom')], output_fp)
+        self.assertNotEqual(error, None)
+
+    def test_run_merge_tree(self):
+        """merge a whole merge tree in a process pool"""
+        for jobs_to_start in (1, 3):
+            reset_internal_count()
+            tree = mergeorder(self.input_fps, self.working_dir)
+            log_f = StringIO()
+            run_merge_tree(tree, jobs_to_start, log_f)
+            for n in tree.nontips(include_self=True):
+                self.assertTrue(n.Processed)
+                self.assertTrue(n.TotalTime >= 0)
+                self.assertTrue(os.path.exists(n.FilePath))
+                self.assertTrue("Node %s completed in" % n.Name in
+                                log_f.getvalue())
+            t = load_table(tree.FilePath)
+            self.assertItemsEqual(t.ids(), ['s%d' % i for i in range(5)])
+            self.assertEqual(len(t.ids(axis='observation')), 6)
+            self.assertEqual(t.get_value_by_ids('o5', 's4'), 9)
+
+    def test_run_merge_tree_error(self):
+        """failed merges raise a JobError"""
+        input_fps = self.input_fps[:2] + \
+            [join(self.working_dir, 'missing.biom')]
+        tree = mergeorder(input_fps, self.working_dir)
+        self.assertRaises(JobError, run_merge_tree, tree, 2)
+
+    def test_run_merge_tree_worker_died(self):
+        """a worker dying without reporting its merge raises a JobError"""
+        tree = mergeorder(self.input_fps, self.working_dir)
+        qiime.parallel.merge_otus.merge_tables_job = exit_merge_job
+        try:
+            self.assertRaises(JobError, run_merge_tree, tree, 2)
+        finally:
+            qiime.parallel.merge_otus.merge_tables_job = merge_tables_job
+
+
+def exit_merge_job(name, input_fps, output_fp):
+    """stands in for merge_tables_job in a worker that dies"""
+    os._exit(1)
 
 if __name__ == '__main__':
     main()
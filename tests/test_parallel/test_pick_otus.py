@@ -22,7 +22,8 @@ from qiime.parallel.pick_otus import (ParallelPickOtusSortMeRNA,
                                       ParallelPickOtusUclustRef,
                                       ParallelPickOtusBlast,
                                       ParallelPickOtusTrie,
-                                      greedy_partition)
+                                      greedy_partition, LinearCostModel,
+                                      fit_cost_model)
 from qiime.util import get_qiime_temp_dir
 from qiime.test import initiate_timeout, disable_timeout
 from qiime.parse import parse_otu_map
@@ -279,6 +280,32 @@ class ParallelPickOtusTrieTests(ParallelPickOtusTests):
         self.assertEqual(len(otu_map[0]), 7)
         self.assertEqual(otu_map, expected)
 
+    def test_parallel_pick_otus_trie_job_costs(self):
+        """ parallel_pick_otus_trie writes the size and time of each job """
+        params = {
+            'jobs_to_start': 2,
+            'prefix_length': 2
+        }
+        app = ParallelPickOtusTrie(jobs_to_start=2,
+                                   parallel_executor='multiprocessing',
+                                   retain_temp_files=True,
+                                   cost_model=LinearCostModel(1.0, 0.0))
+        app(self.small_seq_path,
+            self.test_out,
+            params,
+            job_prefix='POTU_TEST_',
+            poll_directly=True,
+            suppress_submit_jobs=False)
+        # the prefixes AC (4 sequences), AT (2) and AA (1) are balanced by
+        # number of sequences
+        self.assertEqual(app.job_sizes, [(4, 44), (3, 26)])
+        lines = list(open(join(self.test_out, 'POTU_TEST_',
+                               'job_costs.txt')))
+        self.assertEqual(lines[0], '#job\tnum_seqs\tnum_bases\tseconds\n')
+        self.assertEqual([l.split('\t')[:3] for l in lines[1:]],
+                         [['0', '4', '44'], ['1', '3', '26']])
+        self.assertTrue(isinstance(fit_cost_model(lines), LinearCostModel))
+
     def test_parallel_pick_otus_trie_raises(self):
         """ parallel_pick_otus_trie raises error"""
 
@@ -323,6 +350,42 @@ class ParallelPickOtusFunctionTests(TestCase):
         self.assertEquals(obs_levels, [11, 10])
         self.assertEquals(obs_part, [['6', '3', '2'], ['5', '4', '1']])
 
+    def test_linear_cost_model(self):
+        """LinearCostModel estimates costs from sequences and bases"""
+        self.assertEqual(LinearCostModel()(10, 1500), 1500)
+        self.assertEqual(LinearCostModel(2.0, 0.5)(10, 1500), 770.0)
+
+    def test_linear_cost_model_fit(self):
+        """LinearCostModel.fit recovers non-negative coefficients"""
+        job_sizes = [(10, 1000), (20, 1500), (5, 2500), (40, 4000)]
+        run_times = [0.3 * s + 0.01 * b for s, b in job_sizes]
+        model = LinearCostModel.fit(job_sizes, run_times)
+        self.assertAlmostEqual(model.per_seq, 0.3)
+        self.assertAlmostEqual(model.per_base, 0.01)
+
+        # the best unconstrained fit has a negative per_seq
+        run_times = [0.01 * b - 0.1 * s for s, b in job_sizes]
+        model = LinearCostModel.fit(job_sizes, run_times)
+        self.assertEqual(model.per_seq, 0.0)
+        self.assertTrue(model.per_base > 0)
+
+        # uninformative run times give the default model
+        model = LinearCostModel.fit(job_sizes, [0, 0, 0, 0])
+        self.assertEqual((model.per_seq, model.per_base), (0.0, 1.0))
+        self.assertRaises(ValueError, LinearCostModel.fit, [], [])
+        self.assertRaises(ValueError, LinearCostModel.fit, job_sizes, [1])
+
+    def test_fit_cost_model(self):
+        """fit_cost_model fits a model to a job_costs.txt file"""
+        lines = ['#job\tnum_seqs\tnum_bases\tseconds\n',
+                 '0\t10\t1000\t13.000\n',
+                 '1\t20\t1500\t21.000\n',
+                 '2\t0\t0\t0.500\n',
+                 '3\t40\t4000\t52.000\n']
+        model = fit_cost_model(lines)
+        self.assertAlmostEqual(model.per_seq, 0.3)
+        self.assertAlmostEqual(model.per_base, 0.01)
+
 
 refseqs1 = """>r1
 CTGGGCCGTGTCTCAGTCCCAATGTGGCCGTTTACCCTCTCAGGCCGGCTACGCATCATCGCCTTGGTGGGCCGTTACCTCACCAACTAGCTAATGCGCCGCAGGTCCATCCATGTTCACGCCTTGATGGGCGCTTTAATATACTGAGCATGCGCTCTGTATACCTATCCGGTTTTAGCTACCGTTTCCAGCAGTTATCCCGGACACATGGGCTAGG
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from os import rename
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Timer
+from StringIO import StringIO
+from unittest import TestCase, main
+
+from qiime.util import get_qiime_temp_dir
+from qiime.parallel.poller import (Inotify, CompletionWatcher,
+                                   watching_poller, basic_clean_up_f)
+
+
+def write_and_move(fp):
+    """ write fp to a temporary path and rename it into place """
+    open(fp + '.tmp', 'w').write('x\n')
+    rename(fp + '.tmp', fp)
+
+
+class CompletionWatcherTests(TestCase):
+
+    def setUp(self):
+        self.test_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                                prefix='qiime_poller_tests_')
+        self.fps = [join(self.test_dir, 'job%d.txt' % i) for i in range(3)]
+        try:
+            Inotify().close()
+            self.inotify_available = True
+        except OSError:
+            self.inotify_available = False
+
+    def tearDown(self):
+        rmtree(self.test_dir)
+
+    def _check_wait(self, use_inotify, seconds_to_sleep):
+        write_and_move(self.fps[0])
+        watcher = CompletionWatcher(self.fps, seconds_to_sleep,
+                                    use_inotify=use_inotify)
+        # the file created before the watcher started is found immediately
+        self.assertEqual(watcher.pending, set(self.fps[1:]))
+        self.assertEqual(watcher.completion_times.keys(), [self.fps[0]])
+
+        timers = [Timer(0.2, write_and_move, (self.fps[1],)),
+                  Timer(0.4, write_and_move, (self.fps[2],))]
+        for t in timers:
+            t.start()
+        watcher.wait()
+        for t in timers:
+            t.join()
+
+        self.assertEqual(watcher.pending, set())
+        times = watcher.completion_times
+        self.assertEqual(sorted(times), sorted(self.fps))
+        self.assertTrue(times[self.fps[0]] <= times[self.fps[1]]
+                        <= times[self.fps[2]])
+        self.assertTrue(times[self.fps[2]] >= 0.4)
+        return watcher
+
+    def test_wait_polling(self):
+        """ CompletionWatcher detects files by polling """
+        self._check_wait(use_inotify=False, seconds_to_sleep=0.05)
+
+    def test_wait_inotify(self):
+        """ CompletionWatcher detects files renamed into place with inotify
+        """
+        if not self.inotify_available:
+            return
+        # the safety re-check interval is much longer than the test, so the
+        # files must have been found through inotify events
+        watcher = self._check_wait(use_inotify=True, seconds_to_sleep=60)
+        self.assertTrue(watcher.completion_times[self.fps[2]] < 5)
+
+    def test_format_completion_times(self):
+        """ format_completion_times lists files in order of completion """
+        watcher = CompletionWatcher(self.fps, 1, use_inotify=False)
+        watcher.completion_times = {self.fps[0]: 2.5,
+                                    self.fps[1]: 0.25,
+                                    self.fps[2]: 1.0}
+        self.assertEqual(watcher.format_completion_times(),
+                         ['#filepath\tseconds to completion',
+                          '%s\t0.250' % self.fps[1],
+                          '%s\t1.000' % self.fps[2],
+                          '%s\t2.500' % self.fps[0]])
+
+    def test_watching_poller(self):
+        """ watching_poller processes and cleans up results on completion """
+        for fp in self.fps:
+            write_and_move(fp)
+        out_fp = join(self.test_dir, 'merged.txt')
+        merge_map = ['%s\t%s' % ('\t'.join(self.fps), out_fp)]
+        processed = []
+
+        def process_run_results_f(f):
+            processed.extend(f)
+            return True
+
+        completion_times_f = StringIO()
+        times = watching_poller(self.fps,
+                                process_run_results_f,
+                                basic_clean_up_f,
+                                merge_map,
+                                self.fps,
+                                seconds_to_sleep=1,
+                                completion_times_f=completion_times_f)
+        self.assertEqual(processed, merge_map)
+        self.assertEqual(sorted(times), sorted(self.fps))
+        for fp in self.fps:
+            self.assertFalse(exists(fp))
+        self.assertEqual(
+            len(completion_times_f.getvalue().strip().split('\n')), 4)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,16 +10,23 @@ __version__ = "1.8.0-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
-from os import close
-from os.path import exists
-from tempfile import mkstemp
+from os import close, getpid
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
 from unittest import TestCase, main
 
 from skbio.util import remove_files
 
 from qiime.util import get_qiime_temp_dir
 from qiime.parallel.util import (ParallelWrapper,
-                                 BufferedWriter)
+                                 BufferedWriter,
+                                 ShardedWriter,
+                                 strip_job_command,
+                                 run_job_command,
+                                 get_python_script_fp,
+                                 run_python_script,
+                                 JobPool)
 
 
 class ParallelWrapperTests(TestCase):
@@ -29,6 +36,11 @@ class ParallelWrapperTests(TestCase):
         # instantiating the abstract class to test some of the more
         # stand-alone methods
         self.pw = ParallelWrapper()
+        self.dirs_to_remove = []
+
+    def tearDown(self):
+        for d in self.dirs_to_remove:
+            rmtree(d)
 
     def test_merge_to_n_commands_even(self):
         """ _merge_to_n_commands functions as expected (even number of cmds)"""
@@ -182,6 +194,117 @@ class ParallelWrapperTests(TestCase):
         actual = self.pw._merge_to_n_commands(commands, 2)
         self.assertEqual(actual, expected)
 
+    def test_init_invalid_parallel_executor(self):
+        """ ParallelWrapper rejects unknown parallel executors """
+        self.assertRaises(ValueError, ParallelWrapper,
+                          parallel_executor='not-an-executor')
+
+    def test_strip_job_command(self):
+        """ strip_job_command removes the /bin/bash and exit wrappers """
+        self.assertEqual(
+            strip_job_command('/bin/bash; pick_otus.py -h ; mv a b; exit'),
+            ' pick_otus.py -h ; mv a b')
+        self.assertEqual(strip_job_command('pick_otus.py -h'),
+                         'pick_otus.py -h')
+
+    def test_run_job_command(self):
+        """ run_job_command runs the stripped command in a shell """
+        command = '/bin/bash; echo hello ; exit'
+        actual = run_job_command(command)
+        self.assertEqual(actual[:4], (command, 'hello\n', '', 0))
+        self.assertTrue(actual[4] >= 0)
+        self.assertNotEqual(run_job_command('/bin/bash; false; exit')[3], 0)
+
+    def _write_script(self, script):
+        """ write a python script to a temp file which is later removed """
+        script_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                             prefix='ParallelWrapperTests_')
+        self.dirs_to_remove.append(script_dir)
+        script_fp = join(script_dir, 'job_script.py')
+        f = open(script_fp, 'w')
+        f.write(script)
+        f.close()
+        return script_fp
+
+    def test_get_python_script_fp(self):
+        """ get_python_script_fp finds python scripts only """
+        script_fp = self._write_script(job_script)
+        self.assertEqual(get_python_script_fp([script_fp, '-h']), script_fp)
+        self.assertEqual(get_python_script_fp(['echo', 'hello']), None)
+        self.assertEqual(get_python_script_fp(['not_a_command.py']), None)
+        not_python_fp = self._write_script('#!/bin/bash\necho hello\n')
+        self.assertEqual(get_python_script_fp([not_python_fp]), None)
+
+    def test_run_python_script(self):
+        """ run_python_script calls main in this process """
+        script_fp = self._write_script(job_script)
+        self.assertEqual(run_python_script(script_fp, [script_fp, 'a', 'b']),
+                         ('%d a b\n' % getpid(), 'to stderr\n', 0))
+        self.assertEqual(run_python_script(script_fp, [script_fp, 'exit']),
+                         ('', 'failed\n', 1))
+        self.assertEqual(run_python_script(script_fp, [script_fp, '2']),
+                         ('', '', 2))
+        stdout, stderr, return_value = \
+            run_python_script(script_fp, [script_fp, 'raise'])
+        self.assertEqual(return_value, 1)
+        self.assertTrue(stderr.endswith('ValueError: raised\n'))
+
+    def test_run_job_command_python_script(self):
+        """ run_job_command runs python scripts in this process """
+        script_fp = self._write_script(job_script)
+        command = '/bin/bash; %s a ; echo done ; exit' % script_fp
+        self.assertEqual(run_job_command(command)[:4],
+                         (command, '%d a\ndone\n' % getpid(),
+                          'to stderr\n', 0))
+        # subcommands after a failed one are not run
+        command = '/bin/bash; %s 3 ; echo done ; exit' % script_fp
+        self.assertEqual(run_job_command(command)[1:4], ('', '', 3))
+        # commands using the shell's features are run in a shell
+        command = '/bin/bash; %s a | cat ; exit' % script_fp
+        self.assertNotEqual(run_job_command(command)[1],
+                            '%d a\n' % getpid())
+
+    def test_job_pool(self):
+        """ JobPool runs each job in a new process which can start a pool """
+        script_fp = self._write_script(pool_job_script)
+        pool = JobPool(1)
+        try:
+            results = [pool.apply_async(run_job_command,
+                                        ('%s %d' % (script_fp, i),))
+                       for i in range(2)]
+            pool.close()
+            outputs = [r.get(60)[1:4] for r in results]
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual([o[1:] for o in outputs], [('', 0), ('', 0)])
+        pids, squares = zip(*[o[0].split() for o in outputs])
+        self.assertEqual(squares, ('0,1,4', '0,1,4'))
+        self.assertNotEqual(pids[0], pids[1])
+        self.assertFalse(str(getpid()) in pids)
+
+    def test_waits_for_jobs(self):
+        """ only runs which wait for their jobs use the reference db cache """
+        pw = ParallelWrapper(parallel_executor='multiprocessing')
+        self.assertTrue(pw._waits_for_jobs())
+        pw = ParallelWrapper(parallel_executor='cluster_jobs')
+        self.assertFalse(pw._waits_for_jobs())
+        pw._poll_directly = True
+        self.assertTrue(pw._waits_for_jobs())
+        pw = ParallelWrapper(parallel_executor='cluster_jobs',
+                             suppress_polling=True)
+        pw._poll_directly = True
+        self.assertFalse(pw._waits_for_jobs())
+
+    def test_init_invalid_shards_per_job(self):
+        """ ParallelWrapper rejects invalid shards_per_job values """
+        self.assertRaises(ValueError, ParallelWrapper,
+                          parallel_executor='multiprocessing',
+                          shards_per_job=0)
+        self.assertRaises(ValueError, ParallelWrapper,
+                          parallel_executor='cluster_jobs',
+                          shards_per_job=4)
+
     def test_get_random_job_prefix(self):
         """ get_random_job_prefix functions as expected """
 
@@ -242,6 +365,73 @@ class ParallelWrapperTests(TestCase):
         self.assertEqual(actual_40, 1)
 
 
+class ParallelCopier(ParallelWrapper):
+
+    """ Minimal wrapper which copies each split of a fasta file """
+    _job_prefix = 'COPY'
+    _input_splitter = ParallelWrapper._split_fasta
+
+    def _get_job_commands(self, input_fps, output_dir, params, job_prefix,
+                          working_dir, command_prefix='/bin/bash; ',
+                          command_suffix='; exit'):
+        commands = []
+        result_filepaths = []
+        for i, fp in enumerate(input_fps):
+            out_fp = join(working_dir, '%s.%d.out' % (job_prefix, i))
+            commands.append('%s cp %s %s %s' %
+                            (command_prefix, fp, out_fp, command_suffix))
+            result_filepaths.append(out_fp)
+        return commands, result_filepaths
+
+    def _write_merge_map_file(self, input_file_basename, job_result_filepaths,
+                              params, output_dir, merge_map_filepath):
+        open(merge_map_filepath, 'w').write('%s\t%s\n' % (
+            '\t'.join(job_result_filepaths),
+            join(output_dir, input_file_basename + '.out')))
+
+
+class ParallelWrapperShardingTests(TestCase):
+
+    def setUp(self):
+        self.test_out = mkdtemp(dir=get_qiime_temp_dir(),
+                                prefix='qiime_parallel_util_tests_')
+        self.input_fp = join(self.test_out, 'in.fasta')
+        self.fasta_lines = []
+        for i in range(24):
+            self.fasta_lines += ['>s%d' % i, 'ACGT' * (i + 1)]
+        open(self.input_fp, 'w').write('\n'.join(self.fasta_lines))
+
+    def tearDown(self):
+        rmtree(self.test_out)
+
+    def test_shards_per_job(self):
+        """ shards are run on the worker pool and merged in input order """
+        app = ParallelCopier(jobs_to_start=2,
+                             parallel_executor='multiprocessing',
+                             shards_per_job=4)
+        app(self.input_fp, self.test_out, {}, job_prefix='SHARD',
+            poll_directly=True)
+        self.assertEqual(len(app.job_timings), 8)
+        for command, run_time in app.job_timings:
+            self.assertTrue(run_time >= 0)
+        actual = open(join(self.test_out, 'in.out')).read().splitlines()
+        self.assertEqual(actual, self.fasta_lines)
+        self.assertFalse(exists(join(self.test_out, 'SHARD')))
+
+    def test_shards_per_job_retain_temp_files(self):
+        """ shard timings are written when temp files are retained """
+        app = ParallelCopier(jobs_to_start=2,
+                             parallel_executor='multiprocessing',
+                             shards_per_job=3,
+                             retain_temp_files=True)
+        app(self.input_fp, self.test_out, {}, job_prefix='SHARD',
+            poll_directly=True)
+        timings = list(open(join(self.test_out, 'SHARD', 'job_timings.txt')))
+        self.assertEqual(timings[0], '#job\tseconds\tcommand\n')
+        self.assertEqual([l.split('\t')[0] for l in timings[1:]],
+                         map(str, range(6)))
+
+
 class BufferedWriterTests(TestCase):
 
     def setUp(self):
@@ -291,5 +481,92 @@ class BufferedWriterTests(TestCase):
         content = open(self.test_fp, "r").readlines()
         self.assertEquals(content, ["1"])
 
+
+class ShardedWriterTests(TestCase):
+
+    def setUp(self):
+        self.test_out = mkdtemp(dir=get_qiime_temp_dir(),
+                                prefix='qiime_sharded_writer_tests_')
+        self.fps = [join(self.test_out, '%d.txt' % i) for i in range(5)]
+
+    def tearDown(self):
+        rmtree(self.test_out)
+
+    def test_write(self):
+        """ShardedWriter writes each file through a bounded set of handles"""
+        w = ShardedWriter(max_open_files=2, buffer_size=4)
+        expected = dict((fp, '') for fp in self.fps)
+        for i in range(20):
+            fp = self.fps[(i * 3) % 5]
+            w.write(fp, 'ab%d' % i)
+            expected[fp] += 'ab%d' % i
+            self.assertTrue(len(w._handles) <= 2)
+        # files are created as soon as they are first written to
+        self.assertTrue(all(map(exists, self.fps)))
+        self.assertEqual(w.filepaths, [self.fps[i] for i in (0, 3, 1, 4, 2)])
+        w.close()
+        self.assertEqual(w._handles, {})
+        for fp in self.fps:
+            self.assertEqual(open(fp).read(), expected[fp])
+
+    def test_write_buffers(self):
+        """ShardedWriter writes nothing until a buffer is full"""
+        w = ShardedWriter(buffer_size=4, max_buffered_bytes=4)
+        w.write(self.fps[0], 'abc')
+        self.assertEqual(open(self.fps[0]).read(), '')
+        w.write(self.fps[1], 'de')
+        # the buffers together hold too much, so the largest is written
+        w._handles[self.fps[0]].flush()
+        self.assertEqual(open(self.fps[0]).read(), 'abc')
+        self.assertEqual(open(self.fps[1]).read(), '')
+        w.write(self.fps[1], 'fg')
+        w._handles[self.fps[1]].flush()
+        self.assertEqual(open(self.fps[1]).read(), 'defg')
+        w.close()
+
+    def test_init_invalid(self):
+        """ShardedWriter requires at least one open file"""
+        self.assertRaises(ValueError, ShardedWriter, 0)
+
+job_script = """#!/usr/bin/env python
+import sys
+from os import getpid
+
+
+def main():
+    if sys.argv[1] == 'exit':
+        sys.exit('failed')
+    elif sys.argv[1] == 'raise':
+        raise ValueError('raised')
+    elif sys.argv[1].isdigit():
+        sys.exit(int(sys.argv[1]))
+    print getpid(), ' '.join(sys.argv[1:])
+    sys.stderr.write('to stderr\\n')
+
+if __name__ == "__main__":
+    main()
+"""
+
+pool_job_script = """#!/usr/bin/env python
+from os import getpid
+from multiprocessing import Pool
+
+
+def square(x):
+    return x * x
+
+
+def main():
+    pool = Pool(2)
+    squares = pool.map(square, range(3))
+    pool.close()
+    pool.join()
+    print getpid(), ','.join(map(str, squares))
+
+if __name__ == "__main__":
+    main()
+"""
+
+
 if __name__ == "__main__":
     main()
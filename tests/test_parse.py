@@ -32,7 +32,7 @@ from qiime.parse import (group_by_field, group_by_fields,
                          parse_qual_scores, QiimeParseError, parse_newick, parse_trflp,
                          parse_taxa_summary_table, parse_prefs_file, parse_mapping_file_to_dict,
                          mapping_file_to_dict, MinimalQualParser, parse_denoiser_mapping,
-                         parse_otu_map, parse_sample_id_map, parse_taxonomy_to_otu_metadata,
+                         parse_otu_map, parse_otu_map_to_sparse, parse_sample_id_map, parse_taxonomy_to_otu_metadata,
                          is_casava_v180_or_later, MinimalSamParser)
 
 
@@ -1207,6 +1207,45 @@ otu3	s8_7	s2_5""".split('\n')
         self.assertEqual(actual[1], expected_sids)
         self.assertEqual(actual[2], expected_oids)
 
+    def test_parse_otu_map_to_sparse(self):
+        """ parse_otu_map_to_sparse functions as expected
+        """
+        otu_map_f = """otu1	s1_0	s2_1	s1_99
+2	s1_9	s5_2 comment	s3_99	1_3	s1_75
+otu3	s8_7	s2_5""".split('\n')
+        expected_map = array([[2, 1, 0, 0, 0, 0],
+                              [2, 0, 1, 1, 1, 0],
+                              [0, 1, 0, 0, 0, 1]])
+        expected_sids = ['s1', 's2', 's5', 's3', '1', 's8']
+        expected_oids = ['otu1', '2', 'otu3']
+        actual = parse_otu_map_to_sparse(otu_map_f)
+        assert_almost_equal(actual[0].toarray(), expected_map)
+        self.assertEqual(actual[1], expected_sids)
+        self.assertEqual(actual[2], expected_oids)
+
+        # matches parse_otu_map
+        otu_map, sids, oids = parse_otu_map(otu_map_f)
+        self.assertEqual(dict(actual[0].todok().items()), otu_map)
+        self.assertEqual(actual[1], sids)
+        self.assertEqual(actual[2], oids)
+
+    def test_parse_otu_map_to_sparse_w_excludes(self):
+        """ parse_otu_map_to_sparse functions as expected w excluded otu ids
+        """
+        otu_map_f = """otu1	s1_0	s2_1	s1_99
+2	s1_9	s5_2 comment	s3_99	1_3	s1_75
+otu3	s8_7	s2_5""".split('\n')
+        excludes = ['otu1', '2']
+        actual = parse_otu_map_to_sparse(otu_map_f, excludes)
+        assert_almost_equal(actual[0].toarray(), array([[1, 1]]))
+        self.assertEqual(actual[1], ['s8', 's2'])
+        self.assertEqual(actual[2], ['otu3'])
+
+        actual = parse_otu_map_to_sparse([])
+        self.assertEqual(actual[0].shape, (0, 0))
+        self.assertEqual(actual[1], [])
+        self.assertEqual(actual[2], [])
+
     def test_parse_sample_id_map(self):
         """Test parsing a sample id map functions correctly."""
         sample_id_map = ['\t\t\n', '', ' ', '\n', 'S1\ta',
@@ -4355,6 +4355,24 @@ class PickOtusStandaloneFunctions(TestCase):
             [self.otu_map1_file, self.otu_map2_file, ['a\t110 221']])
         self.assertEqual(exp123, actual123)
 
+    def test_map_otu_map_files_spilled(self):
+        """map_otu_map_files: results are the same when spilled to disk
+        """
+        exp123 = {'a': ['seq1', 'seq2', 'seq5', 'seq6',
+                        'seq7', 'seq8', 'seq3', 'seq4']}
+        actual123 = map_otu_map_files(
+            [self.otu_map1_file, self.otu_map2_file, self.otu_map3_file],
+            max_seq_ids_in_memory=1)
+        self.assertTrue(actual123.spilled)
+        self.assertEqual(exp123, actual123)
+        actual123.close()
+
+        exp = ['seq1', 'seq2', 'seq5', 'seq6', 'seq7', 'seq8', 'seq3', 'seq4']
+        actual = map_otu_map_files(
+            [self.otu_map1_file, self.otu_map2_file],
+            self.failures2, max_seq_ids_in_memory=1)
+        self.assertEqual(actual, exp)
+
 dna_seqs_1 = """>cdhit_test_seqs_0 comment fields, not part of sequence identifiers
 AACCCCCACGGTGGATGCCACACGCCCCATACAAAGGGTAGGATGCTTAAGACACATCGCGTCAGGTTTGTGTCAGGCCT
 > cdhit_test_seqs_1
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent", "Jens Reeder"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from unittest import TestCase, main
+
+from skbio.tree import CompressedTrie, fasta_to_pairlist
+
+from qiime.prefix_map import PackedPrefixIndex
+
+
+class PackedPrefixIndexTests(TestCase):
+
+    """Tests of the PackedPrefixIndex class"""
+
+    def setUp(self):
+        self.seqs = [('s1', 'ACGTAATGGT'),
+                     ('s2', 'ACGTATTTTAATTTGGCATGGT'),
+                     ('s3', 'ACGTAAT'),
+                     ('s4', 'ACGTA'),
+                     ('s5', 'ATTTAATGGT'),
+                     ('s6', 'ATTTAAT'),
+                     ('s7', 'AAATAAAAA'),
+                     ('s8', 'ACGTAATGGT'),
+                     ('s9', 'ATTTAATGGT')]
+
+    def test_prefix_map(self):
+        """prefix_map matches the compressed trie prefix map"""
+        expected = {'s1': ['s8', 's3', 's4'],
+                    's2': [],
+                    's5': ['s9', 's6'],
+                    's7': []}
+        for chunk_size in (1, 2, 100):
+            actual = PackedPrefixIndex(self.seqs, chunk_size).prefix_map()
+            self.assertEqual(actual, expected)
+        self.assertEqual(
+            CompressedTrie(fasta_to_pairlist(self.seqs)).prefix_map,
+            expected)
+
+    def test_prefix_map_non_acgt(self):
+        """prefix_map handles characters other than A, C, G and T"""
+        seqs = [('a', 'ACGA'), ('b', 'ACGAN'), ('c', 'AC'), ('d', 'ACGA'),
+                ('e', 'acga'), ('f', 'ACGAAA'), ('g', 'ACGAAA')]
+        expected = {'b': [],
+                    'e': [],
+                    'f': ['g', 'a', 'd', 'c']}
+        # the non-ACGT sequences are seen both before and after the index
+        # switches from 2 to 8 bits per character
+        for chunk_size in (1, 3, 100):
+            actual = PackedPrefixIndex(seqs, chunk_size).prefix_map()
+            self.assertEqual(actual, expected)
+        self.assertEqual(CompressedTrie(fasta_to_pairlist(seqs)).prefix_map,
+                         expected)
+
+    def test_prefix_map_largest_group(self):
+        """prefixes are assigned to the largest group they are a prefix of"""
+        seqs = [('a', 'AC'), ('b', 'ACGT'), ('c', 'ACTT'), ('d', 'ACTT'),
+                ('e', 'A')]
+        expected = {'b': [], 'c': ['d', 'a', 'e']}
+        self.assertEqual(PackedPrefixIndex(seqs).prefix_map(), expected)
+
+    def test_prefix_map_empty(self):
+        """prefix_map of an empty index is empty"""
+        self.assertEqual(PackedPrefixIndex().prefix_map(), {})
+
+    def test_prefix_map_with_seqs(self):
+        """prefix_map_with_seqs returns the keys' seqs in input order"""
+        mapping, seqs = PackedPrefixIndex(self.seqs, 4).prefix_map_with_seqs()
+        self.assertEqual(mapping, PackedPrefixIndex(self.seqs).prefix_map())
+        self.assertEqual(seqs, [('s1', 'ACGTAATGGT'),
+                                ('s2', 'ACGTATTTTAATTTGGCATGGT'),
+                                ('s5', 'ATTTAATGGT'),
+                                ('s7', 'AAATAAAAA')])
+
+    def test_get_seq(self):
+        """get_seq returns the original sequences"""
+        index = PackedPrefixIndex(chunk_size=2)
+        index.extend(self.seqs)
+        for i, (seq_id, seq) in enumerate(self.seqs):
+            self.assertEqual(index.get_seq(i), seq)
+        index.add('s10', 'ACNNT')
+        for i, (seq_id, seq) in enumerate(self.seqs):
+            self.assertEqual(index.get_seq(i), seq)
+        self.assertEqual(index.get_seq(9), 'ACNNT')
+        self.assertEqual(len(index), 10)
+        self.assertRaises(IndexError, index.get_seq, 10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+__author__ = "agent"
+__copyright__ = "Copyright 2026, The QIIME Project"
+__credits__ = ["agent"]
+__license__ = "GPL"
+__version__ = "1.8.0-dev"
+__maintainer__ = "agent"
+__email__ = "agent@local"
+
+from os import utime
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase, main
+
+from qiime.util import get_qiime_temp_dir
+from qiime.reference_db_cache import (ReferenceDbCache, fasta_checksum,
+                                      get_reference_db_cache)
+
+
+class ReferenceDbCacheTests(TestCase):
+
+    """Tests of the ReferenceDbCache class"""
+
+    def setUp(self):
+        self.working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                                   prefix='qiime_reference_db_cache_tests_')
+        self.cache_dir = join(self.working_dir, 'cache')
+        self.ref1_fp = self._write_fasta('ref1.fasta', '>r1\nACGT\n')
+        self.ref2_fp = self._write_fasta('ref2.fasta', '>r2\nGGGGCCCC\n')
+        self.builds = []
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        rmtree(self.working_dir)
+
+    def _write_fasta(self, fn, data):
+        fp = join(self.working_dir, fn)
+        f = open(fp, 'w')
+        f.write(data)
+        f.close()
+        return fp
+
+    def _cache(self, max_size=None):
+        cache = ReferenceDbCache(self.cache_dir, max_size)
+        self.caches.append(cache)
+        return cache
+
+    def _build(self, fasta_fp, output_dir):
+        """ Fake database build: copies the FASTA file to output_dir/db """
+        self.builds.append(fasta_fp)
+        db_fp = join(output_dir, 'db')
+        f = open(db_fp, 'w')
+        f.write(open(fasta_fp).read())
+        f.close()
+        return db_fp, [db_fp]
+
+    def test_get(self):
+        """get builds a database once per reference file contents"""
+        cache = self._cache()
+        db_fp = cache.get('fake', self.ref1_fp, self._build)
+        self.assertTrue(db_fp.startswith(self.cache_dir))
+        self.assertEqual(open(db_fp).read(), '>r1\nACGT\n')
+        self.assertEqual(len(self.builds), 1)
+
+        # a copy of the file elsewhere, used by another cache object (as in
+        # a later run), gets the same database without building it
+        ref1_copy_fp = self._write_fasta('ref1_copy.fasta', '>r1\nACGT\n')
+        self.assertEqual(self._cache().get('fake', ref1_copy_fp, self._build),
+                         db_fp)
+        self.assertEqual(len(self.builds), 1)
+
+        # different contents, parameters or tools are different databases
+        db2_fp = cache.get('fake', self.ref2_fp, self._build)
+        db3_fp = cache.get('fake', self.ref1_fp, self._build, {'max_pos': 5})
+        db4_fp = cache.get('other', self.ref1_fp, self._build)
+        self.assertEqual(len(set([db_fp, db2_fp, db3_fp, db4_fp])), 4)
+        self.assertEqual(len(self.builds), 4)
+        self.assertEqual(len(cache.entries()), 4)
+
+    def test_get_failed_build(self):
+        """get leaves no entry behind if the build fails"""
+        def build_f(fasta_fp, output_dir):
+            raise ValueError("build failed")
+        cache = self._cache()
+        self.assertRaises(ValueError, cache.get, 'fake', self.ref1_fp,
+                          build_f)
+        self.assertEqual(cache.entries(), [])
+        cache.get('fake', self.ref1_fp, self._build)
+        self.assertEqual(len(self.builds), 1)
+
+    def test_evict(self):
+        """evict removes the least recently used entries not in use"""
+        cache = self._cache()
+        db1_fp = cache.get('fake', self.ref1_fp, self._build)
+        db2_fp = cache.get('fake', self.ref2_fp, self._build)
+        # make ref1's database the least recently used
+        key1 = cache.entry_key('fake', self.ref1_fp)
+        utime(join(self.cache_dir, key1, 'entry_info.json'), (0, 0))
+
+        # both entries are in use by cache
+        evicting_cache = self._cache(max_size=0)
+        self.assertEqual(evicting_cache.evict(), [])
+        cache.close()
+
+        # once released, the size limit applies in least recently used order
+        sizes = dict((key, size) for key, last_used, size in cache.entries())
+        evicting_cache.max_size = sum(sizes.values()) - 1
+        self.assertEqual(evicting_cache.evict(), [key1])
+        self.assertFalse(exists(db1_fp))
+        self.assertTrue(exists(db2_fp))
+
+        # evicted entries are rebuilt when they are needed again
+        self.assertEqual(evicting_cache.get('fake', self.ref1_fp,
+                                            self._build), db1_fp)
+        self.assertEqual(len(self.builds), 3)
+
+    def test_fasta_checksum(self):
+        """fasta_checksum depends only on the file contents"""
+        copy_fp = self._write_fasta('copy.fasta', '>r1\nACGT\n')
+        self.assertEqual(fasta_checksum(self.ref1_fp, 3),
+                         fasta_checksum(copy_fp))
+        self.assertNotEqual(fasta_checksum(self.ref1_fp),
+                            fasta_checksum(self.ref2_fp))
+
+    def test_get_reference_db_cache(self):
+        """get_reference_db_cache is None unless a cache dir is configured"""
+        self.assertEqual(get_reference_db_cache({}), None)
+        self.assertEqual(
+            get_reference_db_cache({'reference_db_cache_dir': ''}), None)
+        cache = get_reference_db_cache(
+            {'reference_db_cache_dir': self.cache_dir,
+             'reference_db_cache_max_gb': '0.5'})
+        self.assertEqual(cache.cache_dir, self.cache_dir)
+        self.assertEqual(cache.max_size, 2 ** 29)
+        self.assertTrue(get_reference_db_cache(
+            {'reference_db_cache_dir': self.cache_dir}) is cache)
+        self.caches.append(cache)
+
+
+if __name__ == "__main__":
+    main()
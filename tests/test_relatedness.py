@@ -14,9 +14,9 @@ __email__ = "wdwvt1@gmail.com"
 from unittest import TestCase, main
 from numpy.testing import assert_almost_equal
 from numpy.random import seed
-from numpy import array, arange
+from numpy import array, arange, mean, std
 from qiime.relatedness_library import (reduce_mtx, nri, nti, mpd, mntd,
-                                       random_mpd, random_mntd)
+                                       random_mpd, random_mntd, NullModel)
 
 
 class TopLevelTests(TestCase):
@@ -227,6 +227,45 @@ class TopLevelTests(TestCase):
         assert_almost_equal(-1.2046544711672049, obs_nti)
 
 
+class NullModelTests(TestCase):
+
+    """Tests of the NullModel class"""
+
+    def setUp(self):
+        self.distmat = array([[0.0, 0.4, 2.0, 1.3, 0.8],
+                              [0.4, 0.0, 1.6, 0.2, 1.1],
+                              [2.0, 1.6, 0.0, 1.1, 0.3],
+                              [1.3, 0.2, 1.1, 0.0, 0.9],
+                              [0.8, 1.1, 0.3, 0.9, 0.0]])
+
+    def test_mpd_mntd(self):
+        """Test the null distributions match mpd and mntd of the draws."""
+        seed(0)
+        null_model = NullModel(self.distmat, 20)
+        draws = null_model.draws(3)
+        self.assertEqual(draws.shape, (20, 3))
+        mpds = [mpd(reduce_mtx(self.distmat, d)) for d in draws]
+        mntds = [mntd(reduce_mtx(self.distmat, d)) for d in draws]
+        assert_almost_equal(null_model.mpd(3), (mean(mpds), std(mpds)))
+        assert_almost_equal(null_model.mntd(3), (mean(mntds), std(mntds)))
+
+    def test_draws_reused(self):
+        """Test the draws for each group size are made once."""
+        null_model = NullModel(self.distmat, 10)
+        draws = null_model.draws(2)
+        null_model.draws(4)
+        self.assertTrue(null_model.draws(2) is draws)
+        self.assertEqual(null_model.mpd(2), null_model.mpd(2))
+
+    def test_jobs_to_start(self):
+        """Test splitting the draws over processes gives the same result."""
+        seed(0)
+        exp = random_mntd(self.distmat, 3, 50)
+        seed(0)
+        obs = random_mntd(self.distmat, 3, 50, jobs_to_start=2)
+        assert_almost_equal(obs, exp)
+
+
 # run unit tests if run from command-line
 if __name__ == '__main__':
     main()
@@ -27,8 +27,9 @@ from qiime.split_libraries import (
     count_ambig, split_seq, primer_exceeds_mismatches,
     check_barcode, make_histograms, SeqQualBad,
     seq_exceeds_homopolymers, check_window_qual_scores, check_seqs,
-    local_align_primer_seq, preprocess)
-from qiime.parse import parse_qual_score
+    local_align_primer_seq, preprocess, read_qual_record,
+    StreamingQualScores, PrimerMatcher)
+from qiime.parse import parse_qual_score, QiimeParseError
 
 class FakeOutFile(object):
 
@@ -312,6 +313,14 @@ z\tGG\tGC\t5\tsample_z"""
         self.assertEqual(primer_exceeds_mismatches(mismatch_bad, primers, 2),
                          True)
 
+    def test_local_align_primer_seq_repeated_primer(self):
+        "local_align function reports the first of repeated exact matches"
+        primer = 'TAGC'
+        seq = 'CCTAGCCCTAGCC'
+        expected = (0, 2)
+        actual = local_align_primer_seq(primer, seq)
+        self.assertEqual(actual, expected)
+
     # Tests for local alignment functions
     def test_local_align_primer_seq_fwd_rev_match(self):
         "local_align function can handle fwd/rev primers with no mismatches"
@@ -2216,5 +2225,113 @@ class SeqQualBadTests(TestCase):
         self.assertEqual(str(sq), 'Q\t1')
 
 
+class UnseekableStringIO(StringIO):
+
+    """A StringIO which fails if it is seeked"""
+
+    def seek(self, pos, mode=0):
+        raise AssertionError("seek called")
+
+
+class StreamingQualScoresTests(TestCase):
+
+    """Tests of the StreamingQualScores class"""
+
+    def setUp(self):
+        self.qual1 = '>a comment\n10 20\n30\n\n>b\n40 40\n'
+        self.qual2 = '# comment\n>c\n5\n>d\n6 7\n'
+
+    def _get_all(self, quals, ids):
+        return [None if q is None else q.tolist()
+                for q in map(quals.get, ids)]
+
+    def test_read_qual_record(self):
+        """read_qual_record reads one record at a time"""
+        f = StringIO(self.qual1)
+        seq_id, qual, line = read_qual_record(f)
+        self.assertEqual(seq_id, 'a')
+        self.assertEqual(qual.tolist(), [10, 20, 30])
+        self.assertEqual(line, '>b\n')
+        seq_id, qual, line = read_qual_record(f, line=line)
+        self.assertEqual(seq_id, 'b')
+        self.assertEqual(qual.tolist(), [40, 40])
+        self.assertEqual(line, '')
+        self.assertEqual(read_qual_record(f, line=line), None)
+        self.assertEqual(read_qual_record(StringIO('')), None)
+        self.assertRaises(QiimeParseError, read_qual_record,
+                          StringIO('>a\n1 x\n'))
+        self.assertRaises(QiimeParseError, read_qual_record,
+                          StringIO('1 2\n'))
+
+    def test_get_in_order(self):
+        """records in the same order are read without an index"""
+        quals = StreamingQualScores([UnseekableStringIO(self.qual1),
+                                     UnseekableStringIO(self.qual2)])
+        self.assertTrue(quals)
+        self.assertEqual(self._get_all(quals, ['a', 'b', 'c', 'd']),
+                         [[10, 20, 30], [40, 40], [5], [6, 7]])
+        self.assertEqual(quals.indexed_lookups, 0)
+
+    def test_get_missing(self):
+        """a missing id doesn't change the next record read in lockstep"""
+        quals = StreamingQualScores([StringIO(self.qual1),
+                                     StringIO(self.qual2)])
+        self.assertEqual(self._get_all(quals, ['a', 'x', 'b', 'c', 'd']),
+                         [[10, 20, 30], None, [40, 40], [5], [6, 7]])
+        self.assertEqual(quals.indexed_lookups, 0)
+
+    def test_get_out_of_order(self):
+        """records in a different order are found through the index"""
+        quals = StreamingQualScores([StringIO(self.qual1),
+                                     StringIO(self.qual2)])
+        self.assertEqual(self._get_all(quals, ['c', 'd', 'x', 'a', 'b']),
+                         [[5], [6, 7], None, [10, 20, 30], [40, 40]])
+        # reading continues in lockstep after an indexed lookup
+        self.assertEqual(quals.indexed_lookups, 2)
+
+    def test_empty(self):
+        """no qual files means no qual scores"""
+        quals = StreamingQualScores([])
+        self.assertFalse(quals)
+        self.assertEqual(quals.get('a'), None)
+
+
+class PrimerMatcherTests(TestCase):
+
+    """Tests of the PrimerMatcher class"""
+
+    def setUp(self):
+        self.primers = expand_degeneracies(['AYGGTNACCG'])
+
+    def test_exceeds_mismatches(self):
+        """exceeds_mismatches agrees with primer_exceeds_mismatches"""
+        seqs = ['ACGGTAACCG', 'ACGGTAACCC', 'TCGGTAACCC', 'TTGGTAACCC',
+                'GGGGGGGGGG', 'NCGGTAACCG', 'ACGG', 'ACGGTAACCGTTT']
+        for max_mm in range(4):
+            matcher = PrimerMatcher(self.primers, max_mm)
+            for seq in seqs:
+                self.assertEqual(
+                    matcher.exceeds_mismatches(seq),
+                    primer_exceeds_mismatches(seq, self.primers, max_mm))
+
+    def test_exceeds_mismatches_mixed_lengths(self):
+        """exceeds_mismatches compares prefixes like count_mismatches"""
+        matcher = PrimerMatcher(['AAAA', 'CCCCCCCC', 'GG'], 1)
+        self.assertFalse(matcher.exceeds_mismatches('AAAT'))
+        self.assertFalse(matcher.exceeds_mismatches('CCCCA'))
+        self.assertFalse(matcher.exceeds_mismatches('GTTTT'))
+        self.assertTrue(matcher.exceeds_mismatches('ATTT'))
+        self.assertTrue(matcher.exceeds_mismatches('CCAACCCC'))
+
+    def test_exceeds_mismatches_cached(self):
+        """exceeds_mismatches results are cached up to max_cached"""
+        matcher = PrimerMatcher(self.primers, 1, max_cached=2)
+        self.assertFalse(matcher.exceeds_mismatches('ACGGTAACCC'))
+        self.assertTrue(matcher.exceeds_mismatches('GGGGGGGGGG'))
+        self.assertEqual(len(matcher._cache), 2)
+        self.assertFalse(matcher.exceeds_mismatches('ACGGTAACCG'))
+        self.assertEqual(len(matcher._cache), 1)
+
+
 if __name__ == '__main__':
     main()
@@ -19,6 +19,9 @@ from shutil import rmtree
 from qiime.split_libraries_fastq import (
     process_fastq_single_end_read_file,
     quality_filter_sequence,
+    quality_filter_sequences,
+    qual_score_filter_lengths,
+    read_qual_score_filter,
     bad_chars_from_threshold,
     get_illumina_qual_chars,
     quality_filter_sequence,
@@ -26,6 +29,9 @@ from qiime.split_libraries_fastq import (
     check_header_match_pre180,
     check_header_match_180_or_later,
     correct_barcode,
+    barcode_neighbors,
+    BarcodeCorrector,
+    read_fastq_chunks,
     process_fastq_single_end_read_file_no_barcode,
     extract_reads_from_interleaved
 )
@@ -143,6 +149,54 @@ class SplitLibrariesFastqTests(TestCase):
         expected = (1, "CCAGTGTATGCA", True, None)
         self.assertEqual(actual, expected)
 
+    def test_barcode_neighbors(self):
+        """barcode_neighbors yields each neighbor once"""
+        self.assertEqual(sorted(barcode_neighbors('AC', 1)),
+                         ['AA', 'AG', 'AT', 'CC', 'GC', 'TC'])
+        actual = list(barcode_neighbors('GGAGACAAGGGA', 2))
+        self.assertEqual(len(actual), 12 * 3 + 66 * 9)
+        self.assertEqual(len(set(actual)), len(actual))
+        self.assertFalse('GGAGACAAGGGA' in actual)
+        self.assertEqual(list(barcode_neighbors('ACGT', 0)), [])
+
+    def test_barcode_corrector_matches_correct_barcode(self):
+        """BarcodeCorrector gives the same results as correct_barcode"""
+        barcode_to_sample_id = {
+            "GGAGACAAGGGA": "s1",
+            "ACACCTGGTGAT": "s2"}
+        barcodes = ["GGAGACAAGGGA", "GGAGACAAGGGT", "ACACCTGGTGAC",
+                    "CCAGTGTATGCA", "CCTGTGTATGCA", "CCAGTGTANGCA",
+                    "TTTTGGGGCCCC", "ACACCTGGTGAC"]
+        barcodes.extend(barcode_neighbors("ACACCTGGTGAT", 3))
+
+        for correction_fn in (None, decode_golay_12):
+            expected = [correct_barcode(bc, barcode_to_sample_id,
+                                        correction_fn) for bc in barcodes]
+            bc_corrector = BarcodeCorrector(barcode_to_sample_id,
+                                            correction_fn)
+            self.assertEqual([bc_corrector(bc) for bc in barcodes],
+                             expected)
+            bc_corrector = BarcodeCorrector(barcode_to_sample_id,
+                                            correction_fn)
+            self.assertEqual(bc_corrector.correct_barcodes(barcodes),
+                             expected)
+
+    def test_barcode_corrector_max_cached(self):
+        """BarcodeCorrector returns correct results when cache is full"""
+        barcode_to_sample_id = {
+            "GGAGACAAGGGA": "s1",
+            "ACACCTGGTGAT": "s2"}
+        bc_corrector = BarcodeCorrector(barcode_to_sample_id,
+                                        decode_golay_12,
+                                        max_nt_errors=0,
+                                        max_cached=1)
+        barcodes = ["GGAGACAAGGGT", "ACACCTGGTGAC", "CCTGTGTATGCA"]
+        expected = [(1, "GGAGACAAGGGA", True, "s1"),
+                    (1, "ACACCTGGTGAT", True, "s2"),
+                    (1, "CCAGTGTATGCA", True, None)]
+        self.assertEqual(bc_corrector.correct_barcodes(barcodes), expected)
+        self.assertEqual([bc_corrector(bc) for bc in barcodes], expected)
+
     def test_process_fastq_single_end_read_file_invalid_phred_offset(self):
         # passing phred_offset that isn't 33 or 64 raises error
         with self.assertRaises(ValueError):
@@ -538,6 +592,53 @@ class SplitLibrariesFastqTests(TestCase):
         expected = []
         self.assertEqual(actual, expected)
 
+    def test_process_fastq_single_end_read_file_parallel(self):
+        """process_fastq_single_end_read_file gives same results w workers
+        """
+        kwargs = {'store_unassigned': True,
+                  'min_per_read_length_fraction': 0.45,
+                  'start_seq_id': 42,
+                  'barcode_correction_fn': decode_golay_12}
+        serial_log = FakeFile()
+        serial_histogram = FakeFile()
+        expected = list(process_fastq_single_end_read_file(
+            self.fastq1, self.barcode_fastq1, self.barcode_map1,
+            log_f=serial_log, histogram_f=serial_histogram, **kwargs))
+
+        for chunk_size in (1, 2, 3, 1000):
+            parallel_log = FakeFile()
+            parallel_histogram = FakeFile()
+            actual = list(process_fastq_single_end_read_file(
+                self.fastq1, self.barcode_fastq1, self.barcode_map1,
+                log_f=parallel_log, histogram_f=parallel_histogram,
+                num_workers=2, chunk_size=chunk_size, **kwargs))
+            self.assertEqual(len(actual), len(expected))
+            for i in range(len(expected)):
+                np.testing.assert_equal(actual[i], expected[i])
+            self.assertEqual(parallel_log.s, serial_log.s)
+            self.assertEqual(parallel_histogram.s, serial_histogram.s)
+
+    def test_process_fastq_single_end_read_file_parallel_header_mismatch(
+            self):
+        """process_fastq_single_end_read_file raises error from workers
+        """
+        barcode_fastq1 = self.barcode_fastq1[:]
+        barcode_fastq1[4] = '@990:2:4:11271:9999#1/2'
+        actual = process_fastq_single_end_read_file(
+            self.fastq1, barcode_fastq1, self.barcode_map1,
+            num_workers=2, chunk_size=1)
+        self.assertRaises(FastqParseError, list, actual)
+
+    def test_read_fastq_chunks(self):
+        """read_fastq_chunks yields record-aligned chunks of lines
+        """
+        actual = list(read_fastq_chunks(self.barcode_fastq1[:12],
+                                        self.fastq1[:12], 2))
+        self.assertEqual(actual,
+                         [(self.barcode_fastq1[:8], self.fastq1[:8]),
+                          (self.barcode_fastq1[8:12], self.fastq1[8:12])])
+        self.assertEqual(list(read_fastq_chunks([], [], 2)), [])
+
     def test_process_fastq_single_end_read_file_w_golay_correction(self):
         """process_fastq_single_end_read_file handles golay correction
         """
@@ -780,6 +881,59 @@ class SplitLibrariesFastqTests(TestCase):
         self.assertEqual(bad_chars_from_threshold('@'),
                          {}.fromkeys(exp3))
 
+    def test_qual_score_filter_lengths(self):
+        """qual_score_filter_lengths matches read_qual_score_filter
+        """
+        quals = np.array([[30, 30, 2, 30, 2, 2, 30, 30],
+                          [30, 30, 30, 30, 30, 30, 30, 30],
+                          [2, 2, 2, 30, 30, 30, 30, 2],
+                          [30, 30, 30, 30, 30, 30, 2, 2]], dtype=np.int8)
+        for max_run_length in range(10):
+            for threshold in (None, 1, 2, 30):
+                actual = qual_score_filter_lengths(quals, max_run_length,
+                                                   threshold)
+                expected = [len(read_qual_score_filter('A' * 8, q,
+                                                       max_run_length,
+                                                       threshold)[0])
+                            for q in quals]
+                np.testing.assert_equal(actual, expected)
+
+    def test_quality_filter_sequences(self):
+        """quality_filter_sequences matches quality_filter_sequence
+        """
+        headers = ['990:2:4:11271:5323#1/1',
+                   '990:2:4:11271:5324#0/1',
+                   '990:2:4:11271:5325#1/1',
+                   '990:2:4:11271:5326#1/1',
+                   '990:2:4:11271:5327#1/1',
+                   '990:2:4:11271:5328#1/1']
+        sequences = ['ACGTACGTAC',
+                     'ACGTACGTAC',
+                     'ACGNNCGTAC',
+                     'ACGTACGTNN',
+                     'ACGTAC',
+                     '']
+        qualities = [np.array([30] * 10, dtype=np.int8),
+                     np.array([30] * 10, dtype=np.int8),
+                     np.array([30] * 10, dtype=np.int8),
+                     np.array([30] * 8 + [2, 2], dtype=np.int8),
+                     np.array([30, 2, 30, 30, 30, 30], dtype=np.int8),
+                     np.array([], dtype=np.int8)]
+        for max_bad_run_length in (0, 1, 3):
+            for min_per_read_length in (0, 5, 7.5):
+                for seq_max_N in (0, 1):
+                    for filter_digit in (True, False):
+                        params = (max_bad_run_length, 2, min_per_read_length,
+                                  seq_max_N, filter_digit)
+                        actual = quality_filter_sequences(
+                            headers, sequences, qualities, *params)
+                        expected = [quality_filter_sequence(h, s, q, *params)
+                                    for h, s, q in zip(headers, sequences,
+                                                       qualities)]
+                        self.assertEqual(len(actual), len(expected))
+                        for a, e in zip(actual, expected):
+                            np.testing.assert_equal(a, e)
+
     def test_quality_filter_sequence_pass(self):
         """quality_filter_sequence functions as expected for good read
         """
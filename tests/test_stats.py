@@ -28,7 +28,7 @@ from skbio.util import remove_files
 from numpy.testing import assert_almost_equal, assert_allclose
 from numpy import (array, asarray, roll, median, nan, arange, matrix,
                    concatenate, nan, ndarray, number, ones,
-                   reshape, testing, tril, var, log, fill_diagonal)
+                   reshape, testing, tril, var, log, fill_diagonal, isnan)
 from numpy.random import permutation, shuffle, seed
 from biom import Table, load_table
 
@@ -39,9 +39,11 @@ from qiime.stats import (all_pairs_t_test, _perform_pairwise_tests,
                          paired_difference_analyses,
                          G_2_by_2, g_fit, t_paired, t_one_sample,
                          t_two_sample, mc_t_two_sample,
-                         _permute_observations,
+                         _permute_observations, _t_two_sample_batch,
+                         _iter_permuted_observations,
                          correlation_t, ZeroExpectedError, fisher,
                          safe_sum_p_log_p, permute_2d,
+                         permuted_correlations,
                          pearson, spearman, ANOVA_one_way, mw_t,
                          mw_boot, is_symmetric_and_hollow,
                          tail, fdr_correction,
@@ -947,12 +949,53 @@ class PartialMantelTests(TestHelper):
         self.assertCorrectPValue(0.8, 1.0, self.small_pm_diff2,
                                  p_val_key='mantel_p')
 
+    def test_call_jobs_to_start(self):
+        """Test running partial Mantel with the permutations split up."""
+        seed(0)
+        obs = self.small_pm_diff2(num_perms=99, jobs_to_start=2)
+        assert_almost_equal(obs['mantel_r'], -0.350624881409)
+        self.assertTrue(0.0 <= obs['mantel_p'] <= 1.0)
+        # the split permutations depend only on the random state in this
+        # process
+        seed(0)
+        self.assertEqual(self.small_pm_diff2(num_perms=99, jobs_to_start=2),
+                         obs)
+
 
 class TopLevelTests(TestHelper):
 
     def setUp(self):
         pass
 
+    def test_permuted_correlations(self):
+        """permuted_correlations matches pearson on the permuted matrices"""
+        dm = DistanceMatrix(array([[0, 1, 2, 3, 1.4],
+                                   [1, 0, 1.5, 1.6, 1.7],
+                                   [2, 1.5, 0, 0.8, 1.9],
+                                   [3, 1.6, 0.8, 0, 1.0],
+                                   [1.4, 1.7, 1.9, 1.0, 0]]),
+                            ['s1', 's2', 's3', 's4', 's5'])
+        vectors = [[1, 2, 3, 4, 5, 6, 7, 8, 9, 10],
+                   [0, 1, 0, 1, 1, 0, 0, 1, 0, 0]]
+        seed(0)
+        perms = [permutation(5) for i in range(10)]
+        seed(0)
+        obs, obs_perms = permuted_correlations(dm, vectors, 10)
+
+        assert_almost_equal(obs, [pearson(dm.condensed_form(), v)
+                                  for v in vectors])
+        self.assertEqual(obs_perms.shape, (10, 2))
+        for p, obs_perm in zip(perms, obs_perms):
+            dm_perm = DistanceMatrix(permute_2d(dm.data, p), dm.ids)
+            assert_almost_equal(obs_perm,
+                                [pearson(dm_perm.condensed_form(), v)
+                                 for v in vectors])
+
+        # correlations with a constant vector are undefined
+        obs, obs_perms = permuted_correlations(dm, [[1] * 10], 5)
+        self.assertTrue(isnan(obs[0]))
+        self.assertTrue(isnan(obs_perms).all())
+
     def test_quantile(self):
         """checks for correct quantile statistic values"""
 
@@ -1496,6 +1539,23 @@ class StatTests(TestsHelper):
                                  {'tails': 'high', 'permutations': 99,
                                   'exp_diff': 1}, p_val_idx=3)
 
+    def test_mc_t_two_sample_block_size(self):
+        """Test the block size changes memory use but not the results."""
+        I = array([7.2, 7.1, 9.1, 7.2, 7.3, 7.2, 7.5])
+        II = array([8.8, 7.5, 7.7, 7.6, 7.4, 6.7, 7.2])
+        seed(0)
+        exp = mc_t_two_sample(I, II, permutations=99)
+
+        # one permutation per block, a block smaller than one permutation,
+        # and a block size that doesn't divide the permutations evenly
+        for block_size in 14, 1, 100:
+            seed(0)
+            obs = mc_t_two_sample(I, II, permutations=99,
+                                  block_size=block_size)
+            assert_allclose(obs[:2], exp[:2])
+            assert_allclose(obs[2], exp[2])
+            self.assertEqual(obs[3], exp[3])
+
     def test_mc_t_two_sample_unbalanced_obs(self):
         """Test gives correct results with unequal number of obs per sample."""
         # Verified against R's t.test() and Deducer::perm.t.test().
@@ -1589,6 +1649,35 @@ class StatTests(TestsHelper):
                                             obs[1][0]))),
                         sorted(I + II))
 
+    def test_iter_permuted_observations(self):
+        """Test permutations don't depend on the block size."""
+        I = [10, 20., 1]
+        II = [2, 4, 5, 7]
+        seed(0)
+        exp_xs, exp_ys = _permute_observations(I, II, 10)
+        for block_size in (1, 3, 10):
+            seed(0)
+            blocks = list(_iter_permuted_observations(I, II, 10, block_size))
+            self.assertEqual(len(blocks), -(-10 // block_size))
+            assert_allclose(concatenate([b[0] for b in blocks]), exp_xs)
+            assert_allclose(concatenate([b[1] for b in blocks]), exp_ys)
+
+    def test_t_two_sample_batch(self):
+        """Test batched t statistics match t_two_sample."""
+        x = array([[7.2, 7.1, 9.1], [7.3, 7.2, 7.5], [1, 1, 1]])
+        y = array([[8.8, 7.5], [7.7, 7.6], [1, 1]])
+        assert_allclose(_t_two_sample_batch(x, y),
+                        [t_two_sample(a, b)[0] for a, b in zip(x, y)])
+        assert_allclose(_t_two_sample_batch(x, y, exp_diff=0.5),
+                        [t_two_sample(a, b, exp_diff=0.5)[0]
+                         for a, b in zip(x, y)])
+
+        # a single observation in either sample
+        assert_allclose(_t_two_sample_batch(x, y[:, :1]),
+                        [t_two_sample(a, b)[0] for a, b in zip(x, y[:, :1])])
+        assert_allclose(_t_two_sample_batch(y[:, :1], x),
+                        [t_two_sample(a, b)[0] for a, b in zip(y[:, :1], x)])
+
     def test_tail(self):
         """tail should return prob/2 if test is true, or 1-(prob/2) if false
         """
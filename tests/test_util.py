@@ -2,7 +2,7 @@
 from __future__ import division
 # unit tests for util.py
 
-from os import chdir, getcwd, mkdir, rmdir, remove, close
+from os import chdir, getcwd, mkdir, rmdir, remove, close, environ, utime
 from os.path import split, abspath, dirname, exists, isdir, join
 from glob import glob
 from random import seed
@@ -35,6 +35,7 @@ from qiime.util import (make_safe_f, FunctionWithParams, qiime_blast_seqs,
                         raise_error_on_parallel_unavailable,
                         convert_OTU_table_relative_abundance, create_dir,
                         summarize_pcoas, _compute_jn_pcoa_avg_ranges, _flip_vectors, IQR,
+                        load_pcoa_files, PCoAFiles,
                         idealfourths, isarray, matrix_IQR, degap_fasta_aln,
                         write_degapped_fasta_to_file, compare_otu_maps, get_diff_for_otu_maps,
                         convert_otu_table_relative, write_seqs_to_fasta,
@@ -128,6 +129,37 @@ class TopLevelTests(TestCase):
         with open(output_fp, 'r') as f:
             self.assertTrue(f.read(1) == '{')
 
+    def test_load_qiime_config_cached(self):
+        """load_qiime_config returns copies and rereads changed files"""
+        fd, config_fp = mkstemp(prefix="test_qiime_config_")
+        close(fd)
+        self.files_to_remove.append(config_fp)
+        f = open(config_fp, 'w')
+        f.write('test_only_key\tvalue1\n')
+        f.close()
+
+        orig_config_fp = environ.get('QIIME_CONFIG_FP')
+        environ['QIIME_CONFIG_FP'] = config_fp
+        try:
+            qiime_config = load_qiime_config()
+            self.assertEqual(qiime_config['test_only_key'], 'value1')
+            # changes to the result don't affect later results
+            qiime_config['test_only_key'] = 'changed'
+            self.assertEqual(load_qiime_config()['test_only_key'], 'value1')
+            self.assertEqual(load_qiime_config()['not_a_key'], None)
+
+            f = open(config_fp, 'w')
+            f.write('test_only_key\tvalue2\n')
+            f.close()
+            # make sure the modification time changes
+            utime(config_fp, (0, 0))
+            self.assertEqual(load_qiime_config()['test_only_key'], 'value2')
+        finally:
+            if orig_config_fp is None:
+                del environ['QIIME_CONFIG_FP']
+            else:
+                environ['QIIME_CONFIG_FP'] = orig_config_fp
+
 
     def test_expand_otu_ids(self):
         """expand otu ids functions as expected """
@@ -1043,6 +1075,52 @@ class FunctionWithParamsTests(TestCase):
         self.assertEqual(-x.std(ddof=1) / 2, low_matrix[0, 0])
         self.assertEqual(x.std(ddof=1) / 2, high_matrix[0, 0])
 
+    def test_compute_jn_pcoa_avg_ranges_blocks(self):
+        """_compute_jn_pcoa_avg_ranges is independent of the block size
+        """
+        matrices = [array([[2.0, 4.0, -4.5], [-1.2, -0.1, 1.2]]),
+                    array([[3.0, 4.2, -4.5], [-1.1, -0.1, 1.3]]),
+                    array([[7.0, 3.9, -4.1], [-1.4, -0.3, 1.2]]),
+                    array([[1.0, 4.1, -4.6], [-1.2, 0.2, 1.1]])]
+        import qiime.util
+        orig_block_size = qiime.util.JN_PCOA_BLOCK_SIZE
+        try:
+            for method in ('IQR', 'sdev'):
+                expected = _compute_jn_pcoa_avg_ranges(matrices, method)
+                qiime.util.JN_PCOA_BLOCK_SIZE = 4
+                # the matrices can be passed as an iterator
+                actual = _compute_jn_pcoa_avg_ranges(iter(matrices), method)
+                qiime.util.JN_PCOA_BLOCK_SIZE = orig_block_size
+                for e, a in zip(expected, actual):
+                    assert_almost_equal(a, e)
+        finally:
+            qiime.util.JN_PCOA_BLOCK_SIZE = orig_block_size
+
+        self.assertRaises(ValueError, _compute_jn_pcoa_avg_ranges, [],
+                          'sdev')
+        self.assertRaises(ValueError, _compute_jn_pcoa_avg_ranges,
+                          [matrices[0], matrices[0][:1]], 'sdev')
+        self.assertRaises(ValueError, _compute_jn_pcoa_avg_ranges,
+                          matrices, 'median')
+
+    def test_load_pcoa_files(self):
+        """load_pcoa_files parses the support PCoAs as they are needed
+        """
+        pcoa_dir = join(get_qiime_project_dir(), 'qiime_test_data',
+                        'make_2d_plots', 'pcoa')
+        master_pcoa, support_pcoas = load_pcoa_files(pcoa_dir)
+        self.assertTrue(isinstance(support_pcoas, PCoAFiles))
+        self.assertEqual(len(support_pcoas), 10)
+        # the support PCoAs can be iterated over more than once
+        for i in range(2):
+            pcoas = list(support_pcoas)
+            self.assertEqual(len(pcoas), 10)
+            self.assertTrue(master_pcoa[0] in [p[0] for p in pcoas])
+        matrix_average, matrix_low, matrix_high, eigval_average, m_names = \
+            summarize_pcoas(master_pcoa, support_pcoas, method='IQR')
+        self.assertEqual(m_names, master_pcoa[0])
+        self.assertEqual(matrix_average.shape, master_pcoa[1].shape)
+
     def test_summarize_pcoas(self):
         """summarize_pcoas works
         """
@@ -372,6 +372,46 @@ class DownstreamWorkflowTests(TestCase):
         log_fp = glob(join(self.test_out, 'log*.txt'))[0]
         self.assertTrue(getsize(log_fp) > 0)
 
+    def test_run_alpha_rarefaction_commands(self):
+        """ run_alpha_rarefaction uses the parallel scripts on a cluster
+        """
+        def record_commands(commands, status_update_callback, logger,
+                            close_logger_on_success):
+            self.commands = [cmd for group in commands for _, cmd in group]
+        params = parse_qiime_parameters(
+            ['collate_alpha:example_path example.txt'])
+        qiime_config = dict(self.qiime_config)
+
+        # in memory, with collate_alpha's parameters
+        qiime_config['parallel_executor'] = 'multiprocessing'
+        run_alpha_rarefaction(self.test_data['biom'][0],
+                              self.test_data['map'][0], self.test_out,
+                              record_commands, params, qiime_config,
+                              parallel=True, max_rare_depth=18,
+                              suppress_md5=True,
+                              status_update_callback=no_status_updates)
+        self.assertTrue(self.commands[0].startswith(
+            'compute_alpha_rarefaction.py'))
+        self.assertTrue('--example_path example.txt' in self.commands[0])
+        self.assertTrue(' -O ' in self.commands[0])
+
+        # with the cluster_jobs parallel_executor
+        qiime_config['parallel_executor'] = 'cluster_jobs'
+        run_alpha_rarefaction(self.test_data['biom'][0],
+                              self.test_data['map'][0], self.test_out,
+                              record_commands, params, qiime_config,
+                              parallel=True, max_rare_depth=18,
+                              suppress_md5=True,
+                              status_update_callback=no_status_updates,
+                              retain_intermediate_files=False)
+        self.assertTrue(self.commands[0].startswith(
+            'parallel_multiple_rarefactions.py'))
+        self.assertTrue(self.commands[1].startswith(
+            'parallel_alpha_diversity.py'))
+        self.assertTrue(self.commands[2].startswith('collate_alpha.py'))
+        self.assertTrue('--example_path example.txt' in self.commands[2])
+        self.assertTrue(self.commands[3].startswith('rm -r'))
+
     def test_run_jackknifed_beta_diversity(self):
         """ run_jackknifed_beta_diversity generates expected results """
 